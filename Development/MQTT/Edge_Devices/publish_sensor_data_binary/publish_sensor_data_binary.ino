@@ -0,0 +1,329 @@
+#include <dht.h>
+#include <ArduinoJson.h>
+
+// Publishes the same sensor data as publish_sensor_data, but switches to
+// binary framing if the smart agent asks for it during the handshake (see
+// Smart_Agents/piduino/binary_framing.py). Each frame is
+//   COBS(payload + CRC16) + 0x00
+// where the payload is
+//   [message type][topic id][value type][value, little-endian]
+// and the topic id is the index of the topic in the table that we send back
+// with the handshake.
+
+dht DHT;
+#define DHT11_PIN 5
+
+// Message types
+#define MSG_READING 0x01
+#define MSG_COMMAND 0x02
+// Value types
+#define TYPE_INT16 0x01
+#define TYPE_INT32 0x02
+#define TYPE_FLOAT32 0x03
+#define TYPE_BOOL 0x04
+#define TYPE_STRING 0x05
+
+// The handshake is always at this baud rate. We agree to switch to anything up
+// to MAX_BAUD.
+const long HANDSHAKE_BAUD = 9600;
+const long MAX_BAUD = 115200;
+bool binary_mode = false;
+
+// Define the pins used for inputs and outputs
+bool dht_present = true;
+const int n_digital_inputs = 1;
+const int n_analog_inputs = 1;
+const int n_digital_outputs = 1;
+int digital_inputs [n_digital_inputs] = {7};
+int analog_inputs [n_analog_inputs] = {A0};
+int digital_outputs [n_digital_outputs] = {13};
+
+// The topic table. A topic's id is its index here, so inputs come first, then
+// the DHT readings, then outputs.
+// Note: don't use A5, since we are using this pin to set the random seed
+const int n_topics = 5;
+const char* topics [n_topics] = {"Movement", "LDR", "Temperature", "Humidity", "LED"};
+const byte TOPIC_DIGITAL_INPUTS = 0;
+const byte TOPIC_ANALOG_INPUTS = 1;
+const byte TOPIC_TEMPERATURE = 2;
+const byte TOPIC_HUMIDITY = 3;
+const byte TOPIC_DIGITAL_OUTPUTS = 4;
+
+// Incoming data. In JSON mode this is a message in progress, in binary mode a
+// frame in progress.
+String data = "";
+byte frame [64];
+int frame_length = 0;
+
+long previous_time = 0;
+long interval = 5000;
+
+long device_id;
+
+uint16_t crc16(const byte* buffer, int length) {
+  // CRC-16/CCITT-FALSE
+  uint16_t crc = 0xFFFF;
+  for (int i=0; i<length; i++) {
+    crc ^= (uint16_t)buffer[i] << 8;
+    for (int bit=0; bit<8; bit++) {
+      if (crc & 0x8000) {
+        crc = (crc << 1) ^ 0x1021;
+      }
+      else {
+        crc = crc << 1;
+      }
+    }
+  }
+  return crc;
+}
+
+int cobs_encode(const byte* input, int length, byte* output) {
+  int read_index = 0;
+  int write_index = 1;
+  int code_index = 0;
+  byte code = 1;
+  while (read_index < length) {
+    if (input[read_index] == 0) {
+      output[code_index] = code;
+      code = 1;
+      code_index = write_index++;
+      read_index++;
+    }
+    else {
+      output[write_index++] = input[read_index++];
+      code++;
+      if (code == 0xFF) {
+        output[code_index] = code;
+        code = 1;
+        code_index = write_index++;
+      }
+    }
+  }
+  output[code_index] = code;
+  return write_index;
+}
+
+int cobs_decode(const byte* input, int length, byte* output) {
+  // Returns the decoded length, or -1 if the input is not valid COBS
+  int read_index = 0;
+  int write_index = 0;
+  while (read_index < length) {
+    byte code = input[read_index++];
+    if (code == 0 || read_index + code - 1 > length) {
+      return -1;
+    }
+    for (int i=1; i<code; i++) {
+      output[write_index++] = input[read_index++];
+    }
+    if (code < 0xFF && read_index < length) {
+      output[write_index++] = 0;
+    }
+  }
+  return write_index;
+}
+
+void send_frame(byte* payload, int length) {
+  // payload must have room for the two CRC bytes
+  uint16_t crc = crc16(payload, length);
+  payload[length++] = crc >> 8;
+  payload[length++] = crc & 0xFF;
+  byte encoded [24];
+  int encoded_length = cobs_encode(payload, length, encoded);
+  Serial.write(encoded, encoded_length);
+  Serial.write((byte)0);
+}
+
+void send_int(byte topic_id, int value) {
+  byte payload [7] = {MSG_READING, topic_id, TYPE_INT16, (byte)(value & 0xFF), (byte)((value >> 8) & 0xFF)};
+  send_frame(payload, 5);
+}
+
+void send_float(byte topic_id, float value) {
+  // Floats on the AVR are IEEE 754 single precision and little-endian
+  byte payload [9] = {MSG_READING, topic_id, TYPE_FLOAT32};
+  memcpy(payload + 3, &value, 4);
+  send_frame(payload, 7);
+}
+
+void handle_command(byte topic_id, byte value_type, const byte* value, int length) {
+  // Check whether the command is for one of our digital outputs
+  for (int i=0; i<n_digital_outputs; i++) {
+    if (topic_id == TOPIC_DIGITAL_OUTPUTS + i) {
+      if (value_type == TYPE_STRING && length == 1) {
+        // Outputs are relayed from MQTT as strings
+        digitalWrite(digital_outputs[i], value[0] == '1' ? HIGH : LOW);
+      }
+      else if ((value_type == TYPE_INT16 || value_type == TYPE_BOOL) && length >= 1) {
+        digitalWrite(digital_outputs[i], value[0] ? HIGH : LOW);
+      }
+    }
+  }
+}
+
+void receive_binary() {
+  while (Serial.available()) {
+    byte inbyte = Serial.read();
+    if (inbyte != 0) {
+      if (frame_length < (int)sizeof(frame)) {
+        frame[frame_length] = inbyte;
+      }
+      frame_length++;
+      continue;
+    }
+    // The end of a frame. Drop it if it overflowed or is damaged.
+    byte decoded [64];
+    int length = -1;
+    if (frame_length <= (int)sizeof(frame)) {
+      length = cobs_decode(frame, frame_length, decoded);
+    }
+    frame_length = 0;
+    if (length < 5) {
+      continue;
+    }
+    uint16_t crc = ((uint16_t)decoded[length - 2] << 8) | decoded[length - 1];
+    if (crc16(decoded, length - 2) != crc) {
+      continue;
+    }
+    if (decoded[0] == MSG_COMMAND) {
+      handle_command(decoded[1], decoded[2], decoded + 3, length - 5);
+    }
+  }
+}
+
+void receive_json() {
+  // Set the json buffer
+  StaticJsonBuffer<500> jsonBuffer;
+
+  while (Serial.available()) {
+    data = data + char(Serial.read());
+  }
+  if (data.length() == 0) {
+    return;
+  }
+  JsonObject& incoming_message = jsonBuffer.parseObject(data);
+  if (!incoming_message.success()) {
+    // Wait for the rest of the message
+    return;
+  }
+  data = "";
+  if (incoming_message["topic"] == "handshake") {
+    // Send back a handshake, and if the agent asked for binary framing, agree
+    // to it along with our topic table
+    JsonObject& outgoing_message = jsonBuffer.createObject();
+    outgoing_message["topic"] = "handshake";
+    outgoing_message["payload"] = device_id;
+    long baud = HANDSHAKE_BAUD;
+    if (incoming_message["binary"] == 1) {
+      baud = incoming_message["baud"];
+      if (baud <= 0 || baud > MAX_BAUD) {
+        baud = MAX_BAUD;
+      }
+      outgoing_message["binary"] = 1;
+      outgoing_message["baud"] = baud;
+      JsonArray& topic_table = outgoing_message.createNestedArray("topics");
+      for (int i=0; i<n_topics; i++) {
+        topic_table.add(topics[i]);
+      }
+    }
+    outgoing_message.printTo(Serial);
+    if (incoming_message["binary"] == 1) {
+      // Make sure the response has gone at the old baud rate before switching.
+      // We stay in binary mode until reset, which happens whenever the smart
+      // agent opens the serial port.
+      Serial.flush();
+      Serial.begin(baud);
+      binary_mode = true;
+      frame_length = 0;
+    }
+  }
+  // Check whether the message is an instruction for one of our digital outputs
+  for (int i=0; i<n_digital_outputs; i++) {
+    if (incoming_message["topic"] == topics[TOPIC_DIGITAL_OUTPUTS + i]) {
+      if (incoming_message["payload"] == "1") {
+        digitalWrite(digital_outputs[i], HIGH);
+      }
+      else if (incoming_message["payload"] == "0") {
+        digitalWrite(digital_outputs[i], LOW);
+      }
+    }
+  }
+}
+
+void send_json_int(const char* topic, int value) {
+  StaticJsonBuffer<100> jsonBuffer;
+  JsonObject& outgoing_message = jsonBuffer.createObject();
+  outgoing_message["topic"] = topic;
+  outgoing_message["payload"] = value;
+  outgoing_message.printTo(Serial);
+}
+
+void send_json_float(const char* topic, float value) {
+  StaticJsonBuffer<100> jsonBuffer;
+  JsonObject& outgoing_message = jsonBuffer.createObject();
+  outgoing_message["topic"] = topic;
+  outgoing_message["payload"] = value;
+  outgoing_message.printTo(Serial);
+}
+
+void publish(byte topic_id, int value) {
+  if (binary_mode) {
+    send_int(topic_id, value);
+  }
+  else {
+    send_json_int(topics[topic_id], value);
+  }
+}
+
+void publish_float(byte topic_id, float value) {
+  if (binary_mode) {
+    send_float(topic_id, value);
+  }
+  else {
+    send_json_float(topics[topic_id], value);
+  }
+}
+
+void setup() {
+  Serial.begin(HANDSHAKE_BAUD);
+
+  for (int i=0; i<n_digital_inputs; i++) {
+    pinMode(digital_inputs[i], INPUT);
+  }
+  for (int i=0; i<n_digital_outputs; i++) {
+    pinMode(digital_outputs[i], OUTPUT);
+  }
+
+  // Create a random seed by reading on the analogue pin
+  randomSeed(analogRead(A5));
+  // Set a random four digit device id (in the future this will be better.
+  device_id = random(1000,10000);
+}
+
+void loop() {
+  if (binary_mode) {
+    receive_binary();
+  }
+  else {
+    receive_json();
+  }
+
+  // Check if we are ready to send new data
+  unsigned long current_time = millis();
+  if (current_time - previous_time > interval) {
+    previous_time = current_time;
+
+    for (int i=0; i<n_digital_inputs; i++) {
+      publish(TOPIC_DIGITAL_INPUTS + i, digitalRead(digital_inputs[i]));
+    }
+    for (int i=0; i<n_analog_inputs; i++) {
+      publish(TOPIC_ANALOG_INPUTS + i, analogRead(analog_inputs[i]));
+    }
+    if (dht_present) {
+      DHT.read11(DHT11_PIN);
+      publish_float(TOPIC_TEMPERATURE, DHT.temperature);
+      publish_float(TOPIC_HUMIDITY, DHT.humidity);
+    }
+  }
+  // Wait a little while.
+  delay(10);
+}
@@ -0,0 +1,95 @@
+'''
+Compares the size and decoding speed of sensor samples stored as CSV text
+(as data_collection and testing_analogue_read write them), as raw columns
+(columnar_store.py) and compressed with sample_codec.
+
+The datasets are testing_analogue_read's output.csv (10 bit ADC readings,
+repeated to the requested number of samples) and synthetic streams like
+those data_collection records.
+
+Decoding speed is in millions of samples per second and MB/s of decoded
+columns (16 bytes a sample). CSV is parsed line by line as fft.py does, and
+with numpy.loadtxt.
+
+Usage:
+    python3 bench_codec.py [samples]
+'''
+import io
+import os
+import sys
+import time
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+import sample_codec
+
+OUTPUT_CSV = os.path.join(os.path.dirname(__file__), '..', '..', '..',
+                          'serial_to_computer', 'testing_analogue_read', 'output.csv')
+
+
+def datasets(count):
+    rng = np.random.RandomState(0)
+    if os.path.exists(OUTPUT_CSV):
+        recorded = np.loadtxt(OUTPUT_CSV, delimiter=',', dtype=np.int64)
+        repeats = count // len(recorded) + 1
+        micros = np.tile(recorded[:, 0], repeats)[:count]
+        yield ('output.csv ADC', np.cumsum(micros) / 1e6,
+               np.tile(recorded[:, 1], repeats)[:count].astype('<i2'), '%d')
+    # Readings every 5 s, as publish_sensor_data sends them
+    seconds = 1500000000.0 + np.arange(count) * 5
+    yield ('LDR every 5 s', seconds,
+           np.clip(500 + np.cumsum(rng.randint(-3, 4, count)), 0, 1023).astype('<i2'), '%d')
+    yield ('Temperature', seconds,
+           np.round(20 + np.cumsum(rng.normal(0, 0.05, count)), 1), '%.1f')
+    yield ('Noisy floats', seconds, rng.normal(size=count), '%.17g')
+
+
+def csv_text(times, values, value_format):
+    buffer = io.StringIO()
+    np.savetxt(buffer, np.column_stack((times, values)), fmt=['%.6f', value_format], delimiter=',')
+    return buffer.getvalue()
+
+
+def parse_lines(text):
+    rows = [tuple(float(v) for v in line.split(',')) for line in text.splitlines()]
+    return np.array([t for t, v in rows]), np.array([v for t, v in rows])
+
+
+def parse_loadtxt(text):
+    table = np.loadtxt(io.StringIO(text), delimiter=',')
+    return table[:, 0], table[:, 1]
+
+
+def best_time(function, *args):
+    best = float('inf')
+    for repeat in range(3):
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    print('%d samples per dataset\n' % count)
+    print('%-16s %12s %12s %12s %10s' % ('', 'CSV B/sample', 'raw', 'codec', 'ratio'))
+    results = []
+    for name, times, values, value_format in datasets(count):
+        text = csv_text(times, values, value_format)
+        encoded = sample_codec.encode(times, values)
+        decoded_times, decoded_values = sample_codec.decode(encoded, values.dtype)
+        assert decoded_times.tobytes() == times.tobytes()
+        assert decoded_values.tobytes() == values.tobytes()
+        print('%-16s %12.2f %12.2f %12.2f %9.1fx' % (
+            name, len(text) / count, 8 + values.dtype.itemsize,
+            len(encoded) / count, len(text) / len(encoded)))
+        results.append((name, [
+            ('CSV lines', best_time(parse_lines, text)),
+            ('CSV loadtxt', best_time(parse_loadtxt, text)),
+            ('codec', best_time(sample_codec.decode, encoded, values.dtype)),
+        ]))
+
+    print('\n%-16s %-12s %14s %10s' % ('', 'decoder', 'Msamples/s', 'MB/s'))
+    for name, timings in results:
+        for decoder, seconds in timings:
+            print('%-16s %-12s %14.2f %10.1f' % (
+                name, decoder, count / seconds / 1e6, 16 * count / seconds / 1e6))
@@ -0,0 +1,83 @@
+'''
+Compares the incremental JSON frame decoder used by SerialDevice.receive_json
+with the previous approach (one byte per read, re-running a regex over the
+whole buffer after every byte). The stream is read from a file with one
+read() call per chunk, so the cost of a system call per read is included.
+
+Usage:
+    python3 bench_framing.py [number of frames]
+'''
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+from framing import JsonFrameDecoder
+
+
+def regex_decoder(fd):
+    '''
+    The receive_json loop before the incremental decoder: one byte per read,
+    rescanning the buffer after every byte
+    '''
+    frames = []
+    data = ''
+    while True:
+        byte = os.read(fd, 1)
+        if not byte:
+            return frames
+        data += byte.decode(errors='ignore')
+        for potential_message in re.findall('\{[^\{\}]+\}', data):
+            try:
+                message = json.loads(potential_message)
+                if type(message) == dict:
+                    frames.append(message)
+                    data = ''
+                    break
+            except Exception:
+                pass
+
+
+def incremental_decoder(fd, chunk=64):
+    '''
+    Feeds the stream in chunks, as bulk reads of in_waiting would
+    '''
+    decoder = JsonFrameDecoder()
+    frames = []
+    while True:
+        data = os.read(fd, chunk)
+        if not data:
+            return frames
+        frames += decoder.feed(data)
+
+
+def bench(function, path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        t0 = time.perf_counter()
+        frames = function(fd)
+        elapsed = time.perf_counter() - t0
+    finally:
+        os.close(fd)
+    return len(frames), elapsed
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    stream = b''.join(json.dumps({'topic': 'LDR', 'payload': 400 + i % 100}).encode()
+                      for i in range(count))
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        f.write(stream)
+    results = []
+    for name, function in [('regex, byte at a time', regex_decoder),
+                           ('incremental, 1 byte chunks', lambda s: incremental_decoder(s, 1)),
+                           ('incremental, 64 byte chunks', incremental_decoder),
+                           ('incremental, 4096 byte chunks', lambda s: incremental_decoder(s, 4096))]:
+        frames, elapsed = bench(function, f.name)
+        results.append(elapsed)
+        print('%-32s %6d frames %8.3f s %10.0f frames/s %8.2f MB/s x%.1f' % (
+            name, frames, elapsed, frames / elapsed, len(stream) / elapsed / 1e6,
+            results[0] / elapsed))
+    os.remove(f.name)
@@ -0,0 +1,141 @@
+'''
+Measures how many messages per second the smart agent can take in from many
+edge devices, and the CPU it uses doing so, with virtual Arduinos (see
+virtual_arduino.py) standing in for real boards. The boards run in a separate
+process, so only the reading side's CPU time is counted.
+
+Devices are read either with a thread per SerialDevice, as serial_relay does,
+or with AsyncSerialDevice on a single event loop.
+
+Usage:
+    python3 bench_serial_devices.py [boards] [interval] [seconds] [--binary] [--line-rate]
+
+interval is the time between each board's batches of four readings. With
+--line-rate, boards are limited to what their baud rate allows (9600 baud,
+or 115200 after agreeing to binary framing).
+'''
+import asyncio
+import multiprocessing
+import os
+import sys
+import threading
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+import piduino
+from async_serial import AsyncSerialDevice
+from virtual_arduino import VirtualBoards, VirtualArduino
+
+BINARY_BAUD = 115200
+
+
+def run_boards(count, interval, line_rate, ports, stop):
+    with VirtualBoards() as boards:
+        for i in range(count):
+            board = boards.add(VirtualArduino(interval=interval, boot_delay=0.1,
+                                              emulate_baud=line_rate, seed=i))
+            ports.put(board.port)
+        stop.wait()
+
+
+def handshake(device, binary):
+    device.flush()
+    device.handshake_request(binary_baud=BINARY_BAUD if binary else None)
+    deadline = piduino.Deadline(5)
+    while not deadline.expired():
+        flag, message = device.receive_json(timeout=deadline.remaining())
+        if flag:
+            break
+        if message['topic'] == 'handshake':
+            device.accept_handshake(message)
+            return True
+    raise IOError('No handshake from ' + device.comport)
+
+
+def bench_threads(ports, binary, seconds):
+    devices = []
+    for port in ports:
+        device = piduino.SerialDevice(port)
+        device.connect(timeout=0)
+        devices.append(device)
+    time.sleep(0.3)
+    for device in devices:
+        handshake(device, binary)
+
+    counts = [0] * len(devices)
+    running = [True]
+
+    def read(i, device):
+        while running[0]:
+            flag, message = device.receive_json(timeout=0.5)
+            if not flag:
+                counts[i] += 1
+
+    threads = [threading.Thread(target=read, args=(i, d)) for i, d in enumerate(devices)]
+    cpu, wall = time.process_time(), time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    running[0] = False
+    for thread in threads:
+        thread.join()
+    cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+    for device in devices:
+        device.shutdown()
+    return sum(counts), cpu, wall
+
+
+def bench_asyncio(ports, binary, seconds):
+    async def main():
+        devices = [AsyncSerialDevice(port) for port in ports]
+        for device in devices:
+            await device.connect(boot_delay=0)
+        await asyncio.sleep(0.3)
+        for device in devices:
+            flag = await device.handshake(binary_baud=BINARY_BAUD if binary else None)
+            if flag:
+                raise flag
+        counts = [0]
+
+        async def read(device):
+            async for message in device:
+                counts[0] += 1
+
+        cpu, wall = time.process_time(), time.perf_counter()
+        tasks = [asyncio.ensure_future(read(device)) for device in devices]
+        await asyncio.sleep(seconds)
+        for task in tasks:
+            task.cancel()
+        cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+        for device in devices:
+            device.shutdown()
+        return counts[0], cpu, wall
+
+    return asyncio.run(main())
+
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    count = int(args[0]) if len(args) > 0 else 20
+    interval = float(args[1]) if len(args) > 1 else 0.01
+    seconds = float(args[2]) if len(args) > 2 else 5.0
+    binary = '--binary' in sys.argv
+    line_rate = '--line-rate' in sys.argv
+
+    print('%d boards, readings every %g s, %s framing%s' %
+          (count, interval, 'binary' if binary else 'JSON',
+           ', limited to line rate' if line_rate else ''))
+    for name, function in [('threads', bench_threads), ('asyncio', bench_asyncio)]:
+        ports = multiprocessing.Queue()
+        stop = multiprocessing.Event()
+        process = multiprocessing.Process(target=run_boards,
+                                          args=(count, interval, line_rate, ports, stop))
+        process.start()
+        try:
+            board_ports = [ports.get(timeout=10) for i in range(count)]
+            messages, cpu, wall = function(board_ports, binary, seconds)
+        finally:
+            stop.set()
+            process.join()
+        print('%-8s %8.0f messages/s  %5.1f%% CPU  %6.1f us CPU per message' %
+              (name, messages / wall, 100 * cpu / wall,
+               1e6 * cpu / messages if messages else float('nan')))
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Edge-side aggregation and downsampling of sensor readings.
+
+For topics with an aggregation rule, the serial relay publishes summaries of
+the readings instead of the readings themselves:
+
+    {"t": 1500000010.0, "count": 312, "min": 401, "max": 463, "mean": 431.2, "last": 455}
+
+t is the end of the window the summary covers. Windows are time based and
+aligned to multiples of the hop:
+
+    window=10           tumbling windows, one summary every 10 s
+    window=10, hop=2    sliding windows, a summary of the last 10 s every 2 s
+
+A deadband suppresses output that has not changed by more than a threshold
+since the last output. With a window, the mean is compared; without one, the
+raw readings are compared and only changed readings are published.
+
+Rules are keyed by '<device>/<topic>' patterns as in batching.py, e.g.
+
+    {'+/LDR': {'window': 10, 'hop': 2, 'deadband': 5}}
+
+Readings that are not numbers are passed through untouched.
+
+When a device goes away or the relay stops, flush() returns what would
+otherwise be lost: a summary of each window that is still open (marked
+"partial": true, with t the end it would have had), and the latest output a
+deadband held back.
+"""
+
+from collections import deque
+from batching import topic_matches
+
+
+class WindowAggregator():
+    '''
+    Computes count, min, max, mean and last over time windows of the given
+    length, emitted every hop seconds (hop == window gives tumbling windows).
+
+    Readings must arrive in time order. min and max are kept in monotonic
+    queues, so each reading costs O(1) amortised however large the window.
+    '''
+    def __init__(self, window, hop=None):
+        if window <= 0:
+            raise ValueError('window must be positive')
+        if hop is None:
+            hop = window
+        if hop <= 0 or hop > window:
+            raise ValueError('hop must be positive and no longer than the window')
+        self.window = float(window)
+        self.hop = float(hop)
+        self.samples = deque()
+        self.minima = deque()
+        self.maxima = deque()
+        self.total = 0.0
+        self.next_emit = None
+
+    def __first_boundary_after(self, timestamp):
+        return (timestamp // self.hop + 1) * self.hop
+
+    def __evict(self, cutoff):
+        while self.samples and self.samples[0][0] < cutoff:
+            self.total -= self.samples.popleft()[1]
+        while self.minima and self.minima[0][0] < cutoff:
+            self.minima.popleft()
+        while self.maxima and self.maxima[0][0] < cutoff:
+            self.maxima.popleft()
+
+    def __emit_until(self, timestamp):
+        '''
+        Returns summaries for every window that ends at or before timestamp
+        '''
+        summaries = []
+        while self.next_emit is not None and timestamp >= self.next_emit:
+            self.__evict(self.next_emit - self.window)
+            if not self.samples:
+                # Nothing left to summarise: wait for the next reading
+                self.next_emit = None
+                break
+            summaries.append(self.__summary())
+            self.next_emit += self.hop
+        return summaries
+
+    def __summary(self):
+        return {
+            't': self.next_emit,
+            'count': len(self.samples),
+            'min': self.minima[0][1],
+            'max': self.maxima[0][1],
+            'mean': self.total / len(self.samples),
+            'last': self.samples[-1][1]
+        }
+
+    def add(self, value, timestamp):
+        '''
+        Adds a reading and returns a (possibly empty) list of summaries for
+        the windows that closed before it
+        '''
+        summaries = self.__emit_until(timestamp)
+        if self.next_emit is None:
+            self.next_emit = self.__first_boundary_after(timestamp)
+        self.samples.append((timestamp, value))
+        self.total += value
+        while self.minima and self.minima[-1][1] >= value:
+            self.minima.pop()
+        self.minima.append((timestamp, value))
+        while self.maxima and self.maxima[-1][1] <= value:
+            self.maxima.pop()
+        self.maxima.append((timestamp, value))
+        return summaries
+
+    def poll(self, now):
+        '''
+        Returns summaries for windows that have closed without a new reading
+        '''
+        return self.__emit_until(now)
+
+    def flush(self):
+        '''
+        Returns a summary of the window that is still open, if it has any
+        readings, and starts again with no readings
+        '''
+        summaries = []
+        if self.next_emit is not None:
+            self.__evict(self.next_emit - self.window)
+            if self.samples:
+                summary = self.__summary()
+                summary['partial'] = True
+                summaries.append(summary)
+        self.samples.clear()
+        self.minima.clear()
+        self.maxima.clear()
+        self.total = 0.0
+        self.next_emit = None
+        return summaries
+
+
+class Deadband():
+    '''
+    Passes a value only if it differs from the last value passed by more than
+    the threshold
+    '''
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.last = None
+
+    def accept(self, value):
+        if self.last is not None and abs(value - self.last) <= self.threshold:
+            return False
+        self.last = value
+        return True
+
+
+class Stage():
+    '''
+    The aggregation state for a single device and topic
+    '''
+    def __init__(self, window=None, hop=None, deadband=None):
+        if window:
+            self.aggregator = WindowAggregator(window, hop)
+        else:
+            self.aggregator = None
+        if deadband is not None:
+            self.deadband = Deadband(deadband)
+        else:
+            self.deadband = None
+        # (output, timestamp) for the latest output the deadband held back,
+        # if nothing has been passed since
+        self.held = None
+
+    def __filter(self, summaries):
+        if self.deadband is None:
+            return summaries
+        passed = []
+        for summary in summaries:
+            if self.deadband.accept(summary['mean']):
+                passed.append(summary)
+                self.held = None
+            else:
+                self.held = summary, summary['t']
+        return passed
+
+    def add(self, value, timestamp):
+        '''
+        Returns a list of summaries, or with no window, a list holding the raw
+        value if it should be published
+        '''
+        if self.aggregator is None:
+            if self.deadband is None or self.deadband.accept(value):
+                self.held = None
+                return [value]
+            self.held = value, timestamp
+            return []
+        return self.__filter(self.aggregator.add(value, timestamp))
+
+    def poll(self, now):
+        if self.aggregator is None:
+            return []
+        return self.__filter(self.aggregator.poll(now))
+
+    def flush(self):
+        '''
+        Returns (output, timestamp) for the open window's summary, or if there
+        is none to pass, the latest output the deadband held back
+        '''
+        flushed = []
+        if self.aggregator is not None:
+            flushed = [(s, s['t']) for s in self.__filter(self.aggregator.flush())]
+        if not flushed and self.held is not None:
+            flushed = [self.held]
+        self.held = None
+        return flushed
+
+
+class Aggregation():
+    '''
+    Holds an aggregation Stage for every device/topic that matches a rule
+    (see module docstring)
+    '''
+    def __init__(self, rules=None):
+        self.rules = []
+        for pattern, options in (rules or {}).items():
+            window = options.get('window')
+            hop = options.get('hop')
+            deadband = options.get('deadband')
+            if not window and deadband is None:
+                raise ValueError('Aggregation rule for ' + pattern +
+                                 ' needs a window or a deadband')
+            # Check the options now rather than on the first reading
+            Stage(window, hop, deadband)
+            self.rules.append((pattern, window, hop, deadband))
+        self.stages = {}
+        self.unaggregated = set()
+
+    def __stage_for(self, device, topic):
+        key = (device, topic)
+        stage = self.stages.get(key)
+        if stage is not None or key in self.unaggregated:
+            return stage
+        for pattern, window, hop, deadband in self.rules:
+            if topic_matches(pattern, device + '/' + topic):
+                stage = Stage(window, hop, deadband)
+                self.stages[key] = stage
+                return stage
+        self.unaggregated.add(key)
+        return None
+
+    def add(self, device, topic, payload, timestamp):
+        '''
+        Passes a reading through the stage for its device and topic.
+
+        Returns None if the reading should be published unchanged (no rule
+        matches, or it is not a number). Otherwise returns the list of
+        outputs to publish in its place, which is often empty: summary dicts
+        for windowed rules, raw values for deadband-only rules.
+        '''
+        stage = self.__stage_for(str(device), topic)
+        if stage is None:
+            return None
+        if isinstance(payload, bool) or not isinstance(payload, (int, float)):
+            return None
+        return stage.add(payload, timestamp)
+
+    def poll(self, now):
+        '''
+        Returns a list of (device, topic, summary) for windows that have
+        closed without new readings
+        '''
+        closed = []
+        for (device, topic), stage in self.stages.items():
+            for summary in stage.poll(now):
+                closed.append((device, topic, summary))
+        return closed
+
+    def flush(self, name=None):
+        '''
+        Returns a list of (device, topic, output, timestamp) for what is still
+        waiting to be published for a device (or every device if name is
+        None): partial window summaries and readings held back by a deadband.
+        Outputs are as returned by add, and timestamp is the time of a held
+        reading or the t of a summary.
+        '''
+        flushed = []
+        for (device, topic), stage in self.stages.items():
+            if name is None or device == str(name):
+                for output, timestamp in stage.flush():
+                    flushed.append((device, topic, output, timestamp))
+        return flushed
+
+    def forget(self, device):
+        device = str(device)
+        for key in [k for k in self.stages if k[0] == device]:
+            del self.stages[key]
+        self.unaggregated = set(k for k in self.unaggregated if k[0] != device)
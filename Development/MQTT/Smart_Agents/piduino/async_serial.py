@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio transport for edge devices.
+
+AsyncSerialDevice is a SerialDevice whose I/O runs on an asyncio event loop
+rather than in a thread of its own. The event loop watches the serial port's
+file descriptor (loop.add_reader), so incoming bytes are fed to the same
+incremental frame decoders as the threaded SerialDevice as soon as they
+arrive, and a device with nothing to say costs nothing. One process can serve
+many boards and an MQTT client from a single loop:
+
+    async def relay(comport):
+        device = AsyncSerialDevice(comport)
+        flag = await device.connect()
+        if not flag:
+            flag = await device.handshake(binary_baud=115200)
+        if flag:
+            return
+        async for message in device:
+            print(device.name, message['topic'], message['payload'])
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.gather(*[relay(port) for port in
+                                             piduino.comport_scan('Arduino')]))
+
+Like the rest of piduino, methods return their errors rather than raising
+them. add_reader needs a real file descriptor, so this works on Linux (e.g.
+the Raspberry Pi) and macOS, but not with serial ports on Windows.
+"""
+
+import asyncio
+import os
+import time
+from serial import SerialException
+from piduino import (SerialDevice, NotConnectedError, ReadTimeoutError,
+                     handshake_message)
+from deadline import Deadline
+
+
+def running_loop():
+    '''
+    Returns the event loop running the calling coroutine
+    '''
+    try:
+        return asyncio.get_running_loop()
+    except AttributeError:
+        # Before Python 3.7, get_event_loop returns the running loop
+        return asyncio.get_event_loop()
+
+
+class AsyncSerialDevice(SerialDevice):
+    '''
+    A SerialDevice with coroutine connect, handshake and send methods. Iterate
+    over it with 'async for' to receive messages until it disconnects.
+    '''
+    def __init__(self, comport, baudrate=9600):
+        SerialDevice.__init__(self, comport, baudrate)
+        self.loop = None
+        self.fd = None
+        self.__arrived = None
+        self.__write_lock = None
+
+    async def connect(self, boot_delay=4):
+        '''
+        Opens the serial port, then waits boot_delay seconds for the Arduino,
+        which resets whenever the port is opened
+        '''
+        self.loop = running_loop()
+        flag = SerialDevice.connect(self, timeout=0)
+        if flag:
+            return flag
+        self.fd = self.ser.fileno()
+        self.__arrived = asyncio.Event()
+        self.__write_lock = asyncio.Lock()
+        self.loop.add_reader(self.fd, self.__on_readable)
+        await asyncio.sleep(boot_delay)
+        return None
+
+    def __on_readable(self):
+        '''
+        Called by the event loop whenever there is data to read
+        '''
+        try:
+            data = self.ser.read(max(self.ser.in_waiting, 1))
+        except (SerialException, OSError) as e:
+            self.stats.disconnects += 1
+            self.__lost()
+            return
+        if not data:
+            return
+        self.stats.bytes_read += len(data)
+        received = time.time()
+        malformed = self.decoder.malformed
+        self.frames.extend((received, message) for message in self.decoder.feed(data))
+        self.stats.malformed_frames += self.decoder.malformed - malformed
+        if self.frames:
+            self.__arrived.set()
+
+    def __lost(self):
+        '''
+        Stops watching the port and wakes anyone waiting for a message
+        '''
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            self.fd = None
+        self.connected = False
+        if self.__arrived is not None:
+            self.__arrived.set()
+
+    async def receive_json(self, timeout=10):
+        '''
+        Receives a single message from a device, unless timeout is reached
+        first. A timeout of None waits for as long as it takes.
+        '''
+        if self.ser is None:
+            # Not connected yet, so there is no reader state either
+            return NotConnectedError("The device is not connected"), ''
+        deadline = Deadline(timeout)
+        while not self.frames:
+            if not self.connected:
+                return NotConnectedError("The device is not connected"), ''
+            self.__arrived.clear()
+            try:
+                await asyncio.wait_for(self.__arrived.wait(), deadline.remaining())
+            except asyncio.TimeoutError:
+                self.stats.timeouts += 1
+                return ReadTimeoutError("The timeout was reached before a valid message was read"), ''
+        received, message = self.frames.popleft()
+        self.stats.frames_received += 1
+        self.stats.last_frame_time = received
+        return None, message
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        flag, message = await self.receive_json(timeout=None)
+        if flag:
+            raise StopAsyncIteration
+        return message
+
+    async def __writable(self):
+        writable = self.loop.create_future()
+
+        def wake():
+            if not writable.done():
+                writable.set_result(None)
+
+        self.loop.add_writer(self.fd, wake)
+        try:
+            await writable
+        finally:
+            self.loop.remove_writer(self.fd)
+
+    async def send(self, message):
+        '''
+        Writes a message, waiting for room in the port's output buffer rather
+        than blocking the loop
+        '''
+        flag, packet = self.encode(message)
+        if flag:
+            return flag
+        if not self.connected or self.fd is None:
+            return NotConnectedError("The device is not connected")
+        # Stop concurrent senders from interleaving their frames
+        async with self.__write_lock:
+            pending = memoryview(packet)
+            while pending:
+                try:
+                    written = os.write(self.fd, pending)
+                    pending = pending[written:]
+                except BlockingIOError:
+                    await self.__writable()
+                except OSError as e:
+                    return e
+        self.stats.bytes_written += len(packet)
+        self.stats.frames_sent += 1
+        return None
+
+    async def handshake_request(self, binary_baud=None):
+        return await self.send(handshake_message(binary_baud))
+
+    async def handshake(self, timeout=5, binary_baud=None):
+        '''
+        Requests a handshake and waits for the response, switching to binary
+        framing if the device agrees to it (see SerialDevice.handshake_request).
+        On success the device's name is set and it is marked as verified.
+        '''
+        flag = self.flush()
+        if flag:
+            return flag
+        flag = await self.handshake_request(binary_baud)
+        if flag:
+            return flag
+        deadline = Deadline(timeout)
+        while True:
+            # The device may still be sending readings from before the
+            # handshake, so keep reading until the deadline
+            flag, message = await self.receive_json(timeout=deadline.remaining())
+            if flag:
+                return flag
+            if message.get('topic') == 'handshake':
+                flag = self.accept_handshake(message)
+                if flag:
+                    return flag
+                self.name = message['payload']
+                self.verified = True
+                return None
+
+    def shutdown(self):
+        self.__lost()
+        return SerialDevice.shutdown(self)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Batched uplink publishing of sensor readings.
+
+By default the serial relay publishes one MQTT message per reading. When
+batching is enabled for a device/topic, readings are collected into a batch
+and published as a single compact JSON object:
+
+    {"t0": 1500000000.123, "dt": [0, 12, 25], "v": [455, 443, 427]}
+
+t0 is the UNIX time (seconds, millisecond resolution) of the first reading in
+the batch, dt holds the offset of each reading from t0 in milliseconds and v
+holds the payloads. A batch is published once it holds max_count readings or
+once its oldest reading is max_delay seconds old, whichever comes first, so
+the extra latency added by batching is bounded by max_delay.
+
+Rules are keyed by '<device>/<topic>' and may use the MQTT wildcards '+'
+(exactly one level) and '#' (any number of trailing levels), e.g.
+
+    {'+/LDR': {'max_count': 50, 'max_delay': 1.0}}
+"""
+
+import json
+import time
+
+DEFAULT_MAX_COUNT = 50
+DEFAULT_MAX_DELAY = 1.0
+
+
+def topic_matches(pattern, topic):
+    '''
+    Returns True if the topic matches an MQTT style subscription pattern
+    '''
+    pattern_levels = pattern.split('/')
+    topic_levels = topic.split('/')
+    for i, level in enumerate(pattern_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != '+' and level != topic_levels[i]:
+            return False
+    return len(pattern_levels) == len(topic_levels)
+
+
+class Batch():
+    '''
+    The readings collected so far for a single device and topic
+    '''
+    def __init__(self, device, topic, max_count, max_delay):
+        self.device = device
+        self.topic = topic
+        self.max_count = max_count
+        self.max_delay = max_delay
+        self.t0 = None
+        self.offsets = []
+        self.values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, payload, timestamp):
+        if self.t0 is None:
+            # Round to the millisecond so that the offsets are exact
+            self.t0 = round(timestamp, 3)
+        self.offsets.append(int(round((timestamp - self.t0) * 1000)))
+        self.values.append(payload)
+
+    def is_due(self, now):
+        if len(self.values) == 0:
+            return False
+        return (len(self.values) >= self.max_count or
+                now - self.t0 >= self.max_delay)
+
+    def encode(self):
+        '''
+        Returns (device, topic, payload, t0) where payload is the batch as a
+        compact JSON string, and empties the batch
+        '''
+        t0 = self.t0
+        packet = json.dumps({'t0': self.t0, 'dt': self.offsets, 'v': self.values},
+                            separators=(',', ':'))
+        self.t0 = None
+        self.offsets = []
+        self.values = []
+        return self.device, self.topic, packet, t0
+
+
+class Batcher():
+    '''
+    Collects readings into per device/topic batches according to a set of
+    rules (see module docstring). Readings that match no rule are not batched.
+    '''
+    def __init__(self, rules=None):
+        self.rules = []
+        for pattern, options in (rules or {}).items():
+            max_count = int(options.get('max_count', DEFAULT_MAX_COUNT))
+            max_delay = float(options.get('max_delay', DEFAULT_MAX_DELAY))
+            if max_count < 1 or max_delay < 0:
+                raise ValueError('Invalid batching rule for ' + pattern)
+            self.rules.append((pattern, max_count, max_delay))
+        self.batches = {}
+        # Readings waiting in batches, kept up to date as they are added and
+        # published so that pending() can be called from another thread
+        # (e.g. a metrics server) without walking self.batches
+        self.waiting = 0
+        # Remember which keys do not match any rule, so that unbatched
+        # readings do not have to check the rules every time
+        self.unbatched = set()
+
+    def __batch_for(self, device, topic):
+        key = (device, topic)
+        batch = self.batches.get(key)
+        if batch is not None or key in self.unbatched:
+            return batch
+        for pattern, max_count, max_delay in self.rules:
+            if topic_matches(pattern, device + '/' + topic):
+                batch = Batch(device, topic, max_count, max_delay)
+                self.batches[key] = batch
+                return batch
+        self.unbatched.add(key)
+        return None
+
+    def add(self, device, topic, payload, timestamp=None):
+        '''
+        Adds a reading to its batch. Returns False if batching is not
+        enabled for this device and topic, in which case the caller should
+        publish the reading itself.
+        '''
+        batch = self.__batch_for(str(device), topic)
+        if batch is None:
+            return False
+        if timestamp is None:
+            timestamp = time.time()
+        batch.add(payload, timestamp)
+        self.waiting += 1
+        return True
+
+    def __encode(self, batches):
+        self.waiting -= sum(len(batch) for batch in batches)
+        return [batch.encode() for batch in batches]
+
+    def ready(self, now=None):
+        '''
+        Returns a list of (device, topic, payload, t0) for every batch that is
+        full or has reached its maximum delay
+        '''
+        if now is None:
+            now = time.time()
+        return self.__encode([batch for batch in self.batches.values() if batch.is_due(now)])
+
+    def flush(self):
+        '''
+        Returns a list of (device, topic, payload, t0) for every non-empty batch,
+        regardless of whether it is due
+        '''
+        return self.__encode([batch for batch in self.batches.values() if len(batch) > 0])
+
+    def pending(self):
+        '''
+        Returns the number of readings waiting in batches
+        '''
+        return self.waiting
+
+    def forget(self, device):
+        '''
+        Drops the state kept for a device (e.g. after it disconnects). Any
+        readings still waiting in its batches are returned as with flush.
+        '''
+        device = str(device)
+        flushed = []
+        for key in [k for k in self.batches if k[0] == device]:
+            batch = self.batches.pop(key)
+            if len(batch) > 0:
+                flushed.append(batch)
+        self.unbatched = set(k for k in self.unbatched if k[0] != device)
+        return self.__encode(flushed)
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Binary framing for serial links to edge devices.
+
+JSON text at 9600 baud spends most of the link on braces, quotes and key
+names. Devices that support it can switch to binary frames during the
+handshake (see SerialDevice.handshake_request): the smart agent asks for
+binary mode and a baud rate, and the device replies with the topics it
+publishes and subscribes to. From then on a topic is sent as its index in that
+table.
+
+A frame on the wire is
+
+    COBS(payload + CRC16) + 0x00
+
+COBS (Consistent Overhead Byte Stuffing) removes every zero byte from the
+frame at a cost of one byte per 254, so 0x00 unambiguously ends a frame and a
+receiver can resynchronise after any corruption. The CRC is CRC-16/CCITT-FALSE
+(polynomial 0x1021, initial value 0xFFFF), sent big-endian.
+
+The payload of a frame is
+
+    [message type][topic id][value type][value]
+
+with the value little-endian, as on the AVR:
+
+    value type  0x01 int16, 0x02 int32, 0x03 float32, 0x04 bool (1 byte),
+                0x05 UTF-8 string (rest of the payload)
+
+A temperature reading is therefore 10 bytes on the wire, against about 40 as
+JSON. The reference sketch is
+Edge_Devices/publish_sensor_data_binary/publish_sensor_data_binary.ino.
+"""
+
+import struct
+
+MSG_READING = 0x01
+MSG_COMMAND = 0x02
+
+TYPE_INT16 = 0x01
+TYPE_INT32 = 0x02
+TYPE_FLOAT32 = 0x03
+TYPE_BOOL = 0x04
+TYPE_STRING = 0x05
+
+HEADER = struct.Struct('<BBB')
+VALUE_FORMATS = {
+    TYPE_INT16: struct.Struct('<h'),
+    TYPE_INT32: struct.Struct('<i'),
+    TYPE_FLOAT32: struct.Struct('<f'),
+    TYPE_BOOL: struct.Struct('<?'),
+}
+
+
+def __crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for bit in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xffff
+            else:
+                crc = (crc << 1) & 0xffff
+        table.append(crc)
+    return table
+
+CRC16_TABLE = __crc16_table()
+
+# RPI_to_Arduino/piduino/utils.py has its own copies of crc16, cobs_encode and
+# cobs_decode for the same framing on bluetooth links (the two packages are
+# installed separately). A fix to one copy must be made to the other.
+
+
+def crc16(data, crc=0xffff):
+    '''
+    CRC-16/CCITT-FALSE of a bytes-like object
+    '''
+    table = CRC16_TABLE
+    for byte in bytearray(data):
+        crc = ((crc << 8) & 0xffff) ^ table[(crc >> 8) ^ byte]
+    return crc
+
+
+def cobs_encode(data):
+    '''
+    Encodes bytes so that they contain no zero bytes
+    '''
+    out = bytearray()
+    for block in bytes(data).split(b'\x00'):
+        # Each block is followed by an (implied) zero, apart from the last
+        while len(block) >= 254:
+            out.append(0xff)
+            out += block[:254]
+            block = block[254:]
+        out.append(len(block) + 1)
+        out += block
+    return bytes(out)
+
+
+def cobs_decode(data):
+    '''
+    Reverses cobs_encode. Raises ValueError if the data is not valid COBS.
+    '''
+    data = bytes(data)
+    out = bytearray()
+    i = 0
+    n = len(data)
+    while i < n:
+        code = bytearray(data[i:i + 1])[0]
+        end = i + code
+        if code == 0 or end > n:
+            raise ValueError('Invalid COBS data')
+        block = data[i + 1:end]
+        if b'\x00' in block:
+            raise ValueError('Invalid COBS data')
+        out += block
+        i = end
+        if code < 0xff and i < n:
+            out.append(0)
+    return bytes(out)
+
+
+def encode_frame(payload):
+    '''
+    Adds the CRC and COBS encoding to a payload, ready to be written
+    '''
+    return cobs_encode(payload + struct.pack('>H', crc16(payload))) + b'\x00'
+
+
+def encode_value(value):
+    '''
+    Returns (value type, packed value) for the smallest type that holds value.
+    Raises ValueError for an int that does not fit in an int32.
+    '''
+    if isinstance(value, bool):
+        return TYPE_BOOL, VALUE_FORMATS[TYPE_BOOL].pack(value)
+    if isinstance(value, int):
+        if -0x8000 <= value < 0x8000:
+            return TYPE_INT16, VALUE_FORMATS[TYPE_INT16].pack(value)
+        if not -0x80000000 <= value < 0x80000000:
+            raise ValueError('%d does not fit in an int32' % value)
+        return TYPE_INT32, VALUE_FORMATS[TYPE_INT32].pack(value)
+    if isinstance(value, float):
+        return TYPE_FLOAT32, VALUE_FORMATS[TYPE_FLOAT32].pack(value)
+    return TYPE_STRING, str(value).encode('utf-8')
+
+
+def encode_message(message_type, topic_id, value):
+    value_type, packed = encode_value(value)
+    return HEADER.pack(message_type, topic_id, value_type) + packed
+
+
+def decode_message(payload, topics):
+    '''
+    Turns a frame payload into a message dict like those sent as JSON,
+    {'topic': ..., 'payload': ...}. Raises ValueError if it is invalid.
+    '''
+    if len(payload) < HEADER.size:
+        raise ValueError('Frame too short')
+    message_type, topic_id, value_type = HEADER.unpack(payload[:HEADER.size])
+    if topic_id >= len(topics):
+        raise ValueError('Unknown topic id %d' % topic_id)
+    packed = payload[HEADER.size:]
+    if value_type == TYPE_STRING:
+        value = packed.decode('utf-8')
+    elif value_type in VALUE_FORMATS:
+        value, = VALUE_FORMATS[value_type].unpack(packed)
+        if value_type == TYPE_FLOAT32:
+            # Drop the noise from widening to a double: 21.5 rather than
+            # 21.50000000000001
+            value = float('%.7g' % value)
+    else:
+        raise ValueError('Unknown value type %d' % value_type)
+    message = {'topic': topics[topic_id], 'payload': value}
+    if message_type == MSG_COMMAND:
+        message['command'] = True
+    return message
+
+
+class BinaryFrameDecoder():
+    '''
+    Turns a stream of bytes into a list of message dicts. Has the same
+    interface as framing.JsonFrameDecoder.
+    '''
+    def __init__(self, topics, max_frame=512):
+        self.topics = list(topics)
+        self.max_frame = max_frame
+        self.malformed = 0
+        self.buffer = b''
+
+    def reset(self):
+        self.buffer = b''
+
+    def feed(self, data):
+        frames = []
+        pieces = (self.buffer + bytes(data)).split(b'\x00')
+        # The last piece has not been terminated yet
+        self.buffer = pieces.pop()
+        if len(self.buffer) > self.max_frame:
+            self.malformed += 1
+            self.buffer = b''
+        for piece in pieces:
+            if not piece:
+                continue
+            try:
+                frame = cobs_decode(piece)
+                if len(frame) < 2:
+                    raise ValueError('Frame too short')
+                payload, crc = frame[:-2], struct.unpack('>H', frame[-2:])[0]
+                if crc16(payload) != crc:
+                    raise ValueError('CRC mismatch')
+                frames.append(decode_message(payload, self.topics))
+            except (ValueError, struct.error, UnicodeDecodeError):
+                self.malformed += 1
+        return frames
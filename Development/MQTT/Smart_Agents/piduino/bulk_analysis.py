@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+"""
+Summarises (and optionally converts) directories of collected CSV data in
+parallel (needs numpy).
+
+Files are cut into chunks of about CHUNK_BYTES at line boundaries, and the
+chunks are parsed and summarised by a pool of worker processes, so a single
+large file is spread over every core as well as thousands of small ones.
+Chunks are parsed with numpy.loadtxt; a chunk that does not parse (e.g. it
+has rows with text payloads) is parsed row by row and the bad rows skipped.
+Rows whose timestamp goes back in time within a chunk are dropped.
+
+The summaries of a stream's chunks are merged in order (rotated files first,
+see writer_pool.py) into:
+
+    rows, skipped   rows read, and rows dropped as unreadable or backwards
+    count           samples
+    first, last     timestamps of the first and last sample
+    rate            samples per second
+    gaps            intervals more than GAP_FACTOR times the median interval
+                    (or longer than --gap seconds), their total and longest
+    min, max, mean, std of the values
+    fft             (with --fft) the strongest frequencies in the last
+                    --fft-samples samples
+
+With --store, the samples are also appended to a columnar store (see
+columnar_store.py); rows that go back in time across chunks are dropped
+before they are stored, as are rows no later than what the store already
+held for the stream (e.g. when the same files are analysed again). Those are
+reported as already_stored.
+
+    python3 bulk_analysis.py Data/ --workers 4
+    python3 bulk_analysis.py output.csv --relative-micros --fft
+    python3 bulk_analysis.py Data/ --store Store --codec delta-xor --json
+"""
+
+import argparse
+import csv
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+import numpy as np
+from columnar_store import ColumnarStore, CODECS, DEFAULT_ROLLUPS, conversion_order, stream_name
+
+CHUNK_BYTES = 8 * 1024 * 1024
+GAP_FACTOR = 5
+FFT_SAMPLES = 65536
+FFT_PEAKS = 3
+
+
+class Summary():
+    '''
+    Statistics of a run of samples in time order, which can be merged with
+    the statistics of the run that follows
+    '''
+    def __init__(self):
+        self.rows = 0
+        self.skipped = 0
+        self.count = 0
+        self.first = None
+        self.last = None
+        self.mean = 0.0
+        # Sum of squared differences from the mean
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.interval = None
+        self.gaps = 0
+        self.gap_time = 0.0
+        # (start, length)
+        self.longest_gap = None
+
+    def add(self, times, values, gap=None):
+        '''
+        Summarises the samples of a chunk into an empty summary. Gaps are
+        intervals longer than gap seconds, or GAP_FACTOR times the median.
+        '''
+        self.count = len(times)
+        if self.count == 0:
+            return
+        self.first = float(times[0])
+        self.last = float(times[-1])
+        self.mean = float(values.mean())
+        self.m2 = float(((values - self.mean) ** 2).sum())
+        self.min = float(values.min())
+        self.max = float(values.max())
+        intervals = np.diff(times)
+        if len(intervals):
+            self.interval = float(np.median(intervals))
+            gaps = np.flatnonzero(intervals > self.gap_threshold(gap))
+            if len(gaps):
+                self.gaps = len(gaps)
+                self.gap_time = float(intervals[gaps].sum())
+                longest = gaps[np.argmax(intervals[gaps])]
+                self.longest_gap = (float(times[longest]), float(intervals[longest]))
+
+    def gap_threshold(self, gap=None):
+        if gap is not None:
+            return gap
+        if self.interval:
+            return GAP_FACTOR * self.interval
+        return float('inf')
+
+    def shift(self, offset):
+        '''
+        Moves the timestamps by offset seconds
+        '''
+        if self.count:
+            self.first += offset
+            self.last += offset
+        if self.longest_gap:
+            self.longest_gap = (self.longest_gap[0] + offset, self.longest_gap[1])
+
+    def merge(self, other, gap=None):
+        '''
+        Adds the summary of the samples that follow these
+        '''
+        self.rows += other.rows
+        self.skipped += other.skipped
+        if other.count == 0:
+            return
+        if self.count == 0:
+            rows, skipped = self.rows, self.skipped
+            self.__dict__.update(other.__dict__)
+            self.rows, self.skipped = rows, skipped
+            return
+        between = other.first - self.last
+        if between > self.gap_threshold(gap):
+            self.gaps += 1
+            self.gap_time += between
+            if self.longest_gap is None or between > self.longest_gap[1]:
+                self.longest_gap = (self.last, between)
+        self.gaps += other.gaps
+        self.gap_time += other.gap_time
+        if other.longest_gap and (self.longest_gap is None or
+                                  other.longest_gap[1] > self.longest_gap[1]):
+            self.longest_gap = other.longest_gap
+        # Chan et al.'s parallel variance
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.mean += delta * other.count / count
+        # The median of the longer run stands in for the whole
+        if other.interval is not None and (self.interval is None or other.count > self.count):
+            self.interval = other.interval
+        self.count = count
+        self.last = other.last
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def report(self):
+        report = {'rows': self.rows, 'skipped': self.skipped, 'count': self.count}
+        if self.count:
+            duration = self.last - self.first
+            report.update({
+                'first': self.first,
+                'last': self.last,
+                'rate': (self.count - 1) / duration if duration > 0 else None,
+                'median_interval': self.interval,
+                'gaps': self.gaps,
+                'gap_time': self.gap_time,
+                'longest_gap': self.longest_gap,
+                'min': self.min,
+                'max': self.max,
+                'mean': self.mean,
+                'std': (self.m2 / self.count) ** 0.5,
+            })
+        return report
+
+
+def parse_rows(data):
+    '''
+    Returns (first column, second column, rows, bad rows) of CSV text
+    '''
+    if not data.strip():
+        return np.empty(0), np.empty(0), 0, 0
+    try:
+        table = np.loadtxt(io.BytesIO(data), delimiter=',', usecols=(0, 1), ndmin=2,
+                           dtype=np.float64)
+        return table[:, 0], table[:, 1], len(table), 0
+    except (ValueError, IndexError):
+        pass
+    first = []
+    second = []
+    rows = 0
+    bad = 0
+    for row in csv.reader(io.StringIO(data.decode(errors='replace'))):
+        if not row:
+            continue
+        rows += 1
+        try:
+            a = float(row[0])
+            b = float(row[1])
+        except (ValueError, IndexError):
+            bad += 1
+            continue
+        first.append(a)
+        second.append(b)
+    return np.array(first), np.array(second), rows, bad
+
+
+def read_chunk(path, start, end):
+    '''
+    Returns the lines that start in [start, end) of a file
+    '''
+    with open(path, 'rb') as f:
+        if start > 0:
+            # The line that crosses start belongs to the chunk before
+            f.seek(start - 1)
+            f.readline()
+            start = f.tell()
+        if start >= end:
+            return b''
+        data = f.read(end - start)
+        if data and not data.endswith(b'\n'):
+            data += f.readline()
+    return data
+
+
+def analyse_chunk(task):
+    '''
+    Parses and summarises a chunk of a file (run in the worker processes).
+    Returns (task, summary, timestamps, values), with the arrays only if
+    the task asks for them.
+    '''
+    path, start, end, relative_micros, gap, keep = task
+    data = read_chunk(path, start, end)
+    first, second, rows, bad = parse_rows(data)
+    if relative_micros:
+        # Seconds from the start of the chunk; shifted to the file's time by
+        # the caller
+        times = np.cumsum(first) / 1e6
+    else:
+        times = first
+        # Drop rows that go back in time
+        keep_rows = times >= np.maximum.accumulate(times) if len(times) else np.ones(0, bool)
+        if not np.all(keep_rows):
+            bad += int(len(times) - np.count_nonzero(keep_rows))
+            times = times[keep_rows]
+            second = second[keep_rows]
+    summary = Summary()
+    summary.add(times, second, gap)
+    summary.rows = rows
+    summary.skipped = bad
+    return task, summary, (times if keep else None), (second if keep else None)
+
+
+def make_tasks(paths, relative_micros=False, gap=None, keep=False, chunk_bytes=CHUNK_BYTES):
+    tasks = []
+    for path in conversion_order(paths):
+        size = os.path.getsize(path)
+        for start in range(0, max(size, 1), chunk_bytes):
+            tasks.append((path, start, min(start + chunk_bytes, size), relative_micros, gap, keep))
+    return tasks
+
+
+def find_csv(paths):
+    '''
+    Returns the CSV files in the given files and directories
+    '''
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, subdirectories, files in os.walk(path):
+                found.extend(os.path.join(directory, name) for name in files
+                             if name.endswith('.csv'))
+        else:
+            found.append(path)
+    return found
+
+
+def fft_peaks(times, values, peaks=FFT_PEAKS):
+    '''
+    Returns the strongest (frequency, amplitude) components of samples taken
+    at a roughly constant interval, strongest first
+    '''
+    if len(values) < 4:
+        return []
+    interval = float(np.median(np.diff(times)))
+    if interval <= 0:
+        return []
+    # As fft.calculateFFT: amplitudes of the positive frequencies, doubled
+    # because they are shared with the negative ones
+    amplitudes = 2 * np.abs(np.fft.rfft(values - values.mean())) / len(values)
+    frequencies = np.fft.rfftfreq(len(values), d=interval)
+    strongest = np.argsort(amplitudes[1:])[::-1][:peaks] + 1
+    return [(float(frequencies[i]), float(amplitudes[i])) for i in strongest]
+
+
+class Progress():
+    '''
+    Prints how far through the chunks we are, at most twice a second
+    '''
+    def __init__(self, total_bytes, stream=sys.stderr, enabled=True):
+        self.total_bytes = total_bytes
+        self.done_bytes = 0
+        self.stream = stream
+        self.enabled = enabled
+        self.started = time.perf_counter()
+        self.printed = 0
+
+    def update(self, done_bytes, final=False):
+        self.done_bytes += done_bytes
+        now = time.perf_counter()
+        if self.enabled and (final or now - self.printed >= 0.5):
+            self.printed = now
+            elapsed = max(now - self.started, 1e-9)
+            self.stream.write('\r%6.1f%%  %8.1f MB  %7.1f MB/s' % (
+                100.0 * self.done_bytes / max(self.total_bytes, 1),
+                self.done_bytes / 1e6, self.done_bytes / elapsed / 1e6))
+            if final:
+                self.stream.write('\n')
+            self.stream.flush()
+
+
+def analyse(paths, workers=None, relative_micros=False, gap=None, store=None,
+            fft_samples=None, chunk_bytes=CHUNK_BYTES, progress=True):
+    '''
+    Summarises the CSV files in paths. Returns ({stream: report}, totals).
+    '''
+    files = find_csv(paths)
+    keep = store is not None or bool(fft_samples)
+    tasks = make_tasks(files, relative_micros, gap, keep, chunk_bytes)
+    total_bytes = sum(os.path.getsize(path) for path in files)
+    workers = workers or os.cpu_count() or 1
+    summaries = {}
+    recent = {}
+    # The last timestamp each stream had in the store before this run, and
+    # the rows skipped because the store already held them
+    stored_until = {}
+    already_stored = {}
+    # Where each file's relative timestamps have got to
+    file_time = {}
+    meter = Progress(total_bytes, enabled=progress)
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap(analyse_chunk, tasks)
+    else:
+        pool = None
+        results = map(analyse_chunk, tasks)
+    try:
+        # Results come back in task order, so chunks are merged in time order
+        for task, summary, times, values in results:
+            path, start, end = task[:3]
+            if relative_micros:
+                # Each file is a separate recording, named after its directory
+                # too (e.g. testing_analogue_read-output)
+                name = '%s-%s' % (os.path.basename(os.path.dirname(os.path.abspath(path))),
+                                  stream_name(path)[0])
+            else:
+                name, stamp = stream_name(path)
+            if relative_micros:
+                offset = file_time.get(path, 0.0)
+                summary.shift(offset)
+                if times is not None:
+                    times = times + offset
+                if summary.count:
+                    file_time[path] = summary.last
+            total = summaries.setdefault(name, Summary())
+            if times is not None and total.count and len(times) and times[0] < total.last:
+                # Rows that go back in time across chunks
+                keep_rows = times >= total.last
+                summary.skipped += int(len(times) - np.count_nonzero(keep_rows))
+                times = times[keep_rows]
+                values = values[keep_rows]
+                rows, skipped = summary.rows, summary.skipped
+                summary = Summary()
+                summary.add(times, values, gap)
+                summary.rows, summary.skipped = rows, skipped
+            total.merge(summary, gap)
+            if store is not None and times is not None:
+                if name not in stored_until:
+                    last = store.writer(name).time_range()
+                    stored_until[name] = last[1] if last is not None else None
+                    already_stored[name] = 0
+                new_times, new_values = times, values
+                if stored_until[name] is not None and len(times):
+                    keep_rows = times > stored_until[name]
+                    already_stored[name] += int(len(times) - np.count_nonzero(keep_rows))
+                    new_times = times[keep_rows]
+                    new_values = values[keep_rows]
+                store.append(name, new_times, new_values)
+            if fft_samples and values is not None:
+                recent.setdefault(name, []).append((times, values))
+                held = sum(len(t) for t, v in recent[name])
+                while held - len(recent[name][0][0]) >= fft_samples:
+                    held -= len(recent[name].pop(0)[0])
+            meter.update(end - start)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    meter.update(0, final=True)
+
+    reports = {}
+    for name, summary in sorted(summaries.items()):
+        reports[name] = summary.report()
+        if name in already_stored:
+            reports[name]['already_stored'] = already_stored[name]
+        if fft_samples and recent.get(name):
+            times = np.concatenate([t for t, v in recent[name]])[-fft_samples:]
+            values = np.concatenate([v for t, v in recent[name]])[-fft_samples:]
+            reports[name]['fft'] = fft_peaks(times, values)
+    elapsed = time.perf_counter() - meter.started
+    totals = {
+        'files': len(files),
+        'bytes': total_bytes,
+        'rows': sum(s.rows for s in summaries.values()),
+        'seconds': elapsed,
+        'workers': workers,
+        'mb_per_second': total_bytes / elapsed / 1e6 if elapsed else None,
+        'rows_per_second': sum(s.rows for s in summaries.values()) / elapsed if elapsed else None,
+    }
+    return reports, totals
+
+
+def format_time(timestamp):
+    # Relative timestamps (e.g. from output.csv) are printed as seconds
+    if timestamp < 1e8:
+        return '%.3f s' % timestamp
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
+def print_reports(reports, totals, stream=sys.stdout):
+    for name, report in reports.items():
+        stream.write('%s\n' % name)
+        stream.write('    %d rows, %d skipped, %d samples\n' % (
+            report['rows'], report['skipped'], report['count']))
+        if report.get('already_stored'):
+            stream.write('    %d rows already in the store\n' % report['already_stored'])
+        if report['count']:
+            stream.write('    %s to %s, %s samples/s, median interval %.6g s\n' % (
+                format_time(report['first']), format_time(report['last']),
+                '%.4g' % report['rate'] if report['rate'] else '-', report['median_interval'] or 0))
+            if report['gaps']:
+                start, length = report['longest_gap']
+                stream.write('    %d gaps totalling %.1f s, longest %.1f s at %s\n' % (
+                    report['gaps'], report['gap_time'], length, format_time(start)))
+            stream.write('    min %.6g  max %.6g  mean %.6g  std %.6g\n' % (
+                report['min'], report['max'], report['mean'], report['std']))
+        for frequency, amplitude in report.get('fft', []):
+            stream.write('    %.4g Hz at amplitude %.4g\n' % (frequency, amplitude))
+    stream.write('%d files, %.1f MB, %d rows in %.2f s with %d workers: %.1f MB/s, %.0f rows/s\n' % (
+        totals['files'], totals['bytes'] / 1e6, totals['rows'], totals['seconds'],
+        totals['workers'], totals['mb_per_second'] or 0, totals['rows_per_second'] or 0))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Summarises collected CSV data in parallel')
+    parser.add_argument('paths', nargs='+', help='CSV files and directories of them')
+    parser.add_argument('--workers', type=int, help='processes (default: one per core)')
+    parser.add_argument('--relative-micros', action='store_true',
+                        help='the first column is microseconds since the previous row')
+    parser.add_argument('--gap', type=float,
+                        help='report intervals longer than this many seconds as gaps')
+    parser.add_argument('--fft', action='store_true', help='report the strongest frequencies')
+    parser.add_argument('--fft-samples', type=int, default=FFT_SAMPLES)
+    parser.add_argument('--store', help='also append the samples to this columnar store')
+    parser.add_argument('--codec', choices=sorted(CODECS), help='compress the store')
+    parser.add_argument('--chunk-mb', type=float, default=CHUNK_BYTES / 1e6)
+    parser.add_argument('--json', action='store_true', help='print the summaries as JSON')
+    parser.add_argument('--quiet', action='store_true', help='do not show progress')
+    args = parser.parse_args(argv)
+
+    store = None
+    if args.store:
+        store = ColumnarStore(args.store, rollups=DEFAULT_ROLLUPS, codec=args.codec)
+    reports, totals = analyse(args.paths, args.workers, args.relative_micros, args.gap, store,
+                              args.fft_samples if args.fft else None,
+                              max(int(args.chunk_mb * 1e6), 1), not args.quiet)
+    if args.json:
+        json.dump({'streams': reports, 'totals': totals}, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        print_reports(reports, totals)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
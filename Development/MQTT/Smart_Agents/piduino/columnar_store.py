@@ -0,0 +1,632 @@
+# -*- coding: utf-8 -*-
+"""
+An append-only columnar store for collected sensor data (needs numpy).
+
+data_collection writes a 'timestamp,payload' text row per reading, and every
+analysis has to parse the text again. Here each stream (e.g.
+'Coffee_Room-1234-LDR') is a directory of fixed width binary columns:
+
+    Coffee_Room-1234-LDR/
+        index.json             chunk list, dtypes and chunk size
+        chunk-000000.time      float64 UNIX timestamps, little endian
+        chunk-000000.value     values (float64 unless chosen otherwise)
+        chunk-000001.time
+        ...
+
+A chunk holds up to chunk_size samples; the index records how many samples
+each chunk holds and their first and last timestamps. Columns are read with
+numpy.memmap, so slicing a few samples out of millions reads only the pages
+that are touched, and nothing is parsed:
+
+    store = ColumnarStore('Store')
+    times, values = store.read('Coffee_Room-1234-LDR')
+    for times, values in store.stream('Coffee_Room-1234-LDR').chunks():
+        ...
+
+Timestamps within a stream must not go backwards, so every chunk covers a
+time range that starts after the previous one ends. Time range queries
+binary search the index for the first chunk, then the chunk for the first
+sample, and only read the chunks in the range:
+
+    times, values = store.query('Coffee_Room-1234-LDR', start, end)
+    times, values = store.latest('Coffee_Room-1234-LDR', 6 * 3600)
+    for times, values in store.stream('Coffee_Room-1234-LDR').iter_range(start, end):
+        ...
+
+Streams can also keep rollups (see rollups.py): count, min, max and sum for
+every second, minute, hour etc., updated as samples are appended. Queries at
+one of those resolutions read the rollup instead of the samples:
+
+    store = ColumnarStore('Store', rollups=(1, 60, 3600))
+    buckets = store.latest('Coffee_Room-1234-LDR', 6 * 3600, resolution=60)
+    means = buckets['sum'] / buckets['count']
+
+Ranges include start and exclude end, and are in UNIX time.
+
+Streams can be compressed with a codec from CODECS (see sample_codec.py).
+Each chunk is compressed into a single chunk-NNNNNN.packed file once it is
+full, and is decoded into arrays (instead of memmapped) when read. The chunk
+being appended to is never compressed.
+
+    store = ColumnarStore('Store', codec='delta-xor')
+
+A stream must only have one writer, but any number of readers. The writer
+appends to the column files before rewriting the index (atomically), so
+readers only see whole samples; call refresh() to see new ones. If the writer
+is killed between the two, samples beyond the index are recovered (or the
+shorter column is cut back) the next time the stream is opened for writing.
+
+Existing CSV files can be converted from the command line:
+
+    python3 columnar_store.py convert Store Data/*.csv
+    python3 columnar_store.py convert Store output.csv --relative-micros
+    python3 columnar_store.py info Store
+    python3 columnar_store.py query Store Coffee_Room-1234-LDR --last 21600 --resolution 60
+
+Rotated files (see writer_pool.py) are appended to their stream in time
+order. Rows whose payload is not a number, or whose timestamp goes backwards,
+are skipped and counted.
+"""
+
+import argparse
+import csv
+import json
+import os
+import re
+import sys
+import time
+from bisect import bisect_left
+import numpy as np
+from rollups import Rollup, ROLLUP_DTYPE
+import sample_codec
+
+TIME_DTYPE = np.dtype('<f8')
+DEFAULT_VALUE_DTYPE = '<f8'
+DEFAULT_CHUNK_SIZE = 65536
+# Seconds, minutes and hours
+DEFAULT_ROLLUPS = (1, 60, 3600)
+INDEX_NAME = 'index.json'
+INDEX_VERSION = 1
+
+# Codecs for full chunks: name: (encode(times, values), decode(data, value_dtype))
+CODECS = {
+    'delta-xor': (sample_codec.encode, sample_codec.decode),
+}
+
+ROLLUP_FIELDS = ROLLUP_DTYPE.names
+
+# Matches the suffix of a file rotated by WriterPool, e.g. '.20170724T150000'
+ROTATED = re.compile(r'^(.*)\.(\d{8}T\d{6}(?:-\d+)?)$')
+
+
+class ColumnarStream():
+    '''
+    The chunks and index of one stream. Open it with writable=True to append.
+    '''
+    def __init__(self, directory, writable=False, value_dtype=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE, rollups=(), codec=None):
+        if codec is not None and codec not in CODECS:
+            raise ValueError('Unknown codec: %r' % codec)
+        self.directory = directory
+        self.writable = writable
+        self.bounds = None
+        index_path = os.path.join(directory, INDEX_NAME)
+        if os.path.exists(index_path):
+            self.refresh()
+            if value_dtype is not None and np.dtype(value_dtype) != self.value_dtype:
+                raise ValueError('stream %s holds %s values, not %s' %
+                                 (directory, self.value_dtype.str, np.dtype(value_dtype).str))
+            if writable:
+                self.__repair_tail()
+                # Catch up if the last writer was killed before updating them
+                for rollup in self.rollups.values():
+                    rollup.update(self)
+        elif writable:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.value_dtype = np.dtype(value_dtype or DEFAULT_VALUE_DTYPE)
+            self.chunk_size = chunk_size
+            self.codec = codec
+            self.index = []
+            self.rollups = dict((r, Rollup(directory, r)) for r in rollups)
+            self.__save_index()
+        else:
+            raise KeyError('No stream at ' + directory)
+
+    def refresh(self):
+        '''
+        Rereads the index (and rollups), to see samples appended by another
+        process
+        '''
+        with open(os.path.join(self.directory, INDEX_NAME)) as f:
+            index = json.load(f)
+        if index.get('version') != INDEX_VERSION:
+            raise ValueError('Unknown index version in ' + self.directory)
+        if np.dtype(index['time_dtype']) != TIME_DTYPE:
+            raise ValueError('Unknown timestamp dtype in ' + self.directory)
+        self.value_dtype = np.dtype(index['value_dtype'])
+        self.chunk_size = index['chunk_size']
+        self.codec = index.get('codec')
+        self.index = index['chunks']
+        self.bounds = None
+        self.rollups = dict((r, Rollup(self.directory, r)) for r in index.get('rollups', []))
+
+    def __save_index(self):
+        index = {
+            'version': INDEX_VERSION,
+            'time_dtype': TIME_DTYPE.str,
+            'value_dtype': self.value_dtype.str,
+            'chunk_size': self.chunk_size,
+            'codec': self.codec,
+            'rollups': sorted(self.rollups),
+            'chunks': self.index,
+        }
+        path = os.path.join(self.directory, INDEX_NAME)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(path + '.tmp', path)
+
+    def __paths(self, chunk):
+        base = os.path.join(self.directory, chunk['file'])
+        return base + '.time', base + '.value'
+
+    def __packed_path(self, chunk):
+        return os.path.join(self.directory, chunk['file'] + '.packed')
+
+    def __repair_tail(self):
+        # Make the last chunk agree with its files, in case the last writer
+        # was killed after writing samples but before saving the index
+        if not self.index:
+            return
+        chunk = self.index[-1]
+        time_path, value_path = self.__paths(chunk)
+        count = min(os.path.getsize(time_path) // TIME_DTYPE.itemsize,
+                    os.path.getsize(value_path) // self.value_dtype.itemsize,
+                    self.chunk_size)
+        for path, dtype in [(time_path, TIME_DTYPE), (value_path, self.value_dtype)]:
+            if os.path.getsize(path) != count * dtype.itemsize:
+                with open(path, 'r+b') as f:
+                    f.truncate(count * dtype.itemsize)
+        if count != chunk['count']:
+            chunk['count'] = count
+            self.bounds = None
+            if count:
+                times = np.memmap(time_path, dtype=TIME_DTYPE, mode='r', shape=(count,))
+                chunk['t_min'] = float(times[0])
+                chunk['t_max'] = float(times[-1])
+            else:
+                chunk['t_min'] = chunk['t_max'] = None
+            self.__save_index()
+
+    def __len__(self):
+        return sum(chunk['count'] for chunk in self.index)
+
+    def time_range(self):
+        '''
+        Returns the first and last timestamps, or None if the stream is empty
+        '''
+        chunks = [chunk for chunk in self.index if chunk['count']]
+        if not chunks:
+            return None
+        return chunks[0]['t_min'], chunks[-1]['t_max']
+
+    def chunk(self, number):
+        '''
+        Returns (timestamps, values) memmaps of a chunk, or arrays if it is
+        compressed
+        '''
+        chunk = self.index[number]
+        count = chunk['count']
+        if count == 0:
+            return np.empty(0, TIME_DTYPE), np.empty(0, self.value_dtype)
+        if chunk.get('codec'):
+            encode, decode = CODECS[chunk['codec']]
+            with open(self.__packed_path(chunk), 'rb') as f:
+                return decode(f.read(), self.value_dtype)
+        time_path, value_path = self.__paths(chunk)
+        return (np.memmap(time_path, dtype=TIME_DTYPE, mode='r', shape=(count,)),
+                np.memmap(value_path, dtype=self.value_dtype, mode='r', shape=(count,)))
+
+    def chunks(self):
+        '''
+        Yields (timestamps, values) memmaps of every chunk in order
+        '''
+        for number in range(len(self.index)):
+            yield self.chunk(number)
+
+    def read(self, start=None, stop=None):
+        '''
+        Returns (timestamps, values) arrays of samples start to stop (by
+        position, as with slicing). Only the chunks that overlap are read.
+        '''
+        start, stop, step = slice(start, stop).indices(len(self))
+        times = []
+        values = []
+        offset = 0
+        for number, chunk in enumerate(self.index):
+            end = offset + chunk['count']
+            if end > start and offset < stop:
+                chunk_times, chunk_values = self.chunk(number)
+                times.append(chunk_times[max(start - offset, 0):stop - offset])
+                values.append(chunk_values[max(start - offset, 0):stop - offset])
+            offset = end
+        if len(times) == 1:
+            return times[0], values[0]
+        if not times:
+            return np.empty(0, TIME_DTYPE), np.empty(0, self.value_dtype)
+        return np.concatenate(times), np.concatenate(values)
+
+    def append(self, times, values):
+        '''
+        Appends samples to the stream. Raises ValueError if the timestamps go
+        backwards or are not finite.
+        '''
+        if not self.writable:
+            raise IOError('Stream %s is not open for writing' % self.directory)
+        times = np.ascontiguousarray(times, dtype=TIME_DTYPE).ravel()
+        values = np.ascontiguousarray(values, dtype=self.value_dtype).ravel()
+        if len(times) != len(values):
+            raise ValueError('There must be a value for every timestamp')
+        if len(times) == 0:
+            return
+        if not np.all(np.isfinite(times)):
+            raise ValueError('Timestamps must be finite')
+        last = self.time_range()
+        if np.any(np.diff(times) < 0) or (last is not None and times[0] < last[1]):
+            raise ValueError('Timestamps must not go backwards')
+
+        offset = 0
+        while offset < len(times):
+            if not self.index or self.index[-1]['count'] >= self.chunk_size:
+                self.index.append({'file': 'chunk-%06d' % len(self.index),
+                                   'count': 0, 't_min': None, 't_max': None})
+            chunk = self.index[-1]
+            end = min(offset + self.chunk_size - chunk['count'], len(times))
+            time_path, value_path = self.__paths(chunk)
+            with open(time_path, 'ab') as f:
+                f.write(times[offset:end].tobytes())
+            with open(value_path, 'ab') as f:
+                f.write(values[offset:end].tobytes())
+            if chunk['count'] == 0:
+                chunk['t_min'] = float(times[offset])
+            chunk['t_max'] = float(times[end - 1])
+            chunk['count'] += end - offset
+            offset = end
+        self.bounds = None
+        self.__save_index()
+        if self.codec:
+            self.compress()
+        for rollup in self.rollups.values():
+            rollup.update(self)
+
+    def compress(self, codec=None):
+        '''
+        Compresses the full chunks (all but the last) that are not already
+        compressed, with the stream's codec or the one given
+        '''
+        if not self.writable:
+            raise IOError('Stream %s is not open for writing' % self.directory)
+        codec = codec or self.codec
+        if codec not in CODECS:
+            raise ValueError('Unknown codec: %r' % codec)
+        encode, decode = CODECS[codec]
+        for number, chunk in enumerate(self.index[:-1]):
+            if chunk.get('codec') or chunk['count'] == 0:
+                continue
+            times, values = self.chunk(number)
+            path = self.__packed_path(chunk)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(encode(times, values))
+            os.replace(path + '.tmp', path)
+            del times, values
+            # Readers that have the old index still have the columns open
+            # (or will fail to open them, and should refresh)
+            chunk['codec'] = codec
+            self.__save_index()
+            for path in self.__paths(chunk):
+                os.remove(path)
+
+    def disk_usage(self):
+        '''
+        Returns the bytes used by the stream's chunks
+        '''
+        total = 0
+        for chunk in self.index:
+            paths = [self.__packed_path(chunk)] if chunk.get('codec') else self.__paths(chunk)
+            total += sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+        return total
+
+    def __chunk_bounds(self):
+        # The first sample number and the first and last timestamps of every
+        # chunk that holds samples, for binary searching
+        if self.bounds is None:
+            offsets = []
+            t_min = []
+            t_max = []
+            offset = 0
+            for number, chunk in enumerate(self.index):
+                if chunk['count']:
+                    offsets.append((number, offset))
+                    t_min.append(chunk['t_min'])
+                    t_max.append(chunk['t_max'])
+                offset += chunk['count']
+            self.bounds = offsets, t_min, t_max
+        return self.bounds
+
+    def iter_range(self, start=None, end=None):
+        '''
+        Yields (timestamps, values) memmap slices, a chunk at a time, of the
+        samples with start <= timestamp < end
+        '''
+        offsets, t_min, t_max = self.__chunk_bounds()
+        # The first chunk that ends at or after start, and the first chunk
+        # that starts at or after end
+        first = 0 if start is None else bisect_left(t_max, start)
+        last = len(offsets) if end is None else bisect_left(t_min, end)
+        for position in range(first, last):
+            times, values = self.chunk(offsets[position][0])
+            lo = 0 if start is None else np.searchsorted(times, start, 'left')
+            hi = len(times) if end is None else np.searchsorted(times, end, 'left')
+            if hi > lo:
+                yield times[lo:hi], values[lo:hi]
+
+    def position(self, timestamp):
+        '''
+        Returns the number of samples with timestamps before the given one
+        '''
+        offsets, t_min, t_max = self.__chunk_bounds()
+        position = bisect_left(t_max, timestamp)
+        if position == len(offsets):
+            return len(self)
+        number, offset = offsets[position]
+        times, values = self.chunk(number)
+        return offset + int(np.searchsorted(times, timestamp, 'left'))
+
+    def read_range(self, start=None, end=None):
+        '''
+        Returns (timestamps, values) arrays of the samples with
+        start <= timestamp < end
+        '''
+        first = 0 if start is None else self.position(start)
+        last = len(self) if end is None else self.position(end)
+        return self.read(first, last)
+
+    def rollup(self, resolution, start=None, end=None):
+        '''
+        Returns the rollup buckets (see rollups.py) that start in [start, end),
+        counting the bucket that start falls in. Raises KeyError if the stream
+        has no rollup at that resolution.
+        '''
+        if resolution not in self.rollups:
+            raise KeyError('%s has no %g second rollup' % (self.directory, resolution))
+        return self.rollups[resolution].read(self, start, end)
+
+
+class ColumnarStore():
+    '''
+    A directory of streams (see module docstring)
+    '''
+    def __init__(self, directory, chunk_size=DEFAULT_CHUNK_SIZE,
+                 value_dtype=DEFAULT_VALUE_DTYPE, rollups=(), codec=None):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.value_dtype = value_dtype
+        # Rollup resolutions and codec of new streams
+        self.rollups = rollups
+        self.codec = codec
+        # Streams opened for writing, by name
+        self.writers = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __path(self, name):
+        if not name or name.startswith('.') or os.sep in name or '/' in name:
+            raise ValueError('Bad stream name: %r' % name)
+        return os.path.join(self.directory, name)
+
+    def streams(self):
+        '''
+        Returns the names of the streams in the store
+        '''
+        return sorted(name for name in os.listdir(self.directory)
+                      if os.path.exists(os.path.join(self.directory, name, INDEX_NAME)))
+
+    def stream(self, name):
+        '''
+        Opens a stream for reading. Raises KeyError if there is no such stream.
+        '''
+        return ColumnarStream(self.__path(name))
+
+    def writer(self, name, value_dtype=None):
+        '''
+        Returns the stream open for writing, creating it if needed
+        '''
+        stream = self.writers.get(name)
+        if stream is None:
+            stream = ColumnarStream(self.__path(name), writable=True,
+                                    value_dtype=value_dtype or self.value_dtype,
+                                    chunk_size=self.chunk_size, rollups=self.rollups,
+                                    codec=self.codec)
+            self.writers[name] = stream
+        return stream
+
+    def append(self, name, times, values):
+        self.writer(name).append(times, values)
+
+    def read(self, name, start=None, stop=None):
+        return self.stream(name).read(start, stop)
+
+    def query(self, name, start=None, end=None, resolution=None):
+        '''
+        Returns (timestamps, values) of the samples with start <= timestamp <
+        end, or with a resolution, the rollup buckets over that range
+        '''
+        stream = self.writers.get(name) or self.stream(name)
+        if resolution is None:
+            return stream.read_range(start, end)
+        return stream.rollup(resolution, start, end)
+
+    def latest(self, name, seconds, now=None, resolution=None):
+        '''
+        As query, over the last given number of seconds
+        '''
+        if now is None:
+            now = time.time()
+        return self.query(name, now - seconds, None, resolution)
+
+
+def stream_name(path):
+    '''
+    Returns the stream a CSV file belongs to, and the rotation stamp if it
+    has been rotated by WriterPool (or None)
+    '''
+    name = os.path.basename(path)
+    if name.endswith('.csv'):
+        name = name[:-len('.csv')]
+    match = ROTATED.match(name)
+    if match:
+        return match.group(1), match.group(2)
+    return name, None
+
+
+def read_csv(path, relative_micros=False, batch=DEFAULT_CHUNK_SIZE):
+    '''
+    Yields (timestamps, values, skipped) arrays of up to batch rows from a
+    'timestamp,value' CSV file. With relative_micros, the first column is
+    instead the microseconds since the previous row (as in
+    testing_analogue_read's output.csv), and timestamps are counted in
+    seconds from the first row.
+    '''
+    elapsed = 0
+    with open(path, newline='') as f:
+        times = []
+        values = []
+        skipped = 0
+        for row in csv.reader(f):
+            try:
+                t = float(row[0])
+                value = float(row[1])
+            except (ValueError, IndexError):
+                skipped += 1
+                continue
+            if relative_micros:
+                elapsed += int(t)
+                t = elapsed / 1e6
+            times.append(t)
+            values.append(value)
+            if len(times) >= batch:
+                yield np.array(times, TIME_DTYPE), np.array(values), skipped
+                times = []
+                values = []
+                skipped = 0
+        if times or skipped:
+            yield np.array(times, TIME_DTYPE), np.array(values), skipped
+
+
+def convert_csv(path, store, name=None, relative_micros=False):
+    '''
+    Appends a CSV file to a stream in the store (named after the file if no
+    name is given). Returns (rows converted, rows skipped).
+    '''
+    if name is None:
+        name, stamp = stream_name(path)
+    stream = store.writer(name)
+    converted = 0
+    skipped = 0
+    for times, values, bad in read_csv(path, relative_micros, store.chunk_size):
+        skipped += bad
+        # Drop rows that go back in time, rather than failing the whole file
+        last = stream.time_range()
+        if len(times):
+            floor = np.maximum.accumulate(times)
+            keep = times >= floor
+            if last is not None:
+                keep &= times > last[1]
+            skipped += int(len(times) - np.count_nonzero(keep))
+            times = times[keep]
+            values = values[keep]
+        stream.append(times, values)
+        converted += len(times)
+    return converted, skipped
+
+
+def conversion_order(paths):
+    '''
+    Sorts CSV files so each stream's rotated files come first, oldest first,
+    followed by the file currently being written
+    '''
+    def key(path):
+        name, stamp = stream_name(path)
+        return name, stamp is None, stamp or ''
+    return sorted(paths, key=key)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Converts CSV sensor data to a columnar store')
+    commands = parser.add_subparsers(dest='command')
+    convert = commands.add_parser('convert', help='append CSV files to the store')
+    convert.add_argument('store')
+    convert.add_argument('files', nargs='+')
+    convert.add_argument('--name', help='stream to append to (default: from the file name)')
+    convert.add_argument('--relative-micros', action='store_true',
+                         help='the first column is microseconds since the previous row')
+    convert.add_argument('--value-dtype', default=DEFAULT_VALUE_DTYPE,
+                         help='numpy dtype of new streams\' values, e.g. <i2')
+    convert.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    convert.add_argument('--codec', choices=sorted(CODECS),
+                         help='compress full chunks of new streams')
+    convert.add_argument('--rollups', default=','.join(str(r) for r in DEFAULT_ROLLUPS),
+                         help='comma separated rollup resolutions of new streams, in seconds')
+    info = commands.add_parser('info', help='list the streams in the store')
+    info.add_argument('store')
+    query = commands.add_parser('query', help='print samples or rollups in a time range as CSV')
+    query.add_argument('store')
+    query.add_argument('name')
+    query.add_argument('--start', type=float)
+    query.add_argument('--end', type=float)
+    query.add_argument('--last', type=float, help='seconds before now (instead of --start)')
+    query.add_argument('--resolution', type=float, help='read the rollup at this resolution')
+    args = parser.parse_args(argv)
+
+    if args.command == 'convert':
+        rollups = tuple(float(r) if '.' in r else int(r)
+                        for r in args.rollups.split(',') if r)
+        store = ColumnarStore(args.store, chunk_size=args.chunk_size,
+                              value_dtype=args.value_dtype, rollups=rollups,
+                              codec=args.codec)
+        for path in conversion_order(args.files):
+            converted, skipped = convert_csv(path, store, args.name, args.relative_micros)
+            print('%s: %d rows converted, %d skipped' % (path, converted, skipped))
+    elif args.command == 'info':
+        store = ColumnarStore(args.store)
+        for name in store.streams():
+            stream = store.stream(name)
+            time_range = stream.time_range()
+            print('%s: %d samples in %d chunks (%d bytes), %s%s' % (
+                name, len(stream), len(stream.index), stream.disk_usage(),
+                '%.3f to %.3f' % time_range if time_range else 'empty',
+                ', rollups %s' % ', '.join('%gs' % r for r in sorted(stream.rollups))
+                if stream.rollups else ''))
+    elif args.command == 'query':
+        store = ColumnarStore(args.store)
+        start = args.start
+        if args.last is not None:
+            start = time.time() - args.last
+        writer = csv.writer(sys.stdout)
+        if args.resolution is None:
+            times, values = store.query(args.name, start, args.end)
+            writer.writerow(['timestamp', 'value'])
+            writer.writerows(zip(times.tolist(), values.tolist()))
+        else:
+            resolution = int(args.resolution) if args.resolution.is_integer() else args.resolution
+            buckets = store.query(args.name, start, args.end, resolution)
+            writer.writerow(ROLLUP_FIELDS)
+            writer.writerows(buckets.tolist())
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,8 +6,10 @@ Created on Mon Jul 24 15:24:20 2017
 """
 import time
 import threading
+import signal
+import sys
 import piduino
-import csv
+from writer_pool import WriterPool
 
 def timestamp():
     # Returns an integer UNIX time
@@ -33,18 +35,17 @@ def handshake_protocol(device, timeout=5):
     if flag:
         raise flag
         
-    t0 = time.time()
-    # Wait for a response
-    while time.time() - t0 < timeout:
-        if device.ready():
-            flag, message = device.receive_json()
-            if type(flag) == piduino.NotConnectedError:
-                # The device has been disconnected!
-                return None
-            else:
-                if message != '':
-                    if message["topic"] == "handshake":
-                        return message["payload"]
+    deadline = piduino.Deadline(timeout)
+    # Wait for a response. The device may still be sending readings from
+    # before the handshake, so keep reading until the deadline.
+    while not deadline.expired():
+        flag, message = device.receive_json(timeout=deadline.remaining())
+        if type(flag) == piduino.NotConnectedError:
+            # The device has been disconnected!
+            return None
+        elif flag is None:
+            if message.get("topic") == "handshake":
+                return message["payload"]
     return None
             
 def connection_thread(device):
@@ -76,6 +77,15 @@ def connection_thread(device):
 connectedEdgeDevices = []
 runningThreads = []
 AGENTNAME = 'Coffee_Room'
+DATA_DIR = 'Data'
+
+# Readings are buffered and written out every few seconds, and each file is
+# rotated daily
+writers = WriterPool(DATA_DIR, max_open=64, flush_interval=5.0, rotate_interval=86400)
+
+# Make sure buffered readings are written if we are killed (e.g. on shutdown)
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
 try:
     while True:
         time.sleep(0.5)
@@ -118,17 +128,14 @@ try:
                     else:
                         if message != '':
                             row = [timestamp(), str(message["payload"])]
-                            with open('Data/' 
-                                      + AGENTNAME 
-                                      + '-' + str(device.name) 
-                                      + '-' + message["topic"] + '.csv', 
-                                      'a', newline='') as f:
-                                writer = csv.writer(f)
-                                writer.writerow(row)
+                            writers.write(AGENTNAME + '-' + str(device.name) + '-' + message["topic"], row)
                                 
         # Clean disconnected arduinos out of the list
         connectedEdgeDevices = [d for d in connectedEdgeDevices if not d.error]
 
+        # Write out readings that have been waiting for a while
+        writers.poll()
+
 except Exception as e:
     raise e
 finally:
@@ -137,4 +144,5 @@ finally:
             device.shutdown()
         except:
             pass
+    writers.close()
     
\ No newline at end of file
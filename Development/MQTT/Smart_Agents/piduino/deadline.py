@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Deadlines for blocking reads.
+
+A read that may be retried several times (e.g. waiting for a handshake, which
+may be preceded by other messages) should share one deadline between the
+retries rather than restarting its timeout each time. Deadlines use the
+monotonic clock, so they are not affected by the system clock being changed
+(which happens on a Raspberry Pi when NTP first syncs after boot).
+"""
+
+import select
+import time
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    monotonic = time.time
+
+
+class Deadline():
+    '''
+    A point in time, timeout seconds from now. A timeout of None never expires.
+    '''
+    def __init__(self, timeout):
+        if timeout is None:
+            self.end = None
+        else:
+            self.end = monotonic() + max(timeout, 0)
+
+    def remaining(self):
+        '''
+        Returns the number of seconds left (never negative), or None if the
+        deadline never expires. Suitable for passing to select.
+        '''
+        if self.end is None:
+            return None
+        return max(self.end - monotonic(), 0.0)
+
+    def expired(self):
+        return self.end is not None and monotonic() >= self.end
+
+
+def wait_readable(fileobj, deadline):
+    '''
+    Blocks until fileobj (anything with a fileno method) has data to read, or
+    until the deadline passes. Returns True if there is data to read.
+    '''
+    readable, _, _ = select.select([fileobj], [], [], deadline.remaining())
+    return bool(readable)
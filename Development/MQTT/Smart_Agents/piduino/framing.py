@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental decoding of the JSON frames sent by edge devices.
+
+The Arduino sketches write JSON objects back to back on the serial port with
+no delimiter between them (ArduinoJson's printTo), e.g.
+
+    {"topic":"LDR","payload":455}{"topic":"Movement","payload":0}
+
+JsonFrameDecoder finds the frame boundaries by tracking brace depth, and
+whether it is inside a string or just after an escape character, so braces
+inside strings and nested objects are handled. Data can be fed in chunks of
+any size. Each byte is looked at once: only the structural characters
+{ } " and \\ are visited from Python, the rest are skipped over by the regex
+engine.
+
+If a frame cannot be decoded (e.g. bytes were lost on the line), or a frame
+grows beyond max_frame bytes without ending, the decoder counts it as
+malformed and resynchronises by scanning again from the byte after the frame's
+opening brace. An opening brace inside a frame that could not start a nested
+object (i.e. it does not follow ':', ',' or '[') is taken to be the start of a
+new frame after a truncated one.
+"""
+
+import json
+import re
+
+STRUCTURAL = re.compile(b'[{}"\\\\]')
+OPEN = ord('{')
+CLOSE = ord('}')
+QUOTE = ord('"')
+BACKSLASH = ord('\\')
+# Characters that can come before a nested object
+VALUE_START = b':,['
+WHITESPACE = b' \t\r\n'
+
+
+class JsonFrameDecoder():
+    '''
+    Turns a stream of bytes into a list of JSON objects (dicts)
+    '''
+    def __init__(self, max_frame=1024):
+        self.max_frame = max_frame
+        self.malformed = 0
+        self.__reset()
+
+    def __reset(self):
+        # The bytes of a frame that started in an earlier chunk
+        self.partial = bytearray()
+        self.depth = 0
+        self.in_string = False
+        # True if the previous chunk ended with an escape character
+        self.escaped = False
+
+    def reset(self):
+        '''
+        Discards any partial frame
+        '''
+        self.__reset()
+
+    def feed(self, data):
+        '''
+        Consumes a chunk of bytes and returns every frame completed by it
+        '''
+        frames = []
+        pending = bytes(data)
+        while pending:
+            pending = self.__scan(pending, frames)
+        return frames
+
+    def __decode(self, frame, frames):
+        try:
+            message = json.loads(frame.decode('utf-8'))
+        except ValueError:
+            message = None
+        if type(message) == dict:
+            frames.append(message)
+            return True
+        self.malformed += 1
+        return False
+
+    def __can_nest(self, data, i):
+        '''
+        Returns True if an opening brace at data[i] can start a nested object
+        '''
+        while i > 0:
+            i -= 1
+            if data[i] not in WHITESPACE:
+                return data[i] in VALUE_START
+        for char in reversed(self.partial):
+            if char not in WHITESPACE:
+                return char in VALUE_START
+        return False
+
+    def __scan(self, data, frames):
+        '''
+        Scans a chunk, appending complete frames. Returns bytes that need to
+        be scanned again after a malformed frame, or None.
+        '''
+        # Where the current frame starts in this chunk, or None if it started
+        # in an earlier chunk (or we are between frames)
+        start = 0 if self.depth > 0 else None
+        skip = 0 if self.escaped else -1
+        self.escaped = False
+        for match in STRUCTURAL.finditer(data):
+            i = match.start()
+            if i == skip:
+                # This character was escaped
+                continue
+            char = data[i]
+            if self.in_string:
+                if char == QUOTE:
+                    self.in_string = False
+                elif char == BACKSLASH:
+                    skip = i + 1
+            elif self.depth == 0:
+                # Between frames, only the start of a new frame matters
+                if char == OPEN:
+                    self.depth = 1
+                    start = i
+            elif char == OPEN:
+                if self.__can_nest(data, i):
+                    self.depth += 1
+                else:
+                    # The previous frame was cut short: start again here
+                    self.malformed += 1
+                    self.partial = bytearray()
+                    self.depth = 1
+                    start = i
+            elif char == CLOSE:
+                self.depth -= 1
+                if self.depth == 0:
+                    frame = self.partial + data[start:i + 1]
+                    self.partial = bytearray()
+                    start = None
+                    if not self.__decode(frame, frames):
+                        # Look for frames inside the bad one
+                        self.__reset()
+                        return bytes(frame[1:]) + data[i + 1:]
+            elif char == QUOTE:
+                self.in_string = True
+
+        if skip == len(data):
+            self.escaped = True
+        if self.depth > 0:
+            self.partial += data[start:]
+            if len(self.partial) > self.max_frame:
+                self.malformed += 1
+                frame = bytes(self.partial)
+                self.__reset()
+                return frame[1:]
+        return None
@@ -4,7 +4,7 @@
 
 cd /
 cd home/pi/piduino
-sudo python3 serial_relay.py
+sudo python3 serial_relay.py --config relay.ini
 cd /
 
 
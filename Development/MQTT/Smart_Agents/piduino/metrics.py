@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Counters, gauges and histograms for the serial relay.
+
+Metrics live in a Registry, which can render them in the Prometheus text
+format (served over HTTP by MetricsServer) or as a JSON friendly snapshot
+(published over MQTT by the relay). Both are cheap enough to be produced every
+few seconds on a Raspberry Pi.
+
+Metrics that belong to objects that come and go (such as serial devices) are
+reported by collector functions, which the registry calls each time it renders
+and which return a list of (name, labels, value) samples.
+"""
+
+import bisect
+import threading
+import time
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+# Seconds. Suitable for anything from a fast serial frame to a slow batch.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                          for k, v in sorted(labels.items())) + '}'
+
+
+class Counter():
+    '''
+    A value that only goes up
+    '''
+    kind = 'counter'
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        return [(self.name, {}, self.value)]
+
+
+class Gauge():
+    '''
+    A value that can go up and down. If a function is given, it is called to
+    get the value whenever the gauge is read.
+    '''
+    kind = 'gauge'
+
+    def __init__(self, name, description, function=None):
+        self.name = name
+        self.description = description
+        self.function = function
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        if self.function is not None:
+            return [(self.name, {}, self.function())]
+        return [(self.name, {}, self.value)]
+
+
+class Histogram():
+    '''
+    Counts observations into fixed buckets, and keeps their count and sum
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        '''
+        Estimates a quantile as the upper bound of the bucket it falls in
+        '''
+        with self.lock:
+            if self.count == 0:
+                return None
+            rank = q * self.count
+            cumulative = 0
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                if cumulative >= rank:
+                    return bound
+            return float('inf')
+
+    def samples(self):
+        with self.lock:
+            samples = []
+            cumulative = 0
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', {'le': repr(bound)}, cumulative))
+            samples.append((self.name + '_bucket', {'le': '+Inf'}, self.count))
+            samples.append((self.name + '_count', {}, self.count))
+            samples.append((self.name + '_sum', {}, self.sum))
+            return samples
+
+
+class Registry():
+    '''
+    Holds a set of metrics and collector functions
+    '''
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.metrics = []
+        self.collectors = []
+        self.previous = None
+
+    def __add(self, metric):
+        metric.name = self.prefix + metric.name
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, description):
+        return self.__add(Counter(name, description))
+
+    def gauge(self, name, description, function=None):
+        return self.__add(Gauge(name, description, function))
+
+    def histogram(self, name, description, buckets=DEFAULT_BUCKETS):
+        return self.__add(Histogram(name, description, buckets))
+
+    def add_collector(self, function):
+        '''
+        Registers a function returning a list of (name, labels, value)
+        '''
+        self.collectors.append(function)
+
+    def __collected(self):
+        samples = []
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                samples.append((self.prefix + name, labels, value))
+        return samples
+
+    def render(self):
+        '''
+        Returns every metric in the Prometheus text exposition format
+        '''
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.description))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, format_labels(labels), value))
+        for name, labels, value in self.__collected():
+            lines.append('%s%s %s' % (name, format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self, now=None):
+        '''
+        Returns a dict of metric values, along with the per second rate of
+        change of every counter since the last snapshot. Histograms are
+        summarised by their count, sum and estimated 50/90/99th percentiles.
+        '''
+        if now is None:
+            now = time.time()
+        values = {}
+        rates = {}
+        for metric in self.metrics:
+            if metric.kind == 'histogram':
+                values[metric.name] = {
+                    'count': metric.count,
+                    'sum': metric.sum,
+                    'p50': metric.quantile(0.5),
+                    'p90': metric.quantile(0.9),
+                    'p99': metric.quantile(0.99)
+                }
+            else:
+                values[metric.name] = metric.samples()[0][2]
+        for name, labels, value in self.__collected():
+            values[name + format_labels(labels)] = value
+
+        if self.previous is not None:
+            then, old = self.previous
+            elapsed = now - then
+            if elapsed > 0:
+                for key, value in values.items():
+                    if key in old and isinstance(value, (int, float)) and \
+                            key.split('{')[0].endswith('_total'):
+                        rates[key] = (value - old[key]) / elapsed
+        self.previous = (now, values)
+        return {'time': now, 'values': values, 'rates': rates}
+
+
+class MetricsServer():
+    '''
+    Serves a registry as plain text on http://<address>:<port>/metrics from a
+    background thread
+    '''
+    def __init__(self, registry, port, address='127.0.0.1'):
+        self.registry = registry
+        handler = self.__handler()
+        self.httpd = HTTPServer((address, port), handler)
+        self.thread = threading.Thread(name='metrics', target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    def __handler(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Don't fill the relay's log with scrapes
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread.start()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
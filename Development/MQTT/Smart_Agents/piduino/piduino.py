@@ -10,12 +10,16 @@ application
 """
 
 import json
+import struct
 import serial
 from serial import SerialException
 import serial.tools.list_ports
 import time
-import re
 import sys
+from collections import deque
+from framing import JsonFrameDecoder
+from deadline import Deadline, wait_readable
+from binary_framing import BinaryFrameDecoder, encode_frame, encode_message, MSG_COMMAND
 
 __version__ = '0.0.1'
 
@@ -49,6 +53,43 @@ def comport_scan(device_type='Arduino'):
         for port in ports:
             matching_ports.append(port[0])
     return matching_ports
+
+
+def handshake_message(binary_baud=None):
+    '''
+    The message sent by SerialDevice.handshake_request
+    '''
+    message = {
+    'topic': 'handshake', 
+    'payload': 'Hello'
+    }
+    if binary_baud:
+        message['binary'] = 1
+        message['baud'] = int(binary_baud)
+    return message
+
+
+class DeviceStats():
+    '''
+    Running totals of what has happened on a device's serial link. These are
+    plain counters, so they can be read at any time (e.g. by a metrics
+    collector) without locking.
+    '''
+    def __init__(self):
+        self.connects = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.frames_received = 0
+        self.frames_sent = 0
+        self.malformed_frames = 0
+        self.timeouts = 0
+        self.disconnects = 0
+        # time.time() at which the last frame returned by receive_json was
+        # read from the port
+        self.last_frame_time = None
+
+    def as_dict(self):
+        return dict(self.__dict__)
     
     
 class SerialDevice():
@@ -56,93 +97,148 @@ class SerialDevice():
     The microcontroller should be constantly sending sensor readings. It does not 
     require input from the smart agent.
     '''
-    def __init__(self, comport):
+    def __init__(self, comport, baudrate=9600):
         self.name = None
         self.comport = comport
+        self.baudrate = baudrate
         self.ser = None
         self.topics = set()
         self.connected = False
         self.verified = False
         self.processing = False
         self.error = False
+        self.stats = DeviceStats()
+        self.decoder = JsonFrameDecoder()
+        # (time read, message) for the messages that have been decoded but not
+        # yet returned by receive_json
+        self.frames = deque()
+        # Set by accept_handshake if the device agrees to binary framing
+        self.binary = False
+        self.topic_table = []
         
     def connect(self, timeout=10):
         try:
-            self.ser = serial.Serial(self.comport, 9600, timeout=timeout)
+            self.ser = serial.Serial(self.comport, self.baudrate, timeout=timeout)
             self.connected = True
-            if not sys.platform.startswith('win'):
-                self.ser.nonblocking()
+            self.stats.connects += 1
             return None
         except Exception as e:
             return e
         
+    def encode(self, message):
+        '''
+        Returns the bytes to write for a message, in JSON or binary framing
+        depending on what was agreed in the handshake
+        '''
+        if self.binary:
+            if message['topic'] not in self.topic_table:
+                return ValueError("The device has no topic id for " + str(message['topic'])), b''
+            topic_id = self.topic_table.index(message['topic'])
+            try:
+                return None, encode_frame(encode_message(MSG_COMMAND, topic_id, message['payload']))
+            except (ValueError, struct.error) as e:
+                # e.g. an int payload too big for the frame
+                return e, b''
+        return None, json.dumps(message).encode('ascii')
+
     def send(self, message):
-        packet = json.dumps(message).encode('ascii')
+        flag, packet = self.encode(message)
+        if flag:
+            return flag
         try:
             self.ser.write(packet)
+            self.stats.bytes_written += len(packet)
+            self.stats.frames_sent += 1
             return None
         except Exception as e:
             return e
             
+    def __waiting(self):
+        if serial.VERSION.startswith('2'):
+            return self.ser.inWaiting()
+        return self.ser.in_waiting
+
+    def __wait_readable(self, deadline):
+        '''
+        Blocks until there is data to read or the deadline passes. Returns
+        False if the deadline passed with nothing to read.
+        '''
+        if self.__waiting() > 0:
+            return True
+        if sys.platform.startswith('win'):
+            # Serial ports can't be passed to select on Windows, so let the
+            # next read block for the time that is left instead
+            timeout = deadline.remaining()
+            if self.ser.timeout != timeout:
+                self.ser.timeout = timeout
+            return True
+        return wait_readable(self.ser, deadline)
+
+    def __read_available(self, deadline):
+        '''
+        Reads everything waiting in the serial buffer. If nothing is waiting,
+        sleeps until something arrives or the deadline passes, in which case
+        b'' is returned.
+        '''
+        if not self.__wait_readable(deadline):
+            return b''
+        data = self.ser.read(max(self.__waiting(), 1))
+        self.stats.bytes_read += len(data)
+        return data
+
     def receive_json(self, timeout=10):
         '''
-        Receives a single message from a device, unless timeout is reached first 
+        Receives a single message from a device, unless timeout is reached first.
+
+        Data is read in bulk and passed through an incremental frame decoder,
+        so any further messages that arrive in the same read are kept for the
+        following calls. While waiting for data the thread is blocked in
+        select (or in the read on Windows), so a slow device costs no CPU.
         '''
-        t0 = time.time()
-        data = ''
-        while True:
-            # We read one byte at a time.
+        deadline = Deadline(timeout)
+        while not self.frames:
             try:
-                data += self.ser.read().decode(errors='ignore')
-            except SerialException as e:
+                data = self.__read_available(deadline)
+            except (SerialException, OSError) as e:
+                # Unplugging the device can give either
+                self.stats.disconnects += 1
                 return NotConnectedError("The device is not connected"), ''
-            # Note: this program cannot cope with internal '{}' brackets inside the json, so be sure not
-            # to use them in the plaintext when composing a message!
-            potential_messages = re.findall('\{[^\{\}]+\}', data)
-            for potential_message in potential_messages:
-                try:
-                    message = json.loads(potential_message)
-                    # json loads is a bit of a blunt instrument. It will interpret "hi" as a 
-                    # jsonic object! 
-                    if type(message) == dict:
-                        return None, message
-
-                except Exception as e:
-                    # Exceptions occur when the message is incomplete. Therefore we
-                    # can ignore them!
-                    pass
-                
-            if time.time() - t0 > timeout:
+            if data:
+                received = time.time()
+                malformed = self.decoder.malformed
+                self.frames.extend((received, message) for message in self.decoder.feed(data))
+                self.stats.malformed_frames += self.decoder.malformed - malformed
+            if not self.frames and deadline.expired():
+                self.stats.timeouts += 1
                 return ReadTimeoutError("The timeout was reached before a valid message was read"), ''
+        received, message = self.frames.popleft()
+        self.stats.frames_received += 1
+        self.stats.last_frame_time = received
+        return None, message
 
     def receive_string(self, timeout=10):
         '''
         Receives a string
         '''
-        data = ''
-        while self.ser.in_waiting:
-            data += self.ser.read().decode(errors='ignore')
-        return data
+        data = b''
+        while self.__waiting():
+            data += self.__read_available(Deadline(timeout))
+        return data.decode(errors='ignore')
     
     def ready(self):
         '''
         Check if the device is ready to send
         '''
+        if self.frames:
+            # Messages have already been read and decoded
+            return None, True
         try:
-            if serial.VERSION.startswith('2'):
-                if self.ser.inWaiting() > 0:
-                    return None, True
-                else:
-                    return None, False
-            else:
-                if self.ser.in_waiting > 0:
-                    return None, True
-                else:
-                    return None, False     
-        except SerialException as e:
+            return None, self.__waiting() > 0
+        except (SerialException, OSError) as e:
+            self.stats.disconnects += 1
             return NotConnectedError("The device is not connected"), False
             
-    def handshake_request(self):
+    def handshake_request(self, binary_baud=None):
         '''
         Can be sent at any time by the smart agent to the arduino. 
         If the arduino receives it, it should respond with a message in the
@@ -152,12 +248,39 @@ class SerialDevice():
                  'source': Arduino ID number,
                  'payload': 'Hello'
             }
+
+        If binary_baud is given, the arduino is also asked to switch to binary
+        framing (see binary_framing.py) at that baud rate. Arduinos that
+        support it add to their response:
+            {
+                 'binary': 1,
+                 'baud': the baud rate they will use,
+                 'topics': [topic 0, topic 1, ...]
+            }
+        and the response should be passed to accept_handshake. Arduinos that
+        do not ignore the request and carry on sending JSON.
+        '''
+        return self.send(handshake_message(binary_baud))
+
+    def accept_handshake(self, message):
+        '''
+        Switches to binary framing and the agreed baud rate if the arduino
+        accepted them in its handshake response
         '''
-        message = {
-        'topic': 'handshake', 
-        'payload': 'Hello'
-        }
-        return self.send(message)
+        if not message.get('binary'):
+            return None
+        try:
+            baud = int(message.get('baud', self.baudrate))
+            if baud != self.baudrate:
+                self.ser.baudrate = baud
+                self.baudrate = baud
+        except Exception as e:
+            return e
+        self.topic_table = list(message.get('topics', []))
+        self.binary = True
+        self.decoder = BinaryFrameDecoder(self.topic_table)
+        self.frames.clear()
+        return None
         
     def flush(self):
         '''
@@ -166,6 +289,8 @@ class SerialDevice():
         try:
             self.ser.flushInput()
             self.ser.flushOutput()
+            self.decoder.reset()
+            self.frames.clear()
             return None
         except Exception as e:
             return e
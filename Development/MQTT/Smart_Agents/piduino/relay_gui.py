@@ -0,0 +1,238 @@
+'''
+Optional tkinter viewer for the serial relay.
+
+The relay itself (serial_relay.py) never imports tkinter. This module drives
+the relay from a tkinter loop and shows the status lines and messages that
+share() leaves in the bounded serial_relay.statusbox and
+serial_relay.messagebox buffers.
+
+Usage:
+    python3 serial_relay.py --gui [--config relay.ini]
+'''
+import tkinter
+import serial_relay
+
+SPACING = 2
+BACKGROUND = 'LightSteelBlue1'
+FONT = 'Helvetica'
+
+STATE = 'waiting'
+
+'''
+GUI WIDGETS AND CALLBACKS
+'''
+class ScrollTextFrame():
+    def __init__(self, parent, padding, labeltext, height, width):
+
+        self.frame = tkinter.Frame(parent, borderwidth=1, bg=BACKGROUND,)
+        self.frame.pack(side=tkinter.LEFT, padx=padding, pady=padding)
+
+        self.label = tkinter.Label(self.frame, justify=tkinter.LEFT, padx=SPACING,
+                                   bg=BACKGROUND,
+                                   font=(FONT, 12),
+                                    text=labeltext).pack()
+        self.scrollbar = tkinter.Scrollbar(self.frame)
+        self.scrollbar.pack(side=tkinter.RIGHT, fill=tkinter.Y)
+        self.textbox = tkinter.Text(self.frame, height=height, width=width)
+        self.textbox.pack()
+
+        # attach listbox to scrollbar
+        self.textbox.config(yscrollcommand=self.scrollbar.set)
+        self.scrollbar.config(command=self.textbox.yview)
+
+    def show(self, lines):
+        '''
+        Moves every line out of a buffer and into the text box, keeping no
+        more than the buffer's maximum number of lines on screen
+        '''
+        added = False
+        while lines:
+            self.textbox.insert(tkinter.END, lines.popleft() + '\n')
+            added = True
+        if added:
+            excess = int(self.textbox.index('end-1c').split('.')[0]) - lines.maxlen
+            if excess > 0:
+                self.textbox.delete('1.0', str(excess + 1) + '.0')
+            self.textbox.see(tkinter.END)
+
+class InputBox():
+    '''
+    Creates an input box with label
+    '''
+    def __init__(self, parent, labeltext, default=''):
+        self.label = tkinter.Label(parent, justify=tkinter.LEFT,
+                                   bg=BACKGROUND,
+                                  font=(FONT, 12),
+                                  text=labeltext).pack()
+        self.inputbox = tkinter.Entry(parent, width=30)
+        self.inputbox.insert(0, default)
+        self.inputbox.pack()
+
+def start_callback():
+    '''
+    Check input
+    '''
+    global STATE
+    hostname = cloud_name_choice.inputbox.get()
+    if hostname == '':
+        status_frame.textbox.insert(tkinter.END, 'Please fill in a cloud name\n')
+        status_frame.textbox.see(tkinter.END)
+        return None
+    agentname = user_name_choice.inputbox.get()
+    if agentname == '':
+        status_frame.textbox.insert(tkinter.END, 'Please fill in a user name\n')
+        status_frame.textbox.see(tkinter.END)
+        return None
+    port = port_choice.inputbox.get()
+    if port == '':
+        status_frame.textbox.insert(tkinter.END, 'No port chosen: using default (1883)\n')
+        port = 1883
+    else:
+        try:
+            port = int(port)
+        except:
+            status_frame.textbox.insert(tkinter.END, 'Need an integer port: using default (1883)\n')
+            port = 1883
+
+    serial_relay.HOSTNAME = hostname
+    serial_relay.AGENTNAME = agentname
+    serial_relay.PORT = port
+    serial_relay.PROTOCOL = '3.1'
+    STATE = 'starting'
+
+    print('START')
+
+def stop_callback():
+    global STATE
+    if STATE == 'running':
+        serial_relay.clean_up(mqttClient)
+    STATE = 'waiting'
+    serial_relay.share('STOP button pressed')
+
+def on_closing():
+    global STATE
+    if STATE == 'running':
+        serial_relay.clean_up(mqttClient)
+    STATE = 'ended'
+    try:
+        root.destroy()
+    except:
+        pass
+
+def run(relay=None):
+    '''
+    Parameters
+    ----------
+    relay: module or None
+        The serial_relay module to drive. serial_relay.py passes itself in
+        when run as a script, since "import serial_relay" would then load a
+        second copy without the --config settings.
+    '''
+    global serial_relay
+    global STATE
+    global root
+    global mqttClient
+    global cloud_name_choice
+    global user_name_choice
+    global port_choice
+    global status_frame
+
+    if relay is not None:
+        serial_relay = relay
+    serial_relay.MODE = 'GUI'
+
+    root = tkinter.Tk("Internet of thingies")
+    root.configure(bg=BACKGROUND)
+
+    title_frame = tkinter.Frame(root, borderwidth=1)
+    title_frame.configure(bg=BACKGROUND)
+    title_frame.pack(padx=SPACING, pady=SPACING)
+
+    title_label = tkinter.Label(title_frame, justify=tkinter.LEFT, padx=SPACING,
+                                bg=BACKGROUND,
+                                font=(FONT, 24),
+                                text="Internet of Thingies").pack()
+
+
+
+    centre_frame = tkinter.Frame(root, borderwidth=1)
+    centre_frame.configure(bg=BACKGROUND)
+    centre_frame.pack(padx=SPACING, pady=SPACING)
+
+    '''
+    CONFIGURATION
+    '''
+
+    left_centre_frame = tkinter.Frame(centre_frame, bg=BACKGROUND, borderwidth=1)
+
+
+
+    cloud_name_choice = InputBox(left_centre_frame, "Cloud network address", default=serial_relay.HOSTNAME)
+    user_name_choice = InputBox(left_centre_frame, "This computer's name", default=serial_relay.AGENTNAME)
+    port_choice = InputBox(left_centre_frame, "Cloud network port (advanced)", default=str(serial_relay.PORT))
+
+    status_frame = ScrollTextFrame(left_centre_frame, SPACING, "Status", 12, 30)
+    left_centre_frame.pack(side=tkinter.LEFT, padx=SPACING, pady=SPACING)
+
+    '''
+    OUTPUT DATA
+    '''
+    messages_frame = ScrollTextFrame(centre_frame, SPACING, "Messages sent/received", 20, 60)
+
+    '''
+    NETWORK VIEW
+    '''
+    network_data_frame = ScrollTextFrame(centre_frame, SPACING, "Network", 20, 30)
+
+
+    '''
+    CONTROL BUTTONS
+    '''
+    bottom_frame = tkinter.Frame(root, borderwidth=1)
+    bottom_frame.configure(bg=BACKGROUND)
+    bottom_frame.pack(padx=SPACING, pady=SPACING)
+
+    stop_button = tkinter.Button(bottom_frame, text="STOP", command=stop_callback)
+    stop_button.pack(side=tkinter.RIGHT, padx=SPACING, pady=SPACING)
+
+    # The start button kickstarts this whole thing
+    start_button = tkinter.Button(bottom_frame, text="START", command=start_callback)
+    start_button.pack(side=tkinter.RIGHT)
+
+    root.protocol("WM_DELETE_WINDOW", on_closing)
+
+    try:
+        while True:
+            # on_closing runs inside root.update() and destroys the widgets,
+            # so stop before touching them again
+            if STATE == 'ended':
+                break
+
+            if STATE == 'starting':
+                status_frame.textbox.insert(tkinter.END, 'Starting\n')
+                try:
+                    mqttClient = serial_relay.setup()
+                    mqttClient.loop_start()
+                    STATE = 'running'
+                except Exception as e:
+                    serial_relay.share(e, error=True)
+                    try:
+                        serial_relay.clean_up(mqttClient)
+                    except:
+                        pass
+                    STATE = 'waiting'
+
+
+            elif STATE == 'running':
+                mqttClient = serial_relay.mainloop(mqttClient)
+
+            # Both buffers are bounded, so anything we have not shown by now
+            # has been dropped rather than using up memory
+            messages_frame.show(serial_relay.messagebox)
+            status_frame.show(serial_relay.statusbox)
+
+            root.update()
+
+    finally:
+        if STATE == 'running':
+            serial_relay.clean_up(mqttClient)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed summaries of a columnar stream (see columnar_store.py) at fixed
+resolutions, so that dashboards can plot days of data without reading every
+sample.
+
+A rollup at resolution r has a bucket for every r seconds (aligned to
+multiples of r) that holds samples:
+
+    t       start of the bucket
+    count   number of samples
+    min, max, sum
+
+(the mean is sum / count). Complete buckets are stored in rollup-<r>.bin next
+to the stream's chunks, and rollup-<r>.json records how many buckets there
+are and how many of the stream's samples they cover. The last bucket is not
+stored until a later sample shows it is complete; it is summarised from the
+raw samples when read, which touches at most r seconds of them.
+"""
+
+import json
+import os
+import numpy as np
+
+ROLLUP_DTYPE = np.dtype([('t', '<f8'), ('count', '<i8'),
+                         ('min', '<f8'), ('max', '<f8'), ('sum', '<f8')])
+
+
+def summarise(times, values, resolution):
+    '''
+    Returns an array of ROLLUP_DTYPE buckets of the given samples, which must
+    be in time order
+    '''
+    if len(times) == 0:
+        return np.empty(0, ROLLUP_DTYPE)
+    values = np.asarray(values, dtype=np.float64)
+    buckets = np.floor(np.asarray(times) / resolution) * resolution
+    starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+    summary = np.empty(len(starts), ROLLUP_DTYPE)
+    summary['t'] = buckets[starts]
+    summary['count'] = np.diff(np.append(starts, len(times)))
+    summary['min'] = np.minimum.reduceat(values, starts)
+    summary['max'] = np.maximum.reduceat(values, starts)
+    summary['sum'] = np.add.reduceat(values, starts)
+    return summary
+
+
+class Rollup():
+    '''
+    The stored buckets of one stream at one resolution
+    '''
+    def __init__(self, directory, resolution):
+        self.directory = directory
+        self.resolution = resolution
+        base = os.path.join(directory, 'rollup-%g' % resolution)
+        self.path = base + '.bin'
+        self.state_path = base + '.json'
+        self.refresh()
+
+    def refresh(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                state = json.load(f)
+            self.samples = state['samples']
+            self.count = state['buckets']
+        else:
+            self.samples = 0
+            self.count = 0
+
+    def __save(self):
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump({'samples': self.samples, 'buckets': self.count}, f)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def update(self, stream):
+        '''
+        Summarises the stream's samples that have arrived since the last
+        update. Only the writer of the stream should call this.
+        '''
+        # Drop buckets written after the state was last saved
+        size = self.count * ROLLUP_DTYPE.itemsize
+        if os.path.exists(self.path) and os.path.getsize(self.path) != size:
+            with open(self.path, 'r+b') as f:
+                f.truncate(size)
+        times, values = stream.read(self.samples)
+        complete = summarise(times, values, self.resolution)[:-1]
+        if len(complete) == 0:
+            return
+        with open(self.path, 'ab') as f:
+            f.write(complete.tobytes())
+        self.samples += int(complete['count'].sum())
+        self.count += len(complete)
+        self.__save()
+
+    def stored(self):
+        '''
+        Returns the stored (complete) buckets as a memmap
+        '''
+        if self.count == 0:
+            return np.empty(0, ROLLUP_DTYPE)
+        return np.memmap(self.path, dtype=ROLLUP_DTYPE, mode='r', shape=(self.count,))
+
+    def read(self, stream, start=None, end=None):
+        '''
+        Returns the buckets starting in [start, end), counting the bucket that
+        start falls in. The last bucket may still be filling up.
+        '''
+        if start is not None:
+            start = np.floor(start / self.resolution) * self.resolution
+        stored = self.stored()
+        first = 0 if start is None else np.searchsorted(stored['t'], start, 'left')
+        last = len(stored) if end is None else np.searchsorted(stored['t'], end, 'left')
+        buckets = stored[first:last]
+        if last == len(stored):
+            times, values = stream.read(self.samples)
+            pending = summarise(times, values, self.resolution)
+            if start is not None:
+                pending = pending[pending['t'] >= start]
+            if end is not None:
+                pending = pending[pending['t'] < end]
+            if len(pending):
+                buckets = np.concatenate((buckets, pending))
+        return buckets
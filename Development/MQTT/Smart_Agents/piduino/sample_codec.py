@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+Lossless compression of (timestamp, value) samples, in the style of
+Facebook's Gorilla: timestamps are stored as deltas of deltas and values as
+deltas (integers) or XORs with the previous value (floats). Sensor readings
+change slowly and arrive at near constant intervals, so most of these are
+zero or small.
+
+Gorilla writes a variable length code for every sample, which has to be
+decoded one sample at a time. Here the samples are cut into blocks of up to
+BLOCK_SIZE, and every residual in a block is packed with the same number of
+bits (enough for the block's largest), so a block is decoded with a few
+vectorised numpy operations instead: unpacking, then a cumulative sum or XOR.
+
+An encoded buffer is a header (MAGIC, then the number of samples) followed
+by blocks. A block starts with its number of samples and the encodings used:
+
+    timestamps  TIME_DOD    whole microseconds: the first timestamp, the first
+                            delta and zigzagged deltas of deltas
+                TIME_XOR    anything else: float64 bits XORed with the
+                            previous timestamp's
+    values      VALUE_DELTA integers (including floats with whole values):
+                            the first value and zigzagged deltas
+                VALUE_SCALED
+                            decimals (e.g. temperatures to 0.1 degrees): as
+                            VALUE_DELTA after multiplying by a power of ten
+                VALUE_XOR   float64 bits XORed with the previous value's
+
+XORs are stored without the trailing zero bits common to the whole block.
+
+    data = encode(times, values)
+    times, values = decode(data, value_dtype='<i2')
+"""
+
+import struct
+import numpy as np
+
+MAGIC = b'PDX1'
+BLOCK_SIZE = 1024
+
+TIME_DOD = 0
+TIME_XOR = 1
+VALUE_DELTA = 0
+VALUE_XOR = 1
+VALUE_SCALED = 2
+# The most decimal places VALUE_SCALED is tried with
+MAX_DECIMALS = 6
+
+HEADER = struct.Struct('<4sI')
+BLOCK_HEADER = struct.Struct('<HBB')
+FIRST = struct.Struct('<q')
+DECIMALS = struct.Struct('<B')
+PACKED = struct.Struct('<BB')
+
+TICKS_PER_SECOND = 1000000
+# Floats with whole values this small are exactly representable as integers
+MAX_WHOLE_FLOAT = 2 ** 53
+
+U64 = np.dtype('<u8')
+I64 = np.dtype('<i8')
+BIT_SHIFTS = np.arange(64, dtype=np.uint64)
+BYTE_OFFSETS = np.arange(8)
+
+
+class DecodeError(Exception):
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
+def zigzag(signed):
+    # Maps 0, -1, 1, -2, ... to 0, 1, 2, 3, ... so small values have few bits
+    signed = signed.astype(I64)
+    return ((signed << 1) ^ (signed >> 63)).view(U64)
+
+
+def unzigzag(unsigned):
+    return ((unsigned >> np.uint64(1)) ^ (np.uint64(0) - (unsigned & np.uint64(1)))).view(I64)
+
+
+def pack(unsigned):
+    '''
+    Returns (shift, width, bytes): the values with their common trailing zero
+    bits shifted off, packed width bits each, least significant first
+    '''
+    combined = int(np.bitwise_or.reduce(unsigned)) if len(unsigned) else 0
+    if combined == 0:
+        return 0, 0, b''
+    shift = (combined & -combined).bit_length() - 1
+    width = (combined >> shift).bit_length()
+    bits = (unsigned[:, None] >> (BIT_SHIFTS[:width] + np.uint64(shift))) & np.uint64(1)
+    return shift, width, np.packbits(bits.astype(np.uint8).ravel(), bitorder='little').tobytes()
+
+
+def unpack(data, offset, count, shift, width):
+    '''
+    Returns count values of width bits packed at offset (see pack) as uint64,
+    and the offset after them
+    '''
+    size = (count * width + 7) // 8
+    if width == 0:
+        return np.zeros(count, U64), offset
+    if offset + size > len(data):
+        raise DecodeError('Packed values are cut short')
+    packed = np.frombuffer(data, np.uint8, size, offset)
+    if width <= 57:
+        # Read the 8 bytes holding each value as a little endian integer,
+        # then shift and mask. Values start at most 7 bits into a byte, so
+        # up to 57 bits fit.
+        padded = np.concatenate((packed, np.zeros(8, np.uint8)))
+        starts = np.arange(count, dtype=np.int64) * width
+        words = padded[(starts >> 3)[:, None] + BYTE_OFFSETS].view(U64).ravel()
+        values = (words >> (starts & 7).astype(np.uint64)) & np.uint64((1 << width) - 1)
+    else:
+        bits = np.unpackbits(packed, bitorder='little')[:count * width]
+        bits = bits.reshape(count, width).astype(np.uint64)
+        values = np.bitwise_or.reduce(bits << BIT_SHIFTS[:width], axis=1)
+    return values << np.uint64(shift), offset + size
+
+
+def _packed(unsigned):
+    shift, width, packed = pack(unsigned)
+    return PACKED.pack(shift, width) + packed
+
+
+def _unpacked(data, offset, count):
+    if offset + PACKED.size > len(data):
+        raise DecodeError('Block is cut short')
+    shift, width = PACKED.unpack_from(data, offset)
+    if width > 64 or shift + width > 64:
+        raise DecodeError('Bad bit width')
+    return unpack(data, offset + PACKED.size, count, shift, width)
+
+
+def _first(data, offset):
+    if offset + FIRST.size > len(data):
+        raise DecodeError('Block is cut short')
+    return FIRST.unpack_from(data, offset)[0], offset + FIRST.size
+
+
+def whole_values(values):
+    '''
+    Returns (decimals, integers) such that integers / 10 ** decimals are
+    exactly the values, or (None, None)
+    '''
+    if values.dtype.kind in 'iub':
+        return 0, values.astype(I64)
+    if values.dtype.kind != 'f' or not np.all(np.isfinite(values)):
+        return None, None
+    # Negative zero is lost as an integer
+    if np.any(np.signbit(values) & (values == 0)):
+        return None, None
+    values = values.astype(np.float64)
+    for decimals in range(MAX_DECIMALS + 1):
+        scale = 10 ** decimals
+        scaled = np.round(values * scale)
+        if not np.all(np.abs(scaled) < MAX_WHOLE_FLOAT):
+            break
+        if np.all((scaled / scale if decimals else scaled) == values):
+            return decimals, scaled.astype(I64)
+    return None, None
+
+
+def encode_block(times, values):
+    times = np.asarray(times, dtype=np.float64)
+    count = len(times)
+    parts = []
+
+    ticks = np.round(times * TICKS_PER_SECOND)
+    if np.all(np.abs(ticks) < MAX_WHOLE_FLOAT) and np.all(ticks / TICKS_PER_SECOND == times):
+        time_mode = TIME_DOD
+        ticks = ticks.astype(I64)
+        deltas = np.diff(ticks)
+        parts.append(FIRST.pack(int(ticks[0])))
+        parts.append(FIRST.pack(int(deltas[0]) if count > 1 else 0))
+        parts.append(_packed(zigzag(np.diff(deltas))))
+    else:
+        time_mode = TIME_XOR
+        bits = times.view(U64)
+        parts.append(FIRST.pack(int(bits[:1].view(I64)[0])))
+        parts.append(_packed(bits[1:] ^ bits[:-1]))
+
+    values = np.asarray(values)
+    decimals, whole = whole_values(values)
+    if whole is not None:
+        if decimals:
+            value_mode = VALUE_SCALED
+            parts.append(DECIMALS.pack(decimals))
+        else:
+            value_mode = VALUE_DELTA
+        parts.append(FIRST.pack(int(whole[0])))
+        parts.append(_packed(zigzag(np.diff(whole))))
+    else:
+        value_mode = VALUE_XOR
+        bits = values.astype(np.float64).view(U64)
+        parts.append(FIRST.pack(int(bits[:1].view(I64)[0])))
+        parts.append(_packed(bits[1:] ^ bits[:-1]))
+
+    return BLOCK_HEADER.pack(count, time_mode, value_mode) + b''.join(parts)
+
+
+def decode_block(data, offset, value_dtype):
+    '''
+    Returns (timestamps, values, offset after the block)
+    '''
+    if offset + BLOCK_HEADER.size > len(data):
+        raise DecodeError('Block is cut short')
+    count, time_mode, value_mode = BLOCK_HEADER.unpack_from(data, offset)
+    offset += BLOCK_HEADER.size
+    if count == 0:
+        raise DecodeError('Empty block')
+
+    first, offset = _first(data, offset)
+    if time_mode == TIME_DOD:
+        first_delta, offset = _first(data, offset)
+        residuals, offset = _unpacked(data, offset, count - 2 if count > 1 else 0)
+        ticks = np.empty(count, I64)
+        ticks[0] = first
+        if count > 1:
+            deltas = np.empty(count - 1, I64)
+            deltas[0] = first_delta
+            np.cumsum(unzigzag(residuals), out=deltas[1:])
+            deltas[1:] += first_delta
+            np.cumsum(deltas, out=ticks[1:])
+            ticks[1:] += first
+        times = ticks / TICKS_PER_SECOND
+    elif time_mode == TIME_XOR:
+        residuals, offset = _unpacked(data, offset, count - 1)
+        bits = np.empty(count, U64)
+        bits[0] = np.int64(first).view(U64)
+        bits[1:] = residuals
+        times = np.bitwise_xor.accumulate(bits).view(np.float64)
+    else:
+        raise DecodeError('Unknown timestamp encoding %d' % time_mode)
+
+    if value_mode == VALUE_SCALED:
+        if offset + DECIMALS.size > len(data):
+            raise DecodeError('Block is cut short')
+        decimals = DECIMALS.unpack_from(data, offset)[0]
+        offset += DECIMALS.size
+    first, offset = _first(data, offset)
+    if value_mode in (VALUE_DELTA, VALUE_SCALED):
+        residuals, offset = _unpacked(data, offset, count - 1)
+        whole = np.empty(count, I64)
+        whole[0] = 0
+        np.cumsum(unzigzag(residuals), out=whole[1:])
+        whole += first
+        if value_mode == VALUE_SCALED:
+            values = (whole / 10 ** decimals).astype(value_dtype)
+        else:
+            values = whole.astype(value_dtype)
+    elif value_mode == VALUE_XOR:
+        residuals, offset = _unpacked(data, offset, count - 1)
+        bits = np.empty(count, U64)
+        bits[0] = np.int64(first).view(U64)
+        bits[1:] = residuals
+        values = np.bitwise_xor.accumulate(bits).view(np.float64).astype(value_dtype)
+    else:
+        raise DecodeError('Unknown value encoding %d' % value_mode)
+    return times, values, offset
+
+
+def encode(times, values, block_size=BLOCK_SIZE):
+    '''
+    Returns the samples encoded as bytes
+    '''
+    times = np.asarray(times, dtype=np.float64).ravel()
+    values = np.asarray(values).ravel()
+    if len(times) != len(values):
+        raise ValueError('There must be a value for every timestamp')
+    if not 0 < block_size <= 65535:
+        raise ValueError('block_size must be between 1 and 65535')
+    blocks = [HEADER.pack(MAGIC, len(times))]
+    for start in range(0, len(times), block_size):
+        blocks.append(encode_block(times[start:start + block_size],
+                                   values[start:start + block_size]))
+    return b''.join(blocks)
+
+
+def decode(data, value_dtype='<f8'):
+    '''
+    Returns (timestamps, values) arrays of encoded samples. Raises
+    DecodeError if the data is not an encoding or is damaged.
+    '''
+    if len(data) < HEADER.size:
+        raise DecodeError('Too short')
+    magic, count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise DecodeError('Not encoded samples')
+    times = np.empty(count, np.float64)
+    values = np.empty(count, value_dtype)
+    offset = HEADER.size
+    position = 0
+    while position < count:
+        block_times, block_values, offset = decode_block(data, offset, value_dtype)
+        end = position + len(block_times)
+        if end > count:
+            raise DecodeError('More samples than the header says')
+        times[position:end] = block_times
+        values[position:end] = block_values
+        position = end
+    return times, values
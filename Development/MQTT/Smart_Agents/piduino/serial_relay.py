@@ -1,14 +1,33 @@
+'''
+Relays JSON messages between Arduinos on serial ports and an MQTT broker.
+
+Usage:
+    python3 serial_relay.py [--config relay.ini] [--gui]
+
+Without --gui the relay runs headless and never imports tkinter. Settings
+default to the values below and can be overridden with a config file (see
+relay.ini.example).
+'''
+import sys
 import time
 import threading
 import logging
+import json
+import argparse
+import configparser
+from collections import deque
 import paho.mqtt.client as Mqtt
 import piduino
-import tkinter
+import batching
+import aggregation
+import store_forward
+from writer_pool import WriterPool
+import metrics
 from sys import version_info
 
 assert version_info >= (3, 0)
 
-HOSTNAME = <name of your host machine>
+HOSTNAME = 'localhost'
 PORT = 1883
 AGENTNAME = 'Emma_PC'
 
@@ -20,24 +39,138 @@ STATUS_CONNECTED = "C"
 STATUS_DISCONNECTED_GRACE = "DG"
 STATUS_DISCONNECTED_UNGRACE = "DU"
 
-logging.basicConfig(level=logging.INFO)
+# Optional batching of sensor readings. Keys are '<device>/<topic>' patterns
+# (MQTT wildcards allowed), values give the batch size and the maximum time in
+# seconds that a reading may wait before it is published, e.g.
+#   BATCHING = {'+/LDR': {'max_count': 50, 'max_delay': 1.0}}
+# Batches are published on '<topic>/batch' (see batching.py for the format).
+# Readings that match no pattern are published individually.
+BATCHING = {}
+
+# Optional aggregation of sensor readings at the edge. Keys are patterns as for
+# BATCHING. For a matching topic, only summaries (count/min/max/mean/last) of
+# each window of readings are published, on '<topic>/agg', and/or readings are
+# only published when they change by more than the deadband, e.g.
+#   AGGREGATION = {'+/LDR': {'window': 10, 'hop': 2, 'deadband': 5}}
+# See aggregation.py for details. If RAW_DIR is set, the raw readings of
+# aggregated topics are kept there as CSV files.
+AGGREGATION = {}
+RAW_DIR = None
+
+# Optional store-and-forward queue. If QUEUE_DIR is set, readings are written
+# to disk before being sent and are drained to the broker at up to DRAIN_RATE
+# messages per second, so that nothing is lost during broker outages or
+# restarts. If it is None, we rely on paho's in-memory buffering.
+QUEUE_DIR = None
+QUEUE_MAX_BYTES = 256 * 1024 * 1024
+QUEUE_FSYNC = 'interval'
+DRAIN_RATE = 100
+
+# Relay metrics (throughput, errors, latency, queue depths) are published as
+# JSON on '<agent>/private/metrics' every METRICS_INTERVAL seconds (0 to turn
+# off), and served as text on http://127.0.0.1:<METRICS_PORT>/metrics if
+# METRICS_PORT is set.
+METRICS_INTERVAL = 60
+METRICS_PORT = None
+
+# Serial ports to relay. If empty, we scan for Arduinos every SCAN_INTERVAL
+# seconds
+SERIAL_PORTS = []
+SCAN_INTERVAL = 5.0
+# If set, Arduinos are asked during the handshake to switch to binary framing
+# at this baud rate (see binary_framing.py). Arduinos that do not support it
+# carry on sending JSON at 9600 baud.
+BINARY_BAUD = None
+# Pause between iterations of the main loop, in seconds
+LOOP_INTERVAL = 0.01
 
+logging.basicConfig(level=logging.INFO)
 
-SPACING = 2
-BACKGROUND = 'LightSteelBlue1'
-FONT = 'Helvetica'
 
 MODE = 'NoGUI'
 LOGGING = True
 VERBOSE = False
-STATE = 'waiting'
 
-def share(info, error=False, message=False):
-    global VERBOSE
-    global LOGGING
-    global MODE
+# Lines waiting to be shown by the GUI (see relay_gui.py). These are bounded,
+# so the oldest lines are dropped if nobody is reading them.
+GUI_BUFFER_LINES = 500
+statusbox = deque(maxlen=GUI_BUFFER_LINES)
+messagebox = deque(maxlen=GUI_BUFFER_LINES)
+
+def load_config(path):
+    '''
+    Overrides the settings at the top of this file with those in an INI style
+    config file (see relay.ini.example). Settings that are missing from the
+    file keep their defaults.
+    '''
+    global HOSTNAME
+    global PORT
+    global PROTOCOL
+    global AGENTNAME
+    global SERIAL_PORTS
+    global SCAN_INTERVAL
+    global BINARY_BAUD
+    global LOOP_INTERVAL
+    global GUI_BUFFER_LINES
+    global BATCHING
+    global AGGREGATION
+    global RAW_DIR
+    global QUEUE_DIR
+    global QUEUE_MAX_BYTES
+    global QUEUE_FSYNC
+    global DRAIN_RATE
+    global METRICS_INTERVAL
+    global METRICS_PORT
     global statusbox
     global messagebox
+
+    config = configparser.ConfigParser()
+    # Topic names are case sensitive
+    config.optionxform = str
+    if not config.read(path):
+        raise IOError('Unable to read config file ' + path)
+
+    HOSTNAME = config.get('broker', 'hostname', fallback=HOSTNAME)
+    PORT = config.getint('broker', 'port', fallback=PORT)
+    PROTOCOL = config.get('broker', 'protocol', fallback=PROTOCOL)
+
+    AGENTNAME = config.get('agent', 'name', fallback=AGENTNAME)
+    ports = config.get('agent', 'serial_ports', fallback='')
+    SERIAL_PORTS = [p.strip() for p in ports.split(',') if p.strip()]
+    SCAN_INTERVAL = config.getfloat('agent', 'scan_interval', fallback=SCAN_INTERVAL)
+    BINARY_BAUD = config.getint('agent', 'binary_baud', fallback=BINARY_BAUD)
+    LOOP_INTERVAL = config.getfloat('agent', 'loop_interval', fallback=LOOP_INTERVAL)
+    GUI_BUFFER_LINES = config.getint('agent', 'gui_buffer_lines', fallback=GUI_BUFFER_LINES)
+    statusbox = deque(maxlen=GUI_BUFFER_LINES)
+    messagebox = deque(maxlen=GUI_BUFFER_LINES)
+
+    if config.has_section('batching'):
+        BATCHING = {}
+        for pattern, value in config.items('batching'):
+            max_count, max_delay = value.split(',')
+            BATCHING[pattern] = {'max_count': int(max_count),
+                                 'max_delay': float(max_delay)}
+
+    if config.has_section('aggregation'):
+        AGGREGATION = {}
+        for pattern, value in config.items('aggregation'):
+            options = {}
+            for option in value.split(','):
+                key, number = option.split('=')
+                options[key.strip()] = float(number)
+            AGGREGATION[pattern] = options
+    RAW_DIR = config.get('agent', 'raw_dir', fallback=RAW_DIR) or None
+
+    QUEUE_DIR = config.get('queue', 'directory', fallback=QUEUE_DIR) or None
+    QUEUE_MAX_BYTES = config.getint('queue', 'max_bytes', fallback=QUEUE_MAX_BYTES)
+    QUEUE_FSYNC = config.get('queue', 'fsync', fallback=QUEUE_FSYNC)
+    DRAIN_RATE = config.getfloat('queue', 'drain_rate', fallback=DRAIN_RATE)
+
+    METRICS_INTERVAL = config.getfloat('metrics', 'interval', fallback=METRICS_INTERVAL)
+    METRICS_PORT = config.getint('metrics', 'port', fallback=METRICS_PORT)
+
+def share(info, error=False, message=False):
+    info = str(info)
     if VERBOSE:
         if error:
             print("ERROR: " + info)
@@ -111,8 +244,9 @@ def handle_message(mqttClient, userdata, message):
 
 
 def handle_publish(mqttClient, userdata, mid):
-     
-    pass
+    # Let the store-and-forward queue know that a message has been delivered
+    if uplink is not None:
+        uplink.handle_publish(mid)
 
 
 def handle_subscribe(mqttClient, userdata, mid, granted_qos):
@@ -124,12 +258,144 @@ def handle_disconnect(mqttClient, userdata, rc):
     global connected
     print('HANDLE DISCONNECT CALLED')
     connected = False
+    if uplink is not None:
+        # Unacknowledged messages will be sent again after reconnecting
+        uplink.handle_disconnect()
     if shouldBeConnected:
         share("Disconnected from MQTT ungracefully.", error=True)
     else:
         mqttClient.loop_stop()
         share("Disconnected from MQTT gracefully.")
 
+def publish_reading(mqttClient, device, message, received):
+    '''
+    Publishes a single reading from an edge device, which was read from the
+    serial port at time received. If aggregation is enabled for its topic,
+    the reading is summarised or filtered first; if batching is enabled, the
+    reading joins a batch.
+    '''
+    now = received
+    outputs = aggregator.add(device.name, message["topic"], message["payload"], now)
+    if outputs is None:
+        outputs = [message["payload"]]
+    elif RAW_DIR is not None:
+        keep_raw(device, message, now)
+
+    for output in outputs:
+        publish_output(mqttClient, str(device.name), message["topic"], output, now)
+
+def publish_output(mqttClient, name, sensor_topic, output, timestamp):
+    '''
+    Publishes a reading or window summary returned by the aggregator (or a
+    reading that is not aggregated)
+    '''
+    if isinstance(output, dict):
+        publish_aggregates(mqttClient, [(name, sensor_topic, output)])
+    elif not batcher.add(name, sensor_topic, output, timestamp):
+        topic = AGENTNAME + '/public/' + name +'/input/' + sensor_topic
+        payload = str(int(timestamp)) + ' ' + str(output)
+        publish_uplink(mqttClient, topic, payload, received=timestamp)
+
+def publish_flushed(mqttClient, flushed):
+    '''
+    Publishes the partial windows and held back readings returned by
+    aggregator.flush. Readings for batched topics join their batches, so
+    flush the batcher afterwards.
+    '''
+    for name, sensor_topic, output, timestamp in flushed:
+        publish_output(mqttClient, name, sensor_topic, output, timestamp)
+
+def keep_raw(device, message, now):
+    '''
+    Keeps a copy of a reading that is not being published in full
+    '''
+    row = [str(int(now)), str(message["payload"])]
+    rawWriters.write(AGENTNAME + '-' + str(device.name) + '-' + message["topic"], row, now)
+
+def publish_aggregates(mqttClient, aggregates):
+    '''
+    Publishes window summaries returned by the aggregator
+    '''
+    for name, sensor_topic, summary in aggregates:
+        topic = AGENTNAME + '/public/' + name + '/input/' + sensor_topic + '/agg'
+        publish_uplink(mqttClient, topic, json.dumps(summary, separators=(',', ':')))
+
+def publish_uplink(mqttClient, topic, payload, received=None):
+    '''
+    Sends sensor data towards the broker, through the store-and-forward queue
+    if there is one. received is the time that the (oldest) reading in the
+    payload was read from the serial port.
+    '''
+    if uplink is not None:
+        # The latency is observed when the queue publishes the record
+        uplink.put(topic, payload, qos=1, received=received)
+    else:
+        # The mqtt code takes care of buffering messages automatically
+        mqttClient.publish(topic, payload, qos=1)
+        if received is not None:
+            relayMetrics['latency'].observe(time.time() - received)
+    relayMetrics['published'].inc()
+    relayMetrics['published_bytes'].inc(len(payload))
+
+def setup_metrics():
+    '''
+    Creates the relay's metrics registry, including a collector for the
+    statistics kept by each serial device
+    '''
+    registry = metrics.Registry(prefix='relay_')
+    relayMetrics = {
+        'readings': registry.counter('readings_total', 'Readings received from edge devices'),
+        'published': registry.counter('published_total', 'Messages handed to the uplink'),
+        'published_bytes': registry.counter('published_bytes_total', 'Payload bytes handed to the uplink'),
+        'read_errors': registry.counter('read_errors_total', 'Failed reads from edge devices'),
+        'reconnects': registry.counter('reconnects_total', 'Edge devices reconnected after being lost'),
+        'latency': registry.histogram('serial_to_publish_seconds',
+                                      'Time from reading a frame from the serial port to publishing it'),
+    }
+    registry.gauge('edge_devices', 'Connected edge devices',
+                   lambda: len([d for d in connectedEdgeDevices if d.verified]))
+    registry.gauge('batched_readings', 'Readings waiting in batches', lambda: batcher.pending())
+    if uplink is not None:
+        registry.gauge('queue_backlog_bytes', 'Bytes in the store-and-forward queue',
+                       lambda: uplink.queue.backlog_bytes())
+        registry.gauge('queue_inflight', 'Messages awaiting acknowledgement',
+                       lambda: uplink.inflight_count())
+
+    def collect_devices():
+        samples = []
+        for device in list(connectedEdgeDevices):
+            labels = {'device': str(device.name), 'port': device.comport}
+            for key, value in device.stats.as_dict().items():
+                if key == 'last_frame_time':
+                    continue
+                if key not in ('connects',):
+                    key = key + '_total'
+                samples.append(('device_' + key, labels, value))
+            try:
+                # Bytes waiting in the OS buffer: if this keeps growing, the
+                # relay is not keeping up with the device
+                samples.append(('device_serial_waiting_bytes', labels, device.ser.in_waiting))
+            except Exception:
+                pass
+        return samples
+    registry.add_collector(collect_devices)
+    return registry, relayMetrics
+
+def publish_metrics(mqttClient):
+    '''
+    Publishes a snapshot of the metrics, including counter rates
+    '''
+    snapshot = metricsRegistry.snapshot()
+    mqttClient.publish(TOPIC_METRICS, json.dumps(snapshot, separators=(',', ':')), qos=0)
+
+def publish_batches(mqttClient, batches):
+    '''
+    Publishes batches returned by the batcher
+    '''
+    for name, sensor_topic, payload, t0 in batches:
+        topic = AGENTNAME + '/public/' + name + '/input/' + sensor_topic + '/batch'
+        publish_uplink(mqttClient, topic, payload, received=t0)
+
 '''
 ARDUINO THREADS:
     The threads below are called to handle the smart agents connections with its
@@ -147,22 +413,27 @@ def handshake_protocol(device, timeout=5):
     
     # Request a handshake
     share('Sending handshake request to new device')
-    flag = device.handshake_request()
+    flag = device.handshake_request(binary_baud=BINARY_BAUD)
     if flag:
         raise flag
         
-    t0 = time.time()
-    # Wait for a response
-    while time.time() - t0 < timeout:
-        if device.ready():
-            flag, message = device.receive_json()
-            if type(flag) == piduino.NotConnectedError:
-                # The device has been disconnected!
-                return None
-            else:
-                if message != '':
-                    if message["topic"] == "handshake":
-                        return message["payload"]
+    deadline = piduino.Deadline(timeout)
+    # Wait for a response. The device may still be sending readings from
+    # before the handshake, so keep reading until the deadline.
+    while not deadline.expired():
+        flag, message = device.receive_json(timeout=deadline.remaining())
+        if type(flag) == piduino.NotConnectedError:
+            # The device has been disconnected!
+            return None
+        elif flag is None:
+            if message.get("topic") == "handshake":
+                flag = device.accept_handshake(message)
+                if flag:
+                    share('Unable to switch to binary framing: ' + str(flag), error=True)
+                    return None
+                if device.binary:
+                    share('Using binary framing at ' + str(device.baudrate) + ' baud')
+                return message["payload"]
     return None
             
 def connection_thread(device, mqttClient):
@@ -214,6 +485,16 @@ def setup():
     global shouldBeConnected
     global runningThreads
     global connected
+    global lastScan
+    global batcher
+    global aggregator
+    global metricsRegistry
+    global relayMetrics
+    global metricsServer
+    global lastMetrics
+    global seenComports
+    global rawWriters
+    global uplink
     
     global TOPIC_ROOT
     global TOPIC_STATUS
@@ -221,6 +502,7 @@ def setup():
     global TOPIC_DISCOVERY
     global TOPIC_HELLO
     global TOPIC_PING
+    global TOPIC_METRICS
     
     TOPIC_ROOT = AGENTNAME
     TOPIC_STATUS = AGENTNAME + "/private/status"
@@ -228,11 +510,36 @@ def setup():
     TOPIC_DISCOVERY = "broker-services/discover" 
     TOPIC_HELLO = "broker-services/hello/" + AGENTNAME
     TOPIC_PING = AGENTNAME + '/private/ping'
+    TOPIC_METRICS = AGENTNAME + '/private/metrics'
     # Assume connected unless proved otherwise
     connected = False
     connectedEdgeDevices = []
     shouldBeConnected = False
     runningThreads = []
+    lastScan = 0
+    batcher = batching.Batcher(BATCHING)
+    aggregator = aggregation.Aggregation(AGGREGATION)
+    if RAW_DIR is None:
+        rawWriters = None
+    else:
+        rawWriters = WriterPool(RAW_DIR, max_open=64, rotate_interval=86400)
+    if QUEUE_DIR is None:
+        uplink = None
+    else:
+        queue = store_forward.SegmentQueue(QUEUE_DIR, max_bytes=QUEUE_MAX_BYTES,
+                                           fsync=QUEUE_FSYNC)
+        uplink = store_forward.StoreAndForward(queue, rate=DRAIN_RATE)
+
+    metricsRegistry, relayMetrics = setup_metrics()
+    if uplink is not None:
+        uplink.latency = relayMetrics['latency']
+    lastMetrics = time.time()
+    seenComports = set()
+    if METRICS_PORT:
+        metricsServer = metrics.MetricsServer(metricsRegistry, METRICS_PORT)
+        metricsServer.start()
+    else:
+        metricsServer = None
 
     if PROTOCOL ==  '3.1':
         mqttClient = Mqtt.Client(protocol=Mqtt.MQTTv31)
@@ -261,6 +568,8 @@ def mainloop(mqttClient):
     global runningThreads
     global connected
     global shouldBeConnected
+    global lastScan
+    global lastMetrics
 
     # Fix connection NOT NEEDED
     if not connected and shouldBeConnected:
@@ -275,14 +584,23 @@ def mainloop(mqttClient):
                                    str(device.name) + ' ' + STATUS_CONNECTED, qos=1)
     
     # Make connections to arduinos
-    # Check for serial connections to suitable devices
-    comports = piduino.comport_scan('Arduino')
-    
+    # Check for serial connections to suitable devices. Scanning is slow, so
+    # only do it every SCAN_INTERVAL seconds
+    if SERIAL_PORTS:
+        comports = SERIAL_PORTS
+    elif time.time() - lastScan >= SCAN_INTERVAL:
+        comports = piduino.comport_scan('Arduino')
+        lastScan = time.time()
+    else:
+        comports = []
     
     for comport in comports:
         # Check if we are already connected to this device
         if comport not in [d.comport for d in connectedEdgeDevices]:
             # If not, create a new device manager
+            if comport in seenComports:
+                relayMetrics['reconnects'].inc()
+            seenComports.add(comport)
             device = piduino.SerialDevice(comport)
             connectedEdgeDevices.append(device)
             
@@ -314,23 +632,43 @@ def mainloop(mqttClient):
                 mqttClient.unsubscribe(AGENTNAME + '/public/' + str(device.name) + '/output/#')
                 # Flag the arduino as disconnected
                 device.error = True    
+                # Don't hold on to readings that we already have
+                publish_flushed(mqttClient, aggregator.flush(device.name))
+                aggregator.forget(device.name)
+                publish_batches(mqttClient, batcher.forget(device.name))
                 
             if waiting:
                 flag, message = device.receive_json()
                 if flag:
-                    print(flag)
-                    logging.error(flag)
+                    relayMetrics['read_errors'].inc()
+                    share('Read from arduino ' + str(device.name) + ' failed: ' + str(flag), error=True)
                 else:
                     if message != '':
-                        topic = AGENTNAME + '/public/' + str(device.name) +'/input/' + message["topic"]
-                        payload = str(int(time.time())) + ' ' + str(message["payload"])
-
-                        # The mqtt code takes care of buffering messages automatically
-                        mqttClient.publish(topic, payload, qos=1)
+                        relayMetrics['readings'].inc()
+                        publish_reading(mqttClient, device, message,
+                                        device.stats.last_frame_time)
                         
                         # Remember the topic being published by the arduino
                         device.topics.add(message["topic"])
     
+    
+    # Publish summaries of windows that have closed since the last reading
+    publish_aggregates(mqttClient, aggregator.poll(time.time()))
+
+    # Publish any batches that are full or have waited long enough
+    publish_batches(mqttClient, batcher.ready())
+
+    if rawWriters is not None:
+        rawWriters.poll()
+
+    # Send queued readings to the broker
+    if uplink is not None and connected:
+        uplink.drain(mqttClient)
+
+    if METRICS_INTERVAL and time.time() - lastMetrics >= METRICS_INTERVAL:
+        lastMetrics = time.time()
+        if connected:
+            publish_metrics(mqttClient)
             
     # Clean disconnected arduinos out of the list
     connectedEdgeDevices = [d for d in connectedEdgeDevices if not d.error]
@@ -341,6 +679,10 @@ def clean_up(mqttClient):
     global connectedEdgeDevices
     global shouldBeConnected
     print('CLEAN UP')
+    # Send the open aggregation windows and any readings still waiting in a
+    # batch
+    publish_flushed(mqttClient, aggregator.flush())
+    publish_batches(mqttClient, batcher.flush())
     for device in connectedEdgeDevices:
         try:
             device.shutdown()
@@ -362,219 +704,44 @@ def clean_up(mqttClient):
     shouldBeConnected = False
     mqttClient.disconnect()
     mqttClient.loop_stop()
+    if uplink is not None:
+        # Anything not yet acknowledged stays on disk for next time
+        uplink.close()
+    if metricsServer is not None:
+        metricsServer.shutdown()
+    if rawWriters is not None:
+        rawWriters.close()
     share('Shutdown was successful')
 
-'''
-GUI WIDGETS AND CALLBACKS
-'''
-class ScrollTextFrame():
-    def __init__(self, parent, padding, labeltext, height, width):
-        
-        self.frame = tkinter.Frame(parent, borderwidth=1, bg=BACKGROUND,)
-        self.frame.pack(side=tkinter.LEFT, padx=padding, pady=padding)
-
-        self.label = tkinter.Label(self.frame, justify=tkinter.LEFT, padx=SPACING,
-                                   bg=BACKGROUND,
-                                   font=(FONT, 12),
-                                    text=labeltext).pack()
-        self.scrollbar = tkinter.Scrollbar(self.frame)
-        self.scrollbar.pack(side=tkinter.RIGHT, fill=tkinter.Y)
-        self.textbox = tkinter.Text(self.frame, height=height, width=width)
-        self.textbox.pack()
-        
-        # attach listbox to scrollbar
-        self.textbox.config(yscrollcommand=self.scrollbar.set)
-        self.scrollbar.config(command=self.textbox.yview)
-    
-class InputBox():
-    '''
-    Creates an input box with label
+def run():
     '''
-    def __init__(self, parent, labeltext, default=''):
-        self.label = tkinter.Label(parent, justify=tkinter.LEFT,
-                                   bg=BACKGROUND,
-                                  font=(FONT, 12),
-                                  text=labeltext).pack()
-        self.inputbox = tkinter.Entry(parent, width=30)
-        self.inputbox.insert(0, default)
-        self.inputbox.pack()
-
-def start_callback():
+    Runs the relay headless until interrupted
     '''
-    Check input
-    '''
-    global HOSTNAME
-    global AGENTNAME
-    global PORT
-    global PROTOCOL
-    global STATE
-    HOSTNAME = cloud_name_choice.inputbox.get()
-    if HOSTNAME == '':
-        status_frame.textbox.insert(tkinter.END, 'Please fill in a cloud name\n')
-        status_frame.textbox.see(tkinter.END)
-        return None
-    AGENTNAME = user_name_choice.inputbox.get()
-    if AGENTNAME == '':
-        status_frame.textbox.insert(tkinter.END, 'Please fill in a user name\n')
-        status_frame.textbox.see(tkinter.END)
-        return None
-    PORT = port_choice.inputbox.get()
-    if PORT == '':
-        status_frame.textbox.insert(tkinter.END, 'No port chosen: using default (1883)\n')
-        PORT = 1883
-    else:
-        try:
-            PORT = int(PORT)
-        except:
-            status_frame.textbox.insert(tkinter.END, 'Need an integer port: using default (1883)\n')
-            PORT = 1883
-
-    PROTOCOL = '3.1'
-    STATE = 'starting'
-    
-    print('START')
-    
-def stop_callback():
-    global STATE
-    if STATE == 'running':
+    mqttClient = setup()
+    mqttClient.loop_start()
+    try:
+        while True:
+            mqttClient = mainloop(mqttClient)
+            time.sleep(LOOP_INTERVAL)
+    finally:
         clean_up(mqttClient)
-    STATE = 'waiting'
-    share('STOP button pressed')
 
-def on_closing():
-    global STATE
-    if STATE == 'running':
-        clean_up(mqttClient)
-    STATE = 'ended'
-    try:
-        root.destroy()    
-    except:
-        pass
-    
-if __name__ == "__main__":    
-    if MODE != 'GUI':
-        mqttClient = setup()
-        mqttClient.loop_start()
-        try:
-            while True:
-                mqttClient = mainloop(mqttClient)
-        except Exception as e:
-            raise e
-            
-        finally:
-            clean_up(mqttClient)
-            
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Relay Arduino serial data to an MQTT broker')
+    parser.add_argument('--config', help='INI file with broker, agent, batching and queue settings')
+    parser.add_argument('--gui', action='store_true', help='show the tkinter viewer')
+    args = parser.parse_args()
+    if args.config:
+        load_config(args.config)
+
+    if args.gui:
+        # Only import tkinter when it is wanted
+        import relay_gui
+        # This module runs as __main__, with the settings load_config read:
+        # hand it over rather than let relay_gui import a fresh serial_relay
+        relay_gui.run(sys.modules[__name__])
     else:
-        root = tkinter.Tk("Internet of thingies")
-        root.configure(bg=BACKGROUND)
-        
-        title_frame = tkinter.Frame(root, borderwidth=1)
-        title_frame.configure(bg=BACKGROUND)
-        title_frame.pack(padx=SPACING, pady=SPACING)
-        
-        title_label = tkinter.Label(title_frame, justify=tkinter.LEFT, padx=SPACING,
-                                    bg=BACKGROUND,
-                                    font=(FONT, 24),
-                                    text="Internet of Thingies").pack()
-        
-        
-        
-        centre_frame = tkinter.Frame(root, borderwidth=1)
-        centre_frame.configure(bg=BACKGROUND)
-        centre_frame.pack(padx=SPACING, pady=SPACING)
-        
-        '''
-        CONFIGURATION 
-        '''
-        
-        left_centre_frame = tkinter.Frame(centre_frame, bg=BACKGROUND, borderwidth=1)
-        
-        
-        
-        cloud_name_choice = InputBox(left_centre_frame, "Cloud network address", default=<name of your host machine>)
-        user_name_choice = InputBox(left_centre_frame, "This computer's name", default="test")
-        port_choice = InputBox(left_centre_frame, "Cloud network port (advanced)", default='1883')
-        
-        status_frame = ScrollTextFrame(left_centre_frame, SPACING, "Status", 12, 30)
-        left_centre_frame.pack(side=tkinter.LEFT, padx=SPACING, pady=SPACING)
-        
-        '''
-        OUTPUT DATA
-        '''
-        messages_frame = ScrollTextFrame(centre_frame, SPACING, "Messages sent/received", 20, 60)
-        
-        '''
-        NETWORK VIEW
-        '''
-        network_data_frame = ScrollTextFrame(centre_frame, SPACING, "Network", 20, 30)
-        
-        
-        '''
-        CONTROL BUTTONS
-        '''
-        bottom_frame = tkinter.Frame(root, borderwidth=1)
-        bottom_frame.configure(bg=BACKGROUND)
-        bottom_frame.pack(padx=SPACING, pady=SPACING)
-        
-        stop_button = tkinter.Button(bottom_frame, text="STOP", command=stop_callback)
-        stop_button.pack(side=tkinter.RIGHT, padx=SPACING, pady=SPACING)
-        
-        # The start button kickstarts this whole thing
-        start_button = tkinter.Button(bottom_frame, text="START", command=start_callback)
-        start_button.pack(side=tkinter.RIGHT)
-        
-        root.protocol("WM_DELETE_WINDOW", on_closing)
-        
         try:
-            while True:
-                
-                if STATE == 'starting':
-                    status_frame.textbox.insert(tkinter.END, 'Starting\n')
-                    devices = []
-                    threads = []
-                    messagebox = []
-                    statusbox = []
-                    try:
-                        mqttClient = setup()
-                        mqttClient.loop_start()
-                        STATE = 'running'
-                    except Exception as e:
-                        share(e, error=True)
-                        status_frame.textbox.insert(tkinter.END, e + '\n')
-                        status_frame.textbox.see(tkinter.END)
-                        try:
-                            clean_up(mqttClient)
-                        except:
-                            pass
-                        STATE = 'waiting'
-                    
-                     
-                elif STATE == 'running':
-                    try:
-                        for message in messagebox:
-                            messages_frame.textbox.insert(tkinter.END, message+'\n')
-                            messages_frame.textbox.see(tkinter.END)
-                            messagebox = []
-                        for status in statusbox:
-                            status_frame.textbox.insert(tkinter.END, status+'\n')
-                            status_frame.textbox.see(tkinter.END)
-                            statusbox = []
-
-                        mqttClient = mainloop(mqttClient)
-                        status_frame.textbox.see(tkinter.END)
-                    except Exception as e:
-                        raise e
-                if STATE != 'ended':
-                    root.update()
-                else:
-                    break
-        except Exception as e:
-            raise e
-            
-        finally:
-            if STATE == 'running':
-                clean_up(mqttClient)
-
-
-
-                
+            run()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+"""
+Disk-backed store-and-forward queue for the serial relay.
+
+Every reading is appended to a segment file on disk before it is sent to the
+broker. While the broker is reachable the queue is drained at a controlled
+rate; a record is only removed from the queue once the broker has
+acknowledged it (PUBACK for QoS 1). If the broker goes away, or the relay is
+restarted, sending resumes from the oldest unacknowledged record, so delivery
+is at-least-once.
+
+Layout of the queue directory:
+
+    000000000001.seg    append-only segment files, oldest first
+    000000000002.seg
+    cursor              '<segment> <offset>' of the oldest unacknowledged record
+
+Each record is an 8 byte header (big-endian length and CRC32 of the body)
+followed by the body, a JSON list [topic, payload, qos, received], where
+received is the time the (oldest) reading in the payload was read from the
+serial port, or null. Records from before received was added have only the
+first three. The total size of
+the segments is capped; when the cap is reached the oldest segment is
+deleted, even if it has not been sent.
+"""
+
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+
+HEADER = struct.Struct('>II')
+SEGMENT_SUFFIX = '.seg'
+CURSOR_FILE = 'cursor'
+
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_NEVER = 'never'
+
+
+def segment_name(seq):
+    return '%012d' % seq + SEGMENT_SUFFIX
+
+
+class SegmentQueue():
+    '''
+    A durable FIFO queue of (topic, payload, qos, received) records.
+
+    Records are read with get(), which returns a position along with each
+    record. Passing that position to commit() marks everything up to and
+    including the record as delivered. rewind() goes back to the oldest record
+    that has not been committed.
+
+    Parameters
+    ----------
+    directory: str
+        Where to keep the segment files. Created if it does not exist.
+    segment_bytes: int
+        A new segment file is started once the current one reaches this size.
+    max_bytes: int
+        Cap on the total size of all segments. The oldest segments are
+        evicted to keep within it.
+    fsync: str
+        'always' to fsync after every record, 'interval' to fsync at most once
+        every fsync_interval seconds, 'never' to leave it to the OS.
+    fsync_interval: float
+        Seconds between fsyncs when fsync is 'interval'. The cursor file is
+        also written at most this often.
+    '''
+    def __init__(self, directory, segment_bytes=1024 * 1024,
+                 max_bytes=64 * 1024 * 1024, fsync=FSYNC_INTERVAL,
+                 fsync_interval=1.0):
+        if fsync not in (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER):
+            raise ValueError("fsync must be one of 'always', 'interval' or 'never'")
+        if max_bytes < 2 * segment_bytes:
+            raise ValueError('max_bytes must be at least twice segment_bytes')
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        # Records dropped by eviction or found to be corrupt
+        self.dropped_segments = 0
+        self.corrupt_records = 0
+
+        self.lock = threading.RLock()
+        self.sizes = {}
+        self.writer = None
+        self.reader = None
+        self.reader_seq = None
+        self.last_sync = time.time()
+        self.last_cursor_write = 0
+        self.cursor_dirty = False
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for filename in os.listdir(directory):
+            if filename.endswith(SEGMENT_SUFFIX):
+                seq = int(filename[:-len(SEGMENT_SUFFIX)])
+                self.sizes[seq] = os.path.getsize(self.__path(seq))
+
+        if self.sizes:
+            self.write_seq = max(self.sizes)
+            self.__recover(self.write_seq)
+        else:
+            self.write_seq = 1
+            self.sizes[1] = 0
+        self.writer = open(self.__path(self.write_seq), 'ab')
+
+        self.committed = self.__read_cursor()
+        self.position = self.committed
+
+    def __path(self, seq):
+        return os.path.join(self.directory, segment_name(seq))
+
+    def __recover(self, seq):
+        '''
+        Truncates a segment after its last complete record. Only the segment
+        that was being written can have been cut short by a crash.
+        '''
+        valid = 0
+        with open(self.__path(seq), 'rb') as f:
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                length, crc = HEADER.unpack(header)
+                body = f.read(length)
+                if len(body) < length or zlib.crc32(body) & 0xffffffff != crc:
+                    break
+                valid += HEADER.size + length
+        if valid < self.sizes[seq]:
+            with open(self.__path(seq), 'r+b') as f:
+                f.truncate(valid)
+            self.sizes[seq] = valid
+
+    def __read_cursor(self):
+        first = min(self.sizes)
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE)) as f:
+                seq, offset = (int(x) for x in f.read().split())
+        except (IOError, OSError, ValueError):
+            return (first, 0)
+        if seq < first or seq not in self.sizes:
+            return (first, 0)
+        return (seq, min(offset, self.sizes[seq]))
+
+    def __write_cursor(self):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        with open(path + '.tmp', 'w') as f:
+            f.write('%d %d' % self.committed)
+            f.flush()
+            if self.fsync != FSYNC_NEVER:
+                os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        self.cursor_dirty = False
+        self.last_cursor_write = time.time()
+
+    def __roll(self):
+        self.writer.close()
+        self.write_seq += 1
+        self.sizes[self.write_seq] = 0
+        self.writer = open(self.__path(self.write_seq), 'ab')
+
+    def __evict(self):
+        while sum(self.sizes.values()) > self.max_bytes and len(self.sizes) > 1:
+            oldest = min(self.sizes)
+            if self.reader_seq == oldest:
+                self.reader.close()
+                self.reader = None
+                self.reader_seq = None
+            os.remove(self.__path(oldest))
+            del self.sizes[oldest]
+            self.dropped_segments += 1
+            start = (min(self.sizes), 0)
+            if self.committed < start:
+                self.committed = start
+                self.cursor_dirty = True
+            if self.position < start:
+                self.position = start
+
+    def put(self, topic, payload, qos=1, received=None):
+        '''
+        Appends a record to the queue
+        '''
+        body = json.dumps([topic, payload, qos, received]).encode('utf-8')
+        record = HEADER.pack(len(body), zlib.crc32(body) & 0xffffffff) + body
+        with self.lock:
+            if self.sizes[self.write_seq] >= self.segment_bytes:
+                self.__roll()
+                self.__evict()
+            self.writer.write(record)
+            self.writer.flush()
+            self.sizes[self.write_seq] += len(record)
+            now = time.time()
+            if (self.fsync == FSYNC_ALWAYS or
+                    (self.fsync == FSYNC_INTERVAL and
+                     now - self.last_sync >= self.fsync_interval)):
+                os.fsync(self.writer.fileno())
+                self.last_sync = now
+
+    def get(self):
+        '''
+        Returns (position, (topic, payload, qos, received)) for the next
+        record that has not been read yet, or None if there are no more
+        records
+        '''
+        with self.lock:
+            while True:
+                seq, offset = self.position
+                if seq not in self.sizes:
+                    later = [s for s in self.sizes if s > seq]
+                    if not later:
+                        return None
+                    self.position = (min(later), 0)
+                    continue
+                if offset >= self.sizes[seq]:
+                    if seq == self.write_seq:
+                        return None
+                    self.position = (seq + 1, 0)
+                    continue
+                if self.reader_seq != seq:
+                    if self.reader is not None:
+                        self.reader.close()
+                    self.reader = open(self.__path(seq), 'rb')
+                    self.reader_seq = seq
+                self.reader.seek(offset)
+                header = self.reader.read(HEADER.size)
+                length, crc = HEADER.unpack(header)
+                body = self.reader.read(length)
+                if len(body) < length or zlib.crc32(body) & 0xffffffff != crc:
+                    # Skip the rest of a damaged segment
+                    self.corrupt_records += 1
+                    self.position = (seq, self.sizes[seq])
+                    continue
+                self.position = (seq, offset + HEADER.size + length)
+                record = json.loads(body.decode('utf-8'))
+                topic, payload, qos = record[:3]
+                received = record[3] if len(record) > 3 else None
+                return self.position, (topic, payload, qos, received)
+
+    def commit(self, position):
+        '''
+        Marks every record up to the given position as delivered
+        '''
+        with self.lock:
+            if position <= self.committed:
+                return
+            self.committed = position
+            self.cursor_dirty = True
+            # Delete segments that have been completely delivered
+            for seq in sorted(self.sizes):
+                if seq >= position[0] or seq == self.write_seq:
+                    break
+                if self.reader_seq == seq:
+                    self.reader.close()
+                    self.reader = None
+                    self.reader_seq = None
+                os.remove(self.__path(seq))
+                del self.sizes[seq]
+            if time.time() - self.last_cursor_write >= self.fsync_interval:
+                self.__write_cursor()
+
+    def rewind(self):
+        '''
+        Goes back to the oldest record that has not been committed
+        '''
+        with self.lock:
+            self.position = self.committed
+
+    def backlog_bytes(self):
+        '''
+        Returns the approximate number of bytes not yet committed
+        '''
+        with self.lock:
+            seq, offset = self.committed
+            return sum(size for s, size in self.sizes.items() if s >= seq) - offset
+
+    def close(self):
+        with self.lock:
+            self.writer.flush()
+            if self.fsync != FSYNC_NEVER:
+                os.fsync(self.writer.fileno())
+            self.writer.close()
+            if self.reader is not None:
+                self.reader.close()
+                self.reader = None
+                self.reader_seq = None
+            if self.cursor_dirty:
+                self.__write_cursor()
+
+
+class StoreAndForward():
+    '''
+    Sends records from a SegmentQueue to an MQTT broker and commits them once
+    they are acknowledged.
+
+    drain() should be called regularly from the main loop while connected.
+    handle_publish() and handle_disconnect() should be called from the paho
+    on_publish and on_disconnect callbacks.
+
+    Parameters
+    ----------
+    queue: SegmentQueue
+    rate: float
+        Maximum number of messages sent per second while draining a backlog.
+    max_inflight: int
+        Maximum number of messages awaiting acknowledgement at any one time.
+    latency: metrics.Histogram or None
+        Observes the time from each record's reading being received to the
+        record being published. Records sent again after a disconnect are
+        only observed the first time.
+    '''
+    def __init__(self, queue, rate=50.0, max_inflight=20, latency=None):
+        self.queue = queue
+        self.rate = float(rate)
+        self.max_inflight = max_inflight
+        self.latency = latency
+        # The position of the furthest record published so far
+        self.published = queue.committed
+        self.lock = threading.Lock()
+        # [mid, position, acknowledged] in the order they were sent
+        self.inflight = deque()
+        # Whether drain() is inside publish(), whose PUBACK may arrive (on
+        # paho's network thread) before publish() has returned the mid
+        self.publishing = False
+        # The acknowledgements that arrived while it was. Cleared once the
+        # mid is known, so acks for messages published directly on the client
+        # (status, pings) are not kept, and a reused mid is never matched.
+        self.early_acks = set()
+        self.tokens = 0.0
+        self.last_drain = time.time()
+
+    def put(self, topic, payload, qos=1, received=None):
+        self.queue.put(topic, payload, qos, received)
+
+    def drain(self, mqttClient, now=None):
+        '''
+        Sends as many queued records as the rate and in-flight limits allow.
+        Returns the number of records sent.
+        '''
+        if now is None:
+            now = time.time()
+        # Token bucket allowing bursts of up to one second's worth of messages
+        self.tokens = min(self.rate, self.tokens + (now - self.last_drain) * self.rate)
+        self.last_drain = now
+        sent = 0
+        while self.tokens >= 1:
+            with self.lock:
+                if len(self.inflight) >= self.max_inflight:
+                    break
+            record = self.queue.get()
+            if record is None:
+                break
+            position, (topic, payload, qos, received) = record
+            # Not holding the lock: paho calls on_publish with its own locks
+            # held, and for QoS 0 from inside publish()
+            with self.lock:
+                self.publishing = True
+            try:
+                rc, mid = mqttClient.publish(topic, payload, qos=qos)
+            except BaseException:
+                self.__stop_publishing()
+                raise
+            if rc != 0:
+                # Not connected after all: try again later from the last commit
+                self.__stop_publishing()
+                self.handle_disconnect()
+                break
+            self.tokens -= 1
+            sent += 1
+            if position > self.published:
+                self.published = position
+                if received is not None and self.latency is not None:
+                    self.latency.observe(time.time() - received)
+            # Early acks are collected until the mid is in inflight, so one
+            # arriving in between is not lost
+            with self.lock:
+                acknowledged = qos == 0 or mid in self.early_acks
+                self.inflight.append([mid, position, acknowledged])
+                self.publishing = False
+                self.early_acks = set()
+                self.__commit_acknowledged()
+        return sent
+
+    def __stop_publishing(self):
+        with self.lock:
+            self.publishing = False
+            self.early_acks = set()
+
+    def __commit_acknowledged(self):
+        # Only commit the unbroken run of acknowledged records at the front,
+        # so that nothing is skipped if an earlier message is never acked
+        position = None
+        while self.inflight and self.inflight[0][2]:
+            position = self.inflight.popleft()[1]
+        if position is not None:
+            self.queue.commit(position)
+
+    def handle_publish(self, mid):
+        with self.lock:
+            for entry in self.inflight:
+                if entry[0] == mid:
+                    entry[2] = True
+                    break
+            else:
+                if self.publishing:
+                    self.early_acks.add(mid)
+            self.__commit_acknowledged()
+
+    def handle_disconnect(self):
+        with self.lock:
+            self.inflight.clear()
+            self.early_acks.clear()
+            self.queue.rewind()
+
+    def inflight_count(self):
+        with self.lock:
+            return len(self.inflight)
+
+    def close(self):
+        self.queue.close()
@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+"""
+Virtual Arduinos on pseudo terminals, for testing and benchmarking piduino
+without any hardware.
+
+Each VirtualArduino sits on the master end of a pseudo terminal. Its port
+(e.g. /dev/pts/3) can be opened with SerialDevice, AsyncSerialDevice or
+pyserial exactly like /dev/ttyACM0, and it behaves like a board running the
+shipped sketches:
+
+    publish_sensor_data(_binary)  Answers handshakes (agreeing to binary
+                                  framing if asked, see binary_framing.py),
+                                  sends every sensor reading each interval
+                                  seconds and obeys output messages.
+    protocol (echo=True)          Echoes '<source|destination|message>'
+                                  packets back with its own address as the
+                                  source, as RPI_to_Arduino's protocol.ino
+                                  does.
+
+Opening the port resets a real Arduino (through DTR). Here a board resets when
+its port is opened. It then ignores input for boot_delay seconds, as the
+bootloader does, and comes up with a new random device id in JSON mode at 9600
+baud. By default output is limited to what the line rate allows (a tenth of
+the baud rate in bytes per second).
+
+Faults can be injected: garble is the probability that a frame has a byte
+corrupted, and disconnect_after unplugs the board that many seconds after it
+boots (the host then gets read errors, as with a pulled USB cable).
+
+Any number of boards are run by a single VirtualBoards thread:
+
+    with VirtualBoards() as boards:
+        board = boards.add(VirtualArduino(interval=0.1))
+        device = piduino.SerialDevice(board.port)
+        ...
+
+Run from the command line to point serial_relay (serial_ports in relay.ini)
+at some virtual boards:
+
+    python3 virtual_arduino.py --boards 20 --interval 0.5
+
+This needs pseudo terminals, so it works on Linux and macOS but not Windows.
+"""
+
+import argparse
+import errno
+import json
+import os
+import random
+import select
+import threading
+import time
+
+from framing import JsonFrameDecoder
+from binary_framing import (BinaryFrameDecoder, encode_frame, encode_message,
+                            MSG_READING)
+from deadline import monotonic
+
+HANDSHAKE_BAUD = 9600
+MAX_BAUD = 115200
+
+# The inputs of publish_sensor_data, and functions giving a reading for each
+SENSORS = [
+    ('Movement', lambda rng: rng.randint(0, 1)),
+    ('LDR', lambda rng: rng.randint(300, 700)),
+    ('Temperature', lambda rng: float(rng.randint(18, 24))),
+    ('Humidity', lambda rng: float(rng.randint(30, 60))),
+]
+OUTPUTS = ['LED']
+
+# Protocol characters from RPI_to_Arduino/piduino/utils.py
+PACKET_START = ord('<')
+PACKET_DIVIDE = ord('|')
+PACKET_END = ord('>')
+ESCAPE = ord('\\')
+TO_ESCAPE = (PACKET_START, PACKET_DIVIDE, PACKET_END, ESCAPE)
+
+# Stop generating readings if this much output is waiting for the host, as
+# a real board stalls when its serial buffer is full
+MAX_OUTBOX = 64 * 1024
+
+
+def escape(data):
+    escaped = bytearray()
+    for byte in data:
+        if byte in TO_ESCAPE:
+            escaped.append(ESCAPE)
+        escaped.append(byte)
+    return escaped
+
+
+class VirtualArduinoStats():
+    def __init__(self):
+        self.resets = 0
+        self.handshakes = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.commands = 0
+        self.echoes = 0
+        self.garbled = 0
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+class VirtualArduino():
+    '''
+    A single emulated board (see module docstring). Readings are sent every
+    interval seconds. The board must be added to a VirtualBoards to run.
+    '''
+    def __init__(self, interval=5.0, sensors=SENSORS, outputs=OUTPUTS,
+                 binary=True, echo=False, boot_delay=1.0, emulate_baud=True,
+                 garble=0.0, disconnect_after=None,
+                 address='98:D3:32:10:8E:5D', seed=None):
+        self.interval = interval
+        self.sensors = list(sensors)
+        self.outputs = list(outputs)
+        self.topic_table = [name for name, function in self.sensors] + self.outputs
+        self.allow_binary = binary
+        self.echo = echo
+        self.boot_delay = boot_delay
+        self.emulate_baud = emulate_baud
+        self.garble = garble
+        self.disconnect_after = disconnect_after
+        self.address = address
+        self.random = random.Random(seed)
+        self.stats = VirtualArduinoStats()
+        # The latest value written to each output
+        self.output_values = {}
+
+        self.master, slave = os.openpty()
+        self.port = os.ttyname(slave)
+        # Nobody has the port open until the host opens it
+        os.close(slave)
+        os.set_blocking(self.master, False)
+        self.attached = False
+        self.unplugged = False
+        self.outbox = bytearray()
+        self.__reset(monotonic())
+
+    def fileno(self):
+        return self.master
+
+    def __reset(self, now):
+        '''
+        What happens when DTR resets the board
+        '''
+        self.stats.resets += 1
+        self.booted_at = now + self.boot_delay
+        self.device_id = self.random.randint(1000, 9999)
+        self.binary = False
+        self.baud = HANDSHAKE_BAUD
+        self.decoder = JsonFrameDecoder()
+        self.packet = None
+        self.escaped = False
+        self.next_reading = self.booted_at
+        self.outbox = bytearray()
+        self.allowance = 0.0
+        self.last_send = now
+
+    def booting(self, now):
+        return now < self.booted_at
+
+    def check_attached(self, now):
+        '''
+        Notices the host opening or closing the port. Returns True if the
+        host has it open.
+        '''
+        if self.unplugged:
+            return False
+        poller = select.poll()
+        poller.register(self.master, select.POLLIN)
+        hung_up = any(event & select.POLLHUP for fd, event in poller.poll(0))
+        if not hung_up and not self.attached:
+            self.__reset(now)
+        self.attached = not hung_up
+        return self.attached
+
+    def unplug(self):
+        '''
+        Disconnects the board, as if its cable was pulled out
+        '''
+        if not self.unplugged:
+            self.unplugged = True
+            self.attached = False
+            os.close(self.master)
+
+    def __queue(self, frame):
+        if self.garble and self.random.random() < self.garble:
+            frame = bytearray(frame)
+            frame[self.random.randrange(len(frame))] ^= 1 << self.random.randrange(8)
+            self.stats.garbled += 1
+        self.outbox += frame
+        self.stats.frames_sent += 1
+
+    def __send(self, topic, value):
+        if self.binary:
+            topic_id = self.topic_table.index(topic)
+            self.__queue(encode_frame(encode_message(MSG_READING, topic_id, value)))
+        else:
+            self.__queue(json.dumps({'topic': topic, 'payload': value},
+                                    separators=(',', ':')).encode('ascii'))
+
+    def __handle_message(self, message):
+        topic = message.get('topic')
+        if topic == 'handshake' and not self.binary:
+            self.stats.handshakes += 1
+            reply = {'topic': 'handshake', 'payload': self.device_id}
+            if self.allow_binary and message.get('binary') == 1:
+                baud = message.get('baud', MAX_BAUD)
+                if not isinstance(baud, int) or baud <= 0 or baud > MAX_BAUD:
+                    baud = MAX_BAUD
+                reply.update({'binary': 1, 'baud': baud, 'topics': self.topic_table})
+                self.__queue(json.dumps(reply, separators=(',', ':')).encode('ascii'))
+                # The reply goes at the old baud rate
+                self.binary = True
+                self.baud = baud
+                self.decoder = BinaryFrameDecoder(self.topic_table)
+            else:
+                self.__queue(json.dumps(reply, separators=(',', ':')).encode('ascii'))
+        elif topic in self.outputs:
+            self.stats.commands += 1
+            self.output_values[topic] = message.get('payload')
+
+    def __handle_packet_byte(self, byte):
+        '''
+        Collects '<source|destination|message>' packets one byte at a time, as
+        protocol.ino does, and echoes them
+        '''
+        if byte == PACKET_START and not self.escaped:
+            self.packet = bytearray()
+        elif byte == PACKET_END and not self.escaped and self.packet is not None:
+            fields = [bytearray()]
+            escaped = False
+            for char in self.packet:
+                if char == PACKET_DIVIDE and not escaped:
+                    fields.append(bytearray())
+                elif char != ESCAPE or escaped:
+                    fields[-1].append(char)
+                escaped = char == ESCAPE and not escaped
+            self.packet = None
+            if len(fields) == 3:
+                source, destination, content = fields
+                reply = (b'<' + escape(self.address.encode('ascii')) + b'|' +
+                         escape(source) + b'|' + escape(content) + b'>\r\n')
+                self.__queue(reply)
+                self.stats.echoes += 1
+        elif self.packet is not None:
+            self.packet.append(byte)
+        self.escaped = byte == ESCAPE and not self.escaped
+
+    def receive(self, data, now):
+        '''
+        Handles bytes written by the host
+        '''
+        self.stats.bytes_received += len(data)
+        if self.booting(now):
+            # The bootloader swallows them
+            return
+        if self.echo:
+            for byte in bytearray(data):
+                self.__handle_packet_byte(byte)
+            return
+        for message in self.decoder.feed(data):
+            self.__handle_message(message)
+
+    def tick(self, now):
+        '''
+        Generates readings that are due and writes as much output as the line
+        allows. Returns the time at which it next needs to be called.
+        '''
+        if self.unplugged or not self.attached:
+            return now + 0.05
+        if self.booting(now):
+            return self.booted_at
+        if (self.disconnect_after is not None and
+                now >= self.booted_at + self.disconnect_after):
+            self.unplug()
+            return now + 0.05
+
+        next_due = now + 1.0
+        if not self.echo:
+            if now >= self.next_reading and len(self.outbox) < MAX_OUTBOX:
+                for name, function in self.sensors:
+                    self.__send(name, function(self.random))
+                # Don't try to catch up if we fell behind
+                self.next_reading = max(self.next_reading + self.interval, now)
+            next_due = min(next_due, self.next_reading)
+
+        if self.outbox:
+            if self.emulate_baud:
+                rate = self.baud / 10.0
+                self.allowance = min(self.allowance + (now - self.last_send) * rate, rate * 0.05)
+                self.last_send = now
+                count = int(self.allowance)
+            else:
+                count = len(self.outbox)
+            if count > 0:
+                try:
+                    written = os.write(self.master, bytes(self.outbox[:count]))
+                except BlockingIOError:
+                    written = 0
+                except OSError as e:
+                    if e.errno != errno.EIO:
+                        raise
+                    written = 0
+                del self.outbox[:written]
+                self.stats.bytes_sent += written
+                if self.emulate_baud:
+                    self.allowance -= written
+            if self.outbox:
+                if self.emulate_baud:
+                    # Wait until a few bytes can go at once
+                    wait = (min(len(self.outbox), 16) - self.allowance) / rate
+                    next_due = min(next_due, now + max(wait, 0.001))
+                else:
+                    next_due = min(next_due, now + 0.001)
+        else:
+            self.last_send = now
+            self.allowance = 0.0
+        return next_due
+
+
+class VirtualBoards():
+    '''
+    Runs any number of VirtualArduinos from a single background thread
+    '''
+    def __init__(self):
+        self.boards = []
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+        self.wake_read, self.wake_write = os.pipe()
+
+    def add(self, board):
+        with self.lock:
+            self.boards.append(board)
+        os.write(self.wake_write, b'x')
+        return board
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(name='virtual-arduinos', target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        os.write(self.wake_write, b'x')
+        if self.thread is not None:
+            self.thread.join()
+        for board in self.boards:
+            board.unplug()
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def __run(self):
+        while self.running:
+            now = monotonic()
+            with self.lock:
+                boards = list(self.boards)
+            poller = select.poll()
+            poller.register(self.wake_read, select.POLLIN)
+            by_fd = {}
+            next_due = now + 1.0
+            for board in boards:
+                # Attached boards hear about the host closing the port from
+                # the poll below
+                if board.attached or board.check_attached(now):
+                    poller.register(board.master, select.POLLIN)
+                    by_fd[board.master] = board
+                next_due = min(next_due, board.tick(now))
+
+            for fd, event in poller.poll(max(next_due - monotonic(), 0) * 1000):
+                if fd == self.wake_read:
+                    os.read(self.wake_read, 1024)
+                    continue
+                board = by_fd[fd]
+                if board.unplugged:
+                    continue
+                if event & select.POLLHUP:
+                    board.attached = False
+                    continue
+                try:
+                    data = os.read(fd, 4096)
+                except (BlockingIOError, OSError):
+                    # The host has closed the port
+                    continue
+                board.receive(data, monotonic())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs virtual Arduinos on pseudo terminals')
+    parser.add_argument('--boards', type=int, default=1)
+    parser.add_argument('--interval', type=float, default=5.0,
+                        help='seconds between readings')
+    parser.add_argument('--boot-delay', type=float, default=1.0)
+    parser.add_argument('--no-binary', action='store_true',
+                        help='refuse binary framing')
+    parser.add_argument('--echo', action='store_true',
+                        help='echo <source|destination|message> packets instead')
+    parser.add_argument('--garble', type=float, default=0.0,
+                        help='probability that a frame is corrupted')
+    args = parser.parse_args()
+
+    with VirtualBoards() as boards:
+        for i in range(args.boards):
+            board = boards.add(VirtualArduino(interval=args.interval,
+                                              boot_delay=args.boot_delay,
+                                              binary=not args.no_binary,
+                                              echo=args.echo,
+                                              garble=args.garble))
+            print(board.port)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Buffered, rotating CSV writers for collected sensor data.
+
+Opening, appending to and closing a file for every reading costs several
+system calls and a metadata update per reading, which is slow on an SD card
+and wears it out. A WriterPool keeps a file open for each stream (e.g.
+'Coffee_Room-1234-LDR', written to Coffee_Room-1234-LDR.csv) and buffers rows
+in memory. A stream's buffer is written out when it reaches flush_bytes, or
+when its oldest row is flush_interval seconds old (checked by write and
+poll). At most flush_interval seconds of data are lost if the process is
+killed, and rows are only ever written whole.
+
+At most max_open files are kept open; the least recently written stream is
+flushed and closed to make room for another.
+
+Files can be rotated once they reach rotate_bytes, and/or at every multiple of
+rotate_interval seconds (e.g. 86400 for daily files). The current file keeps
+its plain name, and a rotated file is renamed with the UTC time of the
+rotation, e.g. Coffee_Room-1234-LDR.20170724T150000.csv.
+
+close() flushes everything and syncs it to disk, so call it on shutdown.
+"""
+
+import csv
+import io
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class Stream():
+    '''
+    An open file and the rows waiting to be written to it
+    '''
+    def __init__(self, path, period):
+        self.path = path
+        self.file = open(path, 'a', newline='')
+        self.size = self.file.tell()
+        # The rotation period the file belongs to
+        self.period = period
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.pending_since = None
+
+    def pending_bytes(self):
+        return self.buffer.tell()
+
+    def flush(self, sync=False):
+        data = self.buffer.getvalue()
+        if data:
+            self.file.write(data)
+            self.size += len(data)
+            self.buffer.seek(0)
+            self.buffer.truncate()
+            self.pending_since = None
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+
+    def close(self, sync=False):
+        self.flush(sync)
+        self.file.close()
+
+
+class WriterPool():
+    '''
+    A pool of open, buffered CSV files in a directory (see module docstring)
+    '''
+    def __init__(self, directory, max_open=32, flush_bytes=64 * 1024,
+                 flush_interval=5.0, rotate_bytes=None, rotate_interval=None):
+        if max_open < 1:
+            raise ValueError('max_open must be at least 1')
+        self.directory = directory
+        self.max_open = max_open
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.rotate_bytes = rotate_bytes
+        self.rotate_interval = rotate_interval
+        # Least recently written first
+        self.streams = OrderedDict()
+        self.lock = threading.Lock()
+        self.rotations = 0
+        self.evictions = 0
+        self.last_poll = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __path(self, name):
+        return os.path.join(self.directory, name + '.csv')
+
+    def __period(self, timestamp):
+        if not self.rotate_interval:
+            return 0
+        return int(timestamp // self.rotate_interval)
+
+    def __open(self, name, now):
+        while len(self.streams) >= self.max_open:
+            oldest, stream = self.streams.popitem(last=False)
+            stream.close()
+            self.evictions += 1
+        path = self.__path(name)
+        if os.path.exists(path):
+            # The file was last written in the period of its mtime
+            period = self.__period(os.path.getmtime(path))
+        else:
+            period = self.__period(now)
+        stream = Stream(path, period)
+        self.streams[name] = stream
+        return stream
+
+    def __rotate(self, name, stream, now):
+        stream.close()
+        stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime(now))
+        rotated = os.path.join(self.directory, '%s.%s.csv' % (name, stamp))
+        count = 1
+        while os.path.exists(rotated):
+            rotated = os.path.join(self.directory, '%s.%s-%d.csv' % (name, stamp, count))
+            count += 1
+        os.rename(stream.path, rotated)
+        self.rotations += 1
+        stream = Stream(stream.path, self.__period(now))
+        self.streams[name] = stream
+        return stream
+
+    def __needs_rotation(self, stream, now):
+        if stream.size == 0 and stream.pending_bytes() == 0:
+            return False
+        if self.rotate_interval and self.__period(now) != stream.period:
+            return True
+        if self.rotate_bytes and stream.size + stream.pending_bytes() >= self.rotate_bytes:
+            return True
+        return False
+
+    def write(self, name, row, now=None):
+        '''
+        Buffers a row (a list of values) for the named stream
+        '''
+        if now is None:
+            now = time.time()
+        with self.lock:
+            stream = self.streams.get(name)
+            if stream is None:
+                stream = self.__open(name, now)
+            else:
+                self.streams.move_to_end(name)
+            if self.__needs_rotation(stream, now):
+                stream = self.__rotate(name, stream, now)
+            stream.writer.writerow(row)
+            if stream.pending_since is None:
+                stream.pending_since = now
+            if stream.pending_bytes() >= self.flush_bytes:
+                stream.flush()
+        if now - self.last_poll >= min(self.flush_interval, 1.0):
+            self.poll(now)
+
+    def poll(self, now=None):
+        '''
+        Writes out the buffers whose oldest row is flush_interval seconds old
+        '''
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.last_poll = now
+            for stream in self.streams.values():
+                if (stream.pending_since is not None and
+                        now - stream.pending_since >= self.flush_interval):
+                    stream.flush()
+
+    def flush(self, sync=False):
+        '''
+        Writes out every buffer, and if sync is True makes sure it has reached
+        the disk
+        '''
+        with self.lock:
+            for stream in self.streams.values():
+                stream.flush(sync)
+
+    def open_count(self):
+        return len(self.streams)
+
+    def close(self):
+        '''
+        Flushes and syncs every stream, and closes the files
+        '''
+        with self.lock:
+            while self.streams:
+                name, stream = self.streams.popitem(last=False)
+                stream.close(sync=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1 @@
+# Required line, so that Github doesn't refuse to accept this file 
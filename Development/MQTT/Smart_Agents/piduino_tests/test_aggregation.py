@@ -0,0 +1,59 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+from aggregation import Aggregation, WindowAggregator
+
+def test_tumbling_window_summary():
+    aggregator = WindowAggregator(10)
+    for i, value in enumerate([5, 1, 9, 3]):
+        assert aggregator.add(value, 100.0 + i) == []
+    summaries = aggregator.add(7, 110.5)
+    assert summaries == [{'t': 110.0, 'count': 4, 'min': 1, 'max': 9,
+                          'mean': 4.5, 'last': 3}]
+    assert aggregator.poll(120.0)[0]['count'] == 1
+
+def test_sliding_window_summaries():
+    aggregator = WindowAggregator(4, hop=2)
+    summaries = []
+    for t in range(100, 106):
+        summaries += aggregator.add(t, float(t))
+    summaries += aggregator.add(0, 106.0)
+    # Windows ending at 102, 104 and 106
+    assert [s['t'] for s in summaries] == [102.0, 104.0, 106.0]
+    assert [s['count'] for s in summaries] == [2, 4, 4]
+    assert summaries[-1]['min'] == 102 and summaries[-1]['max'] == 105
+
+def test_gap_between_readings_is_skipped():
+    aggregator = WindowAggregator(1)
+    aggregator.add(1, 100.2)
+    assert len(aggregator.poll(1000.0)) == 1
+    assert aggregator.poll(2000.0) == []
+
+def test_deadband_without_window_passes_changed_readings():
+    aggregation = Aggregation({'+/LDR': {'deadband': 5}})
+    outputs = [aggregation.add('1234', 'LDR', v, 100.0) for v in [400, 403, 406, 402]]
+    assert outputs == [[400], [], [406], []]
+
+def test_unmatched_and_non_numeric_readings_pass_through():
+    aggregation = Aggregation({'+/LDR': {'window': 10}})
+    assert aggregation.add('1234', 'Movement', 1, 100.0) is None
+    assert aggregation.add('1234', 'LDR', 'error', 100.0) is None
+    assert aggregation.add('1234', 'LDR', 400, 100.0) == []
+    assert aggregation.poll(110.0)[0][:2] == ('1234', 'LDR')
+
+def test_flush_returns_open_windows_and_held_readings():
+    aggregation = Aggregation({'+/LDR': {'window': 10}, '+/Temperature': {'deadband': 1}})
+    for t, value in enumerate([400, 410, 420]):
+        aggregation.add('1234', 'LDR', value, 100.0 + t)
+    aggregation.add('1234', 'Temperature', 20.0, 100.0)
+    aggregation.add('1234', 'Temperature', 20.5, 102.0)
+    aggregation.add('5678', 'LDR', 1, 100.0)
+    flushed = aggregation.flush('1234')
+    assert flushed == [('1234', 'LDR', {'t': 110.0, 'count': 3, 'min': 400, 'max': 420,
+                                        'mean': 410.0, 'last': 420, 'partial': True}, 110.0),
+                       ('1234', 'Temperature', 20.5, 102.0)]
+    assert aggregation.flush('1234') == []
+    assert [f[0] for f in aggregation.flush()] == ['5678']
+    # Once flushed, windows start again
+    aggregation.add('1234', 'LDR', 5, 120.0)
+    assert aggregation.poll(130.0)[0][2]['count'] == 1
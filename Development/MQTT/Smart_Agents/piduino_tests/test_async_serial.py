@@ -0,0 +1,79 @@
+import asyncio
+import json
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+import piduino
+from async_serial import AsyncSerialDevice
+
+READINGS = [{'topic': 'LDR', 'payload': i} for i in range(20)]
+
+async def connected_device():
+    # A pseudo terminal stands in for the Arduino's serial port
+    master, slave = os.openpty()
+    device = AsyncSerialDevice(os.ttyname(slave))
+    assert await device.connect(boot_delay=0) is None
+    return master, slave, device
+
+def test_iterates_over_frames_until_disconnect():
+    async def run():
+        master, slave, device = await connected_device()
+        os.write(master, b''.join(json.dumps(m).encode() for m in READINGS))
+        received = []
+        async for message in device:
+            received.append(message)
+            if len(received) == len(READINGS):
+                # Hang up, which ends the iteration
+                os.close(master)
+                os.close(slave)
+        return received, device
+    received, device = asyncio.run(run())
+    assert received == READINGS
+    assert device.stats.disconnects == 1
+
+def test_handshake_and_send():
+    async def run():
+        master, slave, device = await connected_device()
+        loop = asyncio.get_running_loop()
+        requests = []
+
+        def arduino():
+            # Reply to the handshake request, with a reading first
+            requests.append(os.read(master, 1024))
+            if len(requests) == 1:
+                os.write(master, b'{"topic": "LDR", "payload": 3}'
+                                 b'{"topic": "handshake", "payload": 1234}')
+
+        loop.add_reader(master, arduino)
+        flag = await device.handshake(timeout=2)
+        assert await device.send({'topic': 'LED', 'payload': '1'}) is None
+        await asyncio.sleep(0.05)
+        loop.remove_reader(master)
+        device.shutdown()
+        os.close(master)
+        os.close(slave)
+        return flag, device, requests
+    flag, device, requests = asyncio.run(run())
+    assert flag is None
+    assert device.name == 1234 and device.verified
+    assert json.loads(requests[0].decode()) == piduino.handshake_message()
+    assert json.loads(requests[1].decode()) == {'topic': 'LED', 'payload': '1'}
+
+def test_receive_timeout():
+    async def run():
+        master, slave, device = await connected_device()
+        flag, message = await device.receive_json(timeout=0.1)
+        device.shutdown()
+        os.close(master)
+        os.close(slave)
+        return flag
+    assert type(asyncio.run(run())) == piduino.ReadTimeoutError
+
+def test_receive_before_connecting():
+    async def run():
+        device = AsyncSerialDevice('/dev/no-such-port')
+        flags = [(await device.receive_json(timeout=None))[0]]
+        assert await device.connect(boot_delay=0) is not None
+        flags.append((await device.receive_json(timeout=None))[0])
+        return flags
+    assert [type(flag) for flag in asyncio.run(run())] == [piduino.NotConnectedError] * 2
@@ -0,0 +1,48 @@
+import json
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+from batching import Batcher, topic_matches
+
+def test_topic_matches_wildcards():
+    assert topic_matches('+/LDR', '1234/LDR')
+    assert topic_matches('1234/#', '1234/LDR')
+    assert topic_matches('#', '1234/LDR')
+    assert not topic_matches('+/LDR', '1234/Movement')
+    assert not topic_matches('+', '1234/LDR')
+
+def test_unmatched_readings_are_not_batched():
+    batcher = Batcher({'+/LDR': {'max_count': 3}})
+    assert not batcher.add('1234', 'Movement', 1, 100.0)
+    assert batcher.ready(100.0) == []
+
+def test_batch_published_when_full():
+    batcher = Batcher({'+/LDR': {'max_count': 3, 'max_delay': 60}})
+    for i in range(3):
+        assert batcher.add('1234', 'LDR', 400 + i, 100.0 + i * 0.012)
+    assert batcher.pending() == 3
+    ready = batcher.ready(100.03)
+    assert len(ready) == 1
+    assert batcher.pending() == 0
+    device, topic, payload, t0 = ready[0]
+    assert t0 == 100.0
+    assert (device, topic) == ('1234', 'LDR')
+    assert json.loads(payload) == {'t0': 100.0, 'dt': [0, 12, 24], 'v': [400, 401, 402]}
+    assert batcher.ready(100.03) == []
+
+def test_batch_published_after_max_delay():
+    batcher = Batcher({'1234/+': {'max_count': 100, 'max_delay': 0.5}})
+    batcher.add('1234', 'LDR', 400, 100.0)
+    assert batcher.ready(100.4) == []
+    assert len(batcher.ready(100.5)) == 1
+
+def test_flush_and_forget_return_partial_batches():
+    batcher = Batcher({'#': {'max_count': 100, 'max_delay': 60}})
+    batcher.add('1234', 'LDR', 400, 100.0)
+    batcher.add('5678', 'LDR', 400, 100.0)
+    assert batcher.pending() == 2
+    assert [b[0] for b in batcher.forget('1234')] == ['1234']
+    assert batcher.pending() == 1
+    assert [b[0] for b in batcher.flush()] == ['5678']
+    assert batcher.flush() == []
+    assert batcher.pending() == 0
@@ -0,0 +1,62 @@
+import os
+import sys
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+from binary_framing import (BinaryFrameDecoder, cobs_encode, cobs_decode, crc16,
+                            encode_frame, encode_message, MSG_READING, MSG_COMMAND)
+import piduino
+
+TOPICS = ['Movement', 'LDR', 'Temperature', 'Humidity', 'LED']
+READINGS = [(0, 1), (1, 455), (2, 21.5), (3, 40.0), (1, -70000), (4, 'on'), (0, True)]
+STREAM = b''.join(encode_frame(encode_message(MSG_READING, t, v)) for t, v in READINGS)
+MESSAGES = [{'topic': TOPICS[t], 'payload': v} for t, v in READINGS]
+
+def test_crc16_check_value():
+    # The standard check value for CRC-16/CCITT-FALSE
+    assert crc16(b'123456789') == 0x29b1
+
+def test_cobs_round_trip():
+    for data in [b'', b'\x00', b'\x00\x00', b'a\x00b', b'\x01' * 253, b'\x01' * 254,
+                 b'\x01' * 255, bytes(bytearray(range(256))) * 2]:
+        encoded = cobs_encode(data)
+        assert b'\x00' not in encoded
+        assert cobs_decode(encoded) == data
+
+def test_whole_stream():
+    assert BinaryFrameDecoder(TOPICS).feed(STREAM) == MESSAGES
+
+def test_stream_split_at_every_position():
+    for split in range(len(STREAM)):
+        decoder = BinaryFrameDecoder(TOPICS)
+        frames = decoder.feed(STREAM[:split]) + decoder.feed(STREAM[split:])
+        assert frames == MESSAGES, split
+
+def test_damaged_frame_is_dropped():
+    first = len(encode_frame(encode_message(MSG_READING, *READINGS[0])))
+    damaged = bytearray(STREAM)
+    damaged[first + 3] ^= 0x10
+    decoder = BinaryFrameDecoder(TOPICS)
+    assert decoder.feed(b'noise\x00' + bytes(damaged)) == MESSAGES[:1] + MESSAGES[2:]
+    assert decoder.malformed == 2
+
+def test_commands_are_marked():
+    frame = encode_frame(encode_message(MSG_COMMAND, 4, '1'))
+    assert BinaryFrameDecoder(TOPICS).feed(frame) == [
+        {'topic': 'LED', 'payload': '1', 'command': True}]
+
+def test_unknown_topic_id_is_malformed():
+    decoder = BinaryFrameDecoder(TOPICS[:1])
+    assert decoder.feed(encode_frame(encode_message(MSG_READING, 3, 1))) == []
+    assert decoder.malformed == 1
+
+def test_ints_too_big_for_an_int32_are_errors():
+    frame = encode_frame(encode_message(MSG_COMMAND, 4, 0x7fffffff))
+    assert BinaryFrameDecoder(TOPICS).feed(frame) == [
+        {'topic': 'LED', 'payload': 0x7fffffff, 'command': True}]
+    with pytest.raises(ValueError):
+        encode_message(MSG_COMMAND, 4, 0x80000000)
+    # Returned rather than raised by the device, as its other errors are
+    device = piduino.SerialDevice('unused')
+    device.binary = True
+    device.topic_table = TOPICS
+    assert isinstance(device.send({'topic': 'LED', 'payload': 2 ** 40}), ValueError)
@@ -0,0 +1,105 @@
+import os
+import sys
+import tempfile
+import numpy as np
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+from bulk_analysis import Summary, analyse, fft_peaks, read_chunk
+from columnar_store import ColumnarStore
+
+T0 = 1500000000
+
+def write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+def readings(times, values):
+    rows = zip(np.asarray(times).tolist(), np.asarray(values).tolist())
+    return ''.join('%r,%r\n' % row for row in rows)
+
+def test_merged_summaries_match_the_whole():
+    rng = np.random.RandomState(0)
+    times = np.cumsum(rng.randint(1, 3, 1000)).astype(float)
+    times[600:] += 100
+    values = rng.normal(size=1000)
+    whole = Summary()
+    whole.add(times, values)
+    merged = Summary()
+    for start in range(0, 1000, 170):
+        part = Summary()
+        part.add(times[start:start + 170], values[start:start + 170])
+        merged.merge(part)
+    expected = whole.report()
+    report = merged.report()
+    for key in ['count', 'first', 'last', 'min', 'max', 'gaps']:
+        assert report[key] == expected[key]
+    for key in ['mean', 'std', 'gap_time']:
+        assert report[key] == pytest.approx(expected[key])
+    assert report['longest_gap'][1] == pytest.approx(101, abs=1)
+
+def test_chunks_split_at_lines():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'a.csv')
+        write(path, '1,10\n22,20\n333,30\n')
+        chunks = [read_chunk(path, start, min(start + 4, 18)) for start in range(0, 18, 4)]
+        assert b''.join(chunks) == b'1,10\n22,20\n333,30\n'
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_analyse_directory(workers):
+    with tempfile.TemporaryDirectory() as directory:
+        data = os.path.join(directory, 'Data')
+        os.makedirs(data)
+        times = T0 + np.arange(0, 5000, 5)
+        write(os.path.join(data, 'Room-1-LDR.20170714T000000.csv'), readings(times[:500], range(500)))
+        write(os.path.join(data, 'Room-1-LDR.csv'), readings(times[500:] + 60, range(500, 1000)))
+        write(os.path.join(data, 'Room-1-Msg.csv'), '%d,hello\n%d,3\n%d,4\n' % (T0, T0 + 1, T0))
+        reports, totals = analyse([directory], workers=workers, chunk_bytes=1000, progress=False)
+        ldr = reports['Room-1-LDR']
+        assert (ldr['count'], ldr['skipped'], ldr['gaps']) == (1000, 0, 1)
+        assert ldr['longest_gap'] == (T0 + 2495, 65)
+        assert ldr['mean'] == pytest.approx(499.5)
+        assert ldr['median_interval'] == 5
+        message = reports['Room-1-Msg']
+        assert (message['rows'], message['skipped'], message['count']) == (3, 2, 1)
+        assert totals['files'] == 3 and totals['rows'] == 1003
+
+def test_store_and_fft():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'output.csv')
+        # 50 Hz sampled every 1000 us, as testing_analogue_read records it
+        values = (512 + 100 * np.sin(2 * np.pi * 50 * np.arange(2000) / 1000)).astype(int)
+        write(path, readings([1000] * 2000, values))
+        store = ColumnarStore(os.path.join(directory, 'store'))
+        reports, totals = analyse([path], workers=1, relative_micros=True, store=store,
+                                  fft_samples=1024, chunk_bytes=4096, progress=False)
+        name = os.path.basename(directory) + '-output'
+        report = reports[name]
+        assert report['count'] == 2000
+        assert report['last'] == pytest.approx(2.0)
+        assert report['fft'][0][0] == pytest.approx(50, abs=1)
+        times, stored = store.read(name)
+        assert list(stored) == list(values)
+
+def test_analysing_into_the_same_store_again():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'Room-1-LDR.csv')
+        write(path, readings(1500000000 + np.arange(1000) * 5, np.arange(1000)))
+        store = ColumnarStore(os.path.join(directory, 'store'))
+        reports, totals = analyse([path], workers=1, store=store, chunk_bytes=4096,
+                                  progress=False)
+        assert reports['Room-1-LDR']['already_stored'] == 0
+        # Nothing new, so nothing is appended
+        reports, totals = analyse([path], workers=1, store=store, chunk_bytes=4096,
+                                  progress=False)
+        assert reports['Room-1-LDR']['count'] == 1000
+        assert reports['Room-1-LDR']['already_stored'] == 1000
+        # Later rows are appended after what is there
+        write(path, readings(1500000000 + np.arange(1200) * 5, np.arange(1200)))
+        reports, totals = analyse([path], workers=1, store=store, chunk_bytes=4096,
+                                  progress=False)
+        assert reports['Room-1-LDR']['already_stored'] == 1000
+        times, values = store.read('Room-1-LDR')
+        assert list(values) == list(range(1200))
+
+def test_fft_peaks_of_too_few_samples():
+    assert fft_peaks(np.arange(3.0), np.arange(3.0)) == []
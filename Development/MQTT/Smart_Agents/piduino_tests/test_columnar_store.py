@@ -0,0 +1,195 @@
+import os
+import sys
+import tempfile
+import numpy as np
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+from columnar_store import ColumnarStore, ColumnarStream, convert_csv, conversion_order, main
+
+T0 = 1500000000.0
+
+def test_append_and_read_across_chunks():
+    with tempfile.TemporaryDirectory() as directory:
+        store = ColumnarStore(directory, chunk_size=10)
+        times = T0 + np.arange(25)
+        store.append('a', times[:7], np.arange(7))
+        store.append('a', times[7:], np.arange(7, 25))
+        stream = store.stream('a')
+        assert len(stream) == 25
+        assert [c['count'] for c in stream.index] == [10, 10, 5]
+        assert stream.index[1]['t_min'] == T0 + 10
+        assert stream.time_range() == (T0, T0 + 24)
+        t, v = store.read('a')
+        assert list(t) == list(times)
+        assert list(v) == list(range(25))
+        t, v = store.read('a', 8, 12)
+        assert list(v) == [8, 9, 10, 11]
+        t, v = store.read('a', -3)
+        assert list(v) == [22, 23, 24]
+        assert store.streams() == ['a']
+
+def test_chunks_are_memmapped():
+    with tempfile.TemporaryDirectory() as directory:
+        store = ColumnarStore(directory, chunk_size=4, value_dtype='<i2')
+        store.append('a', T0 + np.arange(6), [1, 2, 3, 4, 5, 6])
+        chunks = list(store.stream('a').chunks())
+        assert isinstance(chunks[0][1], np.memmap)
+        assert chunks[0][1].dtype == np.dtype('<i2')
+        assert list(chunks[1][1]) == [5, 6]
+        assert os.path.getsize(os.path.join(directory, 'a', 'chunk-000000.value')) == 8
+
+def test_timestamps_must_not_go_backwards():
+    with tempfile.TemporaryDirectory() as directory:
+        store = ColumnarStore(directory)
+        store.append('a', [T0, T0 + 1], [1, 2])
+        with pytest.raises(ValueError):
+            store.append('a', [T0], [3])
+        with pytest.raises(ValueError):
+            store.append('a', [T0 + 3, T0 + 2], [3, 4])
+        assert len(store.stream('a')) == 2
+
+def test_readers_see_only_indexed_samples_and_writer_recovers_tail():
+    with tempfile.TemporaryDirectory() as directory:
+        store = ColumnarStore(directory)
+        store.append('a', [T0, T0 + 1], [1, 2])
+        path = os.path.join(directory, 'a', 'chunk-000000')
+        # A writer killed part way through appending a sample
+        with open(path + '.time', 'ab') as f:
+            f.write(np.array([T0 + 2], '<f8').tobytes())
+        with open(path + '.value', 'ab') as f:
+            f.write(np.array([3], '<f8').tobytes()[:4])
+        assert len(store.stream('a')) == 2
+        stream = ColumnarStream(os.path.join(directory, 'a'), writable=True)
+        assert len(stream) == 2
+        assert os.path.getsize(path + '.time') == 16
+        stream.append([T0 + 2], [3])
+        assert list(store.read('a')[1]) == [1, 2, 3]
+
+def test_readers_refresh():
+    with tempfile.TemporaryDirectory() as directory:
+        store = ColumnarStore(directory)
+        store.append('a', [T0], [1])
+        reader = store.stream('a')
+        store.append('a', [T0 + 1], [2])
+        assert len(reader) == 1
+        reader.refresh()
+        assert len(reader) == 2
+
+def test_bad_names():
+    with tempfile.TemporaryDirectory() as directory:
+        store = ColumnarStore(directory)
+        for name in ['', '../a', '.hidden']:
+            with pytest.raises(ValueError):
+                store.append(name, [T0], [1])
+        with pytest.raises(KeyError):
+            store.stream('missing')
+
+def test_convert_csv():
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = os.path.join(directory, 'Room-1234-LDR.csv')
+        with open(csv_path, 'w') as f:
+            f.write('1500000000,455\n1500000001,bad\n1500000002,457\n1499999999,1\n1500000003,458\n')
+        store = ColumnarStore(os.path.join(directory, 'store'))
+        assert convert_csv(csv_path, store) == (3, 2)
+        t, v = store.read('Room-1234-LDR')
+        assert list(t) == [T0, T0 + 2, T0 + 3]
+        assert list(v) == [455, 457, 458]
+        # Converting it again adds nothing
+        assert convert_csv(csv_path, store) == (0, 5)
+        assert len(store.read('Room-1234-LDR')[0]) == 3
+
+def test_convert_relative_micros():
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = os.path.join(directory, 'output.csv')
+        with open(csv_path, 'w') as f:
+            f.write('1000,512\n500,600\n500,700\n')
+        store = ColumnarStore(os.path.join(directory, 'store'))
+        convert_csv(csv_path, store, relative_micros=True)
+        t, v = store.read('output')
+        assert list(t) == [0.001, 0.0015, 0.002]
+
+def test_rotated_files_are_converted_in_order():
+    paths = ['a.csv', 'a.20170725T000000.csv', 'b.csv', 'a.20170724T000000.csv']
+    assert conversion_order(paths) == ['a.20170724T000000.csv', 'a.20170725T000000.csv',
+                                       'a.csv', 'b.csv']
+
+def test_cli(capsys):
+    with tempfile.TemporaryDirectory() as directory:
+        for name, rows in [('a.20170724T000000.csv', '1,1\n2,2\n'), ('a.csv', '3,3\n')]:
+            with open(os.path.join(directory, name), 'w') as f:
+                f.write(rows)
+        store_path = os.path.join(directory, 'store')
+        files = [os.path.join(directory, 'a.csv'), os.path.join(directory, 'a.20170724T000000.csv')]
+        assert main(['convert', store_path] + files) == 0
+        assert main(['info', store_path]) == 0
+        assert 'a: 3 samples in 1 chunks' in capsys.readouterr().out
+
+def test_time_range_queries():
+    with tempfile.TemporaryDirectory() as directory:
+        store = ColumnarStore(directory, chunk_size=10)
+        # Two samples a second, with a gap between 20 s and 40 s
+        times = np.concatenate((T0 + np.arange(0, 20, 0.5), T0 + np.arange(40, 60, 0.5)))
+        store.append('a', times, np.arange(len(times)))
+        t, v = store.query('a', T0 + 5, T0 + 7)
+        assert list(t) == [T0 + 5, T0 + 5.5, T0 + 6, T0 + 6.5]
+        t, v = store.query('a', T0 + 19.6, T0 + 40.5)
+        assert list(t) == [T0 + 40]
+        assert len(store.query('a', T0 + 20, T0 + 40)[0]) == 0
+        assert len(store.query('a', T0 + 100)[0]) == 0
+        assert len(store.query('a', end=T0)[0]) == 0
+        assert len(store.latest('a', 10, now=T0 + 60)[0]) == 20
+        chunks = list(store.stream('a').iter_range(T0 + 4, T0 + 12))
+        assert [len(c[0]) for c in chunks] == [2, 10, 4]
+        assert isinstance(chunks[0][0], np.memmap)
+
+def test_rollups():
+    with tempfile.TemporaryDirectory() as directory:
+        store = ColumnarStore(directory, rollups=(1, 60))
+        times = T0 + np.arange(0, 150, 0.25)
+        values = np.arange(len(times)) % 7
+        store.append('a', times[:100], values[:100])
+        store.append('a', times[100:], values[100:])
+        minutes = store.query('a', resolution=60)
+        assert list(minutes['t']) == [T0 - T0 % 60, T0 - T0 % 60 + 60, T0 - T0 % 60 + 120]
+        assert minutes['count'].sum() == len(times)
+        # The last minute is still filling up and is not stored yet
+        assert store.stream('a').rollups[60].count == 2
+        seconds = store.query('a', T0 + 10.5, T0 + 13, resolution=1)
+        assert list(seconds['t']) == [T0 + 10, T0 + 11, T0 + 12]
+        assert seconds['count'][0] == 4
+        assert seconds['min'][0] == values[40:44].min()
+        assert seconds['max'][0] == values[40:44].max()
+        assert seconds['sum'][0] == values[40:44].sum()
+        with pytest.raises(KeyError):
+            store.query('a', resolution=3600)
+
+def test_rollups_catch_up_after_a_crash():
+    with tempfile.TemporaryDirectory() as directory:
+        store = ColumnarStore(directory, rollups=(1,))
+        store.append('a', T0 + np.arange(10), np.arange(10))
+        # Forget the rollup state, as if the writer died before saving it
+        os.remove(os.path.join(directory, 'a', 'rollup-1.json'))
+        stream = ColumnarStream(os.path.join(directory, 'a'), writable=True)
+        assert stream.rollups[1].count == 9
+        assert list(stream.rollup(1)['count']) == [1] * 10
+
+def test_full_chunks_are_compressed():
+    with tempfile.TemporaryDirectory() as directory:
+        store = ColumnarStore(directory, chunk_size=100, value_dtype='<i2',
+                              rollups=(60,), codec='delta-xor')
+        times = T0 + np.arange(250) * 0.5
+        values = 500 + np.arange(250) % 5
+        store.append('a', times[:150], values[:150])
+        store.append('a', times[150:], values[150:])
+        stream = store.stream('a')
+        assert [c.get('codec') for c in stream.index] == ['delta-xor', 'delta-xor', None]
+        assert sorted(os.listdir(os.path.join(directory, 'a')))[:4] == [
+            'chunk-000000.packed', 'chunk-000001.packed', 'chunk-000002.time', 'chunk-000002.value']
+        assert stream.disk_usage() < 100 * 16
+        t, v = store.read('a')
+        assert list(t) == list(times)
+        assert list(v) == list(values)
+        assert v.dtype == np.dtype('<i2')
+        t, v = store.query('a', T0 + 40, T0 + 60)
+        assert list(v) == list(values[80:120])
+        assert store.query('a', resolution=60)['count'].sum() == 250
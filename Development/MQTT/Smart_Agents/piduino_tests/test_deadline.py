@@ -0,0 +1,55 @@
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+import piduino
+from deadline import Deadline
+
+def test_deadline():
+    deadline = Deadline(0.05)
+    assert not deadline.expired()
+    assert 0 < deadline.remaining() <= 0.05
+    time.sleep(0.06)
+    assert deadline.expired()
+    assert deadline.remaining() == 0
+
+def test_no_timeout_never_expires():
+    assert Deadline(None).remaining() is None
+    assert not Deadline(None).expired()
+
+def open_pty_device():
+    # A pseudo terminal stands in for the Arduino's serial port
+    master, slave = os.openpty()
+    device = piduino.SerialDevice(os.ttyname(slave))
+    assert device.connect(timeout=0) is None
+    return master, slave, device
+
+def test_receive_json_waits_without_using_cpu():
+    master, slave, device = open_pty_device()
+    try:
+        wall, cpu = time.time(), time.process_time()
+        flag, message = device.receive_json(timeout=0.5)
+        wall, cpu = time.time() - wall, time.process_time() - cpu
+        assert type(flag) == piduino.ReadTimeoutError
+        assert 0.45 < wall < 1.0
+        # A busy wait would use about as much CPU as wall clock time
+        assert cpu < 0.1
+        assert device.stats.timeouts == 1
+    finally:
+        device.shutdown()
+        os.close(master)
+        os.close(slave)
+
+def test_receive_json_returns_as_soon_as_a_frame_arrives():
+    master, slave, device = open_pty_device()
+    try:
+        os.write(master, b'{"topic": "handshake", "payload": 1234}')
+        t0 = time.time()
+        flag, message = device.receive_json(timeout=5)
+        assert flag is None
+        assert message == {'topic': 'handshake', 'payload': 1234}
+        assert time.time() - t0 < 1
+    finally:
+        device.shutdown()
+        os.close(master)
+        os.close(slave)
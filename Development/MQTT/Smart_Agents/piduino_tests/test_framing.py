@@ -0,0 +1,46 @@
+import json
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+from framing import JsonFrameDecoder
+
+MESSAGES = [
+    {'topic': 'LDR', 'payload': 455},
+    {'topic': 'Text', 'payload': 'braces {inside} "quoted" \\ strings'},
+    {'topic': 'Nested', 'payload': {'a': [1, {'b': '}'}], 'c': {}}},
+]
+STREAM = b''.join(json.dumps(m).encode() for m in MESSAGES)
+
+def test_whole_stream():
+    assert JsonFrameDecoder().feed(STREAM) == MESSAGES
+
+def test_stream_split_at_every_position():
+    for split in range(len(STREAM)):
+        decoder = JsonFrameDecoder()
+        frames = decoder.feed(STREAM[:split]) + decoder.feed(STREAM[split:])
+        assert frames == MESSAGES, split
+
+def test_stream_one_byte_at_a_time():
+    decoder = JsonFrameDecoder()
+    frames = []
+    for i in range(len(STREAM)):
+        frames += decoder.feed(STREAM[i:i + 1])
+    assert frames == MESSAGES
+
+def test_garbage_between_frames_is_ignored():
+    decoder = JsonFrameDecoder()
+    assert decoder.feed(b'noise } " ' + STREAM) == MESSAGES
+
+def test_resynchronises_after_truncated_frame():
+    decoder = JsonFrameDecoder()
+    good = json.dumps(MESSAGES[0]).encode()
+    frames = decoder.feed(b'{"topic": "LDR", "payload": 4' + good)
+    assert frames == [MESSAGES[0]]
+    assert decoder.malformed == 1
+
+def test_resynchronises_after_oversized_frame():
+    decoder = JsonFrameDecoder(max_frame=64)
+    good = json.dumps(MESSAGES[0]).encode()
+    frames = decoder.feed(b'{"topic": "LDR", "payload": "' + good * 10 + good)
+    assert frames[-1] == MESSAGES[0]
+    assert decoder.malformed >= 1
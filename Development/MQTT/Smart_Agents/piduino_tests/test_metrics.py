@@ -0,0 +1,55 @@
+import os
+import sys
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+from metrics import Registry, MetricsServer
+
+def test_render_text_format():
+    registry = Registry(prefix='relay_')
+    counter = registry.counter('readings_total', 'Readings')
+    histogram = registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0))
+    registry.add_collector(lambda: [('device_bytes_total', {'device': '1234'}, 42)])
+    counter.inc(3)
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    text = registry.render()
+    assert '# TYPE relay_readings_total counter' in text
+    assert 'relay_readings_total 3' in text
+    assert 'relay_latency_seconds_bucket{le="0.1"} 1' in text
+    assert 'relay_latency_seconds_bucket{le="+Inf"} 2' in text
+    assert 'relay_device_bytes_total{device="1234"} 42' in text
+
+def test_snapshot_rates():
+    registry = Registry()
+    counter = registry.counter('frames_total', 'Frames')
+    registry.add_collector(lambda: [('bytes_total', {'device': '1'}, counter.value * 10)])
+    registry.snapshot(now=100.0)
+    counter.inc(50)
+    snapshot = registry.snapshot(now=110.0)
+    assert snapshot['values']['frames_total'] == 50
+    assert snapshot['rates']['frames_total'] == 5.0
+    assert snapshot['rates']['bytes_total{device="1"}'] == 50.0
+
+def test_histogram_quantile():
+    registry = Registry()
+    histogram = registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0, 10.0))
+    assert histogram.quantile(0.5) is None
+    for value in [0.05] * 9 + [5.0]:
+        histogram.observe(value)
+    assert histogram.quantile(0.5) == 0.1
+    assert histogram.quantile(0.99) == 10.0
+
+def test_metrics_server():
+    registry = Registry()
+    registry.counter('frames_total', 'Frames').inc()
+    server = MetricsServer(registry, 0)
+    server.start()
+    try:
+        port = server.httpd.server_address[1]
+        text = urlopen('http://127.0.0.1:%d/metrics' % port).read().decode()
+        assert 'frames_total 1' in text
+    finally:
+        server.shutdown()
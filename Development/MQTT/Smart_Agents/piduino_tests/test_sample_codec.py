@@ -0,0 +1,74 @@
+import os
+import sys
+import numpy as np
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+import sample_codec
+from sample_codec import encode, decode, pack, unpack, DecodeError
+
+T0 = 1500000000.0
+
+def assert_same(a, b):
+    assert a.dtype.itemsize == b.dtype.itemsize
+    assert a.tobytes() == b.tobytes()
+
+def test_adc_readings_compress_well():
+    rng = np.random.RandomState(0)
+    times = T0 + np.arange(10000) * 0.01
+    values = (512 + np.cumsum(rng.randint(-2, 3, 10000))).astype('<i2')
+    data = encode(times, values)
+    # 16 bytes a sample uncompressed
+    assert len(data) < 10000
+    decoded_times, decoded_values = decode(data, '<i2')
+    assert_same(decoded_times, times)
+    assert_same(decoded_values, values)
+
+@pytest.mark.parametrize('seed', range(20))
+def test_round_trip(seed):
+    rng = np.random.RandomState(seed)
+    count = rng.randint(1, 3000)
+    if seed % 2:
+        times = np.sort(rng.random_sample(count) * 1e9)
+    else:
+        times = T0 + np.cumsum(rng.randint(0, 5, count))
+    kind = seed % 4
+    if kind == 0:
+        values = rng.normal(size=count)
+    elif kind == 1:
+        values = rng.randint(-2 ** 62, 2 ** 62, count, dtype=np.int64)
+    elif kind == 2:
+        values = np.round(rng.normal(size=count) * 100)
+    else:
+        values = np.where(rng.random_sample(count) < 0.5, np.nan, -0.0)
+    data = encode(times, values, block_size=rng.randint(1, 2000))
+    decoded_times, decoded_values = decode(data, values.dtype)
+    assert_same(decoded_times, times)
+    assert_same(decoded_values, values)
+
+def test_wide_values_are_packed():
+    values = np.array([0, 2 ** 64 - 1, 2 ** 63, 12345], dtype=np.uint64)
+    shift, width, packed = pack(values)
+    assert (shift, width) == (0, 64)
+    assert list(unpack(packed, 0, 4, shift, width)[0]) == list(values)
+    values = np.array([8, 24, 2 ** 40], dtype=np.uint64)
+    shift, width, packed = pack(values)
+    assert (shift, width) == (3, 38)
+    assert list(unpack(packed, 0, 3, shift, width)[0]) == list(values)
+
+def test_empty():
+    times, values = decode(encode([], []))
+    assert len(times) == 0 and len(values) == 0
+
+def test_damaged_data():
+    data = encode(T0 + np.arange(100), np.arange(100))
+    with pytest.raises(DecodeError):
+        decode(b'junk' + data[4:])
+    with pytest.raises(DecodeError):
+        decode(data[:-3])
+
+def test_decimals_are_scaled():
+    values = np.array([20.1, 20.1, 20.2, 19.9, -0.3])
+    times = T0 + np.arange(5) * 5
+    data = encode(times, values)
+    assert data[sample_codec.HEADER.size + 3] == sample_codec.VALUE_SCALED
+    assert_same(decode(data)[1], values)
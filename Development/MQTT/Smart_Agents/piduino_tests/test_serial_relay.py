@@ -0,0 +1,102 @@
+import os
+import sys
+import json
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+import piduino
+import serial_relay
+from aggregation import Aggregation
+from batching import Batcher
+
+class FakeClient():
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.published.append((topic, payload))
+        return 0, len(self.published)
+
+    def unsubscribe(self, topic):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+class LostDevice():
+    # A verified device whose port has gone away
+    def __init__(self, name, comport):
+        self.name = name
+        self.comport = comport
+        self.connected = True
+        self.verified = True
+        self.error = False
+
+    def ready(self):
+        return piduino.NotConnectedError("The device is not connected"), False
+
+    def shutdown(self):
+        return None
+
+@pytest.fixture
+def relay(monkeypatch):
+    monkeypatch.setattr(serial_relay, 'aggregator', Aggregation({
+        '+/LDR': {'window': 10}, '+/Temperature': {'deadband': 1}}), raising=False)
+    monkeypatch.setattr(serial_relay, 'batcher', Batcher(), raising=False)
+    monkeypatch.setattr(serial_relay, 'uplink', None, raising=False)
+    monkeypatch.setattr(serial_relay, 'rawWriters', None, raising=False)
+    monkeypatch.setattr(serial_relay, 'metricsServer', None, raising=False)
+    monkeypatch.setattr(serial_relay, 'connectedEdgeDevices', [], raising=False)
+    monkeypatch.setattr(serial_relay, 'seenComports', set(), raising=False)
+    monkeypatch.setattr(serial_relay, 'connected', True, raising=False)
+    monkeypatch.setattr(serial_relay, 'shouldBeConnected', True, raising=False)
+    monkeypatch.setattr(serial_relay, 'METRICS_INTERVAL', 0)
+    monkeypatch.setattr(serial_relay, 'LOGGING', False)
+    monkeypatch.setattr(serial_relay, 'TOPIC_EDGE', 'agent/private/edge/', raising=False)
+    monkeypatch.setattr(serial_relay, 'TOPIC_HELLO', 'broker-services/hello/agent', raising=False)
+    monkeypatch.setattr(serial_relay, 'TOPIC_STATUS', 'agent/private/status', raising=False)
+    monkeypatch.setattr(serial_relay, 'AGENTNAME', 'agent')
+    registry, relayMetrics = serial_relay.setup_metrics()
+    monkeypatch.setattr(serial_relay, 'relayMetrics', relayMetrics, raising=False)
+    return serial_relay
+
+def add_readings(relay, client, name, now):
+    device = LostDevice(name, 'port-' + name)
+    for i, value in enumerate([400, 410, 420]):
+        relay.publish_reading(client, device, {'topic': 'LDR', 'payload': value}, now + i)
+    for value in [20.0, 20.5]:
+        relay.publish_reading(client, device, {'topic': 'Temperature', 'payload': value}, now + 3)
+    return device
+
+def flushed(client, name):
+    windows = [json.loads(payload) for topic, payload in client.published
+               if topic == 'agent/public/' + name + '/input/LDR/agg']
+    readings = [payload.split()[1] for topic, payload in client.published
+                if topic == 'agent/public/' + name + '/input/Temperature']
+    return windows, readings
+
+def test_open_windows_are_published_when_a_device_is_lost(relay, monkeypatch):
+    client = FakeClient()
+    device = add_readings(relay, client, '1234', 1000.0)
+    other = add_readings(relay, client, '5678', 1000.0)
+    monkeypatch.setattr(relay, 'SERIAL_PORTS', [device.comport])
+    relay.connectedEdgeDevices = [device]
+    relay.mainloop(client)
+    windows, readings = flushed(client, '1234')
+    assert [(w['count'], w['mean'], w['partial']) for w in windows] == [(3, 410, True)]
+    # The deadband held back 20.5
+    assert readings == ['20.0', '20.5']
+    # The other device's window has closed by now, but is not cut short
+    windows, readings = flushed(client, '5678')
+    assert [w.get('partial') for w in windows] == [None]
+    assert readings == ['20.0']
+
+def test_open_windows_are_published_on_shutdown(relay):
+    client = FakeClient()
+    add_readings(relay, client, '1234', 1000.0)
+    relay.clean_up(client)
+    windows, readings = flushed(client, '1234')
+    assert [(w['count'], w['t'], w['partial']) for w in windows] == [(3, 1010.0, True)]
+    assert readings == ['20.0', '20.5']
@@ -0,0 +1,148 @@
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+from store_forward import SegmentQueue, StoreAndForward
+
+class FakeClient():
+    def __init__(self):
+        self.mid = 0
+        self.rc = 0
+        self.published = []
+
+    def publish(self, topic, payload, qos=0):
+        self.mid += 1
+        self.published.append((self.mid, topic, payload))
+        return self.rc, self.mid
+
+def test_queue_survives_restart(tmpdir):
+    queue = SegmentQueue(str(tmpdir), segment_bytes=64, max_bytes=1024)
+    for i in range(10):
+        queue.put('a/b', str(i))
+    position, record = queue.get()
+    assert record == ('a/b', '0', 1, None)
+    queue.commit(position)
+    queue.close()
+
+    queue = SegmentQueue(str(tmpdir), segment_bytes=64, max_bytes=1024)
+    assert [queue.get()[1][1] for i in range(9)] == [str(i) for i in range(1, 10)]
+    assert queue.get() is None
+
+def test_partial_record_is_truncated_on_restart(tmpdir):
+    queue = SegmentQueue(str(tmpdir))
+    queue.put('a/b', 'complete')
+    queue.close()
+    segment = os.path.join(str(tmpdir), '000000000001.seg')
+    with open(segment, 'ab') as f:
+        f.write(b'\x00\x00\x00\x40partial')
+    queue = SegmentQueue(str(tmpdir))
+    assert queue.get()[1][1] == 'complete'
+    assert queue.get() is None
+
+def test_oldest_segments_are_evicted(tmpdir):
+    queue = SegmentQueue(str(tmpdir), segment_bytes=100, max_bytes=300)
+    for i in range(100):
+        queue.put('a/b', str(i))
+    assert queue.dropped_segments > 0
+    assert queue.backlog_bytes() <= 300 + 100
+    first = queue.get()[1][1]
+    assert int(first) > 0
+
+def test_records_committed_only_when_acknowledged_in_order(tmpdir):
+    queue = SegmentQueue(str(tmpdir))
+    uplink = StoreAndForward(queue, rate=1000, max_inflight=5)
+    client = FakeClient()
+    for i in range(10):
+        uplink.put('a/b', str(i))
+    assert uplink.drain(client, now=uplink.last_drain + 1) == 5
+    uplink.handle_publish(2)
+    assert queue.committed == (1, 0)
+    uplink.handle_publish(1)
+    assert uplink.inflight_count() == 3
+    # Lose the connection: everything after the acknowledged messages is resent
+    uplink.handle_disconnect()
+    client.published = []
+    uplink.drain(client, now=uplink.last_drain + 1)
+    assert [p[2] for p in client.published] == [str(i) for i in range(2, 7)]
+
+def test_drain_is_rate_limited(tmpdir):
+    queue = SegmentQueue(str(tmpdir))
+    uplink = StoreAndForward(queue, rate=10, max_inflight=100)
+    client = FakeClient()
+    for i in range(50):
+        uplink.put('a/b', str(i))
+    assert uplink.drain(client, now=uplink.last_drain + 0.5) == 5
+
+def test_only_acks_for_drained_messages_are_kept(tmpdir):
+    queue = SegmentQueue(str(tmpdir))
+    uplink = StoreAndForward(queue, rate=1000, max_inflight=5)
+    client = FakeClient()
+    # Acks for messages published directly on the client (status, pings)
+    for mid in range(1, 1000):
+        uplink.handle_publish(mid)
+    assert uplink.early_acks == set()
+    # So a queued record given one of their mids waits for its own PUBACK
+    uplink.put('a/b', '0')
+    uplink.drain(client, now=uplink.last_drain + 1)
+    assert uplink.inflight_count() == 1
+    assert queue.committed == (1, 0)
+
+def test_ack_arriving_before_publish_returns(tmpdir):
+    queue = SegmentQueue(str(tmpdir))
+    uplink = StoreAndForward(queue, rate=1000, max_inflight=5)
+
+    class FastClient(FakeClient):
+        def publish(self, topic, payload, qos=0):
+            rc, mid = FakeClient.publish(self, topic, payload, qos)
+            # The broker acks on the network thread before publish() returns
+            uplink.handle_publish(mid)
+            return rc, mid
+
+    for i in range(3):
+        uplink.put('a/b', str(i))
+    assert uplink.drain(FastClient(), now=uplink.last_drain + 1) == 3
+    assert uplink.inflight_count() == 0
+    assert uplink.early_acks == set()
+    assert queue.get() is None
+
+def test_latency_is_observed_when_first_published(tmpdir):
+    class Latency():
+        def __init__(self):
+            self.observed = []
+
+        def observe(self, value):
+            self.observed.append(value)
+
+    queue = SegmentQueue(str(tmpdir))
+    latency = Latency()
+    uplink = StoreAndForward(queue, rate=1000, max_inflight=5, latency=latency)
+    client = FakeClient()
+    received = time.time() - 10
+    uplink.put('a/b', '0', received=received)
+    uplink.put('a/b', '1')
+    assert queue.get()[1] == ('a/b', '0', 1, received)
+    queue.rewind()
+    uplink.drain(client, now=uplink.last_drain + 1)
+    assert len(latency.observed) == 1 and latency.observed[0] >= 10
+    # Not again when it is resent after a disconnect
+    uplink.handle_disconnect()
+    uplink.drain(client, now=uplink.last_drain + 1)
+    assert len(client.published) == 4
+    assert len(latency.observed) == 1
+
+def test_ack_arriving_before_the_mid_is_registered(tmpdir):
+    queue = SegmentQueue(str(tmpdir))
+    client = FakeClient()
+
+    class AckingLatency():
+        # Observed after publish() has returned, but before drain() has
+        # recorded the mid as in flight
+        def observe(self, value):
+            uplink.handle_publish(client.mid)
+
+    uplink = StoreAndForward(queue, rate=1000, max_inflight=3, latency=AckingLatency())
+    for i in range(6):
+        uplink.put('a/b', str(i), received=time.time())
+    assert uplink.drain(client, now=uplink.last_drain + 1) == 6
+    assert uplink.inflight_count() == 0
+    assert queue.get() is None
@@ -0,0 +1,98 @@
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+import piduino
+from virtual_arduino import VirtualBoards, VirtualArduino
+
+def connect(board):
+    device = piduino.SerialDevice(board.port)
+    assert device.connect(timeout=0) is None
+    # Let the board notice the port opening and boot
+    time.sleep(board.boot_delay + 0.1)
+    device.flush()
+    return device
+
+def handshake(device, binary_baud=None):
+    device.handshake_request(binary_baud=binary_baud)
+    deadline = piduino.Deadline(2)
+    while not deadline.expired():
+        flag, message = device.receive_json(timeout=deadline.remaining())
+        assert flag is None
+        if message['topic'] == 'handshake':
+            assert device.accept_handshake(message) is None
+            return message
+    raise AssertionError('No handshake')
+
+def test_json_handshake_and_readings():
+    with VirtualBoards() as boards:
+        board = boards.add(VirtualArduino(interval=0.05, binary=False, boot_delay=0.05))
+        device = connect(board)
+        reply = handshake(device, binary_baud=115200)
+        assert reply == {'topic': 'handshake', 'payload': board.device_id}
+        assert not device.binary
+        topics = set(device.receive_json(timeout=1)[1]['topic'] for i in range(8))
+        assert topics == set(['Movement', 'LDR', 'Temperature', 'Humidity'])
+        device.shutdown()
+
+def test_binary_handshake_and_output():
+    with VirtualBoards() as boards:
+        board = boards.add(VirtualArduino(interval=0.05, boot_delay=0.05))
+        device = connect(board)
+        handshake(device, binary_baud=57600)
+        assert device.binary and device.baudrate == 57600 and board.baud == 57600
+        flag, message = device.receive_json(timeout=1)
+        assert flag is None and message['topic'] in board.topic_table
+        assert device.send({'topic': 'LED', 'payload': '1'}) is None
+        time.sleep(0.1)
+        assert board.output_values == {'LED': '1'}
+        device.shutdown()
+
+def test_reopening_the_port_resets_the_board():
+    with VirtualBoards() as boards:
+        board = boards.add(VirtualArduino(boot_delay=0.05))
+        connect(board).shutdown()
+        time.sleep(0.1)
+        connect(board).shutdown()
+        assert board.stats.resets == 3
+
+def test_echo():
+    with VirtualBoards() as boards:
+        board = boards.add(VirtualArduino(echo=True, boot_delay=0.05, emulate_baud=False))
+        device = connect(board)
+        device.ser.write(b'<11:11:11:11:11:11|' + board.address.encode() + b'|a\\<b\\|c\\\\>')
+        time.sleep(0.1)
+        reply = device.receive_string()
+        assert reply == '<98:D3:32:10:8E:5D|11:11:11:11:11:11|a\\<b\\|c\\\\>\r\n'
+        device.shutdown()
+
+def test_faults():
+    with VirtualBoards() as boards:
+        board = boards.add(VirtualArduino(interval=0.01, boot_delay=0.05, emulate_baud=False,
+                                          garble=0.5, disconnect_after=0.5, seed=1))
+        device = connect(board)
+        while True:
+            flag, message = device.receive_json(timeout=2)
+            if flag:
+                break
+        assert type(flag) == piduino.NotConnectedError
+        assert board.stats.garbled > 0
+        assert device.stats.malformed_frames > 0
+        device.shutdown()
+
+def test_frames_are_timed_when_read():
+    with VirtualBoards() as boards:
+        board = boards.add(VirtualArduino(interval=0.01, binary=False, boot_delay=0.05,
+                                          emulate_baud=False))
+        device = connect(board)
+        time.sleep(0.2)
+        flag, message = device.receive_json(timeout=1)
+        first = device.stats.last_frame_time
+        # The rest arrived in the same read, so were read at the same time
+        # however long they wait to be returned
+        time.sleep(0.2)
+        flag, message = device.receive_json(timeout=1)
+        assert flag is None
+        assert device.stats.last_frame_time == first
+        assert time.time() - first >= 0.2
+        device.shutdown()
@@ -0,0 +1,63 @@
+import os
+import sys
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+from writer_pool import WriterPool
+
+T0 = 1500000000.0
+
+def read(directory, name):
+    with open(os.path.join(directory, name), newline='') as f:
+        return f.read()
+
+def test_rows_are_buffered_until_flush_interval():
+    with tempfile.TemporaryDirectory() as directory:
+        pool = WriterPool(directory, flush_interval=5.0)
+        pool.write('a', [1, 455], now=T0)
+        pool.write('a', [2, 456], now=T0 + 1)
+        assert read(directory, 'a.csv') == ''
+        pool.poll(now=T0 + 5)
+        assert read(directory, 'a.csv') == '1,455\r\n2,456\r\n'
+        pool.close()
+
+def test_size_flush():
+    with tempfile.TemporaryDirectory() as directory:
+        pool = WriterPool(directory, flush_bytes=20)
+        for i in range(5):
+            pool.write('a', [i, 'x' * 5], now=T0)
+        assert read(directory, 'a.csv').count('\n') >= 2
+        pool.close()
+        assert read(directory, 'a.csv').count('\n') == 5
+
+def test_least_recently_written_stream_is_closed():
+    with tempfile.TemporaryDirectory() as directory:
+        pool = WriterPool(directory, max_open=2)
+        for name in ['a', 'b', 'a', 'c', 'b']:
+            pool.write(name, [name], now=T0)
+            assert pool.open_count() <= 2
+        # b was evicted when c was opened, then reopened
+        assert pool.evictions == 2
+        pool.close()
+        assert read(directory, 'a.csv') == 'a\r\na\r\n'
+        assert read(directory, 'b.csv') == 'b\r\nb\r\n'
+        assert read(directory, 'c.csv') == 'c\r\n'
+
+def test_size_rotation():
+    with tempfile.TemporaryDirectory() as directory:
+        pool = WriterPool(directory, flush_bytes=1, rotate_bytes=30)
+        for i in range(10):
+            pool.write('a', [T0 + i, 455], now=T0 + i)
+        pool.close()
+        files = sorted(os.listdir(directory))
+        assert len(files) > 1 and 'a.csv' in files
+        rows = ''.join(read(directory, f) for f in files)
+        assert rows.count('\n') == 10
+
+def test_interval_rotation():
+    with tempfile.TemporaryDirectory() as directory:
+        pool = WriterPool(directory, rotate_interval=3600)
+        pool.write('a', [1], now=T0)
+        pool.write('a', [2], now=T0 + 3600)
+        pool.close()
+        assert read(directory, 'a.csv') == '2\r\n'
+        assert read(directory, 'a.20170714T034000.csv') == '1\r\n'
@@ -0,0 +1,159 @@
+'''
+Simulates a network of hubs around a piduino Coordinator on this machine
+and measures forwarding latency and throughput as the number of hubs grows.
+
+Each hub is a RelayEngine routing as BTServer.relay does (its own devices
+directly, everything else up a TCP link to the coordinator), with local
+socket pairs standing in for its bluetooth devices. Everything runs in one
+thread, polling the coordinator and each hub in turn, so the latency
+includes waiting for the other hubs' turns - as on a real network, where
+each hub is its own machine, it would be lower.
+
+Every packet goes device -> hub -> coordinator -> hub -> device. Routes are
+learned before measuring (one packet from every device), so nothing is
+flooded.
+
+Usage:
+    python3 bench_coordinator.py [packets]
+'''
+import os
+import random
+import socket
+import sys
+import time
+import warnings
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+with warnings.catch_warnings():
+    # piduino warns when bluetooth is missing, which is fine here
+    warnings.simplefilter('ignore')
+    from piduino import Coordinator
+    from relay import RelayEngine, packet_destination
+    from routing import Peer
+    from utils import PacketReassembler
+
+DEVICES_PER_HUB = 4
+
+
+class Device(object):
+    def __init__(self, hub, number):
+        self.address = '98:D3:31:00:%02X:%02X' % (hub, number)
+        self.sock, self.remote = socket.socketpair()
+        self.remote.setblocking(False)
+        self.reassembler = PacketReassembler()
+        self.pending = memoryview(b'')
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def drain(self):
+        packets = 0
+        try:
+            while True:
+                packets += len(self.reassembler.feed(self.remote.recv(65536)))
+        except socket.error:
+            pass
+        return packets
+
+
+def make_hub(port, number):
+    uplink = Peer.connect('127.0.0.1', port, address='COORDINATOR')
+
+    def route(link, packet):
+        destination = packet_destination(packet)
+        if destination in engine.links:
+            return destination
+        return uplink.address if link.device is not uplink else None
+
+    engine = RelayEngine(router=route)
+    engine.add(uplink)
+    devices = [Device(number, i) for i in range(DEVICES_PER_HUB)]
+    for device in devices:
+        engine.add(device)
+    return engine, devices
+
+
+def packet(source, destination, message):
+    return ('<%s|%s|%s>' % (source.address, destination.address, message)).encode()
+
+
+def poll_all(engines):
+    for engine in engines:
+        engine.poll(0)
+
+
+def other_hub_pair(hubs):
+    # A source and a destination on different hubs
+    first, second = random.sample(range(len(hubs)), 2)
+    return random.choice(hubs[first][1]), random.choice(hubs[second][1])
+
+
+def latency(engines, hubs, count):
+    times = []
+    for i in range(count):
+        source, destination = other_hub_pair(hubs)
+        start = time.perf_counter()
+        source.remote.sendall(packet(source, destination, 'reading %d' % i))
+        while not destination.drain():
+            poll_all(engines)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2], times[int(len(times) * 0.99)]
+
+
+def throughput(engines, hubs, count):
+    devices = [device for engine, hub_devices in hubs for device in hub_devices]
+    per_device = max(count // len(devices), 1)
+    for device in devices:
+        source, destination = other_hub_pair(hubs)
+        device.pending = memoryview(packet(device, destination, 'x' * 40) * per_device)
+    start = time.perf_counter()
+    received = 0
+    while received < per_device * len(devices):
+        for device in devices:
+            if len(device.pending):
+                try:
+                    device.pending = device.pending[device.remote.send(device.pending):]
+                except socket.error:
+                    pass
+        poll_all(engines)
+        for device in devices:
+            received += device.drain()
+    return received / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    random.seed(0)
+    print('%5s %8s %14s %14s %12s %10s' % ('hubs', 'devices', 'median (us)', '99th pct (us)',
+                                            'packets/s', 'flooded'))
+    for hub_count in [2, 4, 8, 16]:
+        coordinator = Coordinator(host='127.0.0.1', port=0)
+        hubs = [make_hub(coordinator.port, i) for i in range(hub_count)]
+        engines = [coordinator] + [engine for engine, devices in hubs]
+        while len(coordinator.engine.links) < hub_count:
+            poll_all(engines)
+        # Teach the coordinator every route
+        everyone = [device for engine, devices in hubs for device in devices]
+        for number, (engine, devices) in enumerate(hubs):
+            neighbour = hubs[(number + 1) % hub_count][1][0]
+            for device in devices:
+                device.remote.sendall(packet(device, neighbour, 'hello'))
+        end = time.time() + 5
+        while len(coordinator.routing_table) < len(everyone) and time.time() < end:
+            poll_all(engines)
+        for device in everyone:
+            device.drain()
+        flooded = coordinator.flooded
+
+        median, slowest = latency(engines, hubs, count)
+        rate = throughput(engines, hubs, count * 10)
+        print('%5d %8d %14.1f %14.1f %12.0f %10d' % (
+            hub_count, len(everyone), median * 1e6, slowest * 1e6, rate,
+            coordinator.flooded - flooded))
+        for engine, devices in hubs:
+            engine.links['COORDINATOR'].device.sock.close()
+            engine.close()
+            for device in devices:
+                device.sock.close()
+                device.remote.close()
+        coordinator.close()
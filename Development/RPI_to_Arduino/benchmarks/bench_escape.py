@@ -0,0 +1,93 @@
+'''
+Compares piduino.utils escape() and unpackage() with the previous
+implementations (inserting escapes by slicing, and growing each field one
+character at a time) over a range of message sizes and densities of special
+characters, for str and bytes messages.
+
+Usage:
+    python3 bench_escape.py [largest message size]
+
+Times are per message. The previous implementations are skipped ('-') where
+they would take too long, as escape() took quadratic time.
+'''
+import os
+import random
+import sys
+import timeit
+import warnings
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+with warnings.catch_warnings():
+    # utils warns when bluetooth is missing, which is fine here
+    warnings.simplefilter('ignore')
+    from utils import escape, unpackage, TO_ESCAPE, PACKET_DIVIDE, ESCAPE
+
+BT = "11:11:11:11:11:11"
+DENSITIES = [0.0, 0.01, 0.1, 0.5]
+# Skip the previous implementations when size * size * density is above this
+SLOW_LIMIT = 2e9
+
+
+def slicing_escape(text):
+    '''escape() before it was made linear'''
+    currentIndex = 0
+    while currentIndex < len(text):
+        if text[currentIndex] in TO_ESCAPE:
+            text = text[:currentIndex] + ESCAPE + text[currentIndex:]
+            currentIndex += 1
+        currentIndex += 1
+    return text
+
+
+def char_by_char_unpackage(packaged_message):
+    '''unpackage() before it was made linear'''
+    packetData = [""]
+    charIsEscaped = False
+    for currentChar in packaged_message[1:-1]:
+        if currentChar == PACKET_DIVIDE and not charIsEscaped:
+            packetData.append("")
+            continue
+        if (currentChar == ESCAPE and charIsEscaped) or currentChar != ESCAPE:
+            packetData[-1] += currentChar
+        charIsEscaped = currentChar == ESCAPE and not charIsEscaped
+    return tuple(packetData)
+
+
+def message(size, density, rng):
+    return "".join(rng.choice(TO_ESCAPE) if rng.random() < density
+                   else rng.choice("abcdefghij0123456789")
+                   for i in range(size))
+
+
+def per_call(function, argument):
+    timer = timeit.Timer(lambda: function(argument))
+    number, total = timer.autorange()
+    return min([total] + timer.repeat(2, number)) / number
+
+
+def show(seconds):
+    if seconds is None:
+        return '%10s' % '-'
+    return '%10.1f' % (seconds * 1e6)
+
+
+if __name__ == '__main__':
+    largest = int(sys.argv[1]) if len(sys.argv) > 1 else 262144
+    sizes = [size for size in [64, 1024, 16384, 262144, 4194304] if size <= largest]
+    rng = random.Random(0)
+    print('%8s %8s | %10s %10s %10s | %10s %10s %10s   (microseconds)' % (
+        'size', 'density', 'escape', 'bytes', 'previous',
+        'unpackage', 'bytes', 'previous'))
+    for size in sizes:
+        for density in DENSITIES:
+            text = message(size, density, rng)
+            data = text.encode()
+            packet = "<" + BT + "|" + BT + "|" + escape(text) + ">"
+            slow = size * size * density <= SLOW_LIMIT
+            print('%8d %8g | %s %s %s | %s %s %s' % (
+                size, density,
+                show(per_call(escape, text)),
+                show(per_call(escape, data)),
+                show(per_call(slicing_escape, text) if slow else None),
+                show(per_call(unpackage, packet)),
+                show(per_call(unpackage, packet.encode())),
+                show(per_call(char_by_char_unpackage, packet) if slow else None)))
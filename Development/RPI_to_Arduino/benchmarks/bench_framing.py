@@ -0,0 +1,54 @@
+'''
+Measures how fast piduino.framing decodes newline delimited JSON messages
+arriving in chunks of various sizes, against the most an RFCOMM link
+carries (about 2.1 Mbit/s over the air for Bluetooth 2.0 EDR, as on the
+HC-05, and less in practice), to check that decoding keeps up.
+
+Usage:
+    python3 bench_framing.py [megabytes]
+'''
+import os
+import sys
+import time
+import warnings
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore')
+    from framing import LineDecoder, MessageDecoder, encode
+
+RFCOMM_BYTES_PER_SECOND = 2.1e6 / 8
+# 1008 is a typical RFCOMM MTU
+CHUNK_SIZES = [16, 127, 1008, 4096, 65536]
+
+
+def stream(size, payload):
+    message = encode({'source': 'PiduinoA', 'type': 'reading', 'payload': payload})
+    count = max(size // len(message), 1)
+    return message * count, count
+
+
+def measure(decoder_class, data, count, chunk_size):
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    decoder = decoder_class()
+    start = time.perf_counter()
+    decoded = 0
+    for chunk in chunks:
+        decoded += len(decoder.feed(chunk))
+    elapsed = time.perf_counter() - start
+    assert decoded == count
+    return len(data) / elapsed
+
+
+if __name__ == '__main__':
+    size = int(float(sys.argv[1]) * 1e6) if len(sys.argv) > 1 else 4000000
+    print('%-15s %8s %10s %14s %14s' % ('decoder', 'message', 'chunk', 'MB/s',
+                                        'x RFCOMM'))
+    for payload in ['21.5', 'x' * 900]:
+        data, count = stream(size, payload)
+        message_size = len(data) // count
+        for decoder_class in [LineDecoder, MessageDecoder]:
+            for chunk_size in CHUNK_SIZES:
+                rate = measure(decoder_class, data, count, chunk_size)
+                print('%-15s %8d %10d %14.1f %14.0f' % (
+                    decoder_class.__name__, message_size, chunk_size, rate / 1e6,
+                    rate / RFCOMM_BYTES_PER_SECOND))
@@ -0,0 +1,239 @@
+'''
+Measures the latency and throughput of a link with different
+linkconfig.LinkSettings - send batching, the L2CAP MTU and the ACL flush
+timeout - and saves the best settings for piduino to use
+(BTServer(link_settings=...)).
+
+The far end echoes everything back. Latency is the round trip of one small
+message at a time; throughput is how fast a stream of messages is echoed,
+sent one message per send or joined into batches.
+
+Usage:
+    python3 bench_link.py [local|tcp] [options]
+        Against a stand-in on this machine (a socket pair, or TCP over
+        loopback) when there is no adapter - only batching and the socket
+        buffers mean anything here
+    python3 bench_link.py server rfcomm|l2cap
+        Run on the far end (another Pi) to echo
+    python3 bench_link.py rfcomm|l2cap ADDRESS [options]
+        Against the far end at ADDRESS
+
+Options:
+    --messages N    messages per throughput run (default 2000)
+    --size N        bytes per message (default 64)
+    --save FILE     add the best settings to a link settings file, for
+                    ADDRESS (or for every link, "*", on a stand-in)
+
+Flush timeouts are only tried over bluetooth, and need root.
+'''
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+import warnings
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+with warnings.catch_warnings():
+    # linkconfig warns when bluetooth is missing, which is fine here
+    warnings.simplefilter('ignore')
+    from linkconfig import (LinkSettings, DEFAULT, load_link_settings,
+                            save_link_settings, bluetooth)
+
+RFCOMM_CHANNEL = 1
+L2CAP_PSM = 0x1001
+# The L2CAP MTU that links start with
+DEFAULT_MTU = 672
+BATCH_SIZES = [0, 256, 1008, 4096]
+MTUS = [DEFAULT_MTU, 1691, 4096, 65535]
+FLUSH_TIMEOUTS = [None, 20, 100]
+LATENCY_ROUNDS = 200
+
+
+def echo(sock):
+    try:
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            sock.sendall(data)
+    except (IOError, OSError):
+        pass
+    sock.close()
+
+
+def serve(protocol):
+    if protocol == 'rfcomm':
+        server = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+        server.bind(('', RFCOMM_CHANNEL))
+    else:
+        server = bluetooth.BluetoothSocket(bluetooth.L2CAP)
+        server.bind(('', L2CAP_PSM))
+    server.listen(1)
+    while True:
+        print('Waiting for a connection')
+        sock, address = server.accept()
+        print('Echoing for %s' % str(address))
+        if protocol == 'l2cap':
+            # The client picks the MTU it is measuring
+            bluetooth.set_l2cap_mtu(sock, 65535)
+        threading.Thread(target=echo, args=(sock,)).start()
+
+
+class StandIn(object):
+    '''A socket pair or loopback TCP connection, with an echo thread'''
+    def __init__(self, kind):
+        if kind == 'tcp':
+            server = socket.socket()
+            server.bind(('127.0.0.1', 0))
+            server.listen(1)
+            self.sock = socket.create_connection(server.getsockname())
+            far, _ = server.accept()
+            server.close()
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            self.sock, far = socket.socketpair()
+        threading.Thread(target=echo, args=(far,), daemon=True).start()
+
+    def close(self):
+        self.sock.close()
+
+
+def connect(protocol, address, settings):
+    if protocol in ('local', 'tcp'):
+        link = StandIn(protocol)
+        sock = link.sock
+    elif protocol == 'rfcomm':
+        sock = link = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+        sock.connect((address, RFCOMM_CHANNEL))
+    else:
+        sock = link = bluetooth.BluetoothSocket(bluetooth.L2CAP)
+        sock.connect((address, L2CAP_PSM))
+    remote = address if protocol in ('rfcomm', 'l2cap') else None
+    for error in settings.apply(sock, remote):
+        print('  could not apply %r: %s' % (settings, error))
+    return link, sock
+
+
+def receive_exactly(sock, size):
+    received = 0
+    while received < size:
+        data = sock.recv(65536)
+        if not data:
+            raise IOError('Connection closed')
+        received += len(data)
+    return received
+
+
+def latency(sock, size):
+    message = b'x' * (size - 1) + b'\n'
+    times = []
+    for i in range(LATENCY_ROUNDS):
+        start = time.perf_counter()
+        sock.sendall(message)
+        receive_exactly(sock, len(message))
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return statistics.median(times), times[int(len(times) * 0.99)]
+
+
+def batches(messages, batch_bytes):
+    # What is sent in each send: the messages, joined up to batch_bytes
+    if not batch_bytes:
+        return messages
+    joined = []
+    batch = []
+    size = 0
+    for message in messages:
+        if batch and size + len(message) > batch_bytes:
+            joined.append(b''.join(batch))
+            batch = []
+            size = 0
+        batch.append(message)
+        size += len(message)
+    if batch:
+        joined.append(b''.join(batch))
+    return joined
+
+
+def throughput(sock, settings, count, size):
+    messages = [b'%0*d\n' % (size - 1, i) for i in range(count)]
+    sends = batches(messages, settings.batch_bytes)
+    total = sum(len(message) for message in messages)
+    received = [0]
+
+    def read():
+        received[0] = receive_exactly(sock, total)
+    reader = threading.Thread(target=read)
+    start = time.perf_counter()
+    reader.start()
+    for data in sends:
+        sock.sendall(data)
+    reader.join()
+    return total / (time.perf_counter() - start)
+
+
+def candidates(protocol, size):
+    batch_sizes = [b for b in BATCH_SIZES if b == 0 or b >= size]
+    if protocol == 'l2cap':
+        # Each send is one L2CAP packet, so a batch must fit in the MTU
+        for mtu in MTUS:
+            for batch_bytes in batch_sizes:
+                if batch_bytes <= mtu:
+                    yield LinkSettings(batch_bytes=batch_bytes, l2cap_mtu=mtu)
+    else:
+        for batch_bytes in batch_sizes:
+            yield LinkSettings(batch_bytes=batch_bytes)
+    if protocol in ('rfcomm', 'l2cap') and os.geteuid() == 0:
+        for flush_timeout in FLUSH_TIMEOUTS[1:]:
+            yield LinkSettings(batch_bytes=max(batch_sizes), flush_timeout=flush_timeout,
+                               l2cap_mtu=DEFAULT_MTU if protocol == 'l2cap' else None)
+
+
+def run(protocol, address, count, size):
+    print('%-60s %12s %14s %12s' % ('settings', 'median (us)', '99th pct (us)', 'kB/s'))
+    results = []
+    for settings in candidates(protocol, size):
+        link, sock = connect(protocol, address, settings)
+        try:
+            median, slowest = latency(sock, size)
+            rate = throughput(sock, settings, count, size)
+        finally:
+            link.close()
+        print('%-60r %12.1f %14.1f %12.1f' % (settings, median * 1e6, slowest * 1e6,
+                                             rate / 1e3))
+        results.append((rate, median, settings))
+    # The fastest, of those whose latency is not much worse than the best
+    best_latency = min(median for rate, median, settings in results)
+    rate, median, best = max(r for r in results if r[1] <= 2 * best_latency)
+    print('Best: %r' % best)
+    return best
+
+
+def option(args, name, default):
+    if name in args:
+        index = args.index(name)
+        value = args[index + 1]
+        del args[index:index + 2]
+        return value
+    return default
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    count = int(option(args, '--messages', 2000))
+    size = int(option(args, '--size', 64))
+    save = option(args, '--save', None)
+    protocol = args[0] if args else 'local'
+    if protocol == 'server':
+        serve(args[1])
+        sys.exit()
+    address = args[1] if len(args) > 1 else None
+    if protocol in ('rfcomm', 'l2cap') and (address is None or bluetooth is None):
+        sys.exit(__doc__)
+    best = run(protocol, address, count, size)
+    if save is not None:
+        link_settings = load_link_settings(save) if os.path.exists(save) else {}
+        link_settings[address.upper() if address else DEFAULT] = best
+        save_link_settings(save, link_settings)
+        print('Saved to ' + save)
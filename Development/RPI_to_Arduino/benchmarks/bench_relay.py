@@ -0,0 +1,106 @@
+'''
+Measures how quickly piduino's RelayEngine forwards '<source|destination|message>'
+packets between devices, with local socket pairs standing in for the
+bluetooth links (so this measures the hub's own overhead, not bluetooth's).
+
+For each number of links, one packet at a time is sent from a random
+device to another, and the time until it can be read at the destination is
+recorded (dispatch latency). Then every device sends a burst of packets at
+once, to measure throughput.
+
+Usage:
+    python3 bench_relay.py [packets]
+'''
+import os
+import random
+import socket
+import sys
+import time
+import warnings
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+with warnings.catch_warnings():
+    # utils warns when bluetooth is missing, which is fine here
+    warnings.simplefilter('ignore')
+    from relay import RelayEngine
+    from utils import package, PacketReassembler
+
+
+class Device(object):
+    def __init__(self, number):
+        self.address = '98:D3:31:00:%02X:%02X' % (number // 256, number % 256)
+        self.sock, self.remote = socket.socketpair()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+def drain(device, reassembler):
+    device.remote.setblocking(False)
+    packets = []
+    try:
+        while True:
+            packets += reassembler.feed(device.remote.recv(65536))
+    except socket.error:
+        pass
+    return packets
+
+
+def latency(engine, devices, count):
+    times = []
+    reassemblers = dict((d.address, PacketReassembler()) for d in devices)
+    for i in range(count):
+        source, destination = random.sample(devices, 2)
+        packet = package(source.address, destination.address, 'reading %d' % i).encode()
+        start = time.perf_counter()
+        source.remote.sendall(packet)
+        found = []
+        while not found:
+            engine.poll(1)
+            found = drain(destination, reassemblers[destination.address])
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2], times[int(len(times) * 0.99)]
+
+
+def throughput(engine, devices, count):
+    per_device = max(count // len(devices), 1)
+    reassemblers = dict((d.address, PacketReassembler()) for d in devices)
+    bursts = []
+    for i, source in enumerate(devices):
+        destination = devices[(i + 1) % len(devices)]
+        bursts.append((source, package(source.address, destination.address,
+                                       'x' * 40).encode() * per_device))
+    start = time.perf_counter()
+    for source, burst in bursts:
+        source.remote.setblocking(False)
+        source.pending = memoryview(burst)
+    received = 0
+    while received < per_device * len(devices):
+        for source, burst in bursts:
+            if len(source.pending):
+                try:
+                    source.pending = source.pending[source.remote.send(source.pending):]
+                except socket.error:
+                    pass
+        engine.poll(0.01)
+        for device in devices:
+            received += len(drain(device, reassemblers[device.address]))
+    return received / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    random.seed(0)
+    print('%6s %14s %14s %16s' % ('links', 'median (us)', '99th pct (us)', 'packets/s'))
+    for links in [2, 4, 8, 16, 32]:
+        engine = RelayEngine()
+        devices = [Device(i) for i in range(links)]
+        for device in devices:
+            engine.add(device)
+        median, slowest = latency(engine, devices, count)
+        rate = throughput(engine, devices, count * 10)
+        print('%6d %14.1f %14.1f %16.0f' % (links, median * 1e6, slowest * 1e6, rate))
+        engine.close()
+        for device in devices:
+            device.remote.close()
+            device.sock.close()
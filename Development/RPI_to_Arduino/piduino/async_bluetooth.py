@@ -0,0 +1,390 @@
+"""
+asyncio adapters for bluetooth discovery and RFCOMM links.
+
+The vendored DeviceDiscoverer and BluetoothSocket have fileno(), but are
+otherwise only usable with blocking calls or a select loop of our own.
+Here the event loop watches their file descriptors instead (loop.add_reader
+and loop.add_writer), so scans, connections and messages can share one loop
+with anything else - e.g. an MQTT client on the smart agent:
+
+    async def main():
+        discovery = Discovery()
+        async for found in discover(discovery, duration=3):
+            if found.name and found.name.startswith("Piduino"):
+                device = AsyncBluetoothDevice(BluetoothDevice(found.name, found.address))
+                if await device.connect(timeout=10) is None:
+                    asyncio.ensure_future(read(device))
+
+    async def read(device):
+        async for message in device:
+            print(device.address, message)
+
+Every coroutine can be cancelled (e.g. by asyncio.wait_for): it stops
+watching its file descriptor, and a cancelled connection attempt closes its
+socket. The socket layer raises errors, as asyncio's own sockets do; the
+device layer returns them, as BluetoothDevice does.
+"""
+import asyncio
+import errno
+import os
+import socket
+import warnings
+from collections import deque
+
+from discovery import Found, inquiry_timeout
+from framing import MessageDecoder, encode, RECV_SIZE
+from relay import would_block
+
+try:
+    import bluetooth
+except ImportError:
+    bluetooth = None
+    warnings.warn("Bluetooth can't be imported, this must be testing...")
+
+# The RFCOMM channel the HC-05s listen on
+RFCOMM_CHANNEL = 1
+IN_PROGRESS = (errno.EINPROGRESS, errno.EAGAIN, errno.EWOULDBLOCK, errno.EALREADY)
+
+
+def in_progress(error):
+    # As would_block, for a non-blocking connect that has not finished yet
+    if getattr(error, "errno", None) in IN_PROGRESS:
+        return True
+    return any(str(error).startswith("(%d," % number) for number in IN_PROGRESS)
+
+
+class AsyncBluetoothSocket(object):
+    """
+    Coroutine connect, recv and sendall for a socket (a BluetoothSocket, or
+    any socket with fileno()), which is made non-blocking
+
+    Only one coroutine at a time may receive, and one send.
+    """
+    def __init__(self, sock, loop=None):
+        self.sock = sock
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        sock.setblocking(False)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    async def __ready(self, add, remove):
+        # Waits until the event loop says the socket is readable (add_reader)
+        # or writable (add_writer)
+        fd = self.sock.fileno()
+        ready = self.loop.create_future()
+
+        def wake():
+            if not ready.done():
+                ready.set_result(None)
+
+        add(fd, wake)
+        try:
+            await ready
+        finally:
+            remove(fd)
+
+    async def connect(self, address):
+        try:
+            self.sock.connect(address)
+            return
+        except (IOError, OSError) as e:
+            if not in_progress(e):
+                raise
+        await self.__ready(self.loop.add_writer, self.loop.remove_writer)
+        error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            raise IOError(error, os.strerror(error))
+
+    async def recv(self, size=RECV_SIZE):
+        """
+        Returns the data that has arrived, waiting for some if none has.
+        b"" means the other end has closed the connection.
+        """
+        while True:
+            try:
+                return self.sock.recv(size)
+            except (IOError, OSError) as e:
+                if not would_block(e):
+                    raise
+            await self.__ready(self.loop.add_reader, self.loop.remove_reader)
+
+    async def sendall(self, data):
+        pending = memoryview(data)
+        while pending:
+            try:
+                pending = pending[self.sock.send(pending):]
+                continue
+            except (IOError, OSError) as e:
+                if not would_block(e):
+                    raise
+            await self.__ready(self.loop.add_writer, self.loop.remove_writer)
+
+    def close(self):
+        self.sock.close()
+
+
+async def connect(address, channel=RFCOMM_CHANNEL, timeout=None, settings=None):
+    """
+    Makes an RFCOMM connection to address without blocking the event loop
+
+    Parameters
+    ----------
+    timeout: float or None
+        The longest to wait (seconds), after which asyncio.TimeoutError is
+        raised
+    settings: linkconfig.LinkSettings or None
+        Applied once connected (settings that cannot be applied are ignored)
+
+    Returns
+    -------
+    AsyncBluetoothSocket
+    """
+    if bluetooth is None:
+        raise IOError("Bluetooth is not available")
+    sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+    try:
+        link = AsyncBluetoothSocket(sock)
+        await asyncio.wait_for(link.connect((address, channel)), timeout)
+    except BaseException:
+        # Including cancellation
+        sock.close()
+        raise
+    if settings is not None:
+        settings.apply(sock, address)
+    return link
+
+
+class AsyncBluetoothDevice(object):
+    """
+    Coroutine connect, receive and send for a piduino.BluetoothDevice,
+    which keeps its socket, decoder and settings. Iterate over it with
+    'async for' to receive messages until it disconnects.
+
+    If the device is already connected, its socket is used (and made
+    non-blocking, so do not use the device's own methods as well). Cancel
+    anything waiting to receive before disconnecting.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.link = None
+        self.write_lock = asyncio.Lock()
+        # Messages received but not yet returned by __anext__
+        self.backlog = deque()
+        # Set when receiving fails, which ends 'async for'
+        self.closed = False
+        if device.sock is not None:
+            self.link = AsyncBluetoothSocket(device.sock)
+
+    @property
+    def name(self):
+        return self.device.name
+
+    @property
+    def address(self):
+        return self.device.address
+
+    async def connect(self, timeout=None):
+        """
+        Returns
+        -------
+        None if successful, otherwise the error
+        """
+        try:
+            self.link = await connect(self.device.address, timeout=timeout,
+                                      settings=self.device.settings)
+        except Exception as e:
+            return e
+        self.device.sock = self.link.sock
+        self.device.decoder = MessageDecoder()
+        self.closed = False
+        return None
+
+    async def receive(self):
+        """
+        As BluetoothDevice.receive, waiting for data without blocking the
+        event loop: returns the messages completed by the next data to
+        arrive, and None or the error - IOError if the link has failed or
+        been closed, or ValueError alongside the good messages when some of
+        the data was not a message
+        """
+        if self.link is None:
+            self.closed = True
+            return [], IOError("The device is not connected")
+        try:
+            data = await self.link.recv(RECV_SIZE)
+        except (IOError, OSError) as e:
+            self.closed = True
+            return [], e
+        if not data:
+            self.closed = True
+            return [], IOError("Connection closed by device")
+        messages = self.device.decoder.feed(data)
+        if self.device.decoder.rejected:
+            return messages, ValueError("Data received but incorrectly packaged. data: " +
+                                        b"\n".join(self.device.decoder.rejected).decode(errors="ignore"))
+        return messages, None
+
+    async def send(self, message):
+        """
+        Returns
+        -------
+        None if successful, otherwise the error
+        """
+        if self.link is None:
+            return IOError("The device is not connected")
+        # Stop concurrent senders from interleaving their messages
+        async with self.write_lock:
+            try:
+                await self.link.sendall(encode(message))
+            except (IOError, OSError) as e:
+                return e
+        return None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.backlog:
+            if self.closed:
+                raise StopAsyncIteration
+            messages, error = await self.receive()
+            self.backlog.extend(messages)
+        return self.backlog.popleft()
+
+    def disconnect(self):
+        self.link = None
+        return self.device.disconnect()
+
+
+def cancel(inquiry):
+    # DeviceDiscoverer.cancel_inquiry raises if the adapter has gone away, in
+    # which case the inquiry is over anyway
+    try:
+        inquiry.cancel_inquiry()
+    except Exception:
+        pass
+
+
+async def discover(discovery, duration=3):
+    """
+    Scans for nearby bluetooth devices, yielding each as soon as it and its
+    name are known, as discovery.Discovery.scan finds them
+
+        async for found in discover(discovery):
+            print(found.address, found.name)
+
+    Devices that need their names looked up are yielded as the lookups
+    (discovery.lookup_workers at a time, in threads) finish.
+
+    Parameters
+    ----------
+    discovery: discovery.Discovery
+    duration: int
+        The inquiry duration, in units of 1.28 s. Must be greater than zero.
+
+    Yields
+    ------
+    Found
+        name is None if the device would not give it
+    """
+    if duration <= 0:
+        raise IOError("Duration must be a postive integer greater than zero. "+
+                      "If you pass zero, the program will hang!")
+    loop = asyncio.get_event_loop()
+    cache = discovery.cache
+    results = asyncio.Queue()
+    addresses = set()
+    lookups = set()
+    # The lookups that have not yet put their result on the queue
+    looking = [0]
+    workers = asyncio.Semaphore(discovery.lookup_workers)
+
+    async def lookup(address, device_class):
+        async with workers:
+            try:
+                name = await loop.run_in_executor(None, discovery.lookup_name, address)
+            except Exception:
+                name = None
+        if name is None:
+            cache.failed(address)
+        else:
+            cache.seen(address, name=name)
+        looking[0] -= 1
+        results.put_nowait(Found(address, name, device_class))
+
+    def found(address, device_class, name):
+        cache.seen(address, device_class, name)
+        if address in addresses:
+            return
+        addresses.add(address)
+        if cache.needs_lookup(address):
+            looking[0] += 1
+            task = asyncio.ensure_future(lookup(address, device_class))
+            lookups.add(task)
+            task.add_done_callback(lookups.discard)
+        else:
+            results.put_nowait(Found(address, cache.name(address), device_class))
+
+    inquiry = discovery.start_inquiry(duration)
+    # DeviceDiscoverer closes its socket when the inquiry completes or is
+    # cancelled, after which fileno() no longer says what to stop watching
+    fd = inquiry.fileno() if inquiry is not None else None
+    inquiring = [True]
+    reported = [0]
+
+    def on_readable():
+        try:
+            inquiry.process_event()
+        except Exception:
+            inquiry.done = True
+        for address, device_class, name in inquiry.found[reported[0]:]:
+            found(address, device_class, name)
+        reported[0] = len(inquiry.found)
+        if inquiry.done:
+            finished()
+
+    def finished():
+        if inquiring[0]:
+            inquiring[0] = False
+            if fd is not None:
+                loop.remove_reader(fd)
+            # Wake the generator, which may be waiting only for this
+            results.put_nowait(None)
+
+    if inquiry is None:
+        # Not BlueZ: run the plain inquiry in a thread
+        def inquired(future):
+            if not inquiring[0]:
+                # Given up on
+                return
+            if not future.cancelled() and future.exception() is None:
+                for address, device_class, name in future.result():
+                    found(address, device_class, name)
+            finished()
+        blocking = loop.run_in_executor(None, discovery.inquire, duration)
+        blocking.add_done_callback(inquired)
+    else:
+        loop.add_reader(fd, on_readable)
+    deadline = loop.time() + inquiry_timeout(duration)
+
+    try:
+        while inquiring[0] or looking[0] or not results.empty():
+            timeout = max(deadline - loop.time(), 0) if inquiring[0] else None
+            try:
+                result = await asyncio.wait_for(results.get(), timeout)
+            except asyncio.TimeoutError:
+                # The adapter never said the inquiry was over
+                if inquiry is not None:
+                    cancel(inquiry)
+                finished()
+                continue
+            if result is not None:
+                yield result
+    finally:
+        if inquiry is not None and inquiring[0]:
+            cancel(inquiry)
+        finished()
+        for task in list(lookups):
+            task.cancel()
+        cache.save()
@@ -0,0 +1,83 @@
+"""
+Runs blocking work (name lookups, connection attempts) in threads on behalf
+of a select loop, and hands the results back to the loop's thread.
+
+The threads queue their results and write a byte to a socket that the loop
+selects on, so the loop wakes up as soon as there is a result, without
+polling, and callbacks are only ever called from the loop's thread.
+
+    background = Background()
+    background.run(lambda: ("connected", (address,)))
+    ...
+    readable, _, _ = select.select([background, ...], [], [], timeout)
+    for kind, args in background.results():
+        ...
+"""
+from __future__ import print_function, absolute_import, division
+
+import socket
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class Background(object):
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.receiver, self.sender = socket.socketpair()
+        self.receiver.setblocking(False)
+        self.sender.setblocking(False)
+        self.running = 0
+
+    def fileno(self):
+        # Readable when there are results
+        return self.receiver.fileno()
+
+    def run(self, work, error_kind="error"):
+        """
+        Calls work() in a new thread, and queues what it returns for
+        results(). If work() raises an exception, (error_kind, (error,)) is
+        queued instead, so the loop always hears back.
+        """
+        def run():
+            try:
+                try:
+                    result = work()
+                except Exception as e:
+                    result = (error_kind, (e,))
+                self.queue.put(result)
+            finally:
+                try:
+                    self.sender.send(b"x")
+                except socket.error:
+                    # Closed, or already full of wake ups
+                    pass
+        self.running += 1
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def results(self):
+        """
+        Returns the results queued so far, oldest first. Never blocks.
+        """
+        try:
+            while self.receiver.recv(4096):
+                pass
+        except socket.error:
+            pass
+        results = []
+        while True:
+            try:
+                results.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        self.running -= len(results)
+        return results
+
+    def close(self):
+        self.receiver.close()
+        self.sender.close()
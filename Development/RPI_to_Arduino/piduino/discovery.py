@@ -0,0 +1,360 @@
+"""
+Bluetooth device discovery with a persistent cache of device names.
+
+bluetooth.discover_devices() followed by bluetooth.lookup_name() for each
+result takes up to 10 s per device, one after the other, so scanning a busy
+room takes minutes. Here:
+
+- The inquiry is run with the vendored DeviceDiscoverer, which reports the
+  names that devices include in their inquiry responses (extended inquiry
+  results), so those never need a name request.
+- The names that are still missing are looked up in parallel, a few at a
+  time, so a scan takes as long as the slowest lookup rather than all of
+  them added together.
+- Names (and device classes) are kept in a NameCache, saved to disk, so a
+  device that has been seen before - e.g. one of our HC-05s - is never looked
+  up again while it keeps being seen.
+
+    discovery = Discovery(cache_path="names.json")
+    for device in discovery.scan(duration=3):
+        print(device.address, device.name)
+"""
+from __future__ import print_function, absolute_import, division
+
+import json
+import os
+import select
+import threading
+import time
+import warnings
+from collections import namedtuple
+
+try:
+    import bluetooth
+except ImportError:
+    bluetooth = None
+    warnings.warn("Bluetooth can't be imported, this must be testing...")
+
+# Where the names of devices are kept between runs
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".piduino_names.json")
+# Forget devices that have not been seen for a week
+DEFAULT_TTL = 7 * 24 * 3600
+# Devices that did not answer a name request are not asked again for a minute
+NEGATIVE_TTL = 60
+# The number of name requests made at once
+LOOKUP_WORKERS = 4
+# How long to wait for a device to answer a name request (seconds)
+LOOKUP_TIMEOUT = 10
+# Inquiry durations are in units of 1.28 seconds
+INQUIRY_UNIT = 1.28
+
+
+def inquiry_timeout(duration):
+    # How long an inquiry of duration units can take, with time to spare
+    return duration * INQUIRY_UNIT + 5
+
+
+Found = namedtuple("Found", ["address", "name", "device_class"])
+
+
+class NameCache(object):
+    """
+    Remembers the names and device classes of bluetooth devices
+
+    Notes
+    -----
+    An entry expires ttl seconds after the device was last seen, so the name
+    of a device that is seen at least that often is only ever looked up once.
+    Failed lookups are remembered for negative_ttl seconds, so a device that
+    never answers does not cost a lookup on every scan.
+
+    The cache is thread safe. It is written to path (if given) by save(),
+    atomically, so a crash cannot leave a damaged cache behind.
+
+    Parameters
+    ----------
+    path: str or None
+        The JSON file to keep the cache in
+    ttl: float
+        Seconds after which a device that has not been seen is forgotten
+    negative_ttl: float
+        Seconds for which a failed name lookup is remembered
+    """
+    def __init__(self, path=None, ttl=DEFAULT_TTL, negative_ttl=NEGATIVE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = {}
+        self.changed = False
+        self.lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except (IOError, ValueError):
+                # A cache we cannot read is only a cache: start again
+                self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, address, now=None):
+        """
+        Returns the entry (a dict with 'name', 'device_class', 'seen' and
+        'failed') for address, or None if there is none or it has expired
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            entry = self.entries.get(address)
+            if entry is None:
+                return None
+            if now - entry["seen"] > self.ttl:
+                del self.entries[address]
+                self.changed = True
+                return None
+            return entry
+
+    def name(self, address, now=None):
+        """
+        Returns the cached name of address, or None if it is not known
+        """
+        entry = self.get(address, now)
+        return None if entry is None else entry.get("name")
+
+    def needs_lookup(self, address, now=None):
+        """
+        Returns True if the name of address should be requested
+        """
+        now = time.time() if now is None else now
+        entry = self.get(address, now)
+        if entry is None:
+            return True
+        if entry.get("name") is not None:
+            return False
+        return now - entry.get("failed", 0) > self.negative_ttl
+
+    def seen(self, address, device_class=None, name=None, now=None):
+        """
+        Records that address has been seen, with its name if it is known
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            entry = self.entries.setdefault(address, {"name": None, "device_class": None})
+            entry["seen"] = now
+            if device_class is not None:
+                entry["device_class"] = device_class
+            if name is not None:
+                entry["name"] = name
+                entry.pop("failed", None)
+            self.changed = True
+
+    def failed(self, address, now=None):
+        """
+        Records that a name request to address was not answered
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            entry = self.entries.setdefault(address, {"name": None, "device_class": None})
+            entry.setdefault("seen", now)
+            entry["failed"] = now
+            self.changed = True
+
+    def forget(self, address):
+        with self.lock:
+            if self.entries.pop(address, None) is not None:
+                self.changed = True
+
+    def save(self):
+        """
+        Writes the cache to its file, if it has one and has changed
+        """
+        if self.path is None or not self.changed:
+            return
+        with self.lock:
+            temporary = self.path + ".tmp"
+            with open(temporary, "w") as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            getattr(os, "replace", os.rename)(temporary, self.path)
+            self.changed = False
+
+
+# DeviceDiscoverer is only in the BlueZ (Linux) version of pybluez
+_Inquiry = None
+if hasattr(bluetooth, "DeviceDiscoverer"):
+    class _Inquiry(bluetooth.DeviceDiscoverer):
+        """
+        Collects the results of an inquiry without printing them
+
+        _device_discovered is overridden because, with lookup_names set,
+        DeviceDiscoverer requests the missing names itself, one at a time
+        on the inquiry socket; Discovery requests them in parallel instead.
+        Without lookup_names, it throws away the names in extended inquiry
+        results, which we want to keep.
+        """
+        def pre_inquiry(self):
+            self.found = []
+            self.done = False
+
+        def _device_discovered(self, address, device_class, psrm, pspm,
+                               clockoff, name):
+            if isinstance(name, bytes):
+                name = name.decode("utf-8", "replace")
+            self.found.append((address, device_class, name))
+
+        def inquiry_complete(self):
+            self.done = True
+
+
+class Discovery(object):
+    """
+    Finds nearby bluetooth devices and their names, using a NameCache so
+    that names are only looked up once
+
+    Parameters
+    ----------
+    cache: NameCache or None
+        The cache to use. By default, one kept at cache_path
+    cache_path: str or None
+        Where to keep the default cache. None keeps it in memory only.
+    device_id: int
+        The bluetooth adapter to use (-1 for the first one)
+    lookup_workers: int
+        The number of name requests to make at once
+    lookup_timeout: float
+        How long to wait for a device to answer a name request (seconds)
+    """
+    def __init__(self, cache=None, cache_path=DEFAULT_CACHE_PATH, device_id=-1,
+                 lookup_workers=LOOKUP_WORKERS, lookup_timeout=LOOKUP_TIMEOUT):
+        self.cache = cache if cache is not None else NameCache(cache_path)
+        self.device_id = device_id
+        self.lookup_workers = max(1, lookup_workers)
+        self.lookup_timeout = lookup_timeout
+
+    def start_inquiry(self, duration):
+        """
+        Starts an inquiry for duration units of 1.28 s without waiting for it
+
+        Returns
+        -------
+        DeviceDiscoverer or None
+            The inquiry, which can be passed to select. When it is readable,
+            call its process_event(). Once its done attribute is True, its
+            found attribute holds (address, device_class, name) tuples.
+            None if the inquiry cannot be run this way (not BlueZ, or no
+            access to the HCI socket), in which case use inquire().
+        """
+        if _Inquiry is None:
+            return None
+        try:
+            inquiry = _Inquiry(self.device_id)
+            inquiry.find_devices(lookup_names=False, duration=duration, flush_cache=True)
+        except (bluetooth.BluetoothError, OSError):
+            return None
+        return inquiry
+
+    def inquire(self, duration):
+        """
+        Runs an inquiry for duration units of 1.28 s
+
+        Returns
+        -------
+        list of tuples
+            (address, device_class, name) for each device found, where name
+            is None unless the device included it in its inquiry response
+        """
+        inquiry = self.start_inquiry(duration)
+        if inquiry is None:
+            # Fall back to the plain inquiry, which still gives device classes
+            return [(address, device_class, None) for address, device_class in
+                    bluetooth.discover_devices(duration=duration, flush_cache=True,
+                                               lookup_class=True)]
+        # The adapter ends the inquiry itself; the deadline is in case it
+        # never says so
+        end = time.time() + inquiry_timeout(duration)
+        while not inquiry.done and time.time() < end:
+            readable, _, _ = select.select([inquiry], [], [], max(end - time.time(), 0))
+            if readable:
+                inquiry.process_event()
+        if not inquiry.done:
+            inquiry.cancel_inquiry()
+        return inquiry.found
+
+    def lookup_name(self, address):
+        """
+        Asks the device at address for its name. Returns None if it does not
+        answer.
+        """
+        return bluetooth.lookup_name(address, timeout=self.lookup_timeout)
+
+    def lookup_names(self, addresses):
+        """
+        Looks up the names of addresses in parallel, lookup_workers at a
+        time, recording them in the cache
+
+        Returns
+        -------
+        dict
+            address: name (None for devices that did not answer)
+        """
+        pending = list(addresses)
+        names = {}
+        lock = threading.Lock()
+
+        def work():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    address = pending.pop(0)
+                try:
+                    name = self.lookup_name(address)
+                except Exception:
+                    name = None
+                if name is None:
+                    self.cache.failed(address)
+                else:
+                    self.cache.seen(address, name=name)
+                with lock:
+                    names[address] = name
+
+        workers = [threading.Thread(target=work)
+                   for i in range(min(self.lookup_workers, len(pending)))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return names
+
+    def scan(self, duration=3):
+        """
+        Scans for nearby bluetooth devices
+
+        Parameters
+        ----------
+        duration: int
+            The inquiry duration, in units of 1.28 s. Must be greater than
+            zero.
+
+        Returns
+        -------
+        list of Found
+            (address, name, device_class) of each device found, in the order
+            they were found. name is None if the device would not give it.
+        """
+        if duration <= 0:
+            raise IOError("Duration must be a postive integer greater than zero. "+
+                          "If you pass zero, the program will hang!")
+        found = []
+        addresses = set()
+        for address, device_class, name in self.inquire(duration):
+            if address not in addresses:
+                addresses.add(address)
+                found.append((address, device_class))
+            self.cache.seen(address, device_class, name)
+
+        self.lookup_names([address for address, device_class in found
+                           if self.cache.needs_lookup(address)])
+        self.cache.save()
+        return [Found(address, self.cache.name(address), device_class)
+                for address, device_class in found]
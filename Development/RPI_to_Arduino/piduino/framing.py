@@ -0,0 +1,153 @@
+"""
+Newline delimited JSON framing for the messages exchanged with devices.
+
+Each message is one JSON object followed by a newline. json.dumps never
+puts a newline inside a message (newlines in strings are escaped), and the
+Arduino sketches end their messages with println, so a newline always
+marks the end of a message. Carriage returns and blank lines are ignored.
+
+A device's bytes arrive in chunks of any size, so each device has a
+decoder that keeps the unfinished message between chunks:
+
+    decoder = MessageDecoder()
+    while True:
+        for message in decoder.feed(sock.recv(RECV_SIZE)):
+            ...
+
+Complete lines are sliced out of each chunk with memoryviews, so a message
+that arrives whole in one chunk is never copied before it is decoded. Only
+the unfinished end of a chunk is kept, and at most max_length bytes of it:
+a line longer than that is dropped up to its newline.
+"""
+import json
+import re
+
+# The longest message kept (bytes, without the newline)
+MAX_MESSAGE_LENGTH = 65536
+# How much to ask a socket for at once
+RECV_SIZE = 65536
+DELIMITER = b"\n"
+
+
+def encode(message):
+    """
+    Returns the bytes to send for a message (anything json.dumps accepts)
+    """
+    return json.dumps(message).encode("utf-8") + DELIMITER
+
+
+class LineDecoder(object):
+    """
+    Finds the newline terminated lines in a stream of bytes that arrives in
+    chunks of any size
+
+    Attributes
+    ----------
+    dropped: int
+        The number of lines dropped for being longer than max_length
+    discarded: int
+        The number of bytes in dropped lines
+    """
+    NEWLINE = re.compile(re.escape(DELIMITER))
+
+    def __init__(self, max_length=MAX_MESSAGE_LENGTH):
+        self.max_length = max_length
+        # The unfinished line
+        self.buffer = bytearray()
+        # Whether the rest of the current line is being dropped
+        self.skipping = False
+        self.dropped = 0
+        self.discarded = 0
+
+    def feed(self, data):
+        """
+        Adds a chunk of received bytes
+
+        Parameters
+        ----------
+        data: bytes, bytearray or memoryview
+            The chunk
+
+        Returns
+        -------
+        list of memoryviews
+            The lines completed by this chunk, in order, without their line
+            endings and leaving out blank ones. They may be views of data, so
+            use them before changing data.
+        """
+        view = memoryview(data)
+        lines = []
+        start = 0
+        for match in self.NEWLINE.finditer(view):
+            end = match.start()
+            if self.skipping:
+                self.discarded += end - start
+                self.skipping = False
+            elif self.buffer:
+                # The end of a line that started in an earlier chunk
+                self.buffer += view[start:end]
+                line = memoryview(bytes(self.buffer))
+                del self.buffer[:]
+                self.__add(line, lines)
+            else:
+                self.__add(view[start:end], lines)
+            start = end + 1
+
+        rest = len(view) - start
+        if self.skipping:
+            self.discarded += rest
+        elif len(self.buffer) + rest > self.max_length:
+            self.dropped += 1
+            self.discarded += len(self.buffer) + rest
+            del self.buffer[:]
+            self.skipping = True
+        elif rest:
+            self.buffer += view[start:]
+        return lines
+
+    def __add(self, line, lines):
+        if len(line) and line[-1:] == b"\r":
+            line = line[:-1]
+        if len(line) > self.max_length:
+            self.dropped += 1
+            self.discarded += len(line)
+        elif len(line):
+            lines.append(line)
+
+
+class MessageDecoder(LineDecoder):
+    """
+    A LineDecoder that decodes each line as a JSON object
+
+    Attributes
+    ----------
+    rejected: list of bytes
+        The lines from the last feed() that were not JSON objects
+    """
+    def __init__(self, max_length=MAX_MESSAGE_LENGTH):
+        LineDecoder.__init__(self, max_length)
+        self.rejected = []
+
+    def feed(self, data):
+        """
+        Adds a chunk of received bytes
+
+        Returns
+        -------
+        list of dicts
+            The messages completed by this chunk, in order. Lines that are
+            not JSON objects are left out, and kept in self.rejected.
+        """
+        messages = []
+        self.rejected = []
+        for line in LineDecoder.feed(self, data):
+            try:
+                message = json.loads(str(line, "utf-8"))
+            except ValueError:
+                message = None
+            # json.loads will interpret "hi" as a jsonic object!
+            if type(message) == dict:
+                messages.append(message)
+            else:
+                self.rejected.append(line.tobytes())
+        return messages
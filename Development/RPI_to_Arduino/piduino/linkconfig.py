@@ -0,0 +1,172 @@
+"""
+Settings for the links to devices: socket buffer sizes, the L2CAP MTU, the
+ACL flush timeout, and how many bytes to batch into each send.
+
+By default links are left as the bluetooth stack makes them. Which settings
+are best depends on the adapter, the device and the traffic, so measure them
+with benchmarks/bench_link.py, which saves the best it finds in a file that
+BTServer can load:
+
+    {
+        "*": {"batch_bytes": 1008},
+        "98:D3:31:F5:9A:3B": {"batch_bytes": 0, "flush_timeout": 20}
+    }
+
+Links are matched by address, then by device name, then "*".
+"""
+from __future__ import print_function, absolute_import, division
+
+import json
+import socket
+import warnings
+
+try:
+    import bluetooth
+except ImportError:
+    bluetooth = None
+    warnings.warn("Bluetooth can't be imported, this must be testing...")
+
+# The key of the settings used for links with none of their own
+DEFAULT = "*"
+# The longest ACL flush timeout (milliseconds)
+MAX_FLUSH_TIMEOUT = 1280
+
+
+class LinkSettings(object):
+    """
+    How to set up a link. None leaves a setting as the stack has it.
+
+    Parameters
+    ----------
+    batch_bytes: int
+        Queued packets are joined into sends of up to this many bytes, rather
+        than being sent one at a time (0 to send them one at a time). Worth
+        it where each send costs a radio frame, i.e. RFCOMM and L2CAP.
+    send_buffer, receive_buffer: int or None
+        SO_SNDBUF and SO_RCVBUF (bytes)
+    l2cap_mtu: int or None
+        The incoming and outgoing MTU of an L2CAP link (48 to 65535). Must be
+        set at both ends. Ignored for other sockets.
+    flush_timeout: int or None
+        The ACL flush timeout (milliseconds, 0 to MAX_FLUSH_TIMEOUT): data
+        not acknowledged within it is dropped, so a lossy link stays low
+        latency. 0 never drops data. Applies to every connection to the
+        device, and needs superuser privileges.
+    """
+    FIELDS = ("batch_bytes", "send_buffer", "receive_buffer", "l2cap_mtu",
+              "flush_timeout")
+
+    def __init__(self, batch_bytes=0, send_buffer=None, receive_buffer=None,
+                 l2cap_mtu=None, flush_timeout=None):
+        self.batch_bytes = batch_bytes
+        self.send_buffer = send_buffer
+        self.receive_buffer = receive_buffer
+        self.l2cap_mtu = l2cap_mtu
+        self.flush_timeout = flush_timeout
+
+    def __eq__(self, other):
+        return isinstance(other, LinkSettings) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "LinkSettings(%s)" % ", ".join(
+            "%s=%r" % item for item in sorted(self.to_dict().items()))
+
+    def to_dict(self):
+        # Only what is set, as it would be written in a settings file
+        settings = dict((field, getattr(self, field)) for field in self.FIELDS
+                        if getattr(self, field) is not None)
+        if not settings.get("batch_bytes"):
+            settings.pop("batch_bytes", None)
+        return settings
+
+    @classmethod
+    def from_dict(cls, settings):
+        unknown = set(settings) - set(cls.FIELDS)
+        if unknown:
+            raise ValueError("Unknown link settings: " + ", ".join(sorted(unknown)))
+        return cls(**settings)
+
+    def apply(self, sock, address=None):
+        """
+        Applies the settings to a connected socket (and, for the flush
+        timeout, to the ACL link to address). Every setting is tried, even
+        if an earlier one failed.
+
+        Returns
+        -------
+        list
+            The errors, one for each setting that could not be applied
+        """
+        errors = []
+        for option, value in ((socket.SO_SNDBUF, self.send_buffer),
+                              (socket.SO_RCVBUF, self.receive_buffer)):
+            if value is not None:
+                try:
+                    sock.setsockopt(socket.SOL_SOCKET, option, value)
+                except Exception as e:
+                    errors.append(e)
+        if self.l2cap_mtu is not None and is_l2cap(sock):
+            try:
+                bluetooth.set_l2cap_mtu(sock, self.l2cap_mtu)
+            except Exception as e:
+                errors.append(e)
+        if self.flush_timeout is not None and address is not None:
+            try:
+                if bluetooth is None:
+                    raise IOError("Bluetooth is not available")
+                bluetooth.set_packet_timeout(address, self.flush_timeout)
+            except Exception as e:
+                errors.append(e)
+        return errors
+
+
+def is_l2cap(sock):
+    if bluetooth is None or not hasattr(bluetooth, "get_l2cap_options"):
+        return False
+    try:
+        bluetooth.get_l2cap_options(sock)
+        return True
+    except Exception:
+        return False
+
+
+def load_link_settings(path):
+    """
+    Reads a settings file, as written by save_link_settings
+
+    Returns
+    -------
+    dict
+        address, device name or DEFAULT: LinkSettings
+    """
+    with open(path) as f:
+        return dict((key, LinkSettings.from_dict(value))
+                    for key, value in json.load(f).items())
+
+
+def save_link_settings(path, link_settings):
+    with open(path, "w") as f:
+        json.dump(dict((key, settings.to_dict())
+                       for key, settings in link_settings.items()),
+                  f, indent=4, sort_keys=True)
+
+
+def settings_for(link_settings, address, name=None):
+    """
+    Returns the LinkSettings for a device, or None to leave its link as it is
+
+    Parameters
+    ----------
+    link_settings: LinkSettings, dict or None
+        One LinkSettings for every link, or a dict of them as returned by
+        load_link_settings
+    """
+    if link_settings is None or isinstance(link_settings, LinkSettings):
+        return link_settings
+    for key in (address.upper(), address, name, DEFAULT):
+        if key is not None and key in link_settings:
+            return link_settings[key]
+    return None
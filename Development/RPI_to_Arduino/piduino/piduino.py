@@ -14,6 +14,14 @@ import json
 import bluetooth
 import threading
 import serial.tools.list_ports
+from discovery import Discovery, DEFAULT_CACHE_PATH
+from scanner import Scanner, DEFAULT_INTERVAL
+from relay import RelayEngine, packet_destination
+from pool import ConnectionPool, link_alive
+from framing import MessageDecoder, encode, RECV_SIZE
+from linkconfig import load_link_settings, settings_for
+from routing import RouteCache, Peer, Listener, DEFAULT_PORT, ROUTE_TTL, MAX_ROUTES
+from utils import unpackage
 
 class NotYetImplemented(Exception):
     def __init__(self, value):
@@ -31,6 +39,36 @@ class AuthenticationError(Exception):
     def __init__(self, value):
         self.value = value
         
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    monotonic = time.time
+
+# Failed reconnections in a row after which BTServer stops reconnecting a
+# device and leaves the scanner to find it again
+MAX_RECONNECT_FAILURES = 5
+
+class Deadline():
+    """
+    A point in time, timeout seconds from now, on the monotonic clock. A
+    timeout of None never expires. Used so that a read which is retried
+    several times gives up after timeout seconds in total.
+    """
+    def __init__(self, timeout):
+        if timeout is None:
+            self.end = None
+        else:
+            self.end = monotonic() + max(timeout, 0)
+
+    def remaining(self):
+        # Seconds left, or None for no limit. Suitable for passing to select.
+        if self.end is None:
+            return None
+        return max(self.end - monotonic(), 0.0)
+
+    def expired(self):
+        return self.end is not None and monotonic() >= self.end
+
 def get_time():
     # Required for logging
     now = datetime.datetime.today()
@@ -60,11 +98,17 @@ class BluetoothDevice():
     
     This class handles all direct interaction with sockets. 
     """
-    def __init__(self, name, address):
+    def __init__(self, name, address, settings=None):
         self.name = name
         self.subscriptions = set()
         self.address = address
         self.sock = None
+        # A linkconfig.LinkSettings to apply on connecting, or None
+        self.settings = settings
+        # The settings that could not be applied on connecting
+        self.settings_errors = []
+        # Keeps any unfinished message between calls to receive
+        self.decoder = MessageDecoder()
         
     def fileno(self):
         """
@@ -101,22 +145,19 @@ class BluetoothDevice():
         """
         Attemps to send a message to the device.
 
-        Uses Format to package the message components
+        The message is sent as JSON followed by a newline (see framing)
         
         Parameters
         ----------
-        components: list of strings
+        message: dict
             
 
         Returns
         -------
-        bool
-            True if successful
-            False otherwise
+        None if successful, otherwise the error
         """
-        packet = json.dumps(message)
         try:
-            self.sock.send(packet.encode('utf-8'))
+            self.sock.sendall(encode(message))
             return None
             
         except Exception as e:
@@ -125,14 +166,12 @@ class BluetoothDevice():
 
     def receive(self):
         """
-        Attemps to receive a message from the socket.
-
-        Receives data in chunks. Once it has a full packet
-        (indicated by Format().find_packets returning a non-empty
-        response), it returns the packet. 
+        Attemps to receive messages from the socket.
 
-        If the timout is reached before a message is delivered,
-        receive returns an empty list
+        Reads whatever has arrived (waiting for something if nothing has),
+        and returns every message it completes. A message may arrive over
+        several reads, and one read may complete several messages: the
+        device's decoder keeps any unfinished message for next time.
         
         Parameters
         ----------
@@ -141,38 +180,26 @@ class BluetoothDevice():
 
         Returns
         -------
-        list of lists
-            The packets received from the socket.
+        list of dicts
+            The messages received, in order. Empty if none were completed.
+        error
+            None, or the error if the read failed (DeviceError if the
+            device closed the connection) or FormatError if some of the
+            data received was not a message (the messages are still
+            returned)
         """
-        
-        data = b""
-
-        while True:
-            # Loop terminates at timout or error
-            try:
-                # Read the data in the buffer
-                data += self.sock.recv(4096)
-                try:
-                    message = json.loads(data)
-                except json.JSONDecodeError as e:
-                    message = None
-                
-                return message, ''
-                
-            except Exception as e:
-                # When there is no more data to read, we get Bluetooth error
-                # In this case, we can wait a little while to see if more data is
-                # transmitted
-                return None, e
-
-        # Error handling if no packet is received        
-        if len(data) > 0:
-            return None, FormatError("Listen timeout: data received but incorrectly packaged. " +
-                        "data: " + data.decode(errors="ignore"))
-        else:
-            return None, DeviceError("Listen timeout: no data transmitted!")
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except Exception as e:
+            return [], e
+        if not data:
+            return [], DeviceError("Connection closed by device")
 
-        return []
+        messages = self.decoder.feed(data)
+        if self.decoder.rejected:
+            return messages, FormatError("Data received but incorrectly packaged. " +
+                        "data: " + b"\n".join(self.decoder.rejected).decode(errors="ignore"))
+        return messages, None
 
     def connect(self, timeout):
         """
@@ -182,48 +209,64 @@ class BluetoothDevice():
         This method is defined separately from init to allow for greater
         flexibility (e.g. keeping information about devices that we are
         not currently connected to.)
+
+        If the device is already connected and the link is still alive,
+        the existing socket is kept, so connect can be called whenever a
+        link is needed.
         
         Parameters
         ----------
-        N/A
+        timeout: float
+            The longest to wait for the connection (seconds). 0 or None
+            waits as long as the bluetooth stack does.
 
         Returns
         -------
-        bool
-            True if successful
-            False otherwise
+        None if successful, otherwise the error
         """
+        if self.sock is not None:
+            if self.still_connected():
+                return None
+            self.disconnect()
+            self.sock = None
 
+        sock = None
         try:
             sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
             # The line below will not work on a Windows system because of the limitations
             # of Bluez - unable to set socket options.
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            #sock.settimeout(5)
+            if timeout:
+                sock.settimeout(timeout)
             sock.connect((self.address, 1))
-            
-
-            self.sock = sock
-            return None
-            
-            
         except Exception as e:
-            # Setting a timeout causes an error to be thrown even if the connection
-            # is made. In this case, ignore the error and carry on.
-            if str(e) == "(77, 'File descriptor in bad state')":
-                self.sock = sock
-                return None
-            else:
+            # Setting a timeout can make connect report
+            # (77, 'File descriptor in bad state') even if the connection
+            # is made, so check whether it was rather than assuming either way
+            if sock is None or not link_alive(sock):
+                if sock is not None:
+                    sock.close()
                 return e
 
+        if timeout:
+            # Back to blocking, as without a timeout
+            sock.settimeout(None)
+        self.sock = sock
+        self.decoder = MessageDecoder()
+        if self.settings is not None:
+            # Not being able to tune the link is no reason not to use it
+            self.settings_errors = self.settings.apply(sock, self.address)
+        return None
+
     def still_connected(self):
         """
         Checks if the device is still actually available
         (e.g. if it has powered down or moved out of range it won't be,
         but communications will fail).
 
-        Tests availability using the getpeername method, which returns an
-        error if the device is not longer available
+        Tests availability without blocking (see pool.link_alive): the
+        link is gone if the socket has an error, getpeername fails, or the
+        other end has closed it
 
         Parameters
         ----------
@@ -235,13 +278,7 @@ class BluetoothDevice():
             True if connected
             False otherwise
         """
-        try:
-            self.sock.getpeername()
-            return True
-        except bluetooth.BluetoothError as e:
-            # Rather than returning this error, we just use it to test
-            # whether the socket still links to an endpoint
-            return False
+        return link_alive(self.sock)
 
 class SerialDevice():
     def __init__(self, comport):
@@ -258,7 +295,7 @@ class SerialDevice():
         except Exception as e:
             return e
       
-    def handshake(self, my_key, their_key):
+    def handshake(self, my_key, their_key, timeout=5):
         # Ask the device to authenticate
         message = {
             'source': 'sink',
@@ -270,30 +307,43 @@ class SerialDevice():
             return flag
             
         # Wait until the device returns a response
-        while True:
-            # Check if the device has data waiting to be read
-            if self.ser.in_waiting:
-                # Receive a single message
-                response = self.receive()
-
-
-                if response['type'] == 'handshake':
-                    if response['payload'] == their_key:
-                        self.name = response['source']
-                        return None
-                    else:
-                        return AuthenticationError("Wrong password")
-                else:
-                    return AuthenticationError("Incorrect response to handshake: " + response['type'])
-            break
+        response = self.receive(timeout=timeout)
+        if response is None:
+            return DeviceError("Handshake timeout: no response from device")
+        if response.get('type') == 'handshake':
+            if response.get('payload') == their_key:
+                self.name = response.get('source')
+                return None
+            else:
+                return AuthenticationError("Wrong password")
+        else:
+            return AuthenticationError("Incorrect response to handshake: " + str(response.get('type')))
+
+    def __wait_readable(self, deadline):
+        """
+        Blocks until there is data to read or the deadline passes, so that
+        waiting for a slow device costs no CPU
+        """
+        if self.ser.in_waiting:
+            return True
+        if sys.platform.startswith('win'):
+            # select only works on sockets on Windows, so let pyserial block
+            # in the read instead
+            self.ser.timeout = deadline.remaining()
+            return True
+        readable, _, _ = select.select([self.ser], [], [], deadline.remaining())
+        return bool(readable)
                 
-    def receive(self):
+    def receive(self, timeout=None):
         """
-        Receives a single message
+        Receives a single message, or returns None if timeout seconds pass
+        first. With no timeout, waits for as long as it takes.
         """
+        deadline = Deadline(timeout)
         data = ''
         while True:
-            data += self.ser.readline().decode(errors='ignore').strip()
+            if self.__wait_readable(deadline):
+                data += self.ser.read(max(self.ser.in_waiting, 1)).decode(errors='ignore')
             # Note: this program cannot cope with internal '{}' brackets inside the json, so be sure not
             # to use them in the plaintext when composing a message!
             potential_messages = re.findall('\{[^\{\}]+\}', data)
@@ -307,6 +357,8 @@ class SerialDevice():
 
                 except Exception as e:
                     pass
+            if deadline.expired():
+                return None
         
                     
     def send(self, message):
@@ -334,7 +386,7 @@ class Server():
         else:
             raise flag
 
-    def __prune_devices(self):
+    def prune_devices(self):
         # Remove devices that are no longer available
         # Devices that we are connected to do not show up in scans.
         # Therefore, we want to go through the list of connected devices and
@@ -344,7 +396,7 @@ class Server():
         
         current_devices = []
         for device in self.devices:
-            if device.still_connected:
+            if device.still_connected():
                 current_devices.append(device)
             else:
                 # Close up shop...
@@ -362,7 +414,8 @@ class BTServer(Server):
     # Connects to any available BT devices matching its address pattern
     # Relays packets between nodes in local network
 
-    def __init__(self, address_pattern, scan_duration=5):
+    def __init__(self, address_pattern, scan_duration=5, name_cache=DEFAULT_CACHE_PATH,
+                 scan_interval=DEFAULT_INTERVAL, link_settings=None):
         """
         Initialise a hub
         
@@ -373,13 +426,30 @@ class BTServer(Server):
         scan_duration: positive int
             (default = 5)
             If the scan duration is not a positive int, the scanner will hang!
+        name_cache: string or None
+            The file in which the names of the devices found are kept, so
+            that they are only looked up once. None keeps them in memory.
+        scan_interval: positive number
+            (default = 30)
+            Seconds between background scans (see select)
+        link_settings: linkconfig.LinkSettings, dict, string or None
+            How to set up the links to devices: the same LinkSettings for
+            every link, a dict of them by address or name (see
+            linkconfig.settings_for), or the path of a file of them as
+            saved by benchmarks/bench_link.py. None leaves links as they
+            are made.
             
         Returns
         -------
         N/A
         """
-        Server.__init__(self, name)
+        Server.__init__(self)
         self.address_pattern = address_pattern
+        if isinstance(link_settings, str):
+            link_settings = load_link_settings(link_settings)
+        self.link_settings = link_settings
+        self.discovery = Discovery(cache_path=name_cache)
+        self.scan_duration = 5
         
         # Error handling for scan duration
         # If not an integer, attempt to integerise it. If not positive
@@ -397,6 +467,25 @@ class BTServer(Server):
             if scan_duration > 0:
                 self.scan_duration = scan_duration
 
+        self.scanner = Scanner(address_pattern, discovery=self.discovery,
+                               connect=self.__connect_device,
+                               interval=scan_interval, duration=self.scan_duration,
+                               on_appeared=self.__device_appeared,
+                               on_disappeared=self.__device_disappeared,
+                               on_connected=self.__device_connected,
+                               on_connect_failed=self.__device_connect_failed,
+                               on_scan_failed=self.__scan_failed)
+        # Keeps the links to connected devices alive, reconnecting them
+        # when they fail (see select and relay)
+        self.pool = ConnectionPool(max_failures=MAX_RECONNECT_FAILURES,
+                                   on_lost=self.__device_lost,
+                                   on_restored=self.__device_restored,
+                                   on_dropped=self.__device_dropped)
+        # Created by relay()
+        self.engine = None
+        # The TCP link to the coordinator, if any
+        self.uplink = None
+
     def __get_own_address(self):
         """
         Checks local device (device id = 0) and returns the bluetooth
@@ -448,17 +537,183 @@ class BTServer(Server):
             List of MAC addresses of matching devices
         """
         matching_devices = []
-        nearby_devices = bluetooth.discover_devices(flush_cache=True, duration=self.scan_duration)
-        for device in nearby_devices:
-            name = bluetooth.lookup_name(device)
-            address = str(device)
-            if name != None:
-                if name.startswith(self.address_pattern):
-                    matching_devices.append(BluetoothDevice(name, address))
+        for device in self.discovery.scan(duration=self.scan_duration):
+            if device.name != None:
+                if device.name.startswith(self.address_pattern):
+                    matching_devices.append(BluetoothDevice(
+                        device.name, str(device.address),
+                        settings_for(self.link_settings, str(device.address), device.name)))
         return matching_devices
     
 
                     
+    def __connect_device(self, found):
+        # Called by the scanner, in a thread
+        dev = BluetoothDevice(found.name, found.address,
+                              settings_for(self.link_settings, found.address, found.name))
+        flag = dev.connect(timeout=5)
+        if flag is not None:
+            raise flag
+        return dev
+
+    def __device_appeared(self, found):
+        print("Discovered device " + found.name + " at " + found.address)
+
+    def __device_disappeared(self, found):
+        print("Device " + found.name + " at " + found.address + " has gone")
+
+    def __device_connected(self, found, dev):
+        self.devices.append(dev)
+        self.pool.add(dev)
+        if self.engine is not None:
+            self.engine.add(dev)
+        print("Successfully connected to device " + dev.address)
+        for error in dev.settings_errors:
+            print("Could not apply link settings to " + dev.address + ": " + str(error))
+
+    def __device_lost(self, dev):
+        # Called by the pool, which will try to reconnect
+        if self.engine is not None:
+            self.engine.remove(dev)
+        if dev in self.devices:
+            self.devices.remove(dev)
+        print("Lost connection to device " + dev.address + ", reconnecting")
+
+    def __device_restored(self, dev):
+        self.devices.append(dev)
+        if self.engine is not None:
+            self.engine.add(dev)
+        print("Reconnected to device " + dev.address)
+
+    def __device_dropped(self, dev):
+        # The pool has given up, so leave it to the scanner to find the
+        # device again
+        self.scanner.lost(dev.address)
+        print("Gave up reconnecting to device " + dev.address)
+
+    def __link_closed(self, dev, error):
+        # Called by the relay engine, which has stopped relaying for dev
+        if dev is self.uplink:
+            self.uplink = None
+            dev.disconnect()
+            print("Lost connection to the coordinator: " + str(error))
+            return
+        print("Lost connection to device " + dev.address + ": " + str(error))
+        self.pool.lost(dev)
+
+    def __route(self, link, packet):
+        # Packets for our own devices go straight to them, and anything else
+        # to the coordinator (unless it came from there)
+        destination = packet_destination(packet)
+        if destination in self.engine.links:
+            return destination
+        if self.uplink is not None and link.device is not self.uplink:
+            return self.uplink.address
+        return None
+
+    def connect_coordinator(self, host, port=DEFAULT_PORT):
+        """
+        Connects to a Coordinator over TCP, so that relay() forwards packets
+        for devices that are not connected to this hub through it
+
+        Returns
+        -------
+        None if successful, otherwise the error
+        """
+        try:
+            uplink = Peer.connect(host, port, address="COORDINATOR")
+        except Exception as e:
+            return e
+        self.uplink = uplink
+        if self.engine is not None:
+            self.engine.add(uplink)
+        return None
+
+    def __scan_failed(self, error):
+        print("Scan failed: " + str(error))
+
+    def __device_connect_failed(self, found, error):
+        # For now, we report all errors as we find them. Later they
+        # will just be logged.
+        print("Could not connect to device " + found.address + ": " + str(error))
+
+    def select(self, timeout=None):
+        """
+        Waits until a device has data to read, or until timeout seconds
+        have passed, while scanning for and connecting to new devices in the
+        background.
+
+        This is the non-blocking alternative to update_devices: scans,
+        connection attempts and the pool's health checks and reconnections
+        are driven from here, a step at a time, so relaying is never paused
+        for a scan or a failed device.
+
+        Parameters
+        ----------
+        timeout: float or None
+            The longest to wait. None waits until a device is readable.
+
+        Returns
+        -------
+        list of BluetoothDevices
+            The connected devices that have data to read
+        """
+        deadline = Deadline(timeout)
+        while True:
+            waits = [w for w in (self.scanner.timeout(), self.pool.timeout(),
+                                 deadline.remaining()) if w is not None]
+            wait = min(waits) if waits else None
+            readable, _, _ = select.select(self.devices + self.scanner.selectables()
+                                           + self.pool.selectables(), [], [], wait)
+            self.scanner.process(readable)
+            self.pool.process(readable)
+            ready = [r for r in readable if isinstance(r, BluetoothDevice)]
+            if ready or deadline.expired():
+                return ready
+
+    def relay(self, timeout=None, on_local=None):
+        """
+        Relays '<source|destination|message>' packets between the connected
+        devices (and, through the coordinator if connect_coordinator has
+        been called, devices connected to other hubs), in this thread, for timeout seconds (or forever if
+        timeout is None), while scanning for and connecting to new devices
+        in the background.
+
+        All of the device sockets are multiplexed by one RelayEngine, so a
+        packet is forwarded as soon as it has arrived. Once this has been
+        called, the devices' sockets belong to the engine (they are
+        non-blocking): do not use select() or the devices' own send and
+        receive methods as well.
+
+        Parameters
+        ----------
+        timeout: float or None
+            How long to relay for
+        on_local: callable or None
+            on_local(link, packet) is called for packets that are not for a
+            connected device (only the first call's on_local is used)
+
+        Returns
+        -------
+        int
+            The number of packets relayed
+        """
+        if self.engine is None:
+            self.engine = RelayEngine(on_local=on_local, on_closed=self.__link_closed,
+                                      router=self.__route)
+            for dev in self.devices:
+                self.engine.add(dev)
+            if self.uplink is not None:
+                self.engine.add(self.uplink)
+            self.engine.watch(self.scanner)
+            self.engine.watch(self.pool)
+        deadline = Deadline(timeout)
+        relayed = 0
+        while True:
+            relayed += self.engine.poll(deadline.remaining())
+            if deadline.expired():
+                return relayed
+
     def update_devices(self):
         # This function will need to be run in a thread
         # Continually scans for devices using __scan
@@ -467,7 +722,7 @@ class BTServer(Server):
         # Remove devices that are no longer active
         
         print("Removing unavailable devices")
-        self.__prune_devices()
+        self.prune_devices()
 
         # Scan for new devices
         print("Scanning")
@@ -482,6 +737,9 @@ class BTServer(Server):
             
             if flag is None:
                 self.devices.append(dev)
+                self.pool.add(dev)
+                # So that the background scanner does not connect again
+                self.scanner.connected.add(dev.address)
                 print("Successfully connected!")
             else:
                 # For now, we report all errors as we find them. Later they
@@ -496,16 +754,93 @@ class Coordinator():
     # Routes traffic to distant nodes
     # Coordinator must always be listening and must accept all connections
     # (ignore authentication for now
-    def __init__(self):
-        self.routing_table = {}
+    def __init__(self, host='', port=DEFAULT_PORT, route_ttl=ROUTE_TTL,
+                 max_routes=MAX_ROUTES):
+        """
+        Starts listening for hubs (BTServers calling connect_coordinator)
+
+        Routes are learned from the sources of the packets that the hubs
+        send: a device is reached through the hub its packets came from.
+        Packets to devices with no route yet are sent to every other hub.
+        The routing table is a RouteCache, so routes expire after route_ttl
+        seconds without traffic from the device, the least recently used
+        are dropped beyond max_routes, and the routes through a hub are
+        dropped when the link to it is lost.
+
+        Parameters
+        ----------
+        host, port:
+            Where to listen. Port 0 picks a free port (see self.port)
+        route_ttl: float
+            Seconds for which a route is kept without being confirmed
+        max_routes: int
+            The most routes kept
+        """
+        self.routing_table = RouteCache(max_routes, route_ttl)
         # Later, when we implement authentication, Coordinator will compile
         # a list of Swich devices' public keys
         #self.device_public_keys = {}
-        raise NotYetImplemented()
+        self.logging = False
+        self.flooded = 0
+        # Packets go out to each hub in batches, once per poll
+        self.engine = RelayEngine(on_local=self.__ignore, on_closed=self.__hub_lost,
+                                  router=self.__route)
+        self.listener = Listener(self.__hub_connected, host, port)
+        self.port = self.listener.port
+        self.engine.watch(self.listener)
+
     def __update_routing_table(self, message_source, message_sender):
-        self.routing_table[message_source] = message_sender
+        self.routing_table.learn(message_source, message_sender)
+
+    def __route(self, link, packet):
+        source, destination, message = unpackage(packet)
+        source = source.decode('ascii', 'replace').upper()
+        destination = destination.decode('ascii', 'replace').upper()
+        self.__update_routing_table(source, link.address)
+        next_hop = self.routing_table.get(destination)
+        if next_hop is not None:
+            # None if the destination is on the hub the packet came from,
+            # which should have delivered it itself
+            return next_hop if next_hop != link.address else None
+        # No route yet: try every other hub
+        self.flooded += 1
+        for address in list(self.engine.links):
+            if address != link.address:
+                self.engine.send(address, packet)
+        return None
+
+    def __ignore(self, link, packet):
+        pass
+
+    def __hub_connected(self, peer):
+        self.engine.add(peer)
+        if self.logging:
+            print(get_time() + "Hub connected from " + peer.address)
+
+    def __hub_lost(self, peer, error):
+        forgotten = self.routing_table.invalidate(peer.address)
+        peer.disconnect()
+        if self.logging:
+            print(get_time() + "Lost hub " + peer.address + " (" + str(forgotten) +
+                  " routes): " + str(error))
+
+    def poll(self, timeout=None):
+        """
+        Accepts hubs and routes packets for up to timeout seconds. Returns
+        the number of packets routed.
+        """
+        return self.engine.poll(timeout)
+
     def loop(self, logging=True):
-        raise NotYetImplemented()
+        self.logging = logging
+        if logging:
+            print(get_time() + "Coordinator listening on port " + str(self.port))
+        while True:
+            self.poll()
+
+    def close(self):
+        self.engine.close()
+        self.listener.close()
 
 if __name__ == "__main__":
     pass
@@ -0,0 +1,253 @@
+"""
+A pool of connections to bluetooth devices, one per address, that are
+checked for liveness and reconnected when they fail.
+
+A device's socket is kept open and reused for everything sent to it, rather
+than a new RFCOMM connection being made for each exchange. Every
+check_interval seconds each pooled link is checked without blocking: a
+link is dead if the socket has an error, no longer has a peer, or is
+readable but at end of file. Dead links are reported and reconnected in
+threads, a few at a time, retrying with exponential backoff and jitter, so
+that when many devices go away at once (e.g. a power cut) the reconnection
+attempts neither block the healthy links nor all happen together.
+
+Like a scanner.Scanner, a pool is driven from a select loop (see
+RelayEngine.watch) and calls its callbacks from the loop's thread.
+"""
+from __future__ import print_function, absolute_import, division
+
+import errno
+import select
+import socket
+import time
+
+from background import Background
+from scanner import backoff_delay, BACKOFF, MAX_BACKOFF
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    monotonic = time.time
+
+# Seconds between liveness checks of each link
+CHECK_INTERVAL = 10
+# The number of reconnection attempts made at once
+MAX_RECONNECTING = 2
+# How long a reconnection attempt may take (seconds)
+CONNECT_TIMEOUT = 5
+
+
+def link_alive(sock):
+    """
+    Checks, without blocking, whether a connected socket still has a live
+    link to its peer
+
+    Returns
+    -------
+    bool
+        False if the socket is closed, has an error, has lost its peer or
+        has been closed by the other end
+    """
+    try:
+        if sock is None or sock.fileno() < 0:
+            return False
+        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+            return False
+        sock.getpeername()
+        readable, _, _ = select.select([sock], [], [], 0)
+        if readable:
+            # Readable with nothing to read means the other end has closed.
+            # Peeking leaves any data for whoever reads the socket.
+            return len(sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)) > 0
+        return True
+    except (IOError, OSError, socket.error, ValueError) as e:
+        # Nothing to read yet on a non-blocking socket is not a failure
+        return getattr(e, "errno", None) in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+class ConnectionPool(object):
+    """
+    Keeps one connection per device address alive
+
+    Parameters
+    ----------
+    check_interval: float
+        Seconds between liveness checks of each link
+    connect_timeout: float
+        Passed to device.connect() when reconnecting
+    max_reconnecting: int
+        The most reconnection attempts made at once
+    backoff, max_backoff: float
+        The delay before retrying a failed reconnection doubles from backoff
+        up to max_backoff (seconds), with jitter
+    max_failures: int or None
+        Give up on a device after this many failed reconnections in a row
+        (None to keep trying)
+    on_lost: callable
+        on_lost(device) is called when a link is found to be dead, before it
+        is reconnected
+    on_restored: callable
+        on_restored(device) is called when it has been reconnected
+    on_dropped: callable
+        on_dropped(device) is called when the pool gives up on a device
+    alive: callable
+        alive(device) checks a device's link without blocking. By default,
+        link_alive(device.sock).
+    """
+    def __init__(self, check_interval=CHECK_INTERVAL, connect_timeout=CONNECT_TIMEOUT,
+                 max_reconnecting=MAX_RECONNECTING, backoff=BACKOFF,
+                 max_backoff=MAX_BACKOFF, max_failures=None, on_lost=None,
+                 on_restored=None, on_dropped=None, alive=None):
+        self.check_interval = check_interval
+        self.connect_timeout = connect_timeout
+        self.max_reconnecting = max_reconnecting
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_failures = max_failures
+        self.on_lost = on_lost
+        self.on_restored = on_restored
+        self.on_dropped = on_dropped
+        self.alive = alive if alive is not None else (lambda device: link_alive(device.sock))
+
+        # Every pooled device, by address
+        self.devices = {}
+        self.healthy = set()
+        self.reconnecting = set()
+        self.failures = {}
+        # When each dead device may be tried again
+        self.retry_at = {}
+        self.next_check = monotonic() + check_interval
+        self.background = Background()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def fileno(self):
+        return self.background.fileno()
+
+    def add(self, device):
+        """
+        Pools a connected device, replacing any other with its address
+        """
+        address = device.address.upper()
+        self.devices[address] = device
+        self.healthy.add(address)
+        self.failures.pop(address, None)
+        self.retry_at.pop(address, None)
+
+    def remove(self, address):
+        """
+        Stops pooling a device (it is not disconnected) and returns it
+        """
+        address = address.upper()
+        self.healthy.discard(address)
+        self.failures.pop(address, None)
+        self.retry_at.pop(address, None)
+        return self.devices.pop(address, None)
+
+    def get(self, address):
+        """
+        Returns the connected device with address, or None if there is none
+        (or its link is down and being reconnected). Never blocks.
+        """
+        address = address.upper()
+        if address in self.healthy:
+            return self.devices[address]
+        return None
+
+    def lost(self, device):
+        """
+        Records that device's link has failed (e.g. a send or receive
+        failed), so that it is reconnected
+        """
+        address = device.address.upper()
+        if address not in self.healthy or self.devices.get(address) is not device:
+            return
+        self.healthy.discard(address)
+        device.disconnect()
+        self.retry_at[address] = monotonic()
+        if self.on_lost is not None:
+            self.on_lost(device)
+
+    def check(self):
+        """
+        Checks every healthy link now, and returns the number found dead
+        """
+        dead = [self.devices[address] for address in self.healthy
+                if not self.alive(self.devices[address])]
+        for device in dead:
+            self.lost(device)
+        self.next_check = monotonic() + self.check_interval
+        return len(dead)
+
+    def selectables(self):
+        return [self]
+
+    def timeout(self, now=None):
+        """
+        Returns the longest the select loop should wait before calling
+        process() even if nothing is readable
+        """
+        now = monotonic() if now is None else now
+        times = [self.next_check]
+        if len(self.reconnecting) < self.max_reconnecting:
+            times.extend(at for address, at in self.retry_at.items()
+                         if address not in self.reconnecting)
+        return max(min(times) - now, 0.0)
+
+    def process(self, readable=()):
+        """
+        Handles finished reconnection attempts, checks the links if it is
+        time to, and starts reconnection attempts that are due. Never blocks.
+        """
+        for kind, (device, error) in self.background.results():
+            self.__reconnected(device, error)
+        now = monotonic()
+        if now >= self.next_check:
+            self.check()
+        for address, at in sorted(self.retry_at.items(), key=lambda item: item[1]):
+            if len(self.reconnecting) >= self.max_reconnecting or at > now:
+                break
+            if address in self.reconnecting:
+                continue
+            self.reconnecting.add(address)
+            self.background.run(self.__reconnect(self.devices[address]))
+
+    def close(self):
+        for device in self.devices.values():
+            device.disconnect()
+        self.devices = {}
+        self.healthy = set()
+        self.background.close()
+
+    def __reconnect(self, device):
+        # Returns work for a background thread that reconnects device
+        def work():
+            try:
+                return ("reconnected", (device, device.connect(self.connect_timeout)))
+            except Exception as e:
+                return ("reconnected", (device, e))
+        return work
+
+    def __reconnected(self, device, error):
+        address = device.address.upper()
+        self.reconnecting.discard(address)
+        if self.devices.get(address) is not device:
+            # Removed (or replaced) while reconnecting
+            if error is None:
+                device.disconnect()
+            return
+        if error is None:
+            self.add(device)
+            if self.on_restored is not None:
+                self.on_restored(device)
+            return
+        failures = self.failures.get(address, 0) + 1
+        if self.max_failures is not None and failures >= self.max_failures:
+            self.remove(address)
+            if self.on_dropped is not None:
+                self.on_dropped(device)
+            return
+        self.failures[address] = failures
+        self.retry_at[address] = monotonic() + backoff_delay(
+            failures, self.backoff, self.max_backoff)
@@ -0,0 +1,419 @@
+"""
+A single threaded relay between bluetooth devices, multiplexing all of
+their sockets with selectors (epoll on Linux).
+
+Piduino's Server sends and receives with one blocking call per device and
+a 2 s socket timeout, so one quiet device holds up the rest. A RelayEngine
+instead puts every device's socket in non-blocking mode and waits on all of
+them at once. When a socket is readable, whatever has arrived is fed to that
+device's decoder (a utils.PacketReassembler by default), and each complete
+packet is forwarded to the device whose address is its destination. A
+packet is passed on as soon as its last byte is read, with no polling.
+
+Each device has an outgoing queue. The packets queued for a device while
+handling one batch of ready sockets are written together at the end of it,
+with a single sendmsg() where the socket has one (TCP links between hubs),
+so a busy link costs one system call per batch rather than per packet.
+Bluetooth sockets have no sendmsg, so for them the packets are joined into
+sends of up to batch_bytes each where the device's linkconfig.LinkSettings
+ask for it (otherwise they are sent one at a time).
+If a device's queue grows past max_queued bytes, the engine stops reading
+from the devices that are sending to it until it has drained to half that.
+Their data then waits in the kernel, and bluetooth flow control slows the
+senders down, rather than the hub buffering without limit.
+
+    engine = RelayEngine(on_local=handle)
+    for device in devices:
+        engine.add(device)
+    while True:
+        engine.poll()
+"""
+import errno
+import selectors
+from collections import deque
+from itertools import islice
+
+from utils import PacketReassembler, unpackage
+
+# Stop reading from a device's senders when this many bytes are queued for it
+MAX_QUEUED = 64 * 1024
+# The most read from a socket at once
+RECV_SIZE = 4096
+# The most packets written with one sendmsg (within any system's IOV_MAX)
+MAX_BATCH = 512
+
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+def would_block(error):
+    # pybluez raises BluetoothError(str(e)), losing the errno, so look for it
+    # in the message too
+    if getattr(error, "errno", None) in WOULD_BLOCK:
+        return True
+    return any(str(error).startswith("(%d," % number) for number in WOULD_BLOCK)
+
+
+def packet_destination(packet):
+    """
+    Returns the destination address of a '<source|destination|message>'
+    packet, upper case
+    """
+    source, destination, message = unpackage(packet)
+    return destination.decode("ascii", "replace").upper()
+
+
+class Link(object):
+    """
+    The state the engine keeps for each device
+
+    Attributes
+    ----------
+    device
+        The device, which has address and sock attributes and a fileno()
+        method (e.g. a piduino.BluetoothDevice)
+    decoder
+        Turns received chunks into packets (see RelayEngine)
+    outgoing: deque
+        memoryviews of the bytes waiting to be sent
+    queued: int
+        The number of bytes in outgoing
+    paused: bool
+        True while reading is paused because a destination is full
+    waiting_for: set
+        The addresses of the full devices this one has sent to
+    batch_bytes: int
+        Join queued packets into sends of up to this many bytes where the
+        socket has no sendmsg (0 to send them one at a time)
+    """
+    def __init__(self, device, decoder, batch_bytes=0):
+        self.device = device
+        self.address = device.address.upper()
+        self.decoder = decoder
+        self.batch_bytes = batch_bytes
+        self.outgoing = deque()
+        self.queued = 0
+        self.paused = False
+        self.waiting_for = set()
+        self.events = 0
+        self.received = 0
+        self.sent = 0
+
+
+class RelayEngine(object):
+    """
+    Relays packets between devices, in one thread
+
+    Parameters
+    ----------
+    on_local: callable or None
+        on_local(link, packet) is called for packets whose destination is
+        local_address, or is not a connected device. Such packets are
+        otherwise dropped (and counted in self.dropped).
+    on_closed: callable or None
+        on_closed(device, error) is called when a device's link fails or is
+        closed by the other end. The device has already been removed.
+    local_address: str or None
+        The address of this hub
+    max_queued: int
+        The number of bytes that may be queued for a device before its
+        senders are paused
+    decoder: callable
+        decoder() returns a new decoder for a device: an object whose
+        feed(data) method returns the complete packets in data (as bytes),
+        keeping any incomplete one for next time
+    destination: callable
+        destination(packet) returns the address a packet should go to, or
+        raises an exception if the packet is not valid (it is dropped)
+    router: callable or None
+        router(link, packet) returns the address of the device to forward a
+        packet to, which need not be its destination (e.g. another hub), or
+        None for on_local. By default, the packet's destination.
+    selector: selectors.BaseSelector or None
+        By default, selectors.DefaultSelector()
+    """
+    def __init__(self, on_local=None, on_closed=None, local_address=None,
+                 max_queued=MAX_QUEUED, decoder=PacketReassembler,
+                 destination=packet_destination, router=None, selector=None):
+        self.on_local = on_local
+        self.on_closed = on_closed
+        self.local_address = local_address.upper() if local_address else None
+        self.max_queued = max_queued
+        self.decoder = decoder
+        self.destination = destination
+        self.router = router
+        self.selector = selector if selector is not None else selectors.DefaultSelector()
+        self.links = {}
+        # The links paused until each full device drains, by its address
+        self.blocked = {}
+        # Links with packets queued since the last flush
+        self.dirty = set()
+        self.polling = False
+        self.watchers = []
+        self.watched = {}
+        self.relayed = 0
+        self.dropped = 0
+
+    def add(self, device, batch_bytes=None):
+        """
+        Starts relaying for a connected device, replacing any previous link
+        with the same address
+
+        batch_bytes is Link.batch_bytes: by default, that of the device's
+        settings (a linkconfig.LinkSettings), if it has any
+        """
+        if batch_bytes is None:
+            settings = getattr(device, "settings", None)
+            batch_bytes = settings.batch_bytes if settings is not None else 0
+        link = Link(device, self.decoder(), batch_bytes)
+        if link.address in self.links:
+            self.remove(self.links[link.address].device)
+        device.sock.setblocking(False)
+        self.links[link.address] = link
+        self.__update(link)
+        return link
+
+    def remove(self, device):
+        """
+        Stops relaying for a device. Anything still queued for it is lost.
+        """
+        link = self.links.pop(device.address.upper(), None)
+        if link is None:
+            return
+        if link.events:
+            self.selector.unregister(device)
+        self.dirty.discard(link)
+        for other in self.blocked.values():
+            other.discard(link)
+        # Whoever was waiting for this device to drain need not wait any more
+        self.__unblock(link.address)
+
+    def send(self, address, packet):
+        """
+        Queues packet (bytes) to be sent to the device at address
+
+        Returns
+        -------
+        bool
+            False if there is no such device, or it has max_queued bytes
+            queued already. The packet is queued anyway in the second case;
+            the caller should stop sending until it drains.
+        """
+        link = self.links.get(address.upper())
+        if link is None:
+            return False
+        view = memoryview(packet)
+        link.outgoing.append(view)
+        link.queued += len(view)
+        if self.polling:
+            # Written with everything else for this link at the end of poll
+            self.dirty.add(link)
+        elif not link.events & selectors.EVENT_WRITE:
+            self.__write(link)
+        return link.queued < self.max_queued
+
+    def watch(self, watcher):
+        """
+        Drives watcher from poll(), e.g. a scanner.Scanner, so that devices
+        are found and connected to in the same loop. A watcher has:
+
+        selectables()
+            the objects to wait on for reading (these may change)
+        timeout()
+            the longest to wait before calling process() (or None)
+        process(readable)
+            called after every wait, with those of its selectables that are
+            readable
+        """
+        self.watchers.append(watcher)
+
+    def poll(self, timeout=None):
+        """
+        Waits for up to timeout seconds for sockets to be ready, and then
+        reads, relays and writes whatever it can without blocking
+
+        Returns
+        -------
+        int
+            The number of packets relayed
+        """
+        relayed = self.relayed
+        if self.watchers:
+            self.__sync_watched()
+            for watcher in self.watchers:
+                wait = watcher.timeout()
+                if wait is not None and (timeout is None or wait < timeout):
+                    timeout = wait
+        ready = dict((watcher, []) for watcher in self.watchers)
+        self.polling = True
+        try:
+            for key, events in self.selector.select(timeout):
+                link = key.data
+                if not isinstance(link, Link):
+                    ready[link].append(key.fileobj)
+                    continue
+                if events & selectors.EVENT_READ and self.links.get(link.address) is link:
+                    self.__read(link)
+                if events & selectors.EVENT_WRITE and self.links.get(link.address) is link:
+                    self.__write(link)
+        finally:
+            self.polling = False
+        self.flush()
+        for watcher in self.watchers:
+            watcher.process(ready[watcher])
+        return self.relayed - relayed
+
+    def flush(self):
+        """
+        Writes what can be written of the packets queued during poll()
+        """
+        while self.dirty:
+            link = self.dirty.pop()
+            if self.links.get(link.address) is link:
+                self.__write(link)
+
+    def close(self):
+        for link in list(self.links.values()):
+            self.remove(link.device)
+        for selectable in list(self.watched):
+            self.selector.unregister(selectable)
+        self.watched = {}
+        self.selector.close()
+
+    def __sync_watched(self):
+        # A scanner's inquiry comes and goes, so (un)register the watchers'
+        # selectables as they change
+        current = {}
+        for watcher in self.watchers:
+            for selectable in watcher.selectables():
+                current[selectable] = watcher
+        for selectable in list(self.watched):
+            if selectable not in current:
+                self.selector.unregister(selectable)
+                del self.watched[selectable]
+        for selectable, watcher in current.items():
+            if selectable not in self.watched:
+                self.selector.register(selectable, selectors.EVENT_READ, watcher)
+                self.watched[selectable] = watcher
+
+    def __update(self, link):
+        # (Re)registers the link's socket for the events it needs now
+        events = 0
+        if not link.paused:
+            events |= selectors.EVENT_READ
+        if link.outgoing:
+            events |= selectors.EVENT_WRITE
+        if events == link.events:
+            return
+        if not events:
+            self.selector.unregister(link.device)
+        elif not link.events:
+            self.selector.register(link.device, events, link)
+        else:
+            self.selector.modify(link.device, events, link)
+        link.events = events
+
+    def __fail(self, link, error):
+        self.remove(link.device)
+        if self.on_closed is not None:
+            self.on_closed(link.device, error)
+
+    def __read(self, link):
+        try:
+            data = link.device.sock.recv(RECV_SIZE)
+        except (IOError, OSError) as e:
+            if not would_block(e):
+                self.__fail(link, e)
+            return
+        if not data:
+            self.__fail(link, None)
+            return
+        link.received += len(data)
+        for packet in link.decoder.feed(data):
+            self.__route(link, packet)
+
+    def __route(self, link, packet):
+        try:
+            if self.router is not None:
+                address = self.router(link, packet)
+            else:
+                address = self.destination(packet)
+        except Exception:
+            self.dropped += 1
+            return
+        destination = self.links.get(address) if address is not None else None
+        if destination is None or address == self.local_address:
+            if self.on_local is not None:
+                self.on_local(link, packet)
+            else:
+                self.dropped += 1
+            return
+        self.relayed += 1
+        if not self.send(address, packet):
+            # Backpressure: stop reading from this sender until the
+            # destination has drained
+            link.waiting_for.add(address)
+            self.blocked.setdefault(address, set()).add(link)
+            if not link.paused:
+                link.paused = True
+                self.__update(link)
+
+    def __write(self, link):
+        sock = link.device.sock
+        sendmsg = getattr(sock, "sendmsg", None)
+        outgoing = link.outgoing
+        while outgoing:
+            if sendmsg is not None and len(outgoing) > 1:
+                batch = list(islice(outgoing, MAX_BATCH))
+            elif link.batch_bytes and len(outgoing) > 1:
+                batch = self.__batch(outgoing, link.batch_bytes)
+            else:
+                batch = [outgoing[0]]
+            try:
+                if len(batch) > 1 and sendmsg is not None:
+                    sent = sendmsg(batch)
+                elif len(batch) > 1:
+                    sent = sock.send(b"".join(batch))
+                else:
+                    sent = sock.send(batch[0])
+            except (IOError, OSError) as e:
+                if not would_block(e):
+                    self.__fail(link, e)
+                    return
+                break
+            link.sent += sent
+            link.queued -= sent
+            # Drop what was sent from the front of the queue
+            for view in batch:
+                if sent < len(view):
+                    break
+                sent -= len(outgoing.popleft())
+            else:
+                continue
+            # A short write: the socket is full
+            if sent:
+                outgoing[0] = outgoing[0][sent:]
+            break
+        self.__update(link)
+        if link.queued <= self.max_queued // 2:
+            self.__unblock(link.address)
+
+    @staticmethod
+    def __batch(outgoing, batch_bytes):
+        # The packets at the front of the queue, up to batch_bytes in all
+        # (but at least one)
+        batch = []
+        size = 0
+        for view in outgoing:
+            size += len(view)
+            if batch and size > batch_bytes:
+                break
+            batch.append(view)
+        return batch
+
+    def __unblock(self, address):
+        # Resumes reading from the links that were waiting for address
+        for other in self.blocked.pop(address, ()):
+            other.waiting_for.discard(address)
+            if other.paused and not other.waiting_for:
+                other.paused = False
+                self.__update(other)
@@ -0,0 +1,187 @@
+"""
+Routing between hubs: a cache of which hub each device can be reached
+through, and TCP links between hubs and the coordinator.
+
+A coordinator learns routes as a learning switch does: a packet from
+device X arriving over the link from hub H means X can be reached through
+H. Packets to devices with no route are sent to every hub (except the one
+they came from), and the reply teaches the coordinator the route.
+
+Routes are kept in a RouteCache, which forgets routes that have not been
+confirmed for ttl seconds (the device may have moved to another hub), keeps
+at most max_routes (dropping the least recently used), and forgets every
+route through a hub at once when the link to it is lost.
+"""
+import socket
+import time
+from collections import OrderedDict
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    monotonic = time.time
+
+# The port the coordinator listens on for hubs
+DEFAULT_PORT = 5740
+# Seconds after which a route that has not been confirmed is forgotten
+ROUTE_TTL = 300
+MAX_ROUTES = 4096
+
+
+class RouteCache(object):
+    """
+    A least recently used cache of routes: device address -> the address of
+    the link to send its packets to
+
+    Parameters
+    ----------
+    max_routes: int
+        The most routes kept
+    ttl: float
+        Seconds after which a route that has not been learned again expires
+    """
+    def __init__(self, max_routes=MAX_ROUTES, ttl=ROUTE_TTL):
+        self.max_routes = max_routes
+        self.ttl = ttl
+        # address: (next hop, when it expires), least recently used first
+        self.routes = OrderedDict()
+        # next hop: the addresses routed through it
+        self.through = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.routes)
+
+    def __contains__(self, address):
+        return self.get(address) is not None
+
+    def learn(self, address, next_hop, now=None):
+        """
+        Records that address can be reached through next_hop
+        """
+        now = monotonic() if now is None else now
+        old = self.routes.pop(address, None)
+        if old is not None and old[0] != next_hop:
+            self.through[old[0]].discard(address)
+        self.routes[address] = (next_hop, now + self.ttl)
+        self.through.setdefault(next_hop, set()).add(address)
+        while len(self.routes) > self.max_routes:
+            evicted, (hop, expires) = self.routes.popitem(last=False)
+            self.through[hop].discard(evicted)
+
+    def get(self, address, now=None):
+        """
+        Returns the next hop for address, or None if there is no route
+        """
+        route = self.routes.get(address)
+        if route is None:
+            self.misses += 1
+            return None
+        now = monotonic() if now is None else now
+        if now >= route[1]:
+            self.forget(address)
+            self.misses += 1
+            return None
+        # Most recently used last
+        self.routes[address] = self.routes.pop(address)
+        self.hits += 1
+        return route[0]
+
+    def forget(self, address):
+        route = self.routes.pop(address, None)
+        if route is not None:
+            self.through[route[0]].discard(address)
+
+    def invalidate(self, next_hop):
+        """
+        Forgets every route through next_hop (e.g. when the link to it is
+        lost). Returns the number of routes forgotten.
+        """
+        addresses = self.through.pop(next_hop, set())
+        for address in addresses:
+            self.routes.pop(address, None)
+        return len(addresses)
+
+
+class Peer(object):
+    """
+    A TCP link to another hub or the coordinator, which a RelayEngine can
+    relay over as it does a BluetoothDevice
+
+    Parameters
+    ----------
+    sock: socket
+        The connected socket
+    address: str
+        What to call the link; by default the other end's host:port
+    """
+    def __init__(self, sock, address=None):
+        if address is None:
+            host, port = sock.getpeername()[:2]
+            address = "%s:%d" % (host, port)
+        self.sock = sock
+        self.address = address
+        # Packets are small and latency matters more than filling segments
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (OSError, socket.error):
+            pass
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def disconnect(self):
+        try:
+            self.sock.close()
+            return None
+        except Exception as e:
+            return e
+
+    @classmethod
+    def connect(cls, host, port=DEFAULT_PORT, address=None, timeout=5):
+        return cls(socket.create_connection((host, port), timeout), address)
+
+
+class Listener(object):
+    """
+    Accepts TCP connections from hubs, for a RelayEngine to watch (see
+    RelayEngine.watch)
+
+    Parameters
+    ----------
+    on_accept: callable
+        on_accept(peer) is called with a Peer for each connection
+    host, port:
+        Where to listen. Port 0 picks a free port (see self.port).
+    """
+    def __init__(self, on_accept, host="", port=DEFAULT_PORT, backlog=16):
+        self.on_accept = on_accept
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(backlog)
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def selectables(self):
+        return [self]
+
+    def timeout(self):
+        return None
+
+    def process(self, readable):
+        if self not in readable:
+            return
+        while True:
+            try:
+                sock, address = self.sock.accept()
+            except (OSError, socket.error):
+                return
+            self.on_accept(Peer(sock))
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,355 @@
+"""
+Continuous background discovery of, and connection to, bluetooth devices,
+driven from the same select loop as the devices' sockets.
+
+BTServer.update_devices() blocks for a whole scan and then connects to each
+new device in turn, so nothing is relayed while it runs. A Scanner never
+blocks the loop that drives it:
+
+- Inquiries are run with DeviceDiscoverer, whose HCI socket is selected on
+  alongside the data sockets; each event is processed as it arrives.
+- Name lookups, connection attempts (and, without DeviceDiscoverer, the
+  inquiry itself) run in threads. Their results are queued, and the thread
+  wakes the loop by writing to a socket that is also selected on, so the
+  callbacks are always called from the loop's thread (see background.py).
+- A few connections are attempted at once. A device that cannot be
+  connected to is retried after a delay that doubles (with some jitter)
+  with each failure.
+
+    scanner = Scanner("SCD_ARDUINO", connect=connect, on_connected=add)
+    while True:
+        readable, _, _ = select.select(sockets + scanner.selectables(), [], [],
+                                       scanner.timeout())
+        scanner.process(readable)
+        ...
+"""
+from __future__ import print_function, absolute_import, division
+
+import random
+import time
+
+from background import Background
+from discovery import Discovery, Found, inquiry_timeout
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    monotonic = time.time
+
+# Seconds between the end of one scan and the start of the next
+DEFAULT_INTERVAL = 30
+# The number of connection attempts made at once
+MAX_CONNECTING = 2
+# The delay before the first retry of a failed connection, and the longest
+# delay (seconds)
+BACKOFF = 1.0
+MAX_BACKOFF = 300.0
+# A device that is not connected is forgotten after this many scans in a row
+# that do not find it
+MISSED_SCANS = 3
+
+
+def backoff_delay(failures, base=BACKOFF, limit=MAX_BACKOFF):
+    """
+    Returns how long to wait before retrying after failures failures in a
+    row: doubling each time up to limit, then scaled by a random factor
+    between 0.5 and 1.5 so that devices that failed together do not all
+    retry together
+    """
+    return min(limit, base * 2 ** max(failures - 1, 0)) * random.uniform(0.5, 1.5)
+
+
+class Scanner(object):
+    """
+    Scans for bluetooth devices whose names start with address_pattern, and
+    connects to them, without blocking
+
+    Parameters
+    ----------
+    address_pattern: str
+        Devices whose names start with this are reported and connected to
+    discovery: Discovery or None
+        Runs the inquiries and name lookups. By default, one that keeps the
+        names it finds in discovery.DEFAULT_CACHE_PATH
+    connect: callable or None
+        connect(found) connects to a device (found is a discovery.Found) and
+        returns whatever on_connected should be given, or raises an
+        exception. Called in a thread. If None, nothing is connected to.
+    interval: float
+        Seconds between the end of one scan and the start of the next
+    duration: int
+        The inquiry duration, in units of 1.28 s
+    max_connecting: int
+        The most connection attempts made at once
+    backoff, max_backoff: float
+        The delay before retrying a failed connection doubles from backoff
+        up to max_backoff (seconds)
+    missed_scans: int
+        A device is reported as gone after this many scans in a row that do
+        not find it (devices that are connected do not show up in scans, so
+        they are never reported as gone; call lost() when a link fails)
+    on_appeared: callable
+        on_appeared(found) is called when a matching device is first seen
+    on_disappeared: callable
+        on_disappeared(found) is called when it is no longer seen
+    on_connected: callable
+        on_connected(found, connection) is called when connect succeeds
+    on_connect_failed: callable
+        on_connect_failed(found, error) is called when connect fails
+    on_scan_failed: callable
+        on_scan_failed(error) is called when a scan fails (e.g. the adapter
+        is down). The next scan is still made interval seconds later.
+    """
+    def __init__(self, address_pattern, discovery=None, connect=None,
+                 interval=DEFAULT_INTERVAL, duration=3, max_connecting=MAX_CONNECTING,
+                 backoff=BACKOFF, max_backoff=MAX_BACKOFF, missed_scans=MISSED_SCANS,
+                 on_appeared=None, on_disappeared=None, on_connected=None,
+                 on_connect_failed=None, on_scan_failed=None):
+        if duration <= 0:
+            raise IOError("Duration must be a postive integer greater than zero. "+
+                          "If you pass zero, the program will hang!")
+        self.address_pattern = address_pattern
+        self.discovery = discovery if discovery is not None else Discovery()
+        self.connect = connect
+        self.interval = interval
+        self.duration = duration
+        self.max_connecting = max_connecting
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.missed_scans = missed_scans
+        self.on_appeared = on_appeared
+        self.on_disappeared = on_disappeared
+        self.on_connected = on_connected
+        self.on_connect_failed = on_connect_failed
+        self.on_scan_failed = on_scan_failed
+
+        # Matching devices seen recently, by address
+        self.nearby = {}
+        # The number of scans in a row that have missed each nearby device
+        self.missed = {}
+        self.connected = set()
+        self.connecting = set()
+        self.failures = {}
+        # When each device that failed to connect may be tried again
+        self.retry_at = {}
+
+        self.scanning = False
+        self.scans = 0
+        self.inquiry = None
+        self.inquiry_end = None
+        self.next_scan = monotonic()
+
+        # Runs the name lookups and connection attempts
+        self.background = Background()
+
+    def fileno(self):
+        # Readable when a thread has a result for process()
+        return self.background.fileno()
+
+    def selectables(self):
+        """
+        Returns the objects to select on for reading: the scanner itself,
+        and the inquiry while one is running
+        """
+        if self.inquiry is None:
+            return [self]
+        return [self, self.inquiry]
+
+    def timeout(self, now=None):
+        """
+        Returns the longest the select loop should wait before calling
+        process() even if nothing is readable (None for no limit)
+        """
+        now = monotonic() if now is None else now
+        times = []
+        if not self.scanning:
+            times.append(self.next_scan)
+        if self.inquiry is not None:
+            times.append(self.inquiry_end)
+        if self.connect is not None and len(self.connecting) < self.max_connecting:
+            for address in self.nearby:
+                if address not in self.connected and address not in self.connecting:
+                    times.append(self.retry_at.get(address, now))
+        if not times:
+            return None
+        return max(min(times) - now, 0.0)
+
+    def process(self, readable=(), now=None):
+        """
+        Does whatever is due: handles inquiry events and results from the
+        threads (calling the callbacks), and starts scans and connection
+        attempts. Never blocks.
+
+        Parameters
+        ----------
+        readable: list
+            The objects that select found readable (anything else in it is
+            ignored)
+        """
+        now = monotonic() if now is None else now
+        inquiry = self.inquiry
+        if inquiry is not None:
+            error = None
+            if inquiry in readable:
+                try:
+                    inquiry.process_event()
+                except Exception as e:
+                    error = e
+            if error is not None:
+                try:
+                    inquiry.cancel_inquiry()
+                except Exception:
+                    pass
+                self.inquiry = None
+                self.__scan_failed(error)
+            elif inquiry.done or now >= self.inquiry_end:
+                if not inquiry.done:
+                    # Raises if the adapter has gone away
+                    try:
+                        inquiry.cancel_inquiry()
+                    except Exception as e:
+                        error = e
+                self.inquiry = None
+                if error is not None:
+                    self.__scan_failed(error)
+                else:
+                    self.__inquired(inquiry.found)
+
+        for kind, args in self.background.results():
+            if kind == "inquiry":
+                self.__inquired(*args)
+            elif kind == "names":
+                self.__scanned(*args)
+            elif kind == "connected":
+                self.__connected(*args)
+            elif kind == "failed":
+                self.__failed(*args)
+            elif kind == "scan failed":
+                self.__scan_failed(*args)
+
+        if not self.scanning and monotonic() >= self.next_scan:
+            self.start_scan()
+        self.__start_connecting(monotonic())
+
+    def start_scan(self):
+        """
+        Starts a scan now, unless one is running
+        """
+        if self.scanning:
+            return
+        self.scanning = True
+        self.inquiry = self.discovery.start_inquiry(self.duration)
+        if self.inquiry is not None:
+            self.inquiry_end = monotonic() + inquiry_timeout(self.duration)
+        else:
+            # No DeviceDiscoverer: run the blocking inquiry in a thread
+            self.background.run(lambda: ("inquiry", (self.discovery.inquire(self.duration),)),
+                                "scan failed")
+
+    def lost(self, address):
+        """
+        Records that the link to address has failed, so it will be connected
+        to again if it is still nearby
+        """
+        self.connected.discard(address)
+        self.missed[address] = 0
+
+    def close(self):
+        if self.inquiry is not None:
+            try:
+                self.inquiry.cancel_inquiry()
+            except Exception:
+                pass
+            self.inquiry = None
+        self.background.close()
+
+    def __inquired(self, results):
+        cache = self.discovery.cache
+        found = []
+        addresses = set()
+        for address, device_class, name in results:
+            cache.seen(address, device_class, name)
+            if address not in addresses:
+                addresses.add(address)
+                found.append((address, device_class))
+        unnamed = [address for address, device_class in found if cache.needs_lookup(address)]
+        if unnamed:
+            self.background.run(lambda: ("names", (found, self.discovery.lookup_names(unnamed))),
+                                "scan failed")
+        else:
+            self.__scanned(found)
+
+    def __scanned(self, found, names=None):
+        cache = self.discovery.cache
+        cache.save()
+        seen = set()
+        for address, device_class in found:
+            name = cache.name(address)
+            if name is None or not name.startswith(self.address_pattern):
+                continue
+            seen.add(address)
+            self.missed[address] = 0
+            if address not in self.nearby:
+                self.nearby[address] = Found(address, name, device_class)
+                if self.on_appeared is not None:
+                    self.on_appeared(self.nearby[address])
+        for address in list(self.nearby):
+            if address in seen or address in self.connected or address in self.connecting:
+                continue
+            self.missed[address] = self.missed.get(address, 0) + 1
+            if self.missed[address] >= self.missed_scans:
+                device = self.nearby.pop(address)
+                del self.missed[address]
+                self.failures.pop(address, None)
+                self.retry_at.pop(address, None)
+                if self.on_disappeared is not None:
+                    self.on_disappeared(device)
+        self.scans += 1
+        self.scanning = False
+        self.next_scan = monotonic() + self.interval
+
+    def __scan_failed(self, error):
+        # Try again at the next interval, rather than never scanning again
+        self.scanning = False
+        self.next_scan = monotonic() + self.interval
+        if self.on_scan_failed is not None:
+            self.on_scan_failed(error)
+
+    def __start_connecting(self, now):
+        if self.connect is None:
+            return
+        for address, device in self.nearby.items():
+            if len(self.connecting) >= self.max_connecting:
+                return
+            if address in self.connected or address in self.connecting:
+                continue
+            if self.retry_at.get(address, now) > now:
+                continue
+            self.connecting.add(address)
+            self.background.run(self.__attempt(device))
+
+    def __attempt(self, device):
+        # Returns work for the background thread that connects to device
+        def work():
+            try:
+                return ("connected", (device, self.connect(device)))
+            except Exception as e:
+                return ("failed", (device, e))
+        return work
+
+    def __connected(self, device, connection):
+        self.connecting.discard(device.address)
+        self.connected.add(device.address)
+        self.failures.pop(device.address, None)
+        self.retry_at.pop(device.address, None)
+        if self.on_connected is not None:
+            self.on_connected(device, connection)
+
+    def __failed(self, device, error):
+        self.connecting.discard(device.address)
+        failures = self.failures.get(device.address, 0) + 1
+        self.failures[device.address] = failures
+        self.retry_at[device.address] = monotonic() + backoff_delay(
+            failures, self.backoff, self.max_backoff)
+        if self.on_connect_failed is not None:
+            self.on_connect_failed(device, error)
@@ -6,6 +6,7 @@ import re
 import warnings
 import socket, struct
 import time
+from collections import deque
 
 
 try:
@@ -14,6 +15,8 @@ try:
 except ImportError:
     warnings.warn("Bluetooth can't be imported, this must be testing...")
 
+from discovery import Discovery
+
 # Define special characters
 PACKET_START = "<"
 PACKET_DIVIDE = "|"
@@ -23,6 +26,32 @@ ESCAPE = "\\"
 # A list of characters to escape
 TO_ESCAPE = [PACKET_START, PACKET_DIVIDE, PACKET_END, ESCAPE]
 
+# The special characters as str and as bytes
+SPECIAL_STR = (PACKET_START, PACKET_DIVIDE, PACKET_END, ESCAPE)
+SPECIAL_BYTES = tuple(char.encode("ascii") for char in SPECIAL_STR)
+
+# Splits text into unescaped runs and escape sequences (an ESCAPE and the
+# character after it, or a lone ESCAPE at the end)
+ESCAPE_SEQUENCE = {
+    str: re.compile("(" + re.escape(ESCAPE) + ".?)", re.DOTALL),
+    bytes: re.compile(b"(" + re.escape(ESCAPE.encode("ascii")) + b".?)", re.DOTALL),
+}
+
+# The longest escaped message package() allows, and the longest packet that
+# can hold one: two 17 character addresses and four special characters
+MAX_LENGTH = 1024
+MAX_PACKET_LENGTH = MAX_LENGTH + 2 * 17 + 4
+
+
+def _special_characters(text):
+    """
+    Returns the special characters of the same type as text (SPECIAL_STR or
+    SPECIAL_BYTES), and text as str or bytes
+    """
+    if isinstance(text, (bytes, bytearray, memoryview)):
+        return SPECIAL_BYTES, bytes(text)
+    return SPECIAL_STR, text
+
 
 def notes():
     """
@@ -98,7 +127,11 @@ def read_local_bdaddr():
     return bdaddr.encode('ascii', 'ignore')
 
 
-def scan(address_pattern, duration=3, verbose=False):
+# The Discovery used by scan() unless it is given one
+_discovery = None
+
+
+def scan(address_pattern, duration=3, verbose=False, discovery=None):
     """
     Scans for nearby bluetooth devices and returns a list of addresses
 
@@ -113,6 +146,10 @@ def scan(address_pattern, duration=3, verbose=False):
         good signal (HC05 close to Pi), duration=1 finds the devices.
     verbose: bool
         If True, provides printed output about all nearby devices
+    discovery: Discovery
+        Finds the devices and looks up their names. By default, one that
+        keeps the names it finds in discovery.DEFAULT_CACHE_PATH, so that
+        devices seen before do not have to be asked for their names again.
 
     Returns
     -------
@@ -124,18 +161,21 @@ def scan(address_pattern, duration=3, verbose=False):
     if duration == 0:
         raise IOError("Duration must be a postive integer greater than zero. "+
                       "If you pass zero, the program will hang!")
+    global _discovery
+    if discovery is None:
+        if _discovery is None:
+            _discovery = Discovery()
+        discovery = _discovery
     addresses = []
-    nearby_devices = bluetooth.discover_devices(flush_cache=True, duration=duration)
-    for device in nearby_devices:
-        name = bluetooth.lookup_name(device)
-        if name == None:
+    for device in discovery.scan(duration=duration):
+        if device.name == None:
             if verbose:
-                print('Unknown at MAC address ' + str(device))
+                print('Unknown at MAC address ' + str(device.address))
         else:
             if verbose:
-                print(name + ' at MAC address ' + str(device))
-            if name.startswith(address_pattern):
-                addresses.append(str(device))
+                print(device.name + ' at MAC address ' + str(device.address))
+            if device.name.startswith(address_pattern):
+                addresses.append(str(device.address))
     return addresses
 
 def connect(address):
@@ -196,11 +236,12 @@ def disconnect(sock):
         True if successful
 
     """ 
+    _reassemblers.pop(sock, None)
     sock.close()
     return True
 
 
-def package(source, destination, message, MAX_LENGTH=1024):
+def package(source, destination, message, MAX_LENGTH=MAX_LENGTH):
     """
     Packages a given message using the pattern;
     '<source|destination|message>'
@@ -217,27 +258,33 @@ def package(source, destination, message, MAX_LENGTH=1024):
     destination : str
         The address of the open, connected socket that we
         want to send the message to.
-    message : str
-        The message to send. Must contain no '|', '>' or '<' characters.
+    message : str or bytes
+        The message to send. Special characters are escaped.
 
     Returns
     -------
-    str
+    str or bytes
         The packaged message in the form
-        '<source|destination|message>'
+        '<source|destination|message>', as bytes if message is bytes
     """
     if not bluetooth.is_valid_address(source):
         raise IOError("Source address formatted incorrectly")
     if not bluetooth.is_valid_address(destination):
         raise IOError("Destination address formatted incorrectly")
 
+    special, message = _special_characters(message)
+    start, divide, end, escapeChar = special
+    if isinstance(message, bytes):
+        source = source.encode("ascii")
+        destination = destination.encode("ascii")
+
     escaped = tuple(escape(item) for item in [source, destination, message])
     eSource, eDesination, eMessage = escaped
 
     if len(eMessage) > MAX_LENGTH:
         raise IOError("Escaped message greater than max message length")
 
-    return '<' + eSource + '|' + eDesination + '|' + eMessage + '>'
+    return start + eSource + divide + eDesination + divide + eMessage + end
 
 
 def unpackage(packaged_message):
@@ -248,7 +295,7 @@ def unpackage(packaged_message):
 
     Parameters
     ----------
-    packaged_message : str
+    packaged_message : str, bytes or memoryview
         The packaged message in the form '<source|destination|message>'
 
     Returns
@@ -259,33 +306,43 @@ def unpackage(packaged_message):
         destination
     str
         message
+    (all bytes if packaged_message is bytes or a memoryview)
+
+    Notes
+    -----
+    Any character after an ESCAPE is taken literally (and a lone ESCAPE at
+    the end is dropped), as the Arduino sketch does. Rather than stepping
+    through the packet a character at a time, it is split by a regex into
+    runs of unescaped characters (split at the dividers) and escape
+    sequences, and each section is joined once at the end, so this takes
+    linear time.
     """
-    if(not packaged_message.startswith(PACKET_START) or
-       not packaged_message.endswith(PACKET_END)):
+    special, packaged_message = _special_characters(packaged_message)
+    start, divide, end, escapeChar = special
+    if(len(packaged_message) < 2 or
+       not packaged_message.startswith(start) or
+       not packaged_message.endswith(end)):
         raise IOError("Invalid message: not bookended with "
                       "'{}{}'".format(PACKET_START, PACKET_END))
-    # A list [source, destination, message] to store the packet as it is parsed
-    # char by char
-    packetData = [""]
-    charIsEscaped = False
-    for currentChar in packaged_message[1:-1]:  # remove start and end
-        # If this character is splitting sections of the packet, start a new
-        # section
-        if currentChar == PACKET_DIVIDE and not charIsEscaped:
-            packetData.append("")
-            continue  # Don't look at this character any more
-
-        # Add this character to the current section of the packet
-        if (currentChar == ESCAPE and charIsEscaped) or currentChar != ESCAPE:
-            packetData[-1] += currentChar
-
-        # Set escape flag for next character
-        charIsEscaped = currentChar == ESCAPE and not charIsEscaped
+    # A list [source, destination, message] of the parts of each section
+    packetData = [[]]
+    sequences = ESCAPE_SEQUENCE[type(packaged_message)]
+    parts = sequences.split(packaged_message[1:-1])  # remove start and end
+    for index, part in enumerate(parts):
+        if index % 2:
+            # An escape sequence: keep the character after the ESCAPE
+            packetData[-1].append(part[1:])
+        else:
+            # Unescaped characters: dividers start new sections
+            sections = part.split(divide)
+            packetData[-1].append(sections[0])
+            for section in sections[1:]:
+                packetData.append([section])
 
     if len(packetData) != 3:
         raise IOError("Invalid message: wrong number of components")
 
-    return tuple(packetData)
+    return tuple(packaged_message[:0].join(section) for section in packetData)
 
 
 def send_message(sock, packaged_message):
@@ -318,7 +375,119 @@ def send_message(sock, packaged_message):
     sock.send(packaged_message)
     return True
 
-def listen(sock):
+class PacketReassembler(object):
+    """
+    Finds the '<source|destination|message>' packets in a stream of bytes
+    that arrives in chunks of any size
+
+    Notes
+    -----
+    Packets are found as the Arduino sketch finds them: an unescaped
+    PACKET_START starts a packet (dropping any unfinished one), and an
+    unescaped PACKET_END ends it. Anything outside packets is discarded.
+
+    Only the bytes that have not been looked at are scanned when a chunk
+    arrives (the escape state is kept between chunks), and the special
+    characters are found with a regex rather than a byte at a time, so the
+    time taken is linear in the bytes received. An unfinished packet longer
+    than max_length is dropped, so at most max_length bytes are buffered
+    between chunks.
+
+    Attributes
+    ----------
+    dropped: int
+        The number of packets dropped for being too long or unfinished
+    discarded: int
+        The number of bytes in dropped packets
+    backlog: deque
+        Packets that have been received but not yet returned by listen()
+    """
+    SPECIAL = re.compile(b"[" + re.escape(PACKET_START.encode("ascii")) +
+                         re.escape(PACKET_END.encode("ascii")) +
+                         re.escape(ESCAPE.encode("ascii")) + b"]")
+    START = ord(PACKET_START)
+    END = ord(PACKET_END)
+
+    def __init__(self, max_length=MAX_PACKET_LENGTH):
+        self.max_length = max_length
+        self.buffer = bytearray()
+        # Where to carry on scanning the buffer from
+        self.position = 0
+        # Where the unfinished packet starts in the buffer, or None
+        self.start = None
+        # Whether the byte at position is escaped
+        self.escaped = False
+        self.dropped = 0
+        self.discarded = 0
+        self.backlog = deque()
+
+    def feed(self, data):
+        """
+        Adds a chunk of received bytes
+
+        Parameters
+        ----------
+        data: bytes, bytearray, memoryview or str
+            The chunk (a str is encoded as UTF-8)
+
+        Returns
+        -------
+        list
+            The packets (bytes, including PACKET_START and PACKET_END)
+            completed by this chunk, in order
+        """
+        if isinstance(data, type(u"")):
+            data = data.encode("utf-8")
+        buffer = self.buffer
+        buffer += data
+        packets = []
+        while self.position < len(buffer):
+            if self.escaped:
+                # Whatever this byte is, it does not start or end a packet
+                self.escaped = False
+                self.position += 1
+                continue
+            match = self.SPECIAL.search(buffer, self.position)
+            if match is None:
+                self.position = len(buffer)
+                break
+            index = match.start()
+            self.position = index + 1
+            char = buffer[index]
+            if char == self.START:
+                if self.start is not None:
+                    self.dropped += 1
+                    self.discarded += index - self.start
+                self.start = index
+            elif char == self.END:
+                if self.start is not None:
+                    if index + 1 - self.start > self.max_length:
+                        self.dropped += 1
+                        self.discarded += index + 1 - self.start
+                    else:
+                        packets.append(bytes(buffer[self.start:index + 1]))
+                    self.start = None
+            else:
+                self.escaped = True
+
+        if self.start is not None and self.position - self.start > self.max_length:
+            self.dropped += 1
+            self.discarded += self.position - self.start
+            self.start = None
+        # Keep only the unfinished packet
+        keep = self.position if self.start is None else self.start
+        del buffer[:keep]
+        self.position -= keep
+        if self.start is not None:
+            self.start = 0
+        return packets
+
+
+# A PacketReassembler for each socket that listen() has been used with
+_reassemblers = {}
+
+
+def listen(sock, reassembler=None):
     """
     Listens at a socket until it receives a message, or until it times out
 
@@ -326,6 +495,9 @@ def listen(sock):
     ----------
     socket: BluetoothSocket
         An open bluetooth socket
+    reassembler: PacketReassembler
+        Holds the data received but not yet returned. If not given, one is
+        kept for each socket until it is passed to disconnect().
 
     Notes
     -----
@@ -333,85 +505,303 @@ def listen(sock):
     will automatically terminate after a period with
     BluetoothError: timed out
 
+    Nothing received is lost: every packet in a chunk is returned by
+    successive calls, and an unfinished packet is completed by the next
+    chunk, even if recv() times out in between.
+
     Returns
     -------
     str
         The packaged message received from the socket.
 
+    Raises
+    ------
+    IOError
+        If the connection has been closed
+    """
+    if reassembler is None:
+        reassembler = _reassemblers.setdefault(sock, PacketReassembler())
+    while not reassembler.backlog:
+        data = sock.recv(1024)
+        if not data:
+            raise IOError("Connection closed")
+        reassembler.backlog.extend(reassembler.feed(data))
+    return reassembler.backlog.popleft().decode("utf-8", "replace")
 
 
+def escape(text):
     """
-    # Initialise a variable to store incoming data in
-    data = ''
-    while True:
-        data += sock.recv(1024)
-        packaged_message = ""  # Will store a raw message "<..|..|..>"
-        charIsEscaped = False
-        # Set to true on PACKET_START upto PACKET_END
-        insidePacket = False
-        # Step through each character one at a time
-        for currentChar in data:
-            # If this is the start of the packet, set the flag to store it
-            if currentChar == PACKET_START and not charIsEscaped:
-                insidePacket = True
+    Escapes the special characters from a string
 
-            # Check only escaped characters are escaped
-            if charIsEscaped:
-                if currentChar not in TO_ESCAPE:
-                    warnings.warn("Wrongly escaped character")
+    Parameters
+    ----------
+    text: str, bytes or memoryview
+        string to be escaped
 
-            # Add this character if in the packet
-            if insidePacket:
-                packaged_message += currentChar
+    Returns
+    -------
+    str or bytes
+        escaped string (bytes if text is bytes or a memoryview)
 
+    Notes
+    -----
+    Each special character has an ESCAPE put before it, as the Arduino
+    sketch's escape() does. This is done with one replace() per special
+    character, escaping ESCAPE itself first so that the escapes added for the
+    others are not escaped again. Each replace() is a single pass in C, so
+    this takes linear time (inserting the escapes one at a time by slicing
+    took quadratic time).
+    """
+    special, text = _special_characters(text)
+    start, divide, end, escapeChar = special
+    text = text.replace(escapeChar, escapeChar + escapeChar)
+    for char in (start, divide, end):
+        text = text.replace(char, escapeChar + char)
+    return text
 
-            # Deal with the end of the packet
-            if currentChar == PACKET_END and not charIsEscaped:
-                insidePacket = False
-                return packaged_message
-              
-            # Set up the charIsEscaped flag for the next char
-            charIsEscaped = currentChar == ESCAPE and not charIsEscaped
 
-    return ""
+# Binary packets
+# --------------
+# Instead of '<source|destination|message>' with escaping, a packet can be
+# sent as
+#   COBS(source + destination + message + CRC16) + FRAME_END
+# where source and destination are the 6 raw bytes of the bluetooth address.
+# COBS encoding removes every zero byte, so FRAME_END marks the end of a
+# packet without any escaping, and the CRC catches corruption. This is the
+# same framing as used on the serial links in MQTT/Smart_Agents/piduino
+# (binary_framing.py): crc16, cobs_encode and cobs_decode below are copies of
+# the functions there, as the two packages are installed separately. A fix
+# to one copy must be made to the other.
+FRAME_END = b"\x00"
+ADDRESS_BYTES = 6
+# The longest binary packet (including FRAME_END) of a MAX_LENGTH message:
+# the addresses, message and CRC, plus one COBS byte in 254 and the first
+_MAX_BODY = 2 * ADDRESS_BYTES + MAX_LENGTH + 2
+MAX_FRAME_LENGTH = _MAX_BODY + _MAX_BODY // 254 + 2
+
+
+def _crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for bit in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+        table.append(crc)
+    return table
+
+CRC16_TABLE = _crc16_table()
+
+
+def crc16(data):
+    """
+    Calculates the CRC-16/CCITT-FALSE checksum of some bytes
 
+    Parameters
+    ----------
+    data: bytes
+        The bytes to check
 
-def escape(text):
+    Returns
+    -------
+    int
+        The checksum, between 0 and 0xFFFF
     """
-    Escapes the special characters from a string
+    crc = 0xFFFF
+    for byte in bytearray(data):
+        crc = ((crc << 8) & 0xFFFF) ^ CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+
+def cobs_encode(data):
+    """
+    Encodes bytes using Consistent Overhead Byte Stuffing, so that the
+    result contains no zero bytes
 
     Parameters
     ----------
-    text: str
-        string to be escaped
+    data: bytes
+        The bytes to encode
+
+    Returns
+    -------
+    bytes
+        The encoded bytes, at most one byte in 254 longer than data
+    """
+    encoded = bytearray()
+    for block in bytes(data).split(FRAME_END):
+        # Each block is followed by an implied zero, apart from the last
+        while len(block) >= 254:
+            encoded.append(0xFF)
+            encoded += block[:254]
+            block = block[254:]
+        encoded.append(len(block) + 1)
+        encoded += block
+    return bytes(encoded)
+
+
+def cobs_decode(data):
+    """
+    Decodes bytes encoded by cobs_encode
+
+    Parameters
+    ----------
+    data: bytes
+        The encoded bytes, without the FRAME_END
 
     Returns
     -------
+    bytes
+        The decoded bytes
+
+    Raises
+    ------
+    IOError
+        If data is not valid COBS
+    """
+    data = bytearray(data)
+    decoded = bytearray()
+    index = 0
+    while index < len(data):
+        code = data[index]
+        end = index + code
+        if code == 0 or end > len(data):
+            raise IOError("Invalid binary packet: bad COBS encoding")
+        block = data[index + 1:end]
+        if 0 in block:
+            raise IOError("Invalid binary packet: bad COBS encoding")
+        decoded += block
+        index = end
+        if code < 0xFF and index < len(data):
+            decoded.append(0)
+    return bytes(decoded)
+
+
+def address_to_bytes(address):
+    """
+    Converts a bluetooth address such as '88:53:2E:86:BE:8C' to 6 bytes
+    """
+    return bytes(bytearray(int(part, 16) for part in address.split(":")))
+
+
+def bytes_to_address(data):
+    """
+    Converts 6 bytes to a bluetooth address such as '88:53:2E:86:BE:8C'
+    """
+    return ":".join("%02X" % byte for byte in bytearray(data))
+
+
+def package_binary(source, destination, message, MAX_LENGTH=1024):
+    """
+    Packages a given message as a binary packet (see above). Unlike
+    package, no escaping is needed, so the message may contain any bytes.
+
+    Parameters
+    ----------
+    source : str
+        The bluetooth address of this device
+    destination : str
+        The address of the open, connected socket that we
+        want to send the message to.
+    message : bytes or str
+        The message to send. A str is encoded as UTF-8.
+
+    Returns
+    -------
+    bytes
+        The packet, ending with FRAME_END
+    """
+    if not bluetooth.is_valid_address(source):
+        raise IOError("Source address formatted incorrectly")
+    if not bluetooth.is_valid_address(destination):
+        raise IOError("Destination address formatted incorrectly")
+    if not isinstance(message, (bytes, bytearray)):
+        message = message.encode("utf-8")
+    if len(message) > MAX_LENGTH:
+        raise IOError("Message greater than max message length")
+
+    body = address_to_bytes(source) + address_to_bytes(destination) + bytes(message)
+    return cobs_encode(body + struct.pack(">H", crc16(body))) + FRAME_END
+
+
+def unpackage_binary(packet):
+    """
+    Takes a binary packet made by package_binary and returns the separate
+    components
+
+    Parameters
+    ----------
+    packet : bytes
+        The packet, with or without the trailing FRAME_END
+
+    Returns
+    -------
+    str
+        source
     str
-        escaped string
+        destination
+    bytes
+        message
 
-    Notes
-    -----
-    Could be done completely with regex, something like:
-        regex = r"([" + r"".join(re.escape(char) for char in TO_ESCAPE) + r"])"
-        return re.sub(regex, re.escape(ESCAPE) + r"\1", text)
-    But:
-        1) May cause issues if TO_ESCAPE contains a regex character eg "]"
-        2) Wouldn't work if we wanted to send bytes rather than strings later?
-        3) Arudino doesn't have re library so easier to ensure that method
-           is same (copy the code, change the syntax).
-    """
-
-    currentIndex = 0
-    while currentIndex < len(text):
-        # Go through one character at a time
-        if text[currentIndex] in TO_ESCAPE:
-            # If this char needs escaping, add an escape before it.
-            # text:            "aad\asdf"
-            # current index:       ^
-            # new text:        "add\\asdf"
-            # updated index:        ^
-            text = text[:currentIndex] + ESCAPE + text[currentIndex:]
-            currentIndex += 1  # Update the index
-        currentIndex += 1
-    return text
+    Raises
+    ------
+    IOError
+        If the packet is damaged
+    """
+    packet = bytes(packet)
+    if packet.endswith(FRAME_END):
+        packet = packet[:-1]
+    decoded = cobs_decode(packet)
+    if len(decoded) < 2 * ADDRESS_BYTES + 2:
+        raise IOError("Invalid binary packet: too short")
+    body, checksum = decoded[:-2], struct.unpack(">H", decoded[-2:])[0]
+    if crc16(body) != checksum:
+        raise IOError("Invalid binary packet: checksum does not match")
+    source = bytes_to_address(body[:ADDRESS_BYTES])
+    destination = bytes_to_address(body[ADDRESS_BYTES:2 * ADDRESS_BYTES])
+    return source, destination, body[2 * ADDRESS_BYTES:]
+
+
+def listen_binary(sock, buffered=b"", max_length=MAX_FRAME_LENGTH):
+    """
+    Listens at a socket until it receives a whole binary packet, or until it
+    times out
+
+    Parameters
+    ----------
+    socket: BluetoothSocket
+        An open bluetooth socket
+    buffered: bytes
+        Data left over from the previous call
+    max_length: int
+        The longest packet accepted, including FRAME_END
+
+    Returns
+    -------
+    bytes
+        The packet received from the socket, including FRAME_END
+    bytes
+        Any data received after the packet. Pass this to the next call so
+        that it is not lost.
+
+    Raises
+    ------
+    IOError
+        If the connection is closed, or more than max_length bytes arrive
+        without a FRAME_END (they are discarded; the next call picks up
+        again at the next FRAME_END, as COBS allows)
+    """
+    data = bytes(buffered)
+    while FRAME_END not in data:
+        if len(data) > max_length:
+            raise IOError("Binary packet longer than {} bytes".format(max_length))
+        chunk = sock.recv(1024)
+        if not chunk:
+            raise IOError("Connection closed")
+        data += chunk
+    end = data.index(FRAME_END) + 1
+    if end > max_length:
+        raise IOError("Binary packet longer than {} bytes".format(max_length))
+    return data[:end], data[end:]
@@ -3,7 +3,8 @@ Tests the functions that were changed when adding escaping.
 '''
 
 from utils import (escape, package, unpackage, ESCAPE, TO_ESCAPE, PACKET_START,
-                   PACKET_DIVIDE, PACKET_END)
+                   PACKET_DIVIDE, PACKET_END, PacketReassembler, listen,
+                   disconnect)
 
 
 # A mapping from plaintext to what the escape function should produce
@@ -80,3 +81,192 @@ def test_unpackage():
 test_basic_escaping()
 test_package()
 test_unpackage()
+
+
+def test_binary_package():
+    '''Tests that unpackage_binary(package_binary()) returns the original
+    input, including messages that contain the special characters and zero
+    bytes, and that damaged packets are rejected.
+    '''
+    from utils import package_binary, unpackage_binary, FRAME_END
+    BT = "11:11:11:11:11:11"  # default bt address
+    BT2 = "88:53:2E:86:BE:8C"
+    for message in [b"", b"normal text", b"\x00", b"\x00\x00abc\x00",
+                    (ESCAPE + PACKET_START + PACKET_DIVIDE + PACKET_END).encode(),
+                    bytes(bytearray(range(256))) * 3]:
+        packet = package_binary(BT, BT2, message, MAX_LENGTH=1024)
+        if FRAME_END in packet[:-1]:
+            print("Test binary package failed: {} contains a zero byte"
+                  .format(message))
+        elif unpackage_binary(packet) != (BT, BT2, message):
+            print("Test binary package failed: {} changed to {}"
+                  .format(message, unpackage_binary(packet)))
+        else:
+            print("Test binary package passed: {}".format(message[:20]))
+
+    packet = bytearray(package_binary(BT, BT2, b"normal text"))
+    packet[15] ^= 0x01
+    try:
+        unpackage_binary(bytes(packet))
+        print("Test binary package failed: damaged packet was accepted")
+    except IOError:
+        print("Test binary package passed: damaged packet was rejected")
+
+
+test_binary_package()
+
+
+def test_escape_bytes():
+    '''Tests that escape and unpackage give the same results for bytes and
+    memoryviews as for strings, and that unpackage undoes escape for every
+    combination of the special characters.
+    '''
+    from itertools import product
+    BT = "11:11:11:11:11:11"  # default bt address
+    for length in range(4):
+        for chars in product(TO_ESCAPE + ["a"], repeat=length):
+            text = "".join(chars)
+            data = text.encode()
+            packet = "<" + BT + "|" + BT + "|" + escape(text) + ">"
+            if escape(data) != escape(text).encode():
+                print("Test escape bytes failed: {}".format(data))
+            elif escape(memoryview(data)) != escape(text).encode():
+                print("Test escape memoryview failed: {}".format(data))
+            elif unpackage(packet) != (BT, BT, text):
+                print("Test unpackage failed: {} changed to {}"
+                      .format(text, unpackage(packet)))
+            elif (unpackage(memoryview(packet.encode())) !=
+                  (BT.encode(), BT.encode(), data)):
+                print("Test unpackage bytes failed: {}".format(data))
+            else:
+                print("Test escape bytes passed: {}".format(text))
+
+
+def test_unescape_like_arduino():
+    '''Tests that characters which did not need escaping, and a lone escape
+    at the end, are unescaped as the Arduino sketch does (the character after
+    an escape is kept, the lone escape is dropped).
+    '''
+    for packet, expected in [("<a\\b|c|d>", ("ab", "c", "d")),
+                             ("<a|b|c\\>", ("a", "b", "c")),
+                             ("<a\\||b|c>", ("a|", "b", "c")),
+                             ("<a|b|\\\\\\>", ("a", "b", "\\"))]:
+        if unpackage(packet) != expected:
+            print("Test unescape failed: {} should be {} not {}"
+                  .format(packet, expected, unpackage(packet)))
+        else:
+            print("Test unescape passed: {}".format(packet))
+
+
+test_escape_bytes()
+test_unescape_like_arduino()
+
+
+def test_reassembler():
+    '''Tests that PacketReassembler finds every packet however the stream is
+    cut into chunks, skips escaped special characters, and drops packets that
+    are too long without losing the ones after them.
+    '''
+    BT = "11:11:11:11:11:11"  # default bt address
+    packets = [package(BT, BT, message).encode()
+               for message in ["one", "<two>", "three\\", ""]]
+    stream = b"noise" + b"".join(packets) + b"<unfinished"
+
+    reassembler = PacketReassembler()
+    if reassembler.feed(stream) != packets:
+        print("Test reassembler failed: packets in one chunk")
+    else:
+        print("Test reassembler passed: packets in one chunk")
+
+    reassembler = PacketReassembler()
+    found = []
+    for i in range(len(stream)):
+        found.extend(reassembler.feed(stream[i:i + 1]))
+    if found != packets:
+        print("Test reassembler failed: packets a byte at a time")
+    else:
+        print("Test reassembler passed: packets a byte at a time")
+
+    reassembler = PacketReassembler(max_length=45)
+    long_packet = package(BT, BT, "x" * 10).encode()
+    stream = long_packet + packets[0] + long_packet
+    found = []
+    for i in range(0, len(stream), 7):
+        found.extend(reassembler.feed(stream[i:i + 7]))
+    if found != [packets[0]] or reassembler.dropped != 2:
+        print("Test reassembler failed: long packets should be dropped, got {}"
+              .format(found))
+    elif len(reassembler.buffer) > 45:
+        print("Test reassembler failed: buffered {} bytes"
+              .format(len(reassembler.buffer)))
+    else:
+        print("Test reassembler passed: long packets dropped")
+
+
+class FakeSocket(object):
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv(self, size):
+        return self.chunks.pop(0) if self.chunks else b""
+
+    def close(self):
+        pass
+
+
+def test_listen():
+    '''Tests that listen returns every packet received, in order, whether
+    several arrive together or one is split across several recv calls.
+    '''
+    BT = "11:11:11:11:11:11"  # default bt address
+    messages = ["first", "second", "third|", "fourth"]
+    packets = [package(BT, BT, message).encode() for message in messages]
+    sock = FakeSocket([packets[0] + packets[1] + packets[2][:10],
+                       packets[2][10:20], packets[2][20:] + packets[3]])
+    received = [unpackage(listen(sock))[2] for message in messages]
+    if received != messages:
+        print("Test listen failed: received {}".format(received))
+    else:
+        print("Test listen passed: no packets lost")
+    try:
+        listen(sock)
+        print("Test listen failed: closed connection not noticed")
+    except IOError:
+        print("Test listen passed: closed connection")
+    disconnect(sock)
+
+
+def test_listen_binary():
+    '''Tests that listen_binary gives up on a closed connection and on a
+    packet that never ends, rather than waiting or buffering forever.
+    '''
+    from utils import package_binary, listen_binary, MAX_FRAME_LENGTH
+    BT = "11:11:11:11:11:11"  # default bt address
+    packet = package_binary(BT, BT, b"x" * 1024)
+    if len(packet) > MAX_FRAME_LENGTH:
+        print("Test listen binary failed: longest packet is {} bytes".format(len(packet)))
+    sock = FakeSocket([packet[:500], packet[500:] + packet[:10]])
+    received, buffered = listen_binary(sock)
+    if received != packet or buffered != packet[:10]:
+        print("Test listen binary failed: received {}".format(received))
+    else:
+        print("Test listen binary passed: packet received")
+    try:
+        listen_binary(sock, buffered)
+        print("Test listen binary failed: closed connection not noticed")
+    except IOError:
+        print("Test listen binary passed: closed connection")
+    sock = FakeSocket([b"\x01" * 1024] * 100)
+    try:
+        listen_binary(sock)
+        print("Test listen binary failed: unending packet accepted")
+    except IOError:
+        if len(sock.chunks) < 98:
+            print("Test listen binary failed: buffered {} chunks".format(100 - len(sock.chunks)))
+        else:
+            print("Test listen binary passed: unending packet dropped")
+
+
+test_reassembler()
+test_listen()
+test_listen_binary()
@@ -0,0 +1,258 @@
+import asyncio
+import os
+import socket
+import sys
+import time
+import warnings
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore')
+    from async_bluetooth import AsyncBluetoothSocket, AsyncBluetoothDevice, discover
+    import async_bluetooth
+    from discovery import Discovery, Found
+    from framing import MessageDecoder, encode
+
+A = '98:D3:31:00:00:0A'
+B = '98:D3:31:00:00:0B'
+C = '98:D3:31:00:00:0C'
+
+
+def test_socket_connects_sends_and_receives():
+    async def main():
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        link = AsyncBluetoothSocket(socket.socket())
+        await link.connect(server.getsockname())
+        far, _ = server.accept()
+        far.setblocking(False)
+        # More than fits in the socket buffers, so sendall has to wait
+        data = os.urandom(4 * 1024 * 1024)
+        sending = asyncio.ensure_future(link.sendall(data))
+        received = bytearray()
+        while len(received) < len(data):
+            try:
+                received += far.recv(65536)
+            except socket.error:
+                await asyncio.sleep(0)
+        await sending
+        assert received == data
+        far.sendall(b'reply')
+        assert await link.recv() == b'reply'
+        far.close()
+        assert await link.recv() == b''
+        link.close()
+        server.close()
+    asyncio.run(main())
+
+
+def test_cancelled_receive_stops_watching_the_socket():
+    async def main():
+        sock, remote = socket.socketpair()
+        link = AsyncBluetoothSocket(sock)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(link.recv(), 0.01)
+        # Nothing is left registered with the event loop
+        assert not asyncio.get_running_loop().remove_reader(sock.fileno())
+        remote.sendall(b'late')
+        assert await link.recv() == b'late'
+        link.close()
+        remote.close()
+    asyncio.run(main())
+
+
+class FakeDevice(object):
+    # As a piduino.BluetoothDevice that is connected
+    def __init__(self, address):
+        self.name = 'Piduino'
+        self.address = address
+        self.settings = None
+        self.sock, self.remote = socket.socketpair()
+        self.decoder = MessageDecoder()
+
+    def disconnect(self):
+        self.sock.close()
+
+
+def test_device_receives_and_sends_messages():
+    messages = [{'source': A, 'payload': i} for i in range(100)]
+
+    async def main():
+        fake = FakeDevice(A)
+        device = AsyncBluetoothDevice(fake)
+        stream = b''.join(encode(m) for m in messages)
+
+        async def write():
+            for i in range(0, len(stream), 37):
+                fake.remote.sendall(stream[i:i + 37])
+                await asyncio.sleep(0)
+            fake.remote.sendall(b'not a message\n')
+            fake.remote.close()
+        writer = asyncio.ensure_future(write())
+        received = [message async for message in device]
+        await writer
+        assert received == messages
+        messages_, error = await device.receive()
+        assert messages_ == [] and isinstance(error, IOError)
+        device.disconnect()
+
+        # Concurrent senders do not interleave their messages, even when
+        # they fill the socket's buffer
+        fake = FakeDevice(B)
+        device = AsyncBluetoothDevice(fake)
+        big = [{'payload': '%02d' % i * 30000} for i in range(16)]
+        reading = asyncio.get_running_loop().run_in_executor(None, read_all, fake.remote,
+                                                              len(big))
+        flags = await asyncio.gather(*[device.send(message) for message in big])
+        assert flags == [None] * 16
+        assert sorted((await reading), key=lambda m: m['payload']) == big
+        device.disconnect()
+    asyncio.run(main())
+
+
+def read_all(sock, count):
+    decoder = MessageDecoder()
+    messages = []
+    while len(messages) < count:
+        messages += decoder.feed(sock.recv(65536))
+    assert decoder.rejected == []
+    return messages
+
+
+class FakeInquiry(object):
+    # As the DeviceDiscoverer from Discovery.start_inquiry, reporting the
+    # 'address,class,name' lines written to it. Like the real one, it closes
+    # its socket when the inquiry completes or is cancelled.
+    def __init__(self):
+        self.sock, self.remote = socket.socketpair()
+        self.fd = self.sock.fileno()
+        self.found = []
+        self.done = False
+        self.cancelled = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def process_event(self):
+        for line in self.sock.recv(4096).decode().splitlines():
+            if line == 'done':
+                self.done = True
+                self.sock.close()
+                return
+            address, device_class, name = line.split(',')
+            self.found.append((address, int(device_class), name or None))
+
+    def cancel_inquiry(self):
+        self.cancelled = True
+        self.sock.close()
+
+
+def not_watched(fd):
+    # Whether the running loop has stopped watching fd, which must be open
+    # again (or remove_reader cannot look it up)
+    return not asyncio.get_running_loop().remove_reader(fd)
+
+
+class FakeDiscovery(Discovery):
+    def __init__(self, inquiry, names, lookup_time=0.1):
+        Discovery.__init__(self, cache_path=None)
+        self.inquiry = inquiry
+        self.names = names
+        self.lookup_time = lookup_time
+
+    def start_inquiry(self, duration):
+        return self.inquiry
+
+    def inquire(self, duration):
+        return [(address, 0, None) for address in sorted(self.names)]
+
+    def lookup_name(self, address):
+        time.sleep(self.lookup_time)
+        return self.names.get(address)
+
+
+def test_devices_are_yielded_as_they_are_found():
+    async def main():
+        inquiry = FakeInquiry()
+        discovery = FakeDiscovery(inquiry, {B: 'PiduinoB'})
+        # B needs its name looking up, and C will not give it
+        inquiry.remote.sendall(b'%s,1,\n%s,2,PiduinoA\n' % (B.encode(), A.encode()))
+        results = []
+        async for found in discover(discovery):
+            results.append(found)
+            if len(results) == 1:
+                inquiry.remote.sendall(b'%s,3,\ndone\n' % C.encode())
+        assert results == [Found(A, 'PiduinoA', 2), Found(B, 'PiduinoB', 1),
+                           Found(C, None, 3)]
+        assert not inquiry.cancelled
+        # A socket that reuses the inquiry's descriptor is not still watched
+        reused, other = socket.socketpair()
+        assert reused.fileno() == inquiry.fd
+        assert not_watched(reused.fileno())
+        reused.close()
+        other.close()
+        # Known now, so found again without looking anything up
+        inquiry = discovery.inquiry = FakeInquiry()
+        inquiry.remote.sendall(b'%s,1,\ndone\n' % B.encode())
+        start = time.time()
+        assert [found async for found in discover(discovery)] == [Found(B, 'PiduinoB', 1)]
+        assert time.time() - start < discovery.lookup_time
+    asyncio.run(main())
+
+
+def test_stopping_early_cancels_the_inquiry():
+    async def main():
+        inquiry = FakeInquiry()
+        discovery = FakeDiscovery(inquiry, {})
+        inquiry.remote.sendall(b'%s,1,PiduinoA\n' % A.encode())
+        await with_first(discover(discovery))
+        assert inquiry.cancelled
+        reused, other = socket.socketpair()
+        assert reused.fileno() == inquiry.fd
+        assert not_watched(reused.fileno())
+        reused.close()
+        other.close()
+
+    async def with_first(scan):
+        async for found in scan:
+            assert found.address == A
+            break
+        await scan.aclose()
+    asyncio.run(main())
+
+
+class UncancellableInquiry(FakeInquiry):
+    def cancel_inquiry(self):
+        # As DeviceDiscoverer when the adapter has gone away
+        FakeInquiry.cancel_inquiry(self)
+        raise IOError("error canceling inquiry")
+
+
+def test_inquiry_that_cannot_be_cancelled(monkeypatch):
+    async def main():
+        # Stopping early
+        inquiry = UncancellableInquiry()
+        discovery = FakeDiscovery(inquiry, {})
+        inquiry.remote.sendall(b'%s,1,PiduinoA\n' % A.encode())
+        scan = discover(discovery)
+        async for found in scan:
+            break
+        await scan.aclose()
+        assert inquiry.cancelled
+        # Timing out
+        inquiry = discovery.inquiry = UncancellableInquiry()
+        inquiry.remote.sendall(b'%s,1,PiduinoB\n' % B.encode())
+        assert [found async for found in discover(discovery)] == [Found(B, 'PiduinoB', 1)]
+        assert inquiry.cancelled
+    monkeypatch.setattr(async_bluetooth, 'inquiry_timeout', lambda duration: 0.1)
+    asyncio.run(main())
+
+
+def test_discovery_without_bluez_runs_in_a_thread():
+    async def main():
+        discovery = FakeDiscovery(None, {A: 'PiduinoA', B: None}, lookup_time=0)
+        results = [found async for found in discover(discovery)]
+        # Looked up in parallel, so in either order
+        assert sorted(results) == [Found(A, 'PiduinoA', 0), Found(B, None, 0)]
+    asyncio.run(main())
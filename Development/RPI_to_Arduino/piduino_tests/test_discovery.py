@@ -0,0 +1,90 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import warnings
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore')
+    from discovery import Discovery, NameCache, Found
+
+
+class FakeDiscovery(Discovery):
+    # Answers inquiries with a fixed list of devices and name requests from
+    # a dict, slowly, counting the requests
+    def __init__(self, devices, names, delay=0.0, **kwargs):
+        Discovery.__init__(self, **kwargs)
+        self.devices = devices
+        self.names = names
+        self.delay = delay
+        self.requested = []
+        self.lock = threading.Lock()
+
+    def inquire(self, duration):
+        return self.devices
+
+    def lookup_name(self, address):
+        with self.lock:
+            self.requested.append(address)
+        time.sleep(self.delay)
+        return self.names.get(address)
+
+
+HC05 = '98:D3:31:00:00:01'
+PHONE = '11:22:33:44:55:66'
+SILENT = '00:00:00:00:00:01'
+
+
+def test_names_are_looked_up_once():
+    discovery = FakeDiscovery([(HC05, 0x1f00, None), (PHONE, 0x5a020c, 'Phone')],
+                              {HC05: 'SCD_ARDUINO_1'}, cache_path=None)
+    expected = [Found(HC05, 'SCD_ARDUINO_1', 0x1f00), Found(PHONE, 'Phone', 0x5a020c)]
+    assert discovery.scan(duration=1) == expected
+    # The phone gave its name in the inquiry, so only the HC-05 was asked
+    assert discovery.requested == [HC05]
+    assert discovery.scan(duration=1) == expected
+    assert discovery.requested == [HC05]
+
+
+def test_lookups_are_parallel():
+    devices = [('00:00:00:00:00:%02X' % i, 0, None) for i in range(8)]
+    discovery = FakeDiscovery(devices, {}, delay=0.2, cache_path=None, lookup_workers=4)
+    start = time.time()
+    found = discovery.scan(duration=1)
+    assert time.time() - start < 1.0
+    assert sorted(discovery.requested) == [d[0] for d in devices]
+    assert [f.name for f in found] == [None] * 8
+
+
+def test_failed_lookups_are_retried_later():
+    cache = NameCache(negative_ttl=60)
+    discovery = FakeDiscovery([(SILENT, 0, None)], {}, cache=cache)
+    discovery.scan(duration=1)
+    discovery.scan(duration=1)
+    assert discovery.requested == [SILENT]
+    assert cache.needs_lookup(SILENT, now=time.time() + 61)
+
+
+def test_cache_expires_and_persists():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'names.json')
+        cache = NameCache(path, ttl=100)
+        cache.seen(HC05, 0x1f00, 'SCD_ARDUINO_1', now=1000)
+        cache.save()
+        cache = NameCache(path, ttl=100)
+        assert cache.name(HC05, now=1050) == 'SCD_ARDUINO_1'
+        assert cache.get(HC05, now=1050)['device_class'] == 0x1f00
+        # Seeing a device keeps its name
+        cache.seen(HC05, now=1090)
+        assert cache.name(HC05, now=1150) == 'SCD_ARDUINO_1'
+        assert cache.name(HC05, now=1200) is None
+        assert len(cache) == 0
+
+
+def test_damaged_cache_is_ignored():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'names.json')
+        with open(path, 'w') as f:
+            f.write('{"98:D3')
+        assert len(NameCache(path)) == 0
@@ -0,0 +1,92 @@
+import os
+import socket
+import sys
+import warnings
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore')
+    from framing import LineDecoder, MessageDecoder, encode
+
+MESSAGES = [
+    {'source': 'sink', 'type': 'handshake', 'payload': 'key'},
+    {'source': 'PiduinoA', 'type': 'reading', 'payload': 'line\nbreak and {braces}'},
+    {'source': 'PiduinoB', 'type': 'reading', 'payload': u'°C'},
+]
+
+
+def test_messages_split_anywhere_are_reassembled():
+    stream = b''.join(encode(m) for m in MESSAGES)
+    for split in range(len(stream) + 1):
+        decoder = MessageDecoder()
+        messages = decoder.feed(stream[:split]) + decoder.feed(stream[split:])
+        assert messages == MESSAGES, split
+
+
+def test_every_message_in_a_chunk_is_returned():
+    decoder = MessageDecoder()
+    stream = b''.join(encode(m) for m in MESSAGES * 100)
+    assert decoder.feed(stream) == MESSAGES * 100
+    # One byte at a time
+    received = []
+    for i in range(len(stream)):
+        received += decoder.feed(stream[i:i + 1])
+    assert received == MESSAGES * 100
+    assert len(decoder.buffer) == 0
+
+
+def test_arduino_line_endings_and_blank_lines():
+    # The sketches send with println
+    decoder = MessageDecoder()
+    assert decoder.feed(b'{"a": 1}\r\n\r\n{"b": 2}\r') == [{'a': 1}]
+    assert decoder.feed(b'\n') == [{'b': 2}]
+
+
+def test_complete_lines_are_not_copied():
+    data = bytearray(b'first\nsecond\nunfin')
+    lines = LineDecoder().feed(data)
+    assert [line.tobytes() for line in lines] == [b'first', b'second']
+    assert all(line.obj is data for line in lines)
+
+
+def test_long_lines_are_dropped():
+    decoder = LineDecoder(max_length=10)
+    assert decoder.feed(b'x' * 8) == []
+    assert decoder.feed(b'x' * 8) == []
+    # The rest of the long line is dropped too
+    lines = decoder.feed(b'xxx\nshort\n' + b'y' * 11 + b'\nok\n')
+    assert [line.tobytes() for line in lines] == [b'short', b'ok']
+    assert (decoder.dropped, decoder.discarded) == (2, 30)
+    assert len(decoder.buffer) == 0
+
+
+def test_lines_that_are_not_messages_are_rejected():
+    decoder = MessageDecoder()
+    assert decoder.feed(b'"hi"\n{"a": 1}\n{"a": \n') == [{'a': 1}]
+    assert decoder.rejected == [b'"hi"', b'{"a": ']
+    assert decoder.feed(b'{}\n') == [{}]
+    assert decoder.rejected == []
+
+
+def test_bluetooth_device_receives_every_message():
+    pytest.importorskip('bluetooth')
+    from piduino.piduino import BluetoothDevice, DeviceError, FormatError
+    device = BluetoothDevice('PiduinoA', '98:D3:31:00:00:0A')
+    device.sock, remote = socket.socketpair()
+    stream = b''.join(encode(m) for m in MESSAGES)
+    remote.sendall(stream[:10])
+    assert device.receive() == ([], None)
+    remote.sendall(stream[10:])
+    assert device.receive() == (MESSAGES, None)
+
+    assert device.send(MESSAGES[0]) is None
+    assert MessageDecoder().feed(remote.recv(4096)) == [MESSAGES[0]]
+
+    remote.sendall(b'garbage\n' + encode(MESSAGES[1]))
+    messages, error = device.receive()
+    assert messages == [MESSAGES[1]]
+    assert isinstance(error, FormatError)
+    remote.close()
+    messages, error = device.receive()
+    assert messages == [] and isinstance(error, DeviceError)
+    device.disconnect()
@@ -0,0 +1,107 @@
+import os
+import socket
+import sys
+import warnings
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore')
+    from linkconfig import (LinkSettings, DEFAULT, settings_for, load_link_settings,
+                            save_link_settings)
+    from relay import RelayEngine
+
+A = '98:D3:31:00:00:0A'
+B = '98:D3:31:00:00:0B'
+
+
+def test_settings_are_found_by_address_then_name():
+    fast = LinkSettings(batch_bytes=1008)
+    lossy = LinkSettings(flush_timeout=20)
+    default = LinkSettings(send_buffer=65536)
+    link_settings = {A: fast, 'PiduinoB': lossy, DEFAULT: default}
+    assert settings_for(link_settings, A.lower(), 'PiduinoB') is fast
+    assert settings_for(link_settings, B, 'PiduinoB') is lossy
+    assert settings_for(link_settings, B, 'PiduinoC') is default
+    assert settings_for({}, B) is None
+    assert settings_for(fast, B) is fast
+    assert settings_for(None, B) is None
+
+
+def test_settings_files(tmp_path):
+    path = str(tmp_path / 'links.json')
+    link_settings = {A: LinkSettings(batch_bytes=1008, l2cap_mtu=4096),
+                     DEFAULT: LinkSettings()}
+    save_link_settings(path, link_settings)
+    assert load_link_settings(path) == link_settings
+    with open(path, 'w') as f:
+        f.write('{"*": {"batch_size": 10}}')
+    with pytest.raises(ValueError):
+        load_link_settings(path)
+
+
+def test_settings_that_cannot_be_applied_are_reported():
+    sock, remote = socket.socketpair()
+    settings = LinkSettings(receive_buffer=32768, l2cap_mtu=4096, flush_timeout=20)
+    errors = settings.apply(sock, A)
+    # The MTU is ignored for a socket that is not L2CAP, and without an
+    # adapter (or root) the flush timeout cannot be set
+    assert len(errors) <= 1
+    assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 32768
+    # Nothing to do for a stand in link with no address
+    assert LinkSettings(flush_timeout=20).apply(sock) == []
+    sock.close()
+    remote.close()
+
+
+class CountingSocket(object):
+    # A socket without sendmsg, like a BluetoothSocket
+    def __init__(self, sock):
+        self.sock = sock
+        self.sends = []
+
+    def send(self, data):
+        self.sends.append(len(data))
+        return self.sock.send(data)
+
+    def __getattr__(self, name):
+        if name == 'sendmsg':
+            raise AttributeError(name)
+        return getattr(self.sock, name)
+
+
+class FakeDevice(object):
+    def __init__(self, address, settings=None):
+        self.address = address
+        self.settings = settings
+        sock, self.remote = socket.socketpair()
+        self.sock = CountingSocket(sock)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+def packet(source, destination, message):
+    return ('<%s|%s|%s>' % (source, destination, message)).encode()
+
+
+@pytest.mark.parametrize('batch_bytes, sends', [(0, 20), (200, 5), (4096, 1)])
+def test_relay_batches_sends_to_bluetooth_sockets(batch_bytes, sends):
+    engine = RelayEngine()
+    a = FakeDevice(A)
+    b = FakeDevice(B, LinkSettings(batch_bytes=batch_bytes))
+    engine.add(a)
+    engine.add(b)
+    # Each packet is 48 bytes, so four fit in 200
+    data = b''.join(packet(A, B, 'reading %02d' % i) for i in range(20))
+    a.remote.sendall(data)
+    received = b''
+    while len(received) < len(data):
+        engine.poll(1)
+        b.remote.setblocking(False)
+        try:
+            received += b.remote.recv(4096)
+        except socket.error:
+            pass
+    assert received == data
+    assert len(b.sock.sends) == sends
+    engine.close()
@@ -0,0 +1,137 @@
+import os
+import socket
+import sys
+import time
+import warnings
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore')
+    from pool import ConnectionPool, link_alive
+
+
+class FakeDevice(object):
+    # Connects by making a new socket pair, failing the first `failures` times
+    def __init__(self, address, failures=0, delay=0):
+        self.address = address
+        self.failures = failures
+        self.delay = delay
+        self.connects = 0
+        self.sock = self.remote = None
+        self.connect()
+
+    def connect(self, timeout=None):
+        self.connects += 1
+        time.sleep(self.delay)
+        if self.connects > 1 and self.failures > 0:
+            self.failures -= 1
+            return IOError('Host is down')
+        self.sock, self.remote = socket.socketpair()
+        return None
+
+    def disconnect(self):
+        self.sock.close()
+        return None
+
+
+def run(pool, until, timeout=5):
+    end = time.time() + timeout
+    while not until():
+        assert time.time() < end, 'timed out'
+        pool.process()
+        time.sleep(0.001)
+
+
+def test_link_alive():
+    sock, remote = socket.socketpair()
+    assert link_alive(sock)
+    # Data waiting to be read is left there
+    remote.sendall(b'<a|b|c>')
+    assert link_alive(sock)
+    assert sock.recv(100) == b'<a|b|c>'
+    remote.close()
+    assert not link_alive(sock)
+    sock.close()
+    assert not link_alive(sock)
+
+
+def test_dead_links_are_found_and_reconnected():
+    lost, restored = [], []
+    pool = ConnectionPool(on_lost=lost.append, on_restored=restored.append)
+    healthy = FakeDevice('98:d3:31:00:00:0a')
+    dying = FakeDevice('98:D3:31:00:00:0B')
+    pool.add(healthy)
+    pool.add(dying)
+    healthy_sock = healthy.sock
+    assert pool.get('98:D3:31:00:00:0A') is healthy
+
+    dying.remote.close()
+    assert pool.check() == 1
+    assert lost == [dying]
+    assert pool.get(dying.address) is None
+    run(pool, lambda: restored)
+    assert restored == [dying]
+    assert pool.get(dying.address) is dying
+    assert link_alive(dying.sock)
+    # The healthy link was left alone
+    assert healthy.connects == 1
+    assert healthy.sock is healthy_sock
+    pool.close()
+
+
+def test_failed_reconnections_back_off_and_give_up():
+    dropped = []
+    pool = ConnectionPool(backoff=0.01, max_backoff=0.02, max_failures=3,
+                          on_dropped=dropped.append)
+    flaky = FakeDevice('98:D3:31:00:00:0A', failures=2)
+    gone = FakeDevice('98:D3:31:00:00:0B', failures=100)
+    pool.add(flaky)
+    pool.add(gone)
+    pool.lost(flaky)
+    pool.lost(gone)
+    run(pool, lambda: dropped and pool.get(flaky.address))
+    assert flaky.connects == 1 + 3
+    assert dropped == [gone]
+    assert gone.connects == 1 + 3
+    assert len(pool) == 1
+    pool.close()
+
+
+def test_reconnections_are_limited():
+    pool = ConnectionPool(max_reconnecting=2)
+    devices = [FakeDevice('98:D3:31:00:00:%02X' % i, delay=0.05) for i in range(6)]
+    for device in devices:
+        pool.add(device)
+    most = 0
+    for device in devices:
+        pool.lost(device)
+    end = time.time() + 5
+    while any(pool.get(device.address) is None for device in devices):
+        assert time.time() < end, 'timed out'
+        pool.process()
+        most = max(most, len(pool.reconnecting))
+        time.sleep(0.001)
+    assert most == 2
+    pool.close()
+
+
+def test_btserver_hands_devices_it_gives_up_on_back_to_the_scanner():
+    pytest.importorskip('bluetooth')
+    from piduino.piduino import BTServer, MAX_RECONNECT_FAILURES
+    from discovery import Found
+    server = BTServer('SCD_ARDUINO', name_cache=None)
+    server.pool.backoff = 0.01
+    server.pool.max_backoff = 0.02
+    gone = FakeDevice('98:D3:31:00:00:0A', failures=100)
+    gone.settings_errors = []
+    # As the scanner does when it connects to a device it found
+    server.scanner.connected.add(gone.address)
+    server._BTServer__device_connected(Found(gone.address, 'SCD_ARDUINO_1', 0), gone)
+    server.pool.lost(gone)
+    run(server.pool, lambda: gone.address not in server.scanner.connected)
+    assert gone.connects == 1 + MAX_RECONNECT_FAILURES
+    assert len(server.pool) == 0 and gone not in server.devices
+    # So the next scan that finds it connects to it again
+    assert server.scanner.missed[gone.address] == 0
+    server.pool.close()
+    server.scanner.close()
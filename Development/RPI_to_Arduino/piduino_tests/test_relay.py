@@ -0,0 +1,122 @@
+import os
+import socket
+import sys
+import warnings
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore')
+    from relay import RelayEngine
+    from utils import PacketReassembler
+
+A = '98:D3:31:00:00:0A'
+B = '98:D3:31:00:00:0B'
+C = '98:D3:31:00:00:0C'
+HUB = '00:00:00:00:00:01'
+
+
+class FakeDevice(object):
+    # Like a BluetoothDevice, with the other end of its socket as the
+    # "Arduino"
+    def __init__(self, address):
+        self.address = address
+        self.sock, self.remote = socket.socketpair()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+def packet(source, destination, message):
+    return ('<%s|%s|%s>' % (source, destination, message)).encode()
+
+
+def received(device):
+    # Everything the "Arduino" at device has been sent, as packets
+    device.remote.setblocking(False)
+    data = b''
+    try:
+        while True:
+            data += device.remote.recv(65536)
+    except socket.error:
+        pass
+    return PacketReassembler(max_length=1 << 20).feed(data)
+
+
+def engine_with(*addresses, **kwargs):
+    engine = RelayEngine(**kwargs)
+    devices = [FakeDevice(address) for address in addresses]
+    for device in devices:
+        engine.add(device)
+    return engine, devices
+
+
+def test_packets_are_forwarded_by_destination():
+    engine, (a, b, c) = engine_with(A, B, C)
+    to_b = [packet(A, B, 'one'), packet(A, B, 'two')]
+    to_c = packet(A, C.lower(), 'three')
+    # Several packets in one chunk, and one split across chunks
+    a.remote.sendall(to_b[0] + to_b[1] + to_c[:10])
+    engine.poll(1)
+    a.remote.sendall(to_c[10:])
+    while engine.poll(0.1):
+        pass
+    engine.poll(0.1)
+    assert received(b) == to_b
+    assert received(c) == [to_c]
+    assert engine.relayed == 3
+    engine.close()
+
+
+def test_local_and_unknown_packets():
+    local = []
+    engine, (a, b) = engine_with(A, B, local_address=HUB,
+                                 on_local=lambda link, p: local.append((link.address, p)))
+    a.remote.sendall(packet(A, HUB, 'for the hub') + packet(A, C, 'nobody'))
+    engine.poll(1)
+    assert local == [(A, packet(A, HUB, 'for the hub')), (A, packet(A, C, 'nobody'))]
+    engine.close()
+
+    engine, (a,) = engine_with(A)
+    a.remote.sendall(packet(A, C, 'nobody'))
+    engine.poll(1)
+    assert engine.dropped == 1
+    engine.close()
+
+
+def test_full_destinations_pause_their_senders():
+    engine, (a, b) = engine_with(A, B, max_queued=4096)
+    b.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    message = packet(A, B, 'x' * 900)
+    a.remote.setblocking(False)
+    sent = 0
+    # B never reads, so its socket buffer and then its queue fill up
+    for attempt in range(2000):
+        try:
+            a.remote.send(message)
+            sent += 1
+        except socket.error:
+            pass
+        engine.poll(0)
+        if engine.links[A].paused:
+            break
+    assert engine.links[A].paused
+    assert engine.links[B].queued < 4096 + len(message)
+    # Once B reads, A is read from again and nothing is lost
+    total = []
+    for attempt in range(2000):
+        total += received(b)
+        engine.poll(0.01)
+        if len(total) == sent:
+            break
+    assert len(total) == sent
+    assert not engine.links[A].paused
+    engine.close()
+
+
+def test_closed_links_are_reported():
+    closed = []
+    engine, (a, b) = engine_with(A, B, on_closed=lambda device, error: closed.append(device))
+    a.remote.close()
+    engine.poll(1)
+    assert closed == [a]
+    assert list(engine.links) == [B]
+    engine.close()
@@ -0,0 +1,133 @@
+import os
+import socket
+import sys
+import time
+import warnings
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore')
+    from routing import RouteCache, Peer
+    from relay import RelayEngine, packet_destination
+    from utils import PacketReassembler
+
+A = '98:D3:31:00:00:0A'
+B = '98:D3:31:00:00:0B'
+C = '98:D3:31:00:00:0C'
+
+
+def test_routes_are_learned_and_expire():
+    routes = RouteCache(ttl=10)
+    routes.learn(A, 'hub1', now=0)
+    assert routes.get(A, now=5) == 'hub1'
+    # Learning again (the device sent another packet) extends the route
+    routes.learn(A, 'hub1', now=8)
+    assert routes.get(A, now=15) == 'hub1'
+    assert routes.get(A, now=18) is None
+    assert len(routes) == 0
+    assert (routes.hits, routes.misses) == (2, 1)
+
+
+def test_least_recently_used_routes_are_dropped():
+    routes = RouteCache(max_routes=2)
+    routes.learn(A, 'hub1')
+    routes.learn(B, 'hub1')
+    routes.get(A)
+    routes.learn(C, 'hub2')
+    assert A in routes and C in routes
+    assert B not in routes
+
+
+def test_routes_through_a_lost_hub_are_forgotten():
+    routes = RouteCache()
+    routes.learn(A, 'hub1')
+    routes.learn(B, 'hub2')
+    # A moves to hub2
+    routes.learn(A, 'hub2')
+    routes.learn(C, 'hub1')
+    assert routes.invalidate('hub2') == 2
+    assert A not in routes and B not in routes
+    assert routes.get(C) == 'hub1'
+
+
+class FakeDevice(object):
+    def __init__(self, address):
+        self.address = address
+        self.sock, self.remote = socket.socketpair()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+def packet(source, destination, message):
+    return ('<%s|%s|%s>' % (source, destination, message)).encode()
+
+
+def hub(coordinator_port, *addresses):
+    # A hub as BTServer.relay runs one: its own devices, and an uplink to
+    # the coordinator for everything else
+    uplink = Peer.connect('127.0.0.1', coordinator_port, address='COORDINATOR')
+
+    def route(link, p):
+        destination = packet_destination(p)
+        if destination in engine.links:
+            return destination
+        return uplink.address if link.device is not uplink else None
+
+    engine = RelayEngine(router=route)
+    engine.add(uplink)
+    devices = [FakeDevice(address) for address in addresses]
+    for device in devices:
+        engine.add(device)
+    return engine, devices
+
+
+def run(engines, until, timeout=5):
+    end = time.time() + timeout
+    while not until():
+        assert time.time() < end, 'timed out'
+        for engine in engines:
+            engine.poll(0.001)
+
+
+def test_coordinator_routes_between_hubs():
+    pytest.importorskip('bluetooth')
+    from piduino.piduino import Coordinator
+    coordinator = Coordinator(host='127.0.0.1', port=0)
+    hub1, (a,) = hub(coordinator.port, A)
+    hub2, (b,) = hub(coordinator.port, B)
+    hub3, (c,) = hub(coordinator.port, C)
+    engines = [coordinator, hub1, hub2, hub3]
+    run(engines, lambda: len(coordinator.engine.links) == 3)
+    received = dict((d.address, PacketReassembler()) for d in (a, b, c))
+    got = dict((d.address, []) for d in (a, b, c))
+
+    def arrived(device, count):
+        device.remote.setblocking(False)
+        try:
+            got[device.address] += received[device.address].feed(device.remote.recv(4096))
+        except socket.error:
+            pass
+        return len(got[device.address]) >= count
+
+    # Nothing is known about B yet, so this goes to every hub
+    a.remote.sendall(packet(A, B, 'hello'))
+    run(engines, lambda: arrived(b, 1))
+    assert coordinator.flooded == 1
+    # B's reply teaches the coordinator where B is; A is known already
+    b.remote.sendall(packet(B, A, 'hi'))
+    run(engines, lambda: arrived(a, 1))
+    a.remote.sendall(packet(A, B, 'again'))
+    run(engines, lambda: arrived(b, 2))
+    assert coordinator.flooded == 1
+    assert got[B] == [packet(A, B, 'hello'), packet(A, B, 'again')]
+    assert got[C] == []
+
+    # Losing hub2 forgets the route to B
+    hub2.links['COORDINATOR'].device.sock.close()
+    hub2.close()
+    run([coordinator, hub1, hub3], lambda: B not in coordinator.routing_table)
+    assert A in coordinator.routing_table
+    coordinator.close()
+    hub1.close()
+    hub3.close()
@@ -0,0 +1,223 @@
+import os
+import select
+import socket
+import sys
+import threading
+import time
+import warnings
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'piduino'))
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore')
+    from discovery import Discovery, NameCache
+    from scanner import Scanner, backoff_delay, monotonic
+
+HC05 = ['98:D3:31:00:00:%02X' % i for i in range(6)]
+PHONE = '11:22:33:44:55:66'
+
+
+class FakeDiscovery(Discovery):
+    # Inquiries find whatever is in self.devices, in a thread as without
+    # DeviceDiscoverer
+    def __init__(self, devices, names):
+        Discovery.__init__(self, cache=NameCache())
+        self.devices = devices
+        self.names = names
+
+    def start_inquiry(self, duration):
+        return None
+
+    def inquire(self, duration):
+        return list(self.devices)
+
+    def lookup_name(self, address):
+        return self.names.get(address)
+
+
+class FakeInquiry(object):
+    # Stands in for DeviceDiscoverer: readable when the "adapter" sends an
+    # event, which process_event turns into a result
+    def __init__(self):
+        self.adapter, self.sock = socket.socketpair()
+        self.found = []
+        self.done = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def process_event(self):
+        event = self.sock.recv(64).decode()
+        if event == 'complete':
+            self.done = True
+        else:
+            self.found.append((event, 0x1f00, 'SCD_ARDUINO_fd'))
+
+    def cancel_inquiry(self):
+        self.done = True
+
+
+def run(scanner, until, timeout=5):
+    # A select loop like BTServer.select's, until until() is true
+    end = time.time() + timeout
+    while not until():
+        assert time.time() < end, 'timed out'
+        wait = scanner.timeout()
+        wait = 0.1 if wait is None else min(wait, 0.1)
+        readable, _, _ = select.select(scanner.selectables(), [], [], wait)
+        scanner.process(readable)
+
+
+def test_connects_to_matching_devices_without_blocking():
+    names = dict((address, 'SCD_ARDUINO_%d' % i) for i, address in enumerate(HC05))
+    names[PHONE] = 'Phone'
+    discovery = FakeDiscovery([(a, 0, None) for a in HC05 + [PHONE]], names)
+    lock = threading.Lock()
+    state = {'now': 0, 'most': 0}
+    connected = []
+
+    def connect(found):
+        with lock:
+            state['now'] += 1
+            state['most'] = max(state['most'], state['now'])
+        time.sleep(0.05)
+        with lock:
+            state['now'] -= 1
+        return found.address
+
+    appeared = []
+    scanner = Scanner('SCD_ARDUINO', discovery=discovery, connect=connect,
+                      max_connecting=2, on_appeared=appeared.append,
+                      on_connected=lambda found, c: connected.append(c))
+    start = time.time()
+    scanner.process()
+    # Starting a scan and connecting happens in the background
+    assert time.time() - start < 0.05
+    run(scanner, lambda: len(connected) == len(HC05))
+    assert sorted(connected) == HC05
+    assert sorted(f.address for f in appeared) == HC05
+    assert state['most'] == 2
+    scanner.close()
+
+
+def test_failed_connections_back_off():
+    discovery = FakeDiscovery([(HC05[0], 0, 'SCD_ARDUINO_0')], {})
+    failures = []
+
+    def connect(found):
+        raise IOError('Host is down')
+
+    scanner = Scanner('SCD_ARDUINO', discovery=discovery, connect=connect, backoff=10,
+                      on_connect_failed=lambda found, e: failures.append(str(e)))
+    run(scanner, lambda: failures)
+    scanner.process()
+    assert failures == ['Host is down']
+    assert not scanner.connecting
+    assert 4 < scanner.retry_at[HC05[0]] - monotonic() <= 15
+    assert scanner.timeout() > 4
+    scanner.close()
+
+
+def test_backoff_doubles_with_jitter():
+    for failures, middle in [(1, 1), (2, 2), (5, 16), (20, 300)]:
+        delay = backoff_delay(failures)
+        assert middle * 0.5 <= delay <= middle * 1.5
+
+
+def test_devices_that_are_not_seen_disappear():
+    discovery = FakeDiscovery([(HC05[0], 0, 'SCD_ARDUINO_0')], {})
+    gone = []
+    scanner = Scanner('SCD_ARDUINO', discovery=discovery, interval=1000, missed_scans=2,
+                      on_disappeared=gone.append)
+    run(scanner, lambda: scanner.scans == 1)
+    assert list(scanner.nearby) == [HC05[0]]
+    discovery.devices = []
+    scanner.start_scan()
+    run(scanner, lambda: scanner.scans == 2)
+    assert gone == []
+    scanner.start_scan()
+    run(scanner, lambda: scanner.scans == 3)
+    assert [f.address for f in gone] == [HC05[0]]
+    scanner.close()
+
+
+def test_inquiry_events_are_selected_on():
+    inquiry = FakeInquiry()
+    discovery = FakeDiscovery([], {})
+    discovery.start_inquiry = lambda duration: inquiry
+    appeared = []
+    scanner = Scanner('SCD_ARDUINO', discovery=discovery, on_appeared=appeared.append)
+    scanner.process()
+    assert inquiry in scanner.selectables()
+    inquiry.adapter.send(HC05[0].encode())
+    run(scanner, lambda: inquiry.found)
+    inquiry.adapter.send(b'complete')
+    run(scanner, lambda: appeared)
+    assert appeared[0].name == 'SCD_ARDUINO_fd'
+    assert scanner.selectables() == [scanner]
+    scanner.close()
+    inquiry.adapter.close()
+    inquiry.sock.close()
+
+
+class BrokenDiscovery(FakeDiscovery):
+    # The adapter is down
+    def __init__(self):
+        FakeDiscovery.__init__(self, [], {})
+        self.inquiries = 0
+
+    def inquire(self, duration):
+        self.inquiries += 1
+        raise IOError('(19, "No such device")')
+
+
+def test_failed_scans_are_retried():
+    discovery = BrokenDiscovery()
+    errors = []
+    scanner = Scanner('SCD_ARDUINO', discovery=discovery, interval=0.01,
+                      on_scan_failed=errors.append)
+    # Each failure is reported, and scanning carries on
+    run(scanner, lambda: len(errors) >= 3)
+    assert discovery.inquiries >= 3
+    scanner.close()
+
+
+class FailingInquiry(FakeInquiry):
+    def process_event(self):
+        self.sock.recv(64)
+        raise IOError('(5, "Input/output error")')
+
+
+class UncancellableInquiry(FakeInquiry):
+    def cancel_inquiry(self):
+        # As DeviceDiscoverer when the adapter has gone away
+        raise IOError("error canceling inquiry")
+
+
+def test_inquiry_that_cannot_be_cancelled_ends_the_scan():
+    discovery = FakeDiscovery([], {})
+    inquiry = UncancellableInquiry()
+    discovery.start_inquiry = lambda duration: inquiry
+    errors = []
+    scanner = Scanner('SCD_ARDUINO', discovery=discovery, interval=1000,
+                      on_scan_failed=errors.append)
+    scanner.start_scan()
+    # The adapter never says the inquiry is over
+    scanner.process([], now=scanner.inquiry_end + 1)
+    assert [str(e) for e in errors] == ["error canceling inquiry"]
+    assert not scanner.scanning and scanner.inquiry is None
+    scanner.close()
+
+
+def test_inquiry_errors_end_the_scan():
+    discovery = FakeDiscovery([], {})
+    inquiry = FailingInquiry()
+    discovery.start_inquiry = lambda duration: inquiry
+    errors = []
+    scanner = Scanner('SCD_ARDUINO', discovery=discovery, interval=1000,
+                      on_scan_failed=errors.append)
+    scanner.start_scan()
+    inquiry.adapter.sendall(b'x')
+    run(scanner, lambda: errors)
+    assert inquiry.done
+    assert not scanner.scanning and scanner.inquiry is None
+    assert scanner.timeout() > 100
+    scanner.close()